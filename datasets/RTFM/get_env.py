@@ -1,5 +1,11 @@
 """Implements environment getter for RTFM."""
+import multiprocessing
+import os
+import random
+
 import gym
+import numpy as np
+import torch
 from rtfm import featurizer as X
 import rtfm.tasks
 
@@ -24,3 +30,208 @@ def create_env(env="rtfm:groups_simple_stationary-v0", height=6, width=6, partia
     env = gym.make(env, room_shape=(height, width), partially_observable=partially_observable,
                    max_placement=max_placement, featurizer=f, shuffle_wiki=shuffle_wiki, time_penalty=time_penalty)
     return env
+
+
+class _NoFeatures(X.Featurizer):
+    """Featurizer that computes nothing, so that stepping a task does not featurize it."""
+
+    def get_observation_space(self, task):
+        return {}
+
+    def featurize(self, task):
+        return {}
+
+
+class BatchedRTFMEnv:
+    """Steps a batch of RTFM environments in lockstep, writing their observations into preallocated tensors.
+
+    Every observation key of the featurizer gets one tensor with a leading batch dimension, such as 'name' of size [N, height, width, max_placement, max_name], which is overwritten in place at every reset and step. Text and Symbol features are written cell by cell into these tensors, only visiting the cells that are not empty, instead of being built as nested lists. Environments that finish are reset, and their reset observation written, in the same step.
+
+    With num_workers > 0, the environments are split into shards stepped by forked worker processes, which write into the observation tensors through shared memory.
+    """
+
+    def __init__(self, num_envs, num_workers=0, seed=None, **kwargs):
+        """Initialize BatchedRTFMEnv object.
+
+        Args:
+            num_envs (int): Number of environments.
+            num_workers (int, optional): Number of worker processes to step the environments in. Defaults to 0, which steps them in this process.
+            seed (int, optional): Seed of the environments. Worker k is seeded with seed + k. Defaults to None, which does not seed this process and seeds workers randomly.
+            kwargs: Arguments of create_env, such as env, height or width.
+        """
+        self.num_envs = num_envs
+        self.envs = []
+        # every environment keeps its own featurizer, as it would unbatched
+        self.featurizers = []
+        for _ in range(num_envs):
+            env = create_env(**kwargs).unwrapped
+            self.featurizers.append(env.featurizer)
+            env.featurizer = _NoFeatures()
+            self.envs.append(env)
+        self.featurizer = self.featurizers[0]
+        if seed is not None:
+            random.seed(seed)
+            np.random.seed(seed)
+
+        # allocate the observation tensors from the observation of a reset environment
+        example = self.featurizer.featurize(self.envs[0])
+        self.observations = {k: torch.zeros((num_envs,) + tuple(v.shape), dtype=v.dtype) for k, v in example.items()}
+        self.rewards = torch.zeros(num_envs)
+        self.dones = torch.zeros(num_envs, dtype=torch.bool)
+        self.wins = torch.zeros(num_envs, dtype=torch.bool)
+        for tensor in [*self.observations.values(), self.rewards, self.dones, self.wins]:
+            tensor.share_memory_()
+        self._arrays = {k: v.numpy() for k, v in self.observations.items()}
+        self._results = (self.rewards.numpy(), self.dones.numpy(), self.wins.numpy())
+
+        self._workers = []
+        if num_workers > 0:
+            context = multiprocessing.get_context('fork')
+            bounds = np.linspace(0, num_envs, min(num_workers, num_envs) + 1).astype(int)
+            for k in range(len(bounds) - 1):
+                parent, child = context.Pipe()
+                worker_seed = seed + k if seed is not None else None
+                process = context.Process(target=self._work, args=(child, range(bounds[k], bounds[k + 1]), worker_seed),
+                                          daemon=True)
+                process.start()
+                child.close()
+                self._workers.append((process, parent))
+
+    def __len__(self):
+        """Get number of environments."""
+        return self.num_envs
+
+    def reset(self):
+        """Reset all environments.
+
+        Returns:
+            dict: Maps every observation key to its tensor, of size [num_envs, ...].
+        """
+        self._run('reset', None)
+        return self.observations
+
+    def step(self, actions):
+        """Step all environments, resetting those that finish.
+
+        Args:
+            actions (sequence): One action index per environment.
+
+        Returns:
+            tuple: Observations as in reset, rewards of size [num_envs], whether each environment finished and whether it was won, as bool tensors of size [num_envs]. All are overwritten by the next step.
+        """
+        self._run('step', [int(a) for a in actions])
+        return self.observations, self.rewards, self.dones, self.wins
+
+    def close(self):
+        """Stop the worker processes."""
+        for process, pipe in self._workers:
+            pipe.send(('close', None))
+            process.join()
+        self._workers = []
+
+    def _run(self, command, actions):
+        if not self._workers:
+            self._apply(command, range(self.num_envs), actions)
+            return
+        for _, pipe in self._workers:
+            pipe.send((command, actions))
+        for _, pipe in self._workers:
+            pipe.recv()
+
+    def _work(self, pipe, indices, seed):
+        # worker process: step a shard of the environments on command
+        random.seed(seed)
+        np.random.seed(seed if seed is not None else int.from_bytes(os.urandom(4), 'little'))
+        torch.set_num_threads(1)
+        while True:
+            command, actions = pipe.recv()
+            if command == 'close':
+                break
+            self._apply(command, indices, actions)
+            pipe.send(True)
+
+    def _apply(self, command, indices, actions):
+        for i in indices:
+            env = self.envs[i]
+            if command == 'reset':
+                env.reset()
+            else:
+                _, r, f, w = env.step(actions[i])
+                rewards, dones, wins = self._results
+                rewards[i] = r
+                dones[i] = bool(f)
+                wins[i] = bool(w)
+                if f:
+                    env.reset()
+            featurize_into(self.featurizers[i], env, self._arrays, i)
+
+
+def featurize_into(featurizer, task, arrays, i):
+    """Featurize a task into row i of preallocated arrays, as featurizer.featurize(task) would.
+
+    Args:
+        featurizer (Featurizer): RTFM featurizer.
+        task (rtfm.tasks.task.Task): Task to featurize.
+        arrays (dict): Maps every observation key of the featurizer to an array with a leading batch dimension.
+        i (int): Row to write.
+    """
+    if isinstance(featurizer, X.Concat):
+        for f in featurizer:
+            featurize_into(f, task, arrays, i)
+    elif type(featurizer) is X.Text:
+        _featurize_text(featurizer, task, arrays, i)
+    elif type(featurizer) is X.Symbol:
+        symbol = arrays['symbol'][i]
+        symbol[:] = featurizer.class_map[task.world.EMPTY.__class__]
+        cells, objects = _observed_cells(task)
+        if objects:
+            symbol[cells] = [featurizer.class_map[o.__class__] for o in objects]
+    else:
+        for k, v in featurizer.featurize(task).items():
+            arrays[k][i] = v.numpy() if isinstance(v, torch.Tensor) else v
+
+
+def _observed_cells(task):
+    # (y, x, placement) index arrays and objects of the cells that differ from task.world.EMPTY,
+    # with the objects of a cell ordered and padded to max_placement as World.get_observation does
+    world = task.world
+    perspective = task.perspective
+    if perspective is None:
+        # lookups of positions off the map leave empty sets in it
+        positions = [(x, y) for (x, y), objects in world.map.items()
+                     if objects and 0 <= x < world.width and 0 <= y < world.height]
+    else:
+        positions = [(x, y) for y in range(world.height) for x in range(world.width)]
+    ys, xs, ps, objects = [], [], [], []
+    for x, y in positions:
+        cell = [o for o in world.get_objects_at_pos((x, y), perspective=perspective)]
+        if len(cell) > 1:
+            cell.sort(key=lambda o: getattr(o, 'speed', 0), reverse=True)
+            cell = cell[:task.max_placement]
+        cell += [world.EMPTY] * (task.max_placement - len(cell))
+        ys.extend([y] * len(cell))
+        xs.extend([x] * len(cell))
+        ps.extend(range(len(cell)))
+        objects.extend(cell)
+    return (ys, xs, ps), objects
+
+
+def _featurize_text(featurizer, task, arrays, i, eos='pad', pad='pad'):
+    def lookup(sent, max_len):
+        return featurizer.lookup_sentence(sent, task.vocab, max_len=max_len, eos=eos, pad=pad)
+
+    name, name_len = arrays['name'][i], arrays['name_len'][i]
+    name[:], name_len[:] = lookup(task.world.EMPTY.describe(), task.max_name)
+    cells, objects = _observed_cells(task)
+    if objects:
+        # many objects share a description, such as walls
+        descriptions = [o.describe() for o in objects]
+        encoded = {description: lookup(description, task.max_name) for description in set(descriptions)}
+        names, lengths = zip(*[encoded[description] for description in descriptions])
+        name[cells] = names
+        name_len[cells] = lengths
+    wiki = task.get_tokenized_wiki() if hasattr(task, 'get_tokenized_wiki') else task.get_wiki()
+    arrays['wiki'][i], arrays['wiki_len'][i] = lookup(wiki, task.max_wiki)
+    ins = task.get_tokenized_task() if hasattr(task, 'get_tokenized_task') else task.get_task()
+    arrays['task'][i], arrays['task_len'][i] = lookup(ins, task.max_task)
+    arrays['inv'][i], arrays['inv_len'][i] = lookup(task.get_inv(), task.max_inv)
@@ -13,12 +13,14 @@ sys.path.append(os.getcwd())
 
 import torch
 import torchtext as text
-from collections import defaultdict
 from torch.nn.utils.rnn import pad_sequence
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, Sampler, Subset
 
-from robustness.text_robust import add_text_noise
-from robustness.timeseries_robust import add_timeseries_noise
+from datasets.affect.mmap_data import is_converted, leading_padding, load_converted
+from robustness.robust_suite import RobustTestSuite
+from robustness.text_robust import TextCorpus, WordEmbeddingCache
+from robustness.timeseries_robust import TimeseriesSampleNoise
+from utils.feature_cache import FeatureCache, file_fingerprint
 
 np.seterr(divide='ignore', invalid='ignore')
 
@@ -37,8 +39,9 @@ def drop_entry(dataset):
     #         if ind not in drop:
     #             drop.append(ind)
     
+    keep = np.setdiff1d(np.arange(len(dataset["text"])), drop)
     for modality in list(dataset.keys()):
-        dataset[modality] = np.delete(dataset[modality], drop, 0)
+        dataset[modality] = dataset[modality][keep]
     return dataset
 
 
@@ -98,65 +101,58 @@ def get_rawtext(path, data_kind, vids):
     return text_data, new_vids
 
 
-def _get_word2id(text_data, vids):
-    word2id = defaultdict(lambda: len(word2id))
-    UNK = word2id['unk']
-    data_processed = dict()
-    for i, segment in enumerate(text_data):
-        words = []
-        _words = segment.split()
-        for word in _words:
-            words.append(word2id[word])
-        words = np.asarray(words)
-        data_processed[vids[i]] = words
-
-    def _return_unk():
-        return UNK
+def _glove_lookup():
+    """Get a word lookup for WordEmbeddingCache backed by the GloVe 840B vectors, which embeds unknown words as zeros."""
+    vec = text.vocab.GloVe(name='840B', dim=300)
 
-    word2id.default_factory = _return_unk
-    return data_processed, word2id
+    def _lookup(words):
+        return vec.get_vecs_by_tokens(words, lower_case_backup=True).numpy(), np.ones(len(words), dtype=bool)
+    return _lookup
 
 
-def _get_word_embeddings(word2id, save=False):
-    vec = text.vocab.GloVe(name='840B', dim=300)
-    tokens = []
-    for w, _ in word2id.items():
-        tokens.append(w)
-    
-    ret = vec.get_vecs_by_tokens(tokens, lower_case_backup=True)
-    return ret
+def _glove_embeddings(corpus, embedder, corruption=None, paddings=50):
+    """Embed every document of a TextCorpus, keeping its first `paddings` words and padding shorter ones with zeros at the front.
 
+    Args:
+        corpus (TextCorpus): Tokenized documents.
+        embedder (WordEmbeddingCache): Word embeddings to use.
+        corruption (Corruption, optional): Text noise to apply, as returned by corpus.corrupt. Defaults to None.
+        paddings (int, optional): Number of words per document. Defaults to 50.
 
-def _glove_embeddings(text_data, vids, paddings=50):
-    data_prod, w2id = _get_word2id(text_data, vids)
-    word_embeddings_looks_up = _get_word_embeddings(w2id)
-    looks_up = word_embeddings_looks_up.numpy()
-    embedd_data = []
-    for vid in vids:
-        d = data_prod[vid]
-        tmp = []
-        look_up = [looks_up[x] for x in d]
-        # Padding with zeros at the front
-        # TODO: fix some segs have more than 50 words (FIXed)
-        if len(d) > paddings:
-            for x in d[:paddings]:
-                tmp.append(looks_up[x])
-        else:
-            for i in range(paddings - len(d)):
-                tmp.append(np.zeros(300, ))
-            for x in d:
-                tmp.append(looks_up[x])
-        # try:
-        #     tmp = [looks_up[x] for x in d]
-        # except:
-        
-        embedd_data.append(np.array(tmp))
-    return np.array(embedd_data)
+    Returns:
+        np.ndarray: Embedded documents of shape [num_documents, paddings, 300].
+    """
+    embedd_data = np.zeros((len(corpus), paddings, embedder.dim), dtype=np.float32)
+    for i, (vectors, _) in enumerate(corpus.embed(embedder, corruption)):
+        vectors = vectors[:paddings]
+        embedd_data[i, paddings - len(vectors):] = vectors
+    return embedd_data
+
+
+def _first_nonzero(sample):
+    """Get the index of the first non-zero timestep of a [T, F] sample."""
+    nonzero = (np.asarray(sample) != 0).reshape(len(sample), -1).any(-1)
+    return int(nonzero.argmax()) if nonzero.any() else len(sample)
+
+
+def _sequence_stats(data, starts, chunk_size=1024):
+    """Compute per-sample, per-feature mean and (unbiased) std of the unpadded part of [N, T, F] sequences."""
+    mean = np.empty((len(data),) + data.shape[2:], dtype=np.float32)
+    std = np.empty_like(mean)
+    for i in range(0, len(data), chunk_size):
+        chunk = np.asarray(data[i:i + chunk_size], dtype=np.float64)
+        mask = np.arange(chunk.shape[1])[None, :, None] >= starts[i:i + chunk_size, None, None]
+        count = mask.sum(1)
+        chunk_mean = (chunk * mask).sum(1) / count
+        chunk_var = (((chunk - chunk_mean[:, None]) * mask) ** 2).sum(1) / (count - 1)
+        mean[i:i + chunk_size] = chunk_mean
+        std[i:i + chunk_size] = np.sqrt(chunk_var)
+    return mean, std
 
 
 class Affectdataset(Dataset):
     """Implements Affect data as a torch dataset."""
-    def __init__(self, data: Dict, flatten_time_series: bool, aligned: bool = True, task: str = None, max_pad=False, max_pad_num=50, data_type='mosi', z_norm=False) -> None:
+    def __init__(self, data: Dict, flatten_time_series: bool, aligned: bool = True, task: str = None, max_pad=False, max_pad_num=50, data_type='mosi', z_norm=False, noise=None) -> None:
         """Instantiate AffectDataset
 
         Args:
@@ -168,6 +164,7 @@ class Affectdataset(Dataset):
             max_pad_num (int, optional): Maximum padding number. Defaults to 50.
             data_type (str, optional): What data to load. Defaults to 'mosi'.
             z_norm (bool, optional): Whether to normalize data along the z-axis. Defaults to False.
+            noise (Dict, optional): Maps a modality to a callable taking (sample, index) that corrupts the raw sample on access. Defaults to None.
         """
         self.dataset = data
         self.flatten = flatten_time_series
@@ -177,42 +174,55 @@ class Affectdataset(Dataset):
         self.max_pad_num = max_pad_num
         self.data_type = data_type
         self.z_norm = z_norm
-        self.dataset['audio'][self.dataset['audio'] == -np.inf] = 0.0
+        self.noise = noise if noise is not None else dict()
+        if isinstance(self.dataset['audio'], np.ndarray):
+            # stores written by convert_pickle are already cleaned
+            self.dataset['audio'][self.dataset['audio'] == -np.inf] = 0.0
+
+        # Start offsets and z-norm statistics of clean modalities are computed once here instead of per access
+        self.starts = dict()
+        for modality in ['vision', 'audio', 'text']:
+            source = 'text' if self.aligned else modality
+            if source not in self.noise:
+                if source not in self.starts:
+                    self.starts[source] = leading_padding(self.dataset[source])
+                self.starts[modality] = self.starts[source]
+        self.stats = dict()
+        if self.z_norm:
+            for modality in ['vision', 'audio', 'text']:
+                if modality in self.starts and modality not in self.noise:
+                    self.stats[modality] = _sequence_stats(self.dataset[modality], self.starts[modality])
+
+    @property
+    def lengths(self):
+        """Get the unpadded length of every sample, used to bucket samples of similar length."""
+        seq_len = self.dataset['text'].shape[1]
+        return seq_len - np.stack([self.starts[modality] for modality in self.starts]).min(0)
 
     def __getitem__(self, ind):
         """Get item from dataset."""
-        # vision = torch.tensor(vision)
-        # audio = torch.tensor(audio)
-        # text = torch.tensor(text)
-
-        vision = torch.tensor(self.dataset['vision'][ind])
-        audio = torch.tensor(self.dataset['audio'][ind])
-        text = torch.tensor(self.dataset['text'][ind])
-
-        
-        
-        
-
-        if self.aligned:
-            try:
-                start = text.nonzero(as_tuple=False)[0][0]
-                # start = 0
-            except:
-                print(text, ind)
-                exit()
-            vision = vision[start:].float()
-            audio = audio[start:].float()
-            text = text[start:].float()
-        else:
-            vision = vision[vision.nonzero()[0][0]:].float()
-            audio = audio[audio.nonzero()[0][0]:].float()
-            text = text[text.nonzero()[0][0]:].float()
-
-        # z-normalize data
-        if self.z_norm:
-            vision = torch.nan_to_num((vision - vision.mean(0, keepdims=True)) / (torch.std(vision, axis=0, keepdims=True)))
-            audio = torch.nan_to_num((audio - audio.mean(0, keepdims=True)) / (torch.std(audio, axis=0, keepdims=True)))
-            text = torch.nan_to_num((text - text.mean(0, keepdims=True)) / (torch.std(text, axis=0, keepdims=True)))
+        modalities = dict()
+        for modality in ['vision', 'audio', 'text']:
+            sample = self.dataset[modality][ind]
+            if modality in self.noise:
+                sample = self.noise[modality](sample, ind)
+            modalities[modality] = sample
+
+        for modality in ['vision', 'audio', 'text']:
+            if modality in self.starts:
+                start = self.starts[modality][ind]
+            else:
+                start = _first_nonzero(modalities['text' if self.aligned else modality])
+            data = torch.tensor(modalities[modality][start:], dtype=torch.float32)
+
+            # z-normalize data
+            if modality in self.stats:
+                mean, std = self.stats[modality]
+                data = torch.nan_to_num((data - torch.from_numpy(mean[ind])) / torch.from_numpy(std[ind]))
+            elif self.z_norm:
+                data = torch.nan_to_num((data - data.mean(0, keepdims=True)) / (torch.std(data, axis=0, keepdims=True)))
+            modalities[modality] = data
+        vision, audio, text = modalities['vision'], modalities['audio'], modalities['text']
 
         def _get_class(flag, data_type=self.data_type):
             if data_type in ['mosi', 'mosei', 'sarcasm']:
@@ -257,11 +267,12 @@ class Affectdataset(Dataset):
 def get_dataloader(
         filepath: str, batch_size: int = 32, max_seq_len=50, max_pad=False, train_shuffle: bool = True,
         num_workers: int = 2, flatten_time_series: bool = False, task=None, robust_test=False, data_type='mosi', 
-        raw_path='/home/van/backup/pack/mosi/mosi.hdf5', z_norm=False) -> DataLoader:
+        raw_path='/home/van/backup/pack/mosi/mosi.hdf5', z_norm=False, bucket_by_length=False,
+        cache_dir=None, seed=0) -> DataLoader:
     """Get dataloaders for affect data.
 
     Args:
-        filepath (str): Path to datafile
+        filepath (str): Path to datafile, or to a store written by datasets/affect/mmap_data.py
         batch_size (int, optional): Batch size. Defaults to 32.
         max_seq_len (int, optional): Maximum sequence length. Defaults to 50.
         max_pad (bool, optional): Whether to pad data to max length or not. Defaults to False.
@@ -273,29 +284,38 @@ def get_dataloader(
         data_type (str, optional): What data to load in. Defaults to 'mosi'.
         raw_path (str, optional): Full path to data. Defaults to '/home/van/backup/pack/mosi/mosi.hdf5'.
         z_norm (bool, optional): Whether to normalize data along the z dimension or not. Defaults to False.
+        bucket_by_length (bool, optional): Whether to batch samples of similar length together, to reduce padding when max_pad is False. Defaults to False.
+        cache_dir (str, optional): Directory of the feature cache noisy test text is kept in. Defaults to utils.feature_cache.default_root().
+        seed (int, optional): Seed the test text noise is drawn with. Defaults to 0.
 
     Returns:
         DataLoader: tuple of train dataloader, validation dataloader, test dataloader
     """
-    with open(filepath, "rb") as f:
-        alldata = pickle.load(f)
+    if is_converted(filepath):
+        alldata = load_converted(filepath)
+    else:
+        with open(filepath, "rb") as f:
+            alldata = pickle.load(f)
+        alldata['train'] = drop_entry(alldata['train'])
+        alldata['valid'] = drop_entry(alldata['valid'])
+        alldata['test'] = drop_entry(alldata['test'])
 
     processed_dataset = {'train': {}, 'test': {}, 'valid': {}}
-    alldata['train'] = drop_entry(alldata['train'])
-    alldata['valid'] = drop_entry(alldata['valid'])
-    alldata['test'] = drop_entry(alldata['test'])
 
     process = eval("_process_2") if max_pad else eval("_process_1")
 
     for dataset in alldata:
         processed_dataset[dataset] = alldata[dataset]
 
-    train = DataLoader(Affectdataset(processed_dataset['train'], flatten_time_series, task=task, max_pad=max_pad,               max_pad_num=max_seq_len, data_type=data_type, z_norm=z_norm), \
-                       shuffle=train_shuffle, num_workers=num_workers, batch_size=batch_size, \
-                       collate_fn=process)
-    valid = DataLoader(Affectdataset(processed_dataset['valid'], flatten_time_series, task=task, max_pad=max_pad, max_pad_num=max_seq_len, data_type=data_type, z_norm=z_norm), \
-                       shuffle=False, num_workers=num_workers, batch_size=batch_size, \
-                       collate_fn=process)
+    def _loader(dataset, shuffle):
+        if bucket_by_length and not max_pad:
+            return DataLoader(dataset, num_workers=num_workers, collate_fn=process,
+                              batch_sampler=LengthBucketSampler(dataset.lengths, batch_size, shuffle=shuffle))
+        return DataLoader(dataset, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size,
+                          collate_fn=process)
+
+    train = _loader(Affectdataset(processed_dataset['train'], flatten_time_series, task=task, max_pad=max_pad, max_pad_num=max_seq_len, data_type=data_type, z_norm=z_norm), train_shuffle)
+    valid = _loader(Affectdataset(processed_dataset['valid'], flatten_time_series, task=task, max_pad=max_pad, max_pad_num=max_seq_len, data_type=data_type, z_norm=z_norm), False)
     # test = DataLoader(Affectdataset(processed_dataset['test'], flatten_time_series, task=task), \
     #                   shuffle=False, num_workers=num_workers, batch_size=batch_size, \
     #                   collate_fn=process)
@@ -305,146 +325,114 @@ def get_dataloader(
         file_type = raw_path.split('.')[-1]  # hdf5
         rawtext, vids = get_rawtext(raw_path, file_type, vids)
 
-        # Add text noises
-        robust_text = []
-        robust_text_numpy = []
-        for i in range(10):
+        def _test_loader(test, noise=None):
+            dataset = Affectdataset(test, flatten_time_series, task=task, max_pad=max_pad, max_pad_num=max_seq_len, data_type=data_type, z_norm=z_norm, noise=noise)
+            if noise is not None and 'text' in noise:
+                # Same as drop_entry: samples whose text got dropped are skipped
+                dataset = Subset(dataset, np.flatnonzero(~noise['text'].dropped))
+            return DataLoader(dataset, shuffle=False, num_workers=num_workers,
+                              batch_size=batch_size, collate_fn=process)
+
+        # Add text noises. The noisy text embeddings are cached across runs; when one is missing, the text is
+        # tokenized and its vocabulary embedded once for all noise levels
+        cache = FeatureCache(cache_dir)
+        text_inputs = dict()
+
+        def _robust_text(noise_level):
+            def _compute():
+                if not text_inputs:
+                    text_inputs['corpus'] = TextCorpus(rawtext)
+                    text_inputs['embedder'] = WordEmbeddingCache(_glove_lookup(), 300)
+                corpus = text_inputs['corpus']
+                return _glove_embeddings(corpus, text_inputs['embedder'], corpus.corrupt(noise_level, seed=seed))
             test = dict()
             test['vision'] = alldata['test']["vision"]
             test['audio'] = alldata['test']["audio"]
-            test['text'] = _glove_embeddings(add_text_noise(rawtext, noise_level=i / 10), vids)
+            test['text'] = cache.get_or_compute(_compute, data_type, 'test', 'text', noise='add_text_noise',
+                                                noise_level=noise_level, seed=seed, extractor='glove.840B.300d',
+                                                source=file_fingerprint(raw_path), vids=[str(vid) for vid in vids])
             test['labels'] = alldata['test']["labels"]
-            test = drop_entry(test)
-
-            robust_text_numpy.append(test['text'])
-
-            robust_text.append(
-                DataLoader(Affectdataset(test, flatten_time_series, task=task, max_pad=max_pad, max_pad_num=max_seq_len, data_type=data_type, z_norm=z_norm), shuffle=False, num_workers=num_workers,
-                        batch_size=batch_size, collate_fn=process))
-
-        # Add visual noises
-        robust_vision = []
-        for i in range(10):
-            test = dict()
-            test['vision'] = add_timeseries_noise([alldata['test']['vision'].copy()], noise_level=i / 10, rand_drop=False)[0]
-            
-            test['audio'] = alldata['test']["audio"].copy()
-            test['text'] = alldata['test']['text'].copy()
-            test['labels'] = alldata['test']["labels"]
-            test = drop_entry(test)
-            print('test entries: {}'.format(test['vision'].shape))
-
-            robust_vision.append(
-                DataLoader(Affectdataset(test, flatten_time_series, task=task, max_pad=max_pad, max_pad_num=max_seq_len, data_type=data_type, z_norm=z_norm), shuffle=False, num_workers=num_workers,
-                        batch_size=batch_size, collate_fn=process))
-
-        # Add audio noises
-        robust_audio = []
-        for i in range(10):
-            test = dict()
-            test['vision'] = alldata['test']["vision"].copy()
-            test['audio'] = add_timeseries_noise([alldata['test']['audio'].copy()], noise_level=i / 10, rand_drop=False)[0]
-            test['text'] = alldata['test']['text'].copy()
-            test['labels'] = alldata['test']["labels"]
-            test = drop_entry(test)
-            print('test entries: {}'.format(test['vision'].shape))
-
-            robust_audio.append(
-                DataLoader(Affectdataset(test, flatten_time_series, task=task, max_pad=max_pad, max_pad_num=max_seq_len, data_type=data_type, z_norm=z_norm), shuffle=False, num_workers=num_workers,
-                        batch_size=batch_size, collate_fn=process))
-
-        # Add timeseries noises
-
-        # for i, text in enumerate(robust_text_numpy):
-        
-        #     alldata_test = timeseries_robustness([alldata['test']['vision'], alldata['test']['audio'], text], noise_level=i/10)
-        #     test.append(alldata_test)
-
-        robust_timeseries = []
-        # alldata['test'] = drop_entry(alldata['test'])
-        for i in range(10):
-            robust_timeseries_tmp = add_timeseries_noise(
-                [alldata['test']['vision'].copy(), alldata['test']['audio'].copy(), alldata['test']['text'].copy()],
-                noise_level=i / (10 * 3), rand_drop=False)
-            
-            test = dict()
-            test['vision'] = robust_timeseries_tmp[0]
-            test['audio'] = robust_timeseries_tmp[1]
-            test['text'] = robust_timeseries_tmp[2]
-            test['labels'] = alldata['test']['labels']
-            test = drop_entry(test)
-            print('test entries: {}'.format(test['vision'].shape))
-
-            robust_timeseries.append(
-                DataLoader(Affectdataset(test, flatten_time_series, task=task, max_pad=max_pad, max_pad_num=max_seq_len, data_type=data_type, z_norm=z_norm), shuffle=False, num_workers=num_workers,
-                        batch_size=batch_size, collate_fn=process))
-        test_robust_data = dict()
-        test_robust_data['robust_text'] = robust_text
-        test_robust_data['robust_vision'] = robust_vision
-        test_robust_data['robust_audio'] = robust_audio
-        test_robust_data['robust_timeseries'] = robust_timeseries
+            return _test_loader(drop_entry(test))
+
+        # Add timeseries noises to the given modalities, lazily in Affectdataset.__getitem__
+        def _robust_timeseries(modalities):
+            def _build(noise_level):
+                noise = {modality: TimeseriesSampleNoise(len(alldata['test']['labels']), noise_level, rand_drop=False)
+                         for modality in modalities}
+                return _test_loader(alldata['test'], noise)
+            return _build
+
+        test_robust_data = RobustTestSuite()
+        test_robust_data.add('robust_text', _robust_text, [i / 10 for i in range(10)])
+        test_robust_data.add('robust_vision', _robust_timeseries(['vision']), [i / 10 for i in range(10)])
+        test_robust_data.add('robust_audio', _robust_timeseries(['audio']), [i / 10 for i in range(10)])
+        test_robust_data.add('robust_timeseries', _robust_timeseries(['vision', 'audio', 'text']), [i / (10 * 3) for i in range(10)])
         return train, valid, test_robust_data
     else:
         # test = dict()
-        test = DataLoader(Affectdataset(processed_dataset['test'], flatten_time_series, task=task, max_pad=max_pad, max_pad_num=max_seq_len, data_type=data_type, z_norm=z_norm), \
-                      shuffle=False, num_workers=num_workers, batch_size=batch_size, \
-                      collate_fn=process)
+        test = _loader(Affectdataset(processed_dataset['test'], flatten_time_series, task=task, max_pad=max_pad, max_pad_num=max_seq_len, data_type=data_type, z_norm=z_norm), False)
         return train, valid, test
 
+def _collate_labels(inputs: List):
+    """Stack the first entry of every sample's label into a [batch_size, 1] tensor."""
+    return torch.stack([sample[-1].reshape(-1)[0] for sample in inputs]).view(len(inputs), 1)
+
+
 def _process_1(inputs: List):
     processed_input = []
     processed_input_lengths = []
-    inds = []
-    labels = []
 
     for i in range(len(inputs[0]) - 2):
-        feature = []
-        for sample in inputs:
-            feature.append(sample[i])
+        feature = [sample[i] for sample in inputs]
         processed_input_lengths.append(torch.as_tensor([v.size(0) for v in feature]))
-        pad_seq = pad_sequence(feature, batch_first=True)
-        processed_input.append(pad_seq)
+        processed_input.append(pad_sequence(feature, batch_first=True))
 
-    for sample in inputs:
-        
-        inds.append(sample[-2])
-        # if len(sample[-2].shape) > 2:
-        #     labels.append(torch.where(sample[-2][:, 1] == 1)[0])
-        # else:
-        if sample[-1].shape[1] > 1:
-            labels.append(sample[-1].reshape(sample[-1].shape[1], sample[-1].shape[0])[0])
-        else:
-            labels.append(sample[-1])
-
-    return processed_input, processed_input_lengths, \
-           torch.tensor(inds).view(len(inputs), 1), torch.tensor(labels).view(len(inputs), 1)
+    inds = torch.as_tensor([sample[-2] for sample in inputs]).view(len(inputs), 1)
+    return processed_input, processed_input_lengths, inds, _collate_labels(inputs)
 
 
 def _process_2(inputs: List):
-    processed_input = []
-    processed_input_lengths = []
-    labels = []
+    # samples are already padded to max_pad_num, so each modality is stacked in one copy
+    processed_input = [torch.stack([sample[i] for sample in inputs]) for i in range(len(inputs[0]) - 1)]
+    return processed_input[0], processed_input[1], processed_input[2], _collate_labels(inputs)
 
-    for i in range(len(inputs[0]) - 1):
-        feature = []
-        for sample in inputs:
-            feature.append(sample[i])
-        processed_input_lengths.append(torch.as_tensor([v.size(0) for v in feature]))
-        # pad_seq = pad_sequence(feature, batch_first=True)
-        processed_input.append(torch.stack(feature))
 
-    for sample in inputs:
-        
-        # if len(sample[-2].shape) > 2:
-        #     labels.append(torch.where(sample[-2][:, 1] == 1)[0])
-        # else:
-        # print(sample[-1].shape)
-        if sample[-1].shape[1] > 1:
-            labels.append(sample[-1].reshape(sample[-1].shape[1], sample[-1].shape[0])[0])
-        else:
-            labels.append(sample[-1])
+class LengthBucketSampler(Sampler):
+    """Batch sampler that groups samples of similar length, so padded batches waste less compute."""
+
+    def __init__(self, lengths, batch_size, shuffle=True, bucket_size=100):
+        """Instantiate LengthBucketSampler.
+
+        Args:
+            lengths (np.ndarray): Unpadded length of every sample.
+            batch_size (int): Batch size.
+            shuffle (bool, optional): Whether to shuffle samples before bucketing and batches after it. Defaults to True.
+            bucket_size (int, optional): Number of batches per bucket. Samples are sorted by length within a bucket. Defaults to 100.
+        """
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+
+    def __iter__(self):
+        """Yield batches of indices."""
+        order = torch.randperm(len(self.lengths)).numpy() if self.shuffle else np.arange(len(self.lengths))
+        chunk = self.batch_size * self.bucket_size
+        batches = []
+        for i in range(0, len(order), chunk):
+            bucket = order[i:i + chunk]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            batches.extend(bucket[j:j + self.batch_size] for j in range(0, len(bucket), self.batch_size))
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+        for batch in batches:
+            yield batch.tolist()
 
-    return processed_input[0], processed_input[1], processed_input[2], torch.tensor(labels).view(len(inputs), 1)
+    def __len__(self):
+        """Get number of batches."""
+        chunk = self.batch_size * self.bucket_size
+        full, rest = divmod(len(self.lengths), chunk)
+        return full * self.bucket_size + (rest + self.batch_size - 1) // self.batch_size
 
 
 if __name__ == '__main__':
@@ -0,0 +1,188 @@
+"""Implements a memory-mapped columnar store for the affect pickle datasets."""
+import json
+import os
+import pickle
+import shutil
+import sys
+
+import numpy as np
+
+sys.path.append(os.getcwd())
+
+
+META_FILE = 'meta.json'
+
+
+class PaddedSequences:
+    """Read-only [N, T, F] view over ragged sequences stored as .npy files.
+
+    Rows are zero-padded at the front on access, which is how they were stored in the original pickles.
+    """
+
+    def __init__(self, data_path, offsets_path, seq_len, index=None):
+        """Instantiate PaddedSequences.
+
+        Args:
+            data_path (str): Path to the [sum of lengths, F] .npy file with the concatenated sequences.
+            offsets_path (str): Path to the [N + 1] .npy file with row offsets into data.
+            seq_len (int): Padded sequence length T.
+            index (np.ndarray, optional): Subset of rows to expose, in order. Defaults to all rows.
+        """
+        self.data_path = data_path
+        self.offsets_path = offsets_path
+        self.seq_len = seq_len
+        self._data = None
+        self._offsets = None
+        self.index = index
+
+    def _open(self):
+        if self._data is None:
+            self._data = np.load(self.data_path, mmap_mode='r')
+            self._offsets = np.load(self.offsets_path)
+            if self.index is None:
+                self.index = np.arange(len(self._offsets) - 1)
+
+    @property
+    def shape(self):
+        """Get the padded shape (N, T, F)."""
+        self._open()
+        return (len(self.index), self.seq_len) + self._data.shape[1:]
+
+    @property
+    def dtype(self):
+        """Get the dtype of the stored sequences."""
+        self._open()
+        return self._data.dtype
+
+    @property
+    def starts(self):
+        """Get the index of the first non-padding timestep of every row."""
+        self._open()
+        lengths = self._offsets[self.index + 1] - self._offsets[self.index]
+        return self.seq_len - lengths
+
+    def __len__(self):
+        """Get number of rows."""
+        return self.shape[0]
+
+    def __getitem__(self, ind):
+        """Get a zero-padded row, or a PaddedSequences view over a subset of rows."""
+        self._open()
+        if isinstance(ind, (int, np.integer)):
+            row = self.index[ind]
+            seq = self._data[self._offsets[row]:self._offsets[row + 1]]
+            out = np.zeros((self.seq_len,) + seq.shape[1:], dtype=seq.dtype)
+            out[self.seq_len - len(seq):] = seq
+            return out
+        return PaddedSequences(self.data_path, self.offsets_path, self.seq_len, self.index[ind])
+
+    def __array__(self, dtype=None, copy=None):
+        """Materialize all rows as one padded array."""
+        out = np.stack([self[i] for i in range(len(self))])
+        return out if dtype is None else out.astype(dtype)
+
+    def __getstate__(self):
+        """Drop open memory maps when pickled, so worker processes reopen the files instead of copying them."""
+        state = self.__dict__.copy()
+        state['_data'] = None
+        state['_offsets'] = None
+        return state
+
+
+def leading_padding(data, chunk_size=1024):
+    """Count the all-zero rows at the front of every sequence of [N, T, F] data.
+
+    Args:
+        data (np.ndarray or PaddedSequences): Sequences to scan.
+        chunk_size (int, optional): Number of sequences scanned at once. Defaults to 1024.
+
+    Returns:
+        np.ndarray: Index of the first non-zero timestep of every sequence, T for all-zero sequences.
+    """
+    if isinstance(data, PaddedSequences):
+        return data.starts
+    starts = np.empty(len(data), dtype=np.int64)
+    for i in range(0, len(data), chunk_size):
+        chunk = np.asarray(data[i:i + chunk_size])
+        nonzero = (chunk != 0).reshape(chunk.shape[0], chunk.shape[1], -1).any(-1)
+        starts[i:i + chunk_size] = np.where(nonzero.any(1), nonzero.argmax(1), chunk.shape[1])
+    return starts
+
+
+def convert_pickle(filepath, out_dir):
+    """Convert an affect pickle into a memory-mapped columnar store.
+
+    Entries without text are dropped and -inf audio values are zeroed, as `get_dataloader` and `Affectdataset` would do on load.
+
+    Args:
+        filepath (str): Path to the affect pickle file.
+        out_dir (str): Directory to write the store to. It is written to a temporary directory first and renamed when complete.
+    """
+    with open(filepath, "rb") as f:
+        alldata = pickle.load(f)
+
+    tmp_dir = out_dir.rstrip(os.sep) + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    meta = dict()
+    for split, dataset in alldata.items():
+        # same as get_data.drop_entry: drop entries where there's no text
+        keep = np.asarray(dataset['text']).reshape(len(dataset['text']), -1).sum(1) != 0
+        dataset = {modality: np.asarray(data)[keep] for modality, data in dataset.items()}
+        os.makedirs(os.path.join(tmp_dir, split))
+        meta[split] = dict()
+        for modality, data in dataset.items():
+            path = os.path.join(tmp_dir, split, modality)
+            if modality == 'audio':
+                data[data == -np.inf] = 0.0
+            if modality in ['vision', 'audio', 'text'] and data.ndim == 3:
+                starts = leading_padding(data)
+                lengths = data.shape[1] - starts
+                offsets = np.concatenate([[0], np.cumsum(lengths)])
+                mask = np.arange(data.shape[1])[None, :] >= starts[:, None]
+                np.save(path + '.npy', data[mask])
+                np.save(path + '_offsets.npy', offsets)
+                meta[split][modality] = {'kind': 'ragged', 'seq_len': data.shape[1]}
+            else:
+                np.save(path + '.npy', data, allow_pickle=data.dtype == object)
+                meta[split][modality] = {'kind': 'array', 'object': data.dtype == object}
+    with open(os.path.join(tmp_dir, META_FILE), 'w') as f:
+        json.dump(meta, f)
+    if os.path.exists(out_dir):
+        shutil.rmtree(out_dir)
+    os.rename(tmp_dir, out_dir)
+
+
+def load_converted(store_dir):
+    """Open a store written by `convert_pickle`.
+
+    Args:
+        store_dir (str): Directory of the store.
+
+    Returns:
+        dict: Same split -> modality -> data layout as the affect pickles, with sequences as PaddedSequences and other entries memory-mapped where possible.
+    """
+    with open(os.path.join(store_dir, META_FILE)) as f:
+        meta = json.load(f)
+    alldata = dict()
+    for split, modalities in meta.items():
+        alldata[split] = dict()
+        for modality, info in modalities.items():
+            path = os.path.join(store_dir, split, modality)
+            if info['kind'] == 'ragged':
+                alldata[split][modality] = PaddedSequences(
+                    path + '.npy', path + '_offsets.npy', info['seq_len'])
+            elif info['object']:
+                alldata[split][modality] = np.load(path + '.npy', allow_pickle=True)
+            else:
+                alldata[split][modality] = np.load(path + '.npy', mmap_mode='r')
+    return alldata
+
+
+def is_converted(path):
+    """Check whether path is a store written by `convert_pickle`."""
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, META_FILE))
+
+
+if __name__ == '__main__':
+    convert_pickle(sys.argv[1], sys.argv[2])
@@ -0,0 +1,176 @@
+"""Implements datasets and loaders that index contiguous arrays instead of lists of samples."""
+import numpy as np
+import torch
+from torch.utils.data import BatchSampler, DataLoader, Dataset, RandomSampler, Sampler, SequentialSampler
+
+
+class ArrayDataset(Dataset):
+    """Implements a torch Dataset over arrays that share their first dimension.
+
+    Each sample is one row of every array. Splits are index arrays over the same (optionally memory-mapped) arrays, so nothing is copied per sample and DataLoader workers share the underlying memory.
+    """
+
+    def __init__(self, arrays, indices=None, transforms=None):
+        """Initialize ArrayDataset object.
+
+        Args:
+            arrays (list): Arrays with one row per sample, e.g. [modality_1, modality_2, labels].
+            indices (np.ndarray, optional): Rows that make up this dataset, in order. Defaults to all rows.
+            transforms (list, optional): One callable (or None) per array, applied to every fetched batch of rows of that array. Defaults to None.
+        """
+        self.arrays = arrays
+        self.indices = np.arange(len(arrays[0])) if indices is None else np.asarray(indices)
+        self.transforms = transforms if transforms is not None else [None] * len(arrays)
+
+    def _fetch(self, rows):
+        out = []
+        for array, transform in zip(self.arrays, self.transforms):
+            data = array[rows]
+            out.append(data if transform is None else transform(data))
+        return out
+
+    def __getitem__(self, ind):
+        """Get item from dataset.
+
+        Args:
+            ind (int or list): Index of data to get, or a list of indices to get a whole batch at once.
+
+        Returns:
+            list: One row (or batch of rows) per array.
+        """
+        return self._fetch(self.indices[ind])
+
+    def __len__(self):
+        """Get length of dataset."""
+        return len(self.indices)
+
+
+def batch_dataloader(dataset, batch_size, shuffle=False, num_workers=0, drop_last=False):
+    """Get a DataLoader that slices whole batches out of an ArrayDataset.
+
+    Every batch is fetched with one fancy-indexing call per array instead of one `__getitem__` and collate per sample. Batches contain the same tensors as a regular DataLoader with default collate.
+
+    Args:
+        dataset (ArrayDataset): Dataset to load from.
+        batch_size (int): Batch size.
+        shuffle (bool, optional): Whether to shuffle data or not. Defaults to False.
+        num_workers (int, optional): Number of workers. Defaults to 0.
+        drop_last (bool, optional): Whether to drop the last incomplete batch or not. Defaults to False.
+
+    Returns:
+        torch.utils.data.DataLoader: Dataloader over batches.
+    """
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return DataLoader(dataset, sampler=BatchSampler(sampler, batch_size, drop_last),
+                      batch_size=None, num_workers=num_workers)
+
+
+class InMemoryBatchLoader:
+    """Iterates over batches sliced from tensors that are held in memory or on device.
+
+    The arrays are converted to tensors once, so an epoch only draws a permutation and indexes every tensor with slices of it. Batches contain the same tensors as a regular DataLoader with default collate, and the loader can be passed to the training structures in place of one.
+    """
+
+    def __init__(self, arrays, batch_size, shuffle=False, drop_last=False, device=None, pin_memory=False):
+        """Initialize InMemoryBatchLoader object.
+
+        Args:
+            arrays (list): Arrays or tensors with one row per sample, e.g. [modality_1, modality_2, labels].
+            batch_size (int): Batch size.
+            shuffle (bool, optional): Whether to shuffle data every epoch or not. Defaults to False.
+            drop_last (bool, optional): Whether to drop the last incomplete batch or not. Defaults to False.
+            device (torch.device, optional): Device to keep the tensors on. Defaults to None, which keeps them on the CPU.
+            pin_memory (bool, optional): Whether to return batches in pinned memory, for faster copies to the GPU. Only used when device is None. Defaults to False.
+        """
+        self.tensors = [torch.as_tensor(np.asarray(array)) for array in arrays]
+        if device is not None:
+            self.tensors = [tensor.to(device) for tensor in self.tensors]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.device = device
+        self.pin_memory = pin_memory and device is None and torch.cuda.is_available()
+
+    @classmethod
+    def from_dataset(cls, dataset, batch_size, shuffle=False, **kwargs):
+        """Build an InMemoryBatchLoader over the rows of an ArrayDataset.
+
+        Args:
+            dataset (ArrayDataset): Dataset to load. Its rows are gathered and its transforms applied once.
+            batch_size (int): Batch size.
+            shuffle (bool, optional): Whether to shuffle data every epoch or not. Defaults to False.
+            **kwargs: Other arguments of InMemoryBatchLoader.
+
+        Returns:
+            InMemoryBatchLoader: Loader over the dataset.
+        """
+        return cls(dataset[np.arange(len(dataset))], batch_size, shuffle=shuffle, **kwargs)
+
+    def __iter__(self):
+        """Iterate over batches, as lists with one tensor per array."""
+        num_samples = len(self.tensors[0])
+        order = torch.randperm(num_samples, device=self.device) if self.shuffle else None
+        end = num_samples - num_samples % self.batch_size if self.drop_last else num_samples
+        for start in range(0, end, self.batch_size):
+            if order is None:
+                batch = [tensor[start:start + self.batch_size] for tensor in self.tensors]
+            else:
+                rows = order[start:start + self.batch_size]
+                batch = [tensor[rows] for tensor in self.tensors]
+            if self.pin_memory:
+                batch = [tensor.pin_memory() for tensor in batch]
+            yield batch
+
+    def __len__(self):
+        """Get number of batches."""
+        num_samples = len(self.tensors[0])
+        if self.drop_last:
+            return num_samples // self.batch_size
+        return (num_samples + self.batch_size - 1) // self.batch_size
+
+
+class EpisodeWindowSampler(Sampler):
+    """Samples the windows of an episodic dataset shard by shard, so that reads are mostly sequential.
+
+    Every epoch shuffles the episodes, groups them into shards of episodes_per_shard episodes, and shuffles the windows of each shard among themselves. A batch then reads from the few episodes of one or two shards instead of from one episode per sample, while every epoch still visits all windows in a new order.
+    """
+
+    def __init__(self, episodes, episodes_per_shard=8, shuffle=True, seed=None):
+        """Initialize EpisodeWindowSampler object.
+
+        Args:
+            episodes (np.ndarray): Episode of every sample of the dataset, such as the episodes attribute of the episodic datasets.
+            episodes_per_shard (int, optional): Number of episodes whose windows are shuffled together. Defaults to 8.
+            shuffle (bool, optional): Whether to shuffle or to go through the episodes in order. Defaults to True.
+            seed (int, optional): Seed of the shuffling, combined with the epoch. Defaults to None, which draws one from torch's global generator every epoch, like RandomSampler.
+        """
+        episodes = np.asarray(episodes)
+        self.order = np.argsort(episodes, kind='stable')
+        _, starts = np.unique(episodes[self.order], return_index=True)
+        self.bounds = np.append(starts, len(episodes))
+        self.episodes_per_shard = episodes_per_shard
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def __iter__(self):
+        """Iterate over the indices of one epoch."""
+        num_episodes = len(self.bounds) - 1
+        if not self.shuffle:
+            yield from self.order.tolist()
+            return
+        if self.seed is None:
+            rng = np.random.default_rng(int(torch.empty((), dtype=torch.int64).random_().item()))
+        else:
+            rng = np.random.default_rng([self.seed, self.epoch])
+        self.epoch += 1
+        permutation = rng.permutation(num_episodes)
+        for shard_start in range(0, num_episodes, self.episodes_per_shard):
+            shard = permutation[shard_start:shard_start + self.episodes_per_shard]
+            indices = np.concatenate([self.order[self.bounds[e]:self.bounds[e + 1]] for e in shard])
+            rng.shuffle(indices)
+            yield from indices.tolist()
+
+    def __len__(self):
+        """Get number of samples per epoch."""
+        return len(self.order)
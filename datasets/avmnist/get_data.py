@@ -3,11 +3,17 @@
 Here, the data is assumed to be in a folder titled "avmnist".
 """
 import numpy as np
+import torch
 from torch.utils.data import DataLoader
 
+from datasets.array_dataset import ArrayDataset, InMemoryBatchLoader, batch_dataloader
 
 
-def get_dataloader(data_dir, batch_size=40, num_workers=8, train_shuffle=True, flatten_audio=False, flatten_image=False, unsqueeze_channel=True, generate_sample=False, normalize_image=True, normalize_audio=True):
+def _normalize(data):
+    return data / 255.0
+
+
+def get_dataloader(data_dir, batch_size=40, num_workers=8, train_shuffle=True, flatten_audio=False, flatten_image=False, unsqueeze_channel=True, generate_sample=False, normalize_image=True, normalize_audio=True, mmap_mode=None, batched=False, in_memory=False):
     """Get dataloaders for AVMNIST.
 
     Args:
@@ -21,26 +27,23 @@ def get_dataloader(data_dir, batch_size=40, num_workers=8, train_shuffle=True, f
         generate_sample (bool, optional): Whether to generate a sample and save it to file or not. Defaults to False.
         normalize_image (bool, optional): Whether to normalize the images before returning. Defaults to True.
         normalize_audio (bool, optional): Whether to normalize the audio before returning. Defaults to True.
+        mmap_mode (str, optional): Memory-map the .npy files with this mode (e.g. 'r') instead of reading them into memory. Defaults to None.
+        batched (bool, optional): Whether to slice whole batches at once instead of collating single samples. Defaults to False.
+        in_memory (bool, optional): Whether to hold the data as tensors on the training device and slice batches from them directly. Defaults to False.
 
     Returns:
         tuple: Tuple of (training dataloader, validation dataloader, test dataloader)
     """
-    trains = [np.load(data_dir+"/image/train_data.npy"), np.load(data_dir +
-                                                                 "/audio/train_data.npy"), np.load(data_dir+"/train_labels.npy")]
-    tests = [np.load(data_dir+"/image/test_data.npy"), np.load(data_dir +
-                                                               "/audio/test_data.npy"), np.load(data_dir+"/test_labels.npy")]
+    trains = [np.load(data_dir+"/image/train_data.npy", mmap_mode=mmap_mode), np.load(data_dir +
+                                                                                      "/audio/train_data.npy", mmap_mode=mmap_mode), np.load(data_dir+"/train_labels.npy")]
+    tests = [np.load(data_dir+"/image/test_data.npy", mmap_mode=mmap_mode), np.load(data_dir +
+                                                                                    "/audio/test_data.npy", mmap_mode=mmap_mode), np.load(data_dir+"/test_labels.npy")]
     if flatten_audio:
         trains[1] = trains[1].reshape(60000, 112*112)
         tests[1] = tests[1].reshape(10000, 112*112)
     if generate_sample:
         _saveimg(trains[0][0:100])
         _saveaudio(trains[1][0:9].reshape(9, 112*112))
-    if normalize_image:
-        trains[0] /= 255.0
-        tests[0] /= 255.0
-    if normalize_audio:
-        trains[1] = trains[1]/255.0
-        tests[1] = tests[1]/255.0
     if not flatten_image:
         trains[0] = trains[0].reshape(60000, 28, 28)
         tests[0] = tests[0].reshape(10000, 28, 28)
@@ -51,14 +54,20 @@ def get_dataloader(data_dir, batch_size=40, num_workers=8, train_shuffle=True, f
         tests[1] = np.expand_dims(tests[1], 1)
     trains[2] = trains[2].astype(int)
     tests[2] = tests[2].astype(int)
-    trainlist = [[trains[j][i] for j in range(3)] for i in range(60000)]
-    testlist = [[tests[j][i] for j in range(3)] for i in range(10000)]
-    valids = DataLoader(trainlist[55000:60000], shuffle=False,
-                        num_workers=num_workers, batch_size=batch_size)
-    tests = DataLoader(testlist, shuffle=False,
-                       num_workers=num_workers, batch_size=batch_size)
-    trains = DataLoader(trainlist[0:55000], shuffle=train_shuffle,
-                        num_workers=num_workers, batch_size=batch_size)
+    # normalization is applied to each fetched batch, so the (possibly memory-mapped) arrays are never copied
+    transforms = [_normalize if normalize_image else None,
+                  _normalize if normalize_audio else None, None]
+
+    def _loader(dataset, shuffle):
+        if in_memory:
+            return InMemoryBatchLoader.from_dataset(dataset, batch_size, shuffle=shuffle, device=torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
+        if batched:
+            return batch_dataloader(dataset, batch_size, shuffle=shuffle, num_workers=num_workers)
+        return DataLoader(dataset, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+
+    valids = _loader(ArrayDataset(trains, np.arange(55000, 60000), transforms), False)
+    tests = _loader(ArrayDataset(tests, transforms=transforms), False)
+    trains = _loader(ArrayDataset(trains, np.arange(0, 55000), transforms), train_shuffle)
     return trains, valids, tests
 
 # this function creates an image of 100 numbers in avmnist
@@ -17,7 +17,8 @@ import torch
 
 from torch.utils.data import Dataset
 from torch.utils.data import DataLoader
-from robustness.visual_robust import add_visual_noise
+from datasets.array_dataset import EpisodeWindowSampler
+from robustness.visual_robust import add_visual_noise_batch
 from robustness.timeseries_robust import add_timeseries_noise
 
 dataset_urls = {
@@ -99,18 +100,20 @@ class PushTask():
         val_trajectories = cls.get_eval_trajectories(**dataset_args)
         test_trajectories = cls.get_test_trajectories(
             modalities, **dataset_args)
+        train_dataset = SubsequenceDataset(
+            train_trajectories, subsequence_length, modalities)
         train_loader = DataLoader(
-            SubsequenceDataset(train_trajectories,
-                               subsequence_length, modalities),
+            train_dataset,
             batch_size=batch_size,
-            shuffle=True,
+            sampler=EpisodeWindowSampler(train_dataset.episodes),
             drop_last=drop_last,
         )
+        val_dataset = SubsequenceDataset(
+            val_trajectories, subsequence_length, modalities)
         val_loader = DataLoader(
-            SubsequenceDataset(
-                val_trajectories, subsequence_length, modalities),
+            val_dataset,
             batch_size=batch_size,
-            shuffle=True,
+            sampler=EpisodeWindowSampler(val_dataset.episodes),
         )
         test_loader = dict()
         for modality, trajectories in test_trajectories.items():
@@ -331,8 +334,8 @@ def _load_trajectories(
             else:
                 observations["image"] = raw_trajectory["image"].copy()
             if visual_noise != 0:
-                observations["image"] = np.array(add_visual_noise(
-                    observations["image"], noise_level=visual_noise))
+                observations["image"] = add_visual_noise_batch(
+                    observations["image"], noise_level=visual_noise)
             assert observations["image"].shape == (timesteps, 32, 32)
 
             # Mask image observations based on dataset args
@@ -567,82 +570,57 @@ def split_trajectories(
     ```
         [5:15], [15:25], [25:30], ...
     ```
+    Every subsequence is a tuple of views into the trajectory arrays; use
+    `SubsequenceDataset` to index them lazily instead of listing them all.
+
     Args:
         trajectories (List[torchfilter.base.TrajectoryNumpy]): List of trajectories.
         subsequence_length (int): # of timesteps per subsequence.
     Returns:
         List[torchfilter.base.TrajectoryNumpy]: List of subsequences.
     """
-
-    subsequences = []
-
-    for traj in trajectories:
-        # Chop up each trajectory into overlapping subsequences
-        trajectory_length = len(traj.states)
-        assert len(fp.utils.SliceWrapper(
-            traj.observations)) == trajectory_length
-        assert len(fp.utils.SliceWrapper(traj.controls)) == trajectory_length
-
-        # We iterate over two offsets to generate overlapping subsequences
-        for offset in (0, subsequence_length // 2):
-
-            def split_fn(x: np.ndarray) -> np.ndarray:
-                """Helper: splits arrays of shape `(T, ...)` into `(sections,
-                subsequence_length, ...)`, where `sections = orig_length //
-                subsequence_length`."""
-                # Offset our starting point
-                x = x[offset:]
-
-                # Make sure our array is evenly divisible
-                sections = len(x) // subsequence_length
-                new_length = sections * subsequence_length
-                x = x[:new_length]
-
-                # Split & return
-                return np.split(x, sections)
-
-            for s, o, c in zip(
-                # States are always raw arrays
-                split_fn(traj.states),
-                # Observations and controls can be dictionaries, so we have to jump
-                # through some hoops
-                fp.utils.SliceWrapper(
-                    fp.utils.SliceWrapper(traj.observations).map(split_fn)
-                ),
-                fp.utils.SliceWrapper(
-                    fp.utils.SliceWrapper(traj.controls).map(split_fn)
-                ),
-            ):
-                # Add to subsequences
-                if modalities is None:
-                    subsequences.append(
-                        (
-                            o['gripper_pos'],
-                            o['gripper_sensors'],
-                            o['image'],
-                            c,
-                            s,
-                        )
-                    )
-                else:
-                    mods = []
-                    for m in modalities:
-                        if m == 'gripper_pos': 
-                            mods.append(o['gripper_pos'])
-                        elif m == 'gripper_sensors':
-                            mods.append(o['gripper_sensors'])
-                        elif m == 'image':
-                            mods.append(o['image'])
-                        elif m == 'control':
-                            mods.append(c)
-                    mods.append(s)
-                    subsequences.append(tuple(mods))
-    return subsequences
+    dataset = SubsequenceDataset(trajectories, subsequence_length, modalities)
+    return [dataset[index] for index in range(len(dataset))]
+
+
+def _trajectory_arrays(traj: TrajectoryNumpy, modalities=None):
+    """Get the arrays of a trajectory that make up its subsequences, in order."""
+    trajectory_length = len(traj.states)
+    assert len(fp.utils.SliceWrapper(
+        traj.observations)) == trajectory_length
+    assert len(fp.utils.SliceWrapper(traj.controls)) == trajectory_length
+
+    o, c = traj.observations, traj.controls
+    if modalities is None:
+        return (o['gripper_pos'], o['gripper_sensors'], o['image'], c, traj.states)
+    mods = []
+    for m in modalities:
+        if m == 'gripper_pos':
+            mods.append(o['gripper_pos'])
+        elif m == 'gripper_sensors':
+            mods.append(o['gripper_sensors'])
+        elif m == 'image':
+            mods.append(o['image'])
+        elif m == 'control':
+            mods.append(c)
+    mods.append(traj.states)
+    return tuple(mods)
+
+
+def _subsequence_starts(trajectory_length: int, subsequence_length: int) -> np.ndarray:
+    """Get the first timestep of every subsequence of a trajectory, in the order of `split_trajectories`."""
+    # We iterate over two offsets to generate overlapping subsequences
+    return np.concatenate([
+        offset + subsequence_length *
+        np.arange((trajectory_length - offset) // subsequence_length)
+        for offset in (0, subsequence_length // 2)
+    ]).astype(np.int64)
 
 
 class SubsequenceDataset(Dataset):
     """A data preprocessor for producing training subsequences from
-    a list of trajectories. Thin wrapper around `torchfilter.data.split_trajectories()`.
+    a list of trajectories. Subsequences are those of `split_trajectories()`, returned as
+    views into the trajectory arrays, so memory does not grow with their number or length.
     
     Args:
         trajectories (list): list of trajectories, where each is a tuple of
@@ -661,10 +639,22 @@ class SubsequenceDataset(Dataset):
             subsequence_length (int): Length to sample each subsequence
             modalities (list, optional): List of strings of modalities to choose. Defaults to None. Choose from ['gripper_pos', 'gripper_sensors', 'image', 'control'].
         """
-        # Split trajectory into overlapping subsequences
-        self.subsequences = split_trajectories(
-            trajectories, subsequence_length, modalities
-        )
+        # Keep every trajectory as whole arrays, and index its overlapping
+        # subsequences by (trajectory, first timestep)
+        self.trajectories = [_trajectory_arrays(
+            traj, modalities) for traj in trajectories]
+        self.subsequence_length = subsequence_length
+        windows = [
+            np.stack([np.full(len(starts), i), starts], axis=1)
+            for i, starts in enumerate(
+                _subsequence_starts(len(traj[-1]), subsequence_length)
+                for traj in self.trajectories
+            )
+        ]
+        self.windows = np.concatenate(
+            windows) if windows else np.zeros((0, 2), dtype=np.int64)
+        # Trajectory of every subsequence, for EpisodeWindowSampler
+        self.episodes = self.windows[:, 0]
 
     def __getitem__(self, index: int):
         """Get a subsequence from our dataset.
@@ -676,11 +666,12 @@ class SubsequenceDataset(Dataset):
             numpy array or dict of numpy arrays with shape
             `(subsequence_length, ...)`.
         """
-        return self.subsequences[index]
+        traj, start = self.windows[index]
+        return tuple(x[start:start + self.subsequence_length] for x in self.trajectories[traj])
 
     def __len__(self) -> int:
         """Total number of subsequences in the dataset.
         Returns:
             int: Length of dataset.
         """
-        return len(self.subsequences)
+        return len(self.windows)
@@ -7,8 +7,10 @@ from torch.utils.data import Dataset, DataLoader
 import h5py
 from gensim.models import KeyedVectors
 from .vgg import VGGClassifier
-from robustness.text_robust import add_text_noise
+from robustness.text_robust import TextCorpus, WordEmbeddingCache
 from robustness.visual_robust import add_visual_noise
+from robustness.robust_suite import RobustTestSuite
+from utils.feature_cache import FeatureCache, file_fingerprint
 import os
 import sys
 from typing import *
@@ -16,6 +18,9 @@ import numpy as np
 
 sys.path.append('/home/pliang/multibench/MultiBench/datasets/imdb')
 
+# Number of posters corrupted at once before their VGG features are extracted
+_NOISE_CHUNK = 256
+
 
 class IMDBDataset(Dataset):
     """Implements a torch Dataset class for the imdb dataset."""
@@ -110,7 +115,18 @@ def _process_data(filename, path):
     return data
 
 
-def get_dataloader(path: str, test_path: str, num_workers: int = 8, train_shuffle: bool = True, batch_size: int = 40, vgg: bool = False, skip_process=False, no_robust=False) -> Tuple[Dict]:
+def _word2vec_lookup(word2vec):
+    """Get a word lookup for WordEmbeddingCache backed by gensim KeyedVectors."""
+    def _lookup(words):
+        found = np.array([w in word2vec for w in words], dtype=bool)
+        vectors = np.zeros((len(words), word2vec.vector_size), dtype=np.float32)
+        if found.any():
+            vectors[found] = word2vec[[w for w, known in zip(words, found) if known]]
+        return vectors, found
+    return _lookup
+
+
+def get_dataloader(path: str, test_path: str, num_workers: int = 8, train_shuffle: bool = True, batch_size: int = 40, vgg: bool = False, skip_process=False, no_robust=False, cache_dir=None, seed=0, vgg_batch_size=32, vgg_threads=4) -> Tuple[Dict]:
     """Get dataloaders for IMDB dataset.
 
     Args:
@@ -120,8 +136,12 @@ def get_dataloader(path: str, test_path: str, num_workers: int = 8, train_shuffl
         train_shuffle (bool, optional): Whether to shuffle training data or not. Defaults to True.
         batch_size (int, optional): Batch size of data. Defaults to 40.
         vgg (bool, optional): Whether to return raw images or pre-processed vgg features. Defaults to False.
-        skip_process (bool, optional): Whether to pre-process data or not. Defaults to False.
+        skip_process (bool, optional): Whether to only use noisy test features that are already cached, instead of computing missing ones. Defaults to False.
         no_robust (bool, optional): Whether to not use robustness measures as augmentation. Defaults to False.
+        cache_dir (str, optional): Directory of the feature cache noisy test features are kept in. Defaults to utils.feature_cache.default_root().
+        seed (int, optional): Seed the test noise is drawn with. Defaults to 0.
+        vgg_batch_size (int, optional): Number of posters per VGG forward pass when extracting noisy test features. Defaults to 32.
+        vgg_threads (int, optional): Number of threads resizing posters for VGG. Defaults to 4.
 
     Returns:
         Tuple[Dict]: Tuple of Training dataloader, Validation dataloader, Test Dataloader
@@ -142,70 +162,75 @@ def get_dataloader(path: str, test_path: str, num_workers: int = 8, train_shuffl
     names = test_dataset["imdb_ids"][18160:25959]
 
     dataset = os.path.join(test_path, "dataset")
-
-    if not skip_process:
-        clsf = VGGClassifier(
-            model_path='/home/pliang/multibench/MultiBench/datasets/imdb/vgg16.tar', synset_words='synset_words.txt')
-        googleword2vec = KeyedVectors.load_word2vec_format(
-            '/home/pliang/multibench/MultiBench/datasets/imdb/GoogleNews-vectors-negative300.bin.gz', binary=True)
-
-        images = []
-        texts = []
-        for name in tqdm(names):
-            name = name.decode("utf-8")
-            data = _process_data(name, dataset)
-            images.append(data['image'])
-            plot_id = np.array([len(p) for p in data['plot']]).argmax()
-            texts.append(data['plot'][plot_id])
+    vgg_path = '/home/pliang/multibench/MultiBench/datasets/imdb/vgg16.tar'
+    word2vec_path = '/home/pliang/multibench/MultiBench/datasets/imdb/GoogleNews-vectors-negative300.bin.gz'
+    cache = FeatureCache(cache_dir)
+    # noisy features also depend on the raw test data, and on which of its samples are read
+    raw_key = {'source': file_fingerprint(test_path), 'ids': [name.decode("utf-8") for name in names]}
+    inputs = dict()
+
+    def _inputs():
+        # Raw test data and feature extractors are only loaded when a noisy test set is not cached yet
+        if skip_process:
+            raise FileNotFoundError("Noisy IMDB test features are not cached in " + cache.root)
+        if not inputs:
+            inputs['clsf'] = VGGClassifier(model_path=vgg_path, synset_words='synset_words.txt')
+            googleword2vec = KeyedVectors.load_word2vec_format(word2vec_path, binary=True)
+            images = []
+            texts = []
+            for name in tqdm(names):
+                name = name.decode("utf-8")
+                data = _process_data(name, dataset)
+                images.append(data['image'])
+                plot_id = np.array([len(p) for p in data['plot']]).argmax()
+                texts.append(data['plot'][plot_id])
+            inputs['images'] = images
+            # The plots are tokenized and their vocabulary embedded once for all noise levels
+            inputs['corpus'] = TextCorpus(texts)
+            inputs['embedder'] = WordEmbeddingCache(_word2vec_lookup(googleword2vec), 300)
+        return inputs
 
     # Add visual noises
-    robust_vision = []
-    for noise_level in range(11):
-        vgg_filename = os.path.join(
-            os.getcwd(), 'vgg_features_{}.npy'.format(noise_level))
-        if not skip_process:
-            vgg_features = []
-            images_robust = add_visual_noise(
-                images, noise_level=noise_level/10)
-            for im in tqdm(images_robust):
-                vgg_features.append(clsf.get_features(
-                    Image.fromarray(im)).reshape((-1,)))
-            np.save(vgg_filename, vgg_features)
-        else:
-            assert os.path.exists(vgg_filename) == True
-            vgg_features = np.load(vgg_filename, allow_pickle=True)
-        robust_vision.append([(test_text[i], vgg_features[i], labels[i])
-                             for i in range(len(vgg_features))])
-
-    test_dataloader = dict()
-    test_dataloader['image'] = []
-    for test in robust_vision:
-        test_dataloader['image'].append(DataLoader(IMDBDataset_robust(test, 0, len(
-            test)), shuffle=False, num_workers=num_workers, batch_size=batch_size))
+    def _robust_vision(noise_level):
+        def _fill(out):
+            images = _inputs()['images']
+            # The noise is drawn chunk by chunk from one stream, so it does not depend on vgg_batch_size
+            rng = np.random.default_rng(seed)
+            for i in tqdm(range(0, len(images), _NOISE_CHUNK)):
+                images_robust = add_visual_noise(images[i:i + _NOISE_CHUNK], noise_level=noise_level/10, seed=rng)
+                _inputs()['clsf'].get_features_batch([Image.fromarray(im) for im in images_robust],
+                                                     batch_size=vgg_batch_size, num_threads=vgg_threads,
+                                                     out=out[i:i + _NOISE_CHUNK])
+        vgg_features = cache.get_or_fill(_fill, (len(names), 4096), np.float32, 'imdb', 'test', 'image',
+                                         noise='add_visual_noise', noise_level=noise_level/10, seed=seed,
+                                         extractor=file_fingerprint(vgg_path), **raw_key)
+        test = [(test_text[i], vgg_features[i], labels[i])
+                for i in range(len(vgg_features))]
+        return DataLoader(IMDBDataset_robust(test, 0, len(
+            test)), shuffle=False, num_workers=num_workers, batch_size=batch_size)
 
     # Add text noises
-    robust_text = []
-    for noise_level in range(11):
-        text_filename = os.path.join(
-            os.getcwd(), 'text_features_{}.npy'.format(noise_level))
-        if not skip_process:
+    def _robust_text(noise_level):
+        def _compute():
             text_features = []
-            texts_robust = add_text_noise(texts, noise_level=noise_level/10)
-            for words in tqdm(texts_robust):
-                words = words.split()
-                if len([googleword2vec[w] for w in words if w in googleword2vec]) == 0:
+            corpus, embedder = _inputs()['corpus'], _inputs()['embedder']
+            corruption = corpus.corrupt(noise_level/10, seed=seed)
+            for vectors, found in tqdm(corpus.embed(embedder, corruption), total=len(corpus)):
+                if not found.any():
                     text_features.append(np.zeros((300,)))
                 else:
-                    text_features.append(np.array(
-                        [googleword2vec[w] for w in words if w in googleword2vec]).mean(axis=0))
-            np.save(text_filename, text_features)
-        else:
-            assert os.path.exists(text_filename) == True
-            text_features = np.load(text_filename, allow_pickle=True)
-        robust_text.append([(text_features[i], test_vision[i], labels[i])
-                           for i in range(len(text_features))])
-    test_dataloader['text'] = []
-    for test in robust_text:
-        test_dataloader['text'].append(DataLoader(IMDBDataset_robust(test, 0, len(
-            test)), shuffle=False, num_workers=num_workers, batch_size=batch_size))
+                    text_features.append(vectors[found].mean(axis=0))
+            return np.array(text_features)
+        text_features = cache.get_or_compute(_compute, 'imdb', 'test', 'text', noise='add_text_noise',
+                                             noise_level=noise_level/10, seed=seed, extractor=file_fingerprint(word2vec_path),
+                                             **raw_key)
+        test = [(text_features[i], test_vision[i], labels[i])
+                for i in range(len(text_features))]
+        return DataLoader(IMDBDataset_robust(test, 0, len(
+            test)), shuffle=False, num_workers=num_workers, batch_size=batch_size)
+
+    # Noisy test sets are only built once the test loop reaches them
+    test_dataloader = RobustTestSuite()
+    test_dataloader.add('image', _robust_vision, range(11))
+    test_dataloader.add('text', _robust_text, range(11))
     return train_dataloader, val_dataloader, test_dataloader
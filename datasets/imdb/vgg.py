@@ -1,6 +1,7 @@
 """Implements VGG pre-processer for IMDB data."""
 import theano
 import numpy
+from concurrent.futures import ThreadPoolExecutor
 
 from blocks.bricks import MLP, Rectifier, FeedforwardSequence, Softmax
 from blocks.bricks.conv import (Convolutional, ConvolutionalSequence,
@@ -9,7 +10,8 @@ from blocks.serialization import load_parameters
 from blocks.graph import ComputationGraph
 from blocks.filter import VariableFilter
 from blocks.model import Model
-from PIL import Image
+
+from .vgg_preprocessing import crop_image, normalize_images
 
 
 class VGGNet(FeedforwardSequence):
@@ -128,40 +130,32 @@ class VGGClassifier(object):
         image = VGGClassifier.resize_and_crop_image(image)
         return self.fe_extractor(image)[0]
 
+    def get_features_batch(self, images, batch_size=32, num_threads=4, out=None):
+        """Return the activations of the last hidden layer for a list of images.
+
+        Images are resized and cropped in a thread pool, normalized as one array and run through the network batch_size at a time.
+
+        :images: list of PIL images.
+        :batch_size: Number of images per forward pass.
+        :num_threads: Number of threads resizing images. The network itself uses as many threads as theano is configured to (OMP_NUM_THREADS).
+        :out: Optional [len(images), 4096] array to write the activations to, such as a memory-mapped one.
+        :returns: numpy array with 4096 activations per image.
+        """
+        if out is None:
+            out = numpy.empty((len(images), 4096), dtype='float32')
+        with ThreadPoolExecutor(num_threads) as pool:
+            for i in range(0, len(images), batch_size):
+                batch = numpy.stack(list(pool.map(VGGClassifier.crop_image, images[i:i + batch_size])))
+                out[i:i + batch_size] = self.fe_extractor(VGGClassifier.normalize_images(batch))[0]
+        return out
+
     def resize_and_crop_image(img, output_box=[224, 224], fit=True):
         """Downsample the image.
         
         Sourced from https://github.com/BVLC/caffe/blob/master/tools/extra/resize_and_crop_images.py
         """
-        box = output_box
-        # preresize image with factor 2, 4, 8 and fast algorithm
-        factor = 1
-        while img.size[0] / factor > 2 * box[0] and img.size[1] * 2 / factor > 2 * box[1]:
-            factor *= 2
-        if factor > 1:
-            img.thumbnail(
-                (img.size[0] / factor, img.size[1] / factor), Image.NEAREST)
-
-        # calculate the cropping box and get the cropped part
-        if fit:
-            x1 = y1 = 0
-            x2, y2 = img.size
-            wRatio = 1.0 * x2 / box[0]
-            hRatio = 1.0 * y2 / box[1]
-            if hRatio > wRatio:
-                y1 = int(y2 / 2 - box[1] * wRatio / 2)
-                y2 = int(y2 / 2 + box[1] * wRatio / 2)
-            else:
-                x1 = int(x2 / 2 - box[0] * hRatio / 2)
-                x2 = int(x2 / 2 + box[0] * hRatio / 2)
-            img = img.crop((x1, y1, x2, y2))
-
-        # Resize the image with best quality algorithm ANTI-ALIAS
-        img = img.resize(box, Image.ANTIALIAS).convert('RGB')
-        img = numpy.asarray(img, dtype='float32')[..., [2, 1, 0]]
-        img[:, :, 0] -= 103.939
-        img[:, :, 1] -= 116.779
-        img[:, :, 2] -= 123.68
-        img = img.transpose((2, 0, 1))
-        img = numpy.expand_dims(img, axis=0)
-        return img
+        img = VGGClassifier.crop_image(img, output_box, fit)
+        return VGGClassifier.normalize_images(img[None])
+
+    crop_image = staticmethod(crop_image)
+    normalize_images = staticmethod(normalize_images)
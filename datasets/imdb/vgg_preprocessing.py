@@ -0,0 +1,43 @@
+"""Implements the image preprocessing of the VGG pre-processor for IMDB data, which only needs Pillow and numpy."""
+import numpy
+from PIL import Image
+
+
+def crop_image(img, output_box=[224, 224], fit=True):
+    """Downsample the image to output_box, returning it as a [height, width, 3] uint8 RGB array.
+
+    Sourced from https://github.com/BVLC/caffe/blob/master/tools/extra/resize_and_crop_images.py
+    """
+    box = output_box
+    # preresize image with factor 2, 4, 8 and fast algorithm
+    factor = 1
+    while img.size[0] / factor > 2 * box[0] and img.size[1] * 2 / factor > 2 * box[1]:
+        factor *= 2
+    if factor > 1:
+        img.thumbnail(
+            (img.size[0] / factor, img.size[1] / factor), Image.NEAREST)
+
+    # calculate the cropping box and get the cropped part
+    if fit:
+        x1 = y1 = 0
+        x2, y2 = img.size
+        wRatio = 1.0 * x2 / box[0]
+        hRatio = 1.0 * y2 / box[1]
+        if hRatio > wRatio:
+            y1 = int(y2 / 2 - box[1] * wRatio / 2)
+            y2 = int(y2 / 2 + box[1] * wRatio / 2)
+        else:
+            x1 = int(x2 / 2 - box[0] * hRatio / 2)
+            x2 = int(x2 / 2 + box[0] * hRatio / 2)
+        img = img.crop((x1, y1, x2, y2))
+
+    # Resize the image with best quality algorithm ANTI-ALIAS
+    img = img.resize(box, Image.LANCZOS).convert('RGB')
+    return numpy.asarray(img)
+
+
+def normalize_images(images):
+    """Turn [N, height, width, 3] uint8 RGB images into the mean-subtracted [N, 3, height, width] BGR input of the network."""
+    images = images[..., ::-1].astype('float32')
+    images -= numpy.array([103.939, 116.779, 123.68], dtype='float32')
+    return numpy.ascontiguousarray(images.transpose((0, 3, 1, 2)))
@@ -0,0 +1,227 @@
+"""Implements a sharded, memory-mapped store of Kinetics clips, and a stream of batches over it.
+
+A clip store is a directory with one sub-directory per shard, holding one .npy array per field (video, audio, label) with a row per clip, and an index.json listing the shards. `ClipStream` reads the store shard by shard, loading the next shard on a background thread while batches of the current one are consumed, so that training does not wait for a shard to be unpickled between shards.
+
+Video can be stored as the uint8 frames decoded from the clips, which are a quarter of the size of the normalized float frames; `normalize_video` then turns batches of them into the input of the models, on the device they are trained on.
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from torch.nn import functional as F
+from torch.utils.data import IterableDataset
+
+INDEX_NAME = 'index.json'
+FIELDS = ('video', 'audio', 'label')
+VIDEO_MEAN = (0.43216, 0.394666, 0.37645)
+VIDEO_STD = (0.22803, 0.22145, 0.216989)
+
+
+def write_clip_store(clips, root, shard_size=100, fields=FIELDS):
+    """Write clips into a clip store.
+
+    Args:
+        clips (iterable): Clips, as tuples with one tensor or array per field.
+        root (str): Directory of the store.
+        shard_size (int, optional): Number of clips per shard. Defaults to 100.
+        fields (tuple, optional): Names of the fields of a clip. Defaults to FIELDS.
+
+    Returns:
+        ClipStore: The written store.
+    """
+    shards = []
+    clips = iter(clips)
+    while True:
+        rows = [clip for _, clip in zip(range(shard_size), clips)]
+        if not rows:
+            break
+        shards.append(_write_shard(rows, root, len(shards), fields))
+        if len(rows) < shard_size:
+            break
+    return _write_index(root, shards, fields)
+
+
+def convert_pdt_shards(pdt_files, root, fields=FIELDS):
+    """Convert the .pdt shards saved by tobatch_37.py, lists of clip tuples, into a clip store with the same shards.
+
+    Args:
+        pdt_files (list): Paths of the .pdt shards, in order.
+        root (str): Directory of the store.
+        fields (tuple, optional): Names of the fields of a clip. Defaults to FIELDS.
+
+    Returns:
+        ClipStore: The written store.
+    """
+    shards = [_write_shard(torch.load(pdt_file), root, i, fields) for i, pdt_file in enumerate(pdt_files)]
+    return _write_index(root, shards, fields)
+
+
+def kinetics_stores(data_dir, store_dir=None, prefix='batch_37', num_shards=None):
+    """Open the clip stores of the Kinetics splits, converting the .pdt shards of a split the first time it is opened.
+
+    Args:
+        data_dir (str): Directory with a train, valid and test directory of .pdt shards named <prefix><shard number>.pdt.
+        store_dir (str, optional): Directory to keep the stores in, one per split. Defaults to <data_dir>/clip_store.
+        prefix (str, optional): Name of the .pdt shards before their number. Defaults to 'batch_37'.
+        num_shards (dict, optional): Number of shards of every split. Defaults to the 22, 2 and 3 shards of kinetics_small.
+
+    Returns:
+        dict: Maps 'train', 'valid' and 'test' to their ClipStore.
+    """
+    if store_dir is None:
+        store_dir = os.path.join(data_dir, 'clip_store')
+    if num_shards is None:
+        num_shards = {'train': 22, 'valid': 2, 'test': 3}
+    stores = dict()
+    for split, count in num_shards.items():
+        root = os.path.join(store_dir, split)
+        if not os.path.exists(os.path.join(root, INDEX_NAME)):
+            convert_pdt_shards([os.path.join(data_dir, split, '%s%d.pdt' % (prefix, fid)) for fid in range(count)], root)
+        stores[split] = ClipStore(root)
+    return stores
+
+
+def normalize_video(video):
+    """Turn a batch of uint8 [T, H, W, 3] frames into the normalized, 2x2 average pooled [3, T, W / 2, H / 2] input of the video models, as tobatch_37.py does per clip.
+
+    Video that is not uint8 is taken to be normalized already and returned as is.
+    """
+    if video.dtype != torch.uint8:
+        return video
+    mean = torch.tensor(VIDEO_MEAN, device=video.device)
+    std = torch.tensor(VIDEO_STD, device=video.device)
+    video = ((video.float() / 255.0) - mean) / std
+    video = video.permute(0, 4, 1, 3, 2)
+    batch, channels, frames, width, height = video.shape
+    video = F.avg_pool2d(video.reshape(batch * channels, frames, width, height), (2, 2))
+    return video.reshape(batch, channels, frames, width // 2, height // 2)
+
+
+class ClipStore:
+    """Reads the shards of a clip store as memory-mapped arrays."""
+
+    def __init__(self, root):
+        """Initialize ClipStore object.
+
+        Args:
+            root (str): Directory of the store.
+        """
+        self.root = root
+        with open(os.path.join(root, INDEX_NAME)) as f:
+            index = json.load(f)
+        self.fields = tuple(index['fields'])
+        self.shard_names = [shard['name'] for shard in index['shards']]
+        self.shard_sizes = [shard['size'] for shard in index['shards']]
+
+    def __len__(self):
+        """Get number of shards."""
+        return len(self.shard_names)
+
+    def num_clips(self):
+        """Get number of clips in all shards."""
+        return sum(self.shard_sizes)
+
+    def shard(self, index):
+        """Open a shard.
+
+        Args:
+            index (int): Shard number.
+
+        Returns:
+            dict: Maps every field to its memory-mapped array, with one row per clip.
+        """
+        shard_dir = os.path.join(self.root, self.shard_names[index])
+        return {field: np.load(os.path.join(shard_dir, field + '.npy'), mmap_mode='r') for field in self.fields}
+
+
+class ClipStream(IterableDataset):
+    """Streams batches of clips from a ClipStore, shard by shard, with the next shard loaded in the background.
+
+    Batches are lists with one tensor per field, like those of a DataLoader over the clip tuples, so the stream can be iterated over in place of such a DataLoader. Batches do not span shards.
+    """
+
+    def __init__(self, store, batch_size, shuffle=False, drop_last=False, transforms=None, device=None, seed=None):
+        """Initialize ClipStream object.
+
+        Args:
+            store (ClipStore): Store to read.
+            batch_size (int): Batch size.
+            shuffle (bool, optional): Whether to shuffle the order of the shards and of the clips within each shard every epoch. Defaults to False.
+            drop_last (bool, optional): Whether to drop the last incomplete batch of every shard. Defaults to False.
+            transforms (dict, optional): Maps fields to a function applied to every batch of them, after moving it to device, such as {'video': normalize_video}. Defaults to None.
+            device (torch.device, optional): Device to move batches to. Defaults to None, which keeps them on the CPU.
+            seed (int, optional): Seed of the shuffling, combined with the epoch. Defaults to None, which draws one from torch's global generator every epoch.
+        """
+        self.store = store
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.transforms = transforms if transforms is not None else dict()
+        self.device = device
+        self.seed = seed
+        self.epoch = 0
+
+    def _load(self, index):
+        # read the whole shard into memory, off the thread consuming batches
+        return {field: np.array(array) for field, array in self.store.shard(index).items()}
+
+    def __iter__(self):
+        """Iterate over the batches of one epoch."""
+        if self.seed is None:
+            rng = np.random.default_rng(int(torch.empty((), dtype=torch.int64).random_().item()))
+        else:
+            rng = np.random.default_rng([self.seed, self.epoch])
+        self.epoch += 1
+        order = rng.permutation(len(self.store)) if self.shuffle else np.arange(len(self.store))
+        if len(order) == 0:
+            return
+        with ThreadPoolExecutor(1) as pool:
+            pending = pool.submit(self._load, order[0])
+            for k in range(len(order)):
+                shard = pending.result()
+                if k + 1 < len(order):
+                    pending = pool.submit(self._load, order[k + 1])
+                size = self.store.shard_sizes[order[k]]
+                rows = rng.permutation(size) if self.shuffle else np.arange(size)
+                end = size - size % self.batch_size if self.drop_last else size
+                for start in range(0, end, self.batch_size):
+                    yield self._batch(shard, rows[start:start + self.batch_size])
+
+    def _batch(self, shard, rows):
+        batch = []
+        for field in self.store.fields:
+            data = torch.from_numpy(shard[field][rows])
+            if self.device is not None:
+                data = data.to(self.device, non_blocking=True)
+            transform = self.transforms.get(field)
+            batch.append(data if transform is None else transform(data))
+        return batch
+
+    def __len__(self):
+        """Get number of batches per epoch."""
+        if self.drop_last:
+            return sum(size // self.batch_size for size in self.store.shard_sizes)
+        return sum((size + self.batch_size - 1) // self.batch_size for size in self.store.shard_sizes)
+
+
+def _write_shard(rows, root, index, fields):
+    name = 'shard_{:05d}'.format(index)
+    shard_dir = os.path.join(root, name)
+    os.makedirs(shard_dir, exist_ok=True)
+    for i, field in enumerate(fields):
+        values = [np.asarray(row[i]) for row in rows]
+        if len(set(value.shape for value in values)) > 1:
+            raise ValueError("Clips of shard {} differ in the shape of their {}".format(index, field))
+        array = np.stack(values)
+        np.save(os.path.join(shard_dir, field + '.npy'), array)
+    return {'name': name, 'size': len(rows)}
+
+
+def _write_index(root, shards, fields):
+    # the index is written last, so a store without one is incomplete
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, INDEX_NAME), 'w') as f:
+        json.dump({'fields': list(fields), 'shards': shards}, f, indent=2)
+    return ClipStore(root)
@@ -1,19 +1,55 @@
 """Implements dataloaders for generic MIMIC tasks."""
-from tqdm import tqdm
+from datasets.array_dataset import ArrayDataset, InMemoryBatchLoader, batch_dataloader
+from robustness.robust_suite import RobustTestSuite
 from robustness.tabular_robust import add_tabular_noise
-from robustness.timeseries_robust import add_timeseries_noise
+from robustness.timeseries_robust import TimeseriesSampleNoise
 import sys
 import os
 import numpy as np
-from torch.utils.data import DataLoader
+import torch
+from torch.utils.data import DataLoader, Dataset
 import random
 import pickle
-import copy
 sys.path.append(os.path.dirname(os.path.dirname(os.getcwd())))
 
 
+class MIMICDataset(Dataset):
+    """Implements a torch Dataset class for MIMIC static and timeseries data."""
 
-def get_dataloader(task, batch_size=40, num_workers=1, train_shuffle=True, imputed_path='im.pk', flatten_time_series=False, tabular_robust=True, timeseries_robust=True):
+    def __init__(self, X_s, X_t, y, timeseries_noise=None):
+        """Initialize MIMICDataset object.
+
+        Args:
+            X_s (np.ndarray): Static features, one row per sample.
+            X_t (np.ndarray): Timeseries features, one entry per sample.
+            y (np.ndarray): Labels.
+            timeseries_noise (callable, optional): Callable taking (sample, index) that corrupts the timeseries of a sample on access. Defaults to None.
+        """
+        self.X_s = X_s
+        self.X_t = X_t
+        self.y = y
+        self.timeseries_noise = timeseries_noise
+
+    def __getitem__(self, ind):
+        """Get item from dataset.
+
+        Args:
+            ind (int): Index of data to get
+
+        Returns:
+            tuple: Tuple of static input, timeseries input, and label
+        """
+        x_t = self.X_t[ind]
+        if self.timeseries_noise is not None:
+            x_t = self.timeseries_noise(x_t, ind)
+        return self.X_s[ind], x_t, self.y[ind]
+
+    def __len__(self):
+        """Get length of dataset."""
+        return len(self.y)
+
+
+def get_dataloader(task, batch_size=40, num_workers=1, train_shuffle=True, imputed_path='im.pk', flatten_time_series=False, tabular_robust=True, timeseries_robust=True, batched=False, in_memory=False):
     """Get dataloaders for MIMIC dataset.
 
     Args:
@@ -25,6 +61,8 @@ def get_dataloader(task, batch_size=40, num_workers=1, train_shuffle=True, imput
         flatten_time_series (bool, optional): Whether to flatten time series data or not. Defaults to False.
         tabular_robust (bool, optional): Whether to apply tabular robustness as dataset augmentation or not. Defaults to True.
         timeseries_robust (bool, optional): Whether to apply timeseries robustness noises as dataset augmentation or not. Defaults to True.
+        batched (bool, optional): Whether to slice whole training and validation batches at once instead of collating single samples. Defaults to False.
+        in_memory (bool, optional): Whether to hold the training and validation data as tensors on the training device and slice batches from them directly. Defaults to False.
 
     Returns:
         tuple: Tuple of training dataloader, validation dataloader, and test dataloader
@@ -45,10 +83,8 @@ def get_dataloader(task, batch_size=40, num_workers=1, train_shuffle=True, imput
     X_t_avg = np.average(X_t, axis=(0, 1))
     X_t_std = np.std(X_t, axis=(0, 1))
 
-    for i in range(len(X_s)):
-        X_s[i] = (X_s[i]-X_s_avg)/X_s_std
-        for j in range(len(X_t[0])):
-            X_t[i][j] = (X_t[i][j]-X_t_avg)/X_t_std
+    X_s[:] = (X_s-X_s_avg)/X_s_std
+    X_t[:] = (X_t-X_t_avg)/X_t_std
 
     static_dim = len(X_s[0])
     timestep = len(X_t[0])
@@ -56,58 +92,46 @@ def get_dataloader(task, batch_size=40, num_workers=1, train_shuffle=True, imput
     if flatten_time_series:
         X_t = X_t.reshape(len(X_t), timestep*series_dim)
     if task < 0:
-        y = datafile['adm_labels_all'][:, 1]
         admlbl = datafile['adm_labels_all']
+        # label is the first of columns 1-5 that is positive, 0 if none is
+        positive = admlbl[:, 1:6] > 0
+        y = np.where(positive.any(1), positive.argmax(1) + 1, 0).astype(admlbl.dtype)
         le = len(y)
-        for i in range(0, le):
-            if admlbl[i][1] > 0:
-                y[i] = 1
-            elif admlbl[i][2] > 0:
-                y[i] = 2
-            elif admlbl[i][3] > 0:
-                y[i] = 3
-            elif admlbl[i][4] > 0:
-                y[i] = 4
-            elif admlbl[i][5] > 0:
-                y[i] = 5
-            else:
-                y[i] = 0
     else:
         y = datafile['y_icd9'][:, task]
         le = len(y)
-    datasets = [(X_s[i], X_t[i], y[i]) for i in range(le)]
 
     random.seed(10)
 
-    random.shuffle(datasets)
-
-    valids = DataLoader(datasets[0:le//10], shuffle=False,
-                        num_workers=num_workers, batch_size=batch_size)
-    trains = DataLoader(datasets[le//5:], shuffle=train_shuffle,
-                        num_workers=num_workers, batch_size=batch_size)
-
-    tests = dict()
-    tests['timeseries'] = []
-    for noise_level in tqdm(range(11)):
-        dataset_robust = copy.deepcopy(datasets[le//10:le//5])
-        if tabular_robust:
-            X_s_robust = add_tabular_noise([dataset_robust[i][0] for i in range(
-                len(dataset_robust))], noise_level=noise_level/10)
-        else:
-            X_s_robust = [dataset_robust[i][0]
-                          for i in range(len(dataset_robust))]
-        if timeseries_robust:
-            X_t_robust = add_timeseries_noise([[dataset_robust[i][1] for i in range(
-                len(dataset_robust))]], noise_level=noise_level/10)[0]
-        else:
-            X_t_robust = [dataset_robust[i][1]
-                          for i in range(len(dataset_robust))]
-        y_robust = [dataset_robust[i][2] for i in range(len(dataset_robust))]
-        if flatten_time_series:
-            tests['timeseries'].append(DataLoader([(X_s_robust[i], X_t_robust[i].reshape(timestep*series_dim), y_robust[i])
-                                       for i in range(len(y_robust))], shuffle=False, num_workers=num_workers, batch_size=batch_size))
-        else:
-            tests['timeseries'].append(DataLoader([(X_s_robust[i], X_t_robust[i], y_robust[i]) for i in range(
-                len(y_robust))], shuffle=False, num_workers=num_workers, batch_size=batch_size))
+    # shuffle indices rather than tuples; this yields the same permutation
+    order = list(range(le))
+    random.shuffle(order)
+
+    def _loader(inds, shuffle):
+        dataset = ArrayDataset([X_s, X_t, y], np.array(inds, dtype=np.int64))
+        if in_memory:
+            return InMemoryBatchLoader.from_dataset(dataset, batch_size, shuffle=shuffle, device=torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
+        if batched:
+            return batch_dataloader(dataset, batch_size, shuffle=shuffle, num_workers=num_workers)
+        return DataLoader(dataset, shuffle=shuffle, num_workers=num_workers, batch_size=batch_size)
+
+    valids = _loader(order[0:le//10], False)
+    trains = _loader(order[le//5:], train_shuffle)
+
+    test_inds = order[le//10:le//5]
+    X_s_test = X_s[test_inds]
+    X_t_test = X_t[test_inds]
+    y_test = y[test_inds]
+
+    def _robust_test(noise_level):
+        X_s_robust = add_tabular_noise(
+            X_s_test.copy(), noise_level=noise_level) if tabular_robust else X_s_test
+        X_t_noise = TimeseriesSampleNoise(
+            len(y_test), noise_level=noise_level) if timeseries_robust else None
+        return DataLoader(MIMICDataset(X_s_robust, X_t_test, y_test, X_t_noise),
+                          shuffle=False, num_workers=num_workers, batch_size=batch_size)
+
+    tests = RobustTestSuite()
+    tests.add('timeseries', _robust_test, [noise_level/10 for noise_level in range(11)])
 
     return trains, valids, tests
@@ -1,12 +1,12 @@
 """Implements dataset for MultiModal Manipulation Task."""
 
-import h5py
 import numpy as np
 from tqdm import tqdm
 
 from torch.utils.data import Dataset
 from robustness.visual_robust import add_visual_noise
 from robustness.timeseries_robust import add_timeseries_noise
+from .episode_store import EpisodeReader
 
 
 class MultimodalManipulationDataset(Dataset):
@@ -21,7 +21,8 @@ class MultimodalManipulationDataset(Dataset):
         n_time_steps=1,
         action_dim=4,
         pairing_tolerance=0.06,
-        filedirprefix=""
+        filedirprefix="",
+        reader=None
     ):
         """Initialize dataset.
 
@@ -34,6 +35,7 @@ class MultimodalManipulationDataset(Dataset):
             action_dim (int, optional): Action dimension. Defaults to 4.
             pairing_tolerance (float, optional): Pairing tolerance. Defaults to 0.06.
             filedirprefix (str, optional): File directory prefix (unused). Defaults to "".
+            reader (EpisodeReader, optional): Reader of the episode files, such as a PackedEpisodes. Defaults to an EpisodeReader with default settings.
         """
         #self.dataset_path = [(filedirprefix + ff) for ff in filename_list]
         self.dataset_path = filename_list
@@ -44,6 +46,7 @@ class MultimodalManipulationDataset(Dataset):
         self.dataset = {}
         self.action_dim = action_dim
         self.pairing_tolerance = pairing_tolerance
+        self.reader = reader if reader is not None else EpisodeReader()
 
         self._config_checks()
         self._init_paired_filenames()
@@ -52,6 +55,11 @@ class MultimodalManipulationDataset(Dataset):
         """Get number of items in dataset."""
         return len(self.dataset_path) * (self.episode_length - self.n_time_steps)
 
+    @property
+    def episodes(self):
+        """Get the index in the filename list of the episode of every item, for EpisodeWindowSampler."""
+        return np.arange(len(self)) // (self.episode_length - self.n_time_steps)
+
     def __getitem__(self, idx):
         """Get item in dataset at index idx."""
         list_index = idx // (self.episode_length - self.n_time_steps)
@@ -81,16 +89,15 @@ class MultimodalManipulationDataset(Dataset):
         self, dataset_name, list_index, unpaired_filename, dataset_index, unpaired_idx
     ):
 
-        dataset = h5py.File(dataset_name, "r", swmr=True, libver="latest")
-        unpaired_dataset = h5py.File(
-            unpaired_filename, "r", swmr=True, libver="latest")
+        def dataset(key, index):
+            return self.reader.read(dataset_name, key, index)
 
         if self.training_type == "selfsupervised":
 
-            image = dataset["image"][dataset_index]
-            depth = dataset["depth_data"][dataset_index]
-            proprio = dataset["proprio"][dataset_index][:8]
-            force = dataset["ee_forces_continuous"][dataset_index]
+            image = dataset("image", dataset_index)
+            depth = dataset("depth_data", dataset_index)
+            proprio = dataset("proprio", dataset_index)[:8]
+            force = dataset("ee_forces_continuous", dataset_index)
 
             if image.shape[0] == 3:
                 image = np.transpose(image, (2, 1, 0))
@@ -98,7 +105,7 @@ class MultimodalManipulationDataset(Dataset):
             if depth.ndim == 2:
                 depth = depth.reshape((128, 128, 1))
 
-            flow = np.array(dataset["optical_flow"][dataset_index])
+            flow = dataset("optical_flow", dataset_index)
             flow_mask = np.expand_dims(
                 np.where(
                     flow.sum(axis=2) == 0,
@@ -110,30 +117,28 @@ class MultimodalManipulationDataset(Dataset):
 
             unpaired_image = image
             unpaired_depth = depth
-            unpaired_proprio = unpaired_dataset["proprio"][unpaired_idx][:8]
-            unpaired_force = unpaired_dataset["ee_forces_continuous"][unpaired_idx]
+            unpaired_proprio = self.reader.read(unpaired_filename, "proprio", unpaired_idx)[:8]
+            unpaired_force = self.reader.read(
+                unpaired_filename, "ee_forces_continuous", unpaired_idx)
 
             sample = {
                 "image": image,
                 "depth": depth,
                 "flow": flow,
                 "flow_mask": flow_mask,
-                "action": dataset["action"][dataset_index + 1],
+                "action": dataset("action", dataset_index + 1),
                 "force": force,
                 "proprio": proprio,
-                "ee_yaw_next": dataset["proprio"][dataset_index + 1][:self.action_dim],
+                "ee_yaw_next": dataset("proprio", dataset_index + 1)[:self.action_dim],
                 "contact_next": np.array(
-                    [dataset["contact"][dataset_index + 1].sum() > 0]
-                ).astype(np.float),
+                    [dataset("contact", dataset_index + 1).sum() > 0]
+                ).astype(np.float64),
                 "unpaired_image": unpaired_image,
                 "unpaired_force": unpaired_force,
                 "unpaired_proprio": unpaired_proprio,
                 "unpaired_depth": unpaired_depth,
             }
 
-        dataset.close()
-        unpaired_dataset.close()
-
         if self.transform:
             sample = self.transform(sample)
 
@@ -148,13 +153,15 @@ class MultimodalManipulationDataset(Dataset):
 
         all_combos = set()
 
+        # end effector positions of every episode, read once instead of once per candidate pair
+        positions = {filename: self.reader.episode(filename, "proprio")[:, :3]
+                     for filename in tqdm(set(self.dataset_path), desc="reading_proprio")}
+
         self.paired_filenames = {}
         for list_index in tqdm(range(len(self.dataset_path)), desc="pairing_files"):
             filename = self.dataset_path[list_index]
             file_number, _ = self._parse_filename(filename[:-8])
 
-            dataset = h5py.File(filename, "r", swmr=True, libver="latest")
-
             for idx in range(self.episode_length - self.n_time_steps):
 
                 proprio_dist = None
@@ -170,16 +177,13 @@ class MultimodalManipulationDataset(Dataset):
                         unpaired_filename, unpaired_idx, _ = self._idx_to_filename_idx(
                             unpaired_dataset_idx)
 
-                    with h5py.File(unpaired_filename, "r", swmr=True, libver="latest") as unpaired_dataset:
-                        proprio_dist = np.linalg.norm(
-                            dataset['proprio'][idx][:3] - unpaired_dataset['proprio'][unpaired_idx][:3])
+                    proprio_dist = np.linalg.norm(
+                        positions[filename][idx] - positions[unpaired_filename][unpaired_idx])
 
                 self.paired_filenames[(list_index, idx)] = (
                     unpaired_filename, unpaired_idx)
                 all_combos.add((unpaired_filename, unpaired_idx))
 
-            dataset.close()
-
     def _idx_to_filename_idx(self, idx):
         """
         Utility function for finding info about a dataset index
@@ -231,13 +235,15 @@ class MultimodalManipulationDataset_robust(Dataset):
         noise_level=0,
         image_noise=False,
         force_noise=False,
-        prop_noise=False
+        prop_noise=False,
+        reader=None
     ):
         """
         Args:
             hdf5_file (handle): h5py handle of the hdf5 file with annotations.
             transform (callable, optional): Optional transform to be applied
                 on a sample.
+            reader (EpisodeReader, optional): Reader of the episode files, such as a PackedEpisodes. Defaults to an EpisodeReader with default settings.
         """
         #self.dataset_path = [(filedirprefix + ff) for ff in filename_list]
         self.dataset_path = filename_list
@@ -248,6 +254,7 @@ class MultimodalManipulationDataset_robust(Dataset):
         self.dataset = {}
         self.action_dim = action_dim
         self.pairing_tolerance = pairing_tolerance
+        self.reader = reader if reader is not None else EpisodeReader()
         self.noise_level = noise_level
         self.image_noise = image_noise
         self.force_noise = force_noise
@@ -260,6 +267,11 @@ class MultimodalManipulationDataset_robust(Dataset):
         """Get number of items in dataset."""
         return len(self.dataset_path) * (self.episode_length - self.n_time_steps)
 
+    @property
+    def episodes(self):
+        """Get the index in the filename list of the episode of every item, for EpisodeWindowSampler."""
+        return np.arange(len(self)) // (self.episode_length - self.n_time_steps)
+
     def __getitem__(self, idx):
         """Get item in dataset at index idx."""
         
@@ -290,22 +302,21 @@ class MultimodalManipulationDataset_robust(Dataset):
         self, dataset_name, list_index, unpaired_filename, dataset_index, unpaired_idx
     ):
 
-        dataset = h5py.File(dataset_name, "r", swmr=True, libver="latest")
-        unpaired_dataset = h5py.File(
-            unpaired_filename, "r", swmr=True, libver="latest")
+        def dataset(key, index):
+            return self.reader.read(dataset_name, key, index)
 
         if self.training_type == "selfsupervised":
 
-            image = dataset["image"][dataset_index]
+            image = dataset("image", dataset_index)
             if self.image_noise:
                 image = add_visual_noise(
                     [image], noise_level=self.noise_level)[0]
-            depth = dataset["depth_data"][dataset_index]
-            proprio = dataset["proprio"][dataset_index][:8]
+            depth = dataset("depth_data", dataset_index)
+            proprio = dataset("proprio", dataset_index)[:8]
             if self.prop_noise:
                 proprio = add_timeseries_noise(
                     [proprio], noise_level=self.noise_level)[0]
-            force = dataset["ee_forces_continuous"][dataset_index]
+            force = dataset("ee_forces_continuous", dataset_index)
             if self.force_noise:
                 force = add_timeseries_noise(
                     [force], noise_level=self.noise_level)[0]
@@ -316,7 +327,7 @@ class MultimodalManipulationDataset_robust(Dataset):
             if depth.ndim == 2:
                 depth = depth.reshape((128, 128, 1))
 
-            flow = np.array(dataset["optical_flow"][dataset_index])
+            flow = dataset("optical_flow", dataset_index)
             flow_mask = np.expand_dims(
                 np.where(
                     flow.sum(axis=2) == 0,
@@ -328,30 +339,28 @@ class MultimodalManipulationDataset_robust(Dataset):
 
             unpaired_image = image
             unpaired_depth = depth
-            unpaired_proprio = unpaired_dataset["proprio"][unpaired_idx][:8]
-            unpaired_force = unpaired_dataset["ee_forces_continuous"][unpaired_idx]
+            unpaired_proprio = self.reader.read(unpaired_filename, "proprio", unpaired_idx)[:8]
+            unpaired_force = self.reader.read(
+                unpaired_filename, "ee_forces_continuous", unpaired_idx)
 
             sample = {
                 "image": image,
                 "depth": depth,
                 "flow": flow,
                 "flow_mask": flow_mask,
-                "action": dataset["action"][dataset_index + 1],
+                "action": dataset("action", dataset_index + 1),
                 "force": force,
                 "proprio": proprio,
-                "ee_yaw_next": dataset["proprio"][dataset_index + 1][:self.action_dim],
+                "ee_yaw_next": dataset("proprio", dataset_index + 1)[:self.action_dim],
                 "contact_next": np.array(
-                    [dataset["contact"][dataset_index + 1].sum() > 0]
-                ).astype(np.float),
+                    [dataset("contact", dataset_index + 1).sum() > 0]
+                ).astype(np.float64),
                 "unpaired_image": unpaired_image,
                 "unpaired_force": unpaired_force,
                 "unpaired_proprio": unpaired_proprio,
                 "unpaired_depth": unpaired_depth,
             }
 
-        dataset.close()
-        unpaired_dataset.close()
-
         if self.transform:
             sample = self.transform(sample)
 
@@ -366,13 +375,15 @@ class MultimodalManipulationDataset_robust(Dataset):
 
         all_combos = set()
 
+        # end effector positions of every episode, read once instead of once per candidate pair
+        positions = {filename: self.reader.episode(filename, "proprio")[:, :3]
+                     for filename in tqdm(set(self.dataset_path), desc="reading_proprio")}
+
         self.paired_filenames = {}
         for list_index in tqdm(range(len(self.dataset_path)), desc="pairing_files"):
             filename = self.dataset_path[list_index]
             file_number, _ = self._parse_filename(filename[:-8])
 
-            dataset = h5py.File(filename, "r", swmr=True, libver="latest")
-
             for idx in range(self.episode_length - self.n_time_steps):
 
                 proprio_dist = None
@@ -388,16 +399,13 @@ class MultimodalManipulationDataset_robust(Dataset):
                         unpaired_filename, unpaired_idx, _ = self._idx_to_filename_idx(
                             unpaired_dataset_idx)
 
-                    with h5py.File(unpaired_filename, "r", swmr=True, libver="latest") as unpaired_dataset:
-                        proprio_dist = np.linalg.norm(
-                            dataset['proprio'][idx][:3] - unpaired_dataset['proprio'][unpaired_idx][:3])
+                    proprio_dist = np.linalg.norm(
+                        positions[filename][idx] - positions[unpaired_filename][unpaired_idx])
 
                 self.paired_filenames[(list_index, idx)] = (
                     unpaired_filename, unpaired_idx)
                 all_combos.add((unpaired_filename, unpaired_idx))
 
-            dataset.close()
-
     def _idx_to_filename_idx(self, idx):
         """
         Utility function for finding info about a dataset index
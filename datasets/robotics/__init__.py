@@ -3,3 +3,4 @@ from .MultimodalManipulationDataset import MultimodalManipulationDataset
 from .MultimodalManipulationDataset import MultimodalManipulationDataset_robust
 from .ProcessForce import ProcessForce
 from .ToTensor import ToTensor
+from .episode_store import EpisodeReader, PackedEpisodes, pack_episodes
@@ -0,0 +1,188 @@
+"""Implements pooled, window-cached access to the episode files of the robotics dataset.
+
+Every episode of the MultimodalManipulation dataset is an HDF5 file holding one dataset per modality, indexed by timestep. `EpisodeReader` keeps a bounded LRU of open files instead of opening and closing two of them per sample, and reads a contiguous window of timesteps (by default one HDF5 chunk) at a time into a byte-bounded LRU, so neighbouring samples of an episode are served from memory. Open files are never pickled or shared across processes: every DataLoader worker reopens its own.
+
+`pack_episodes` converts episode files into one memory-mapped .npy array per modality, which `PackedEpisodes` reads through the same interface without any HDF5 metadata access at all.
+"""
+import json
+import os
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+from tqdm import tqdm
+
+PACKED_INDEX_NAME = 'episodes.json'
+
+
+class EpisodeReader:
+    """Reads timesteps of episode files through a per-process pool of open files and a cache of timestep windows."""
+
+    def __init__(self, max_open_files=32, cache_bytes=2**28, window=None):
+        """Initialize EpisodeReader object.
+
+        Args:
+            max_open_files (int, optional): Maximum number of files kept open per process. Defaults to 32.
+            cache_bytes (int, optional): Maximum number of bytes of timestep windows kept in memory per process. Defaults to 2**28.
+            window (int, optional): Number of timesteps to read at once. Defaults to None, which reads one HDF5 chunk of a chunked dataset and a single timestep of a contiguous one.
+        """
+        self.max_open_files = max_open_files
+        self.cache_bytes = cache_bytes
+        self.window = window
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._files = OrderedDict()
+        self._windows = OrderedDict()
+        self._cached_bytes = 0
+
+    def __getstate__(self):
+        """Get the state to pickle, leaving out open files and cached windows."""
+        return {'max_open_files': self.max_open_files, 'cache_bytes': self.cache_bytes, 'window': self.window}
+
+    def __setstate__(self, state):
+        """Restore a pickled reader, which starts without open files."""
+        self.__dict__.update(state)
+        self._reset()
+
+    def close(self):
+        """Close all open files and drop all cached windows."""
+        if self._pid == os.getpid():
+            for f in self._files.values():
+                f.close()
+        self._reset()
+
+    def file(self, filename):
+        """Get an open handle of an episode file, opening it if it is not in the pool yet."""
+        if self._pid != os.getpid():
+            # handles inherited from the parent through fork must not be used by this process
+            self._reset()
+        f = self._files.get(filename)
+        if f is not None:
+            self._files.move_to_end(filename)
+            return f
+        while len(self._files) >= self.max_open_files:
+            self._files.popitem(last=False)[1].close()
+        f = self._files[filename] = h5py.File(filename, "r", swmr=True, libver="latest")
+        return f
+
+    def read(self, filename, key, index):
+        """Read one timestep of a dataset in an episode file.
+
+        Args:
+            filename (str): Episode file.
+            key (str): Dataset in the file, such as "proprio".
+            index (int): Timestep.
+
+        Returns:
+            np.ndarray: The timestep, which can be modified without affecting the cache.
+        """
+        dataset = self.file(filename)[key]
+        window = self.window or (dataset.chunks[0] if dataset.chunks else 1)
+        start = index - index % window
+        cache_key = (filename, key, start)
+        rows = self._windows.get(cache_key)
+        if rows is None:
+            rows = dataset[start:start + window]
+            self._windows[cache_key] = rows
+            self._cached_bytes += rows.nbytes
+            while self._cached_bytes > self.cache_bytes and len(self._windows) > 1:
+                self._cached_bytes -= self._windows.popitem(last=False)[1].nbytes
+        else:
+            self._windows.move_to_end(cache_key)
+        return rows[index - start].copy()
+
+    def episode(self, filename, key):
+        """Read a whole dataset of an episode file, bypassing the window cache.
+
+        Args:
+            filename (str): Episode file.
+            key (str): Dataset in the file, such as "proprio".
+
+        Returns:
+            np.ndarray: All timesteps of the dataset.
+        """
+        return self.file(filename)[key][()]
+
+
+class PackedEpisodes:
+    """Reads timesteps of episodes packed by pack_episodes, through the same interface as EpisodeReader."""
+
+    def __init__(self, packed_dir):
+        """Initialize PackedEpisodes object.
+
+        Args:
+            packed_dir (str): Directory written by pack_episodes.
+        """
+        self.packed_dir = packed_dir
+        with open(os.path.join(packed_dir, PACKED_INDEX_NAME)) as f:
+            index = json.load(f)
+        self.offsets = index['offsets']
+        self.keys = index['keys']
+        self._arrays = None
+
+    def __getstate__(self):
+        """Get the state to pickle, leaving out the memory maps."""
+        return dict(self.__dict__, _arrays=None)
+
+    def arrays(self):
+        """Get the memory-mapped array of every packed dataset, opening them on first use."""
+        if self._arrays is None:
+            self._arrays = {key: np.load(os.path.join(self.packed_dir, key + '.npy'), mmap_mode='r') for key in self.keys}
+        return self._arrays
+
+    def read(self, filename, key, index):
+        """Read one timestep of a dataset in an episode, as in EpisodeReader.read."""
+        start, stop = self.offsets[filename]
+        if not 0 <= index < stop - start:
+            raise IndexError("Timestep {} out of range for {} with {} timesteps".format(index, filename, stop - start))
+        return np.array(self.arrays()[key][start + index])
+
+    def episode(self, filename, key):
+        """Read a whole dataset of an episode, as in EpisodeReader.episode."""
+        start, stop = self.offsets[filename]
+        return np.array(self.arrays()[key][start:stop])
+
+    def close(self):
+        """Drop the memory maps."""
+        self._arrays = None
+
+
+def pack_episodes(filename_list, packed_dir, keys=("image", "depth_data", "proprio", "ee_forces_continuous", "optical_flow", "action", "contact")):
+    """Pack episode files into one memory-mapped array per dataset, to be read with PackedEpisodes.
+
+    Episodes are concatenated along the timestep axis, and an index maps every file name, as given in filename_list, to its range of timesteps.
+
+    Args:
+        filename_list (list): Episode files to pack. Duplicates are packed once.
+        packed_dir (str): Directory to write to.
+        keys (tuple, optional): Datasets to pack. Defaults to all the datasets read by MultimodalManipulationDataset.
+
+    Returns:
+        PackedEpisodes: Reader of the packed episodes.
+    """
+    filenames = list(OrderedDict.fromkeys(filename_list))
+    lengths, shapes = [], dict()
+    for filename in filenames:
+        with h5py.File(filename, "r") as f:
+            lengths.append(len(f[keys[0]]))
+            for key in keys:
+                if len(f[key]) != lengths[-1]:
+                    raise ValueError("Datasets of {} differ in length".format(filename))
+                shapes.setdefault(key, (f[key].shape[1:], f[key].dtype))
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).tolist()
+    os.makedirs(packed_dir, exist_ok=True)
+    for key in keys:
+        shape, dtype = shapes[key]
+        out = np.lib.format.open_memmap(os.path.join(packed_dir, key + '.npy'), mode='w+', dtype=dtype,
+                                        shape=(offsets[-1],) + shape)
+        for i, filename in enumerate(tqdm(filenames, desc="packing " + key)):
+            with h5py.File(filename, "r") as f:
+                f[key].read_direct(out, dest_sel=np.s_[offsets[i]:offsets[i + 1]])
+        out.flush()
+        del out
+    with open(os.path.join(packed_dir, PACKED_INDEX_NAME), 'w') as f:
+        json.dump({'keys': list(keys),
+                   'offsets': {filename: offsets[i:i + 2] for i, filename in enumerate(filenames)}}, f)
+    return PackedEpisodes(packed_dir)
@@ -12,7 +12,7 @@ from .utils import augment_val
 from datasets.robotics import ProcessForce, ToTensor
 from datasets.robotics import MultimodalManipulationDataset, MultimodalManipulationDataset_robust
 from torch.utils.data import DataLoader
-from torch.utils.data.sampler import SubsetRandomSampler
+from datasets.array_dataset import EpisodeWindowSampler
 from torchvision import transforms
 
 
@@ -90,11 +90,13 @@ def get_data(device, configs, filedirprefix="", unimodal=None, output='contact_n
     samplers = {}
     datasets = {}
 
-    samplers["val"] = SubsetRandomSampler(
-        range(len(val_filename_list1) * (configs['ep_length'] - 1))
+    # shuffle episodes, then timesteps within a few episodes at a time, so
+    # that batches read neighbouring timesteps of a few files
+    samplers["val"] = EpisodeWindowSampler(
+        np.arange(len(val_filename_list1) * (configs['ep_length'] - 1)) // (configs['ep_length'] - 1)
     )
-    samplers["train"] = SubsetRandomSampler(
-        range(len(filename_list1) * (configs['ep_length'] - 1))
+    samplers["train"] = EpisodeWindowSampler(
+        np.arange(len(filename_list1) * (configs['ep_length'] - 1)) // (configs['ep_length'] - 1)
     )
 
     print("Sampler finished")
@@ -3,17 +3,29 @@
 from robustness.timeseries_robust import add_timeseries_noise
 import copy
 import datetime
-from posixpath import split
-import io
 import numpy as np
 import pandas as pd
-import requests
 import torch
 from torch.utils.data import DataLoader
 from torch import nn
+from datasets.array_dataset import batch_dataloader
+from .price_store import PriceStore
 
 
-def get_dataloader(stocks, input_stocks, output_stocks, batch_size=16, train_shuffle=True, start_date=datetime.datetime(2000, 6, 1), end_date=datetime.datetime(2021, 2, 28), window_size=500, val_split=3200, test_split=3700, modality_first=True, cuda=True):
+def sliding_windows(series, window_size):
+    """Get every window of a series but the last one, as overlapping views of the series.
+
+    Args:
+        series (torch.Tensor): [T, ...] series.
+        window_size (int): Number of timesteps per window.
+
+    Returns:
+        torch.Tensor: [T - window_size, window_size, ...] windows, where window i is series[i:i + window_size].
+    """
+    return series.unfold(0, window_size, 1)[:len(series) - window_size].movedim(-1, 1)
+
+
+def get_dataloader(stocks, input_stocks, output_stocks, batch_size=16, train_shuffle=True, start_date=datetime.datetime(2000, 6, 1), end_date=datetime.datetime(2021, 2, 28), window_size=500, val_split=3200, test_split=3700, modality_first=True, cuda=True, cache_dir=None, offline=False):
     """Generate dataloader for stock data.
 
     Args:
@@ -29,21 +41,18 @@ def get_dataloader(stocks, input_stocks, output_stocks, batch_size=16, train_shu
         test_split (int, optional): Number of samples in test split. Defaults to 3700.
         modality_first (bool, optional): Whether to make modality the first index or not. Defaults to True.
         cuda (bool, optional): Whether to load data to cuda objects or not. Defaults to True.
+        cache_dir (str, optional): Directory prices are stored in, so that only dates not downloaded before are fetched. Defaults to None, which uses price_store.default_root().
+        offline (bool, optional): Whether to only use stored prices instead of downloading missing ones. Defaults to False.
 
     Returns:
         tuple: Tuple of training data-loader, test data-loader, and validation data-loader.
     """
     stocks = np.array(stocks)
-
-    def _fetch_finance_data(symbol, start, end):
-        url = f'https://query1.finance.yahoo.com/v7/finance/download/{symbol}?period1={start.strftime("%s")}&period2={end.strftime("%s")}&interval=1d&events=history&includeAdjustedClose=true'
-        user_agent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        text = requests.get(url, headers={'User-Agent': user_agent}).text
-        return pd.read_csv(io.StringIO(text), encoding='utf8', parse_dates=True, index_col=0)
+    store = PriceStore(cache_dir, offline=offline)
 
     data = []
     for stock in stocks:
-        fetch = _fetch_finance_data(stock, start_date, end_date)
+        fetch = store.get(stock, start_date, end_date)
         print(stock + ' length: ' + str(len(fetch)))
         fetch.insert(0, 'Symbol', stock)
         data.append(fetch)
@@ -64,14 +73,13 @@ def get_dataloader(stocks, input_stocks, output_stocks, batch_size=16, train_shu
     RX = RX / torch.std(RX[:window_size + val_split])
     Y = Y / torch.std(Y[:val_split])
 
-    X = [RX[i:i + window_size, input_stocks].reshape(
-        1, window_size, -1) for i in range(len(RX) - window_size)]
-    X = torch.cat(X)
-
+    RX = RX[:, input_stocks]
     if cuda:
-        X = X.to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
+        RX = RX.to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
         Y = Y.to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
 
+    X = sliding_windows(RX, window_size)
+
     class _MyDataset(torch.utils.data.Dataset):
         """"""
         def __init__(self, X, Y, modality_first):
@@ -84,11 +92,11 @@ def get_dataloader(stocks, input_stocks, output_stocks, batch_size=16, train_shu
             return len(self.X)
 
         def __getitem__(self, index):
-            """Get item from dataset."""
-            # Data augmentation
+            """Get item from dataset, or a whole batch if index is a list of indices."""
+            # Data augmentation, quantizing every window to 25 levels between its extremes
             def _quantize(x, y):
-                hi = torch.max(x)
-                lo = torch.min(x)
+                hi = torch.amax(x, dim=(-2, -1), keepdim=True)
+                lo = torch.amin(x, dim=(-2, -1), keepdim=True)
                 x = (x - lo) * 25 / (hi - lo)
                 x = torch.round(x)
                 x = x * (hi - lo) / 25 + lo
@@ -96,30 +104,20 @@ def get_dataloader(stocks, input_stocks, output_stocks, batch_size=16, train_shu
 
             x, y = _quantize(self.X[index], self.Y[index])
 
-            if not modality_first:
+            if not self.modality_first:
                 return x, y
             else:
-                if len(x.shape) == 2:
-                    x = x.permute([1, 0])
-                    x = list(x)
-                    x.append(y)
-                    return x
-                else:
-                    x = x.permute([0, 2, 1])
-                    res = []
-                    for data, label in zip(x, y):
-                        data = list(data)
-                        data.append(label)
-                        res.append(data)
-                    return res
+                # one [(batch,) window_size] tensor per input stock
+                x = list(x.movedim(-1, 0))
+                x.append(y)
+                return x
 
     train_ds = _MyDataset(X[:val_split], Y[:val_split], modality_first)
-    train_loader = torch.utils.data.DataLoader(
-        train_ds, shuffle=train_shuffle, batch_size=batch_size)
+    train_loader = batch_dataloader(
+        train_ds, batch_size, shuffle=train_shuffle)
     val_ds = _MyDataset(X[val_split:test_split],
                        Y[val_split:test_split], modality_first)
-    val_loader = torch.utils.data.DataLoader(
-        val_ds, shuffle=False, batch_size=batch_size, drop_last=False)
+    val_loader = batch_dataloader(val_ds, batch_size, shuffle=False)
     test_loader = dict()
     test_loader['timeseries'] = []
     for noise_level in range(9):
@@ -129,8 +127,8 @@ def get_dataloader(stocks, input_stocks, output_stocks, batch_size=16, train_shu
         if cuda:
             X_robust = X_robust.to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
         test_ds = _MyDataset(X_robust, Y[test_split:], modality_first)
-        test_loader['timeseries'].append(torch.utils.data.DataLoader(
-            test_ds, shuffle=False, batch_size=batch_size, drop_last=False))
+        test_loader['timeseries'].append(
+            batch_dataloader(test_ds, batch_size, shuffle=False))
     print(len(test_loader))
     return train_loader, val_loader, test_loader
 
@@ -0,0 +1,129 @@
+"""Implements an on-disk store of daily stock prices, so that the stocks dataset does not download every symbol on every call.
+
+Prices of each symbol are kept as a .npy record array with one row per trading day, next to a .json file recording the (half-open) range of dates that was fetched. A request for dates outside that range only fetches the missing dates before and after it, so the store grows incrementally.
+"""
+import datetime
+import io
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import requests
+
+PRICE_COLUMNS = ('Open', 'High', 'Low', 'Close', 'Adj Close', 'Volume')
+
+
+def default_root():
+    """Get the directory prices are stored in when none is given: $MULTIBENCH_STOCKS, or ~/.cache/multibench/stocks."""
+    return os.environ.get('MULTIBENCH_STOCKS', os.path.join(os.path.expanduser('~'), '.cache', 'multibench', 'stocks'))
+
+
+def fetch_finance_data(symbol, start, end):
+    """Download daily prices of a symbol from Yahoo Finance.
+
+    Args:
+        symbol (str): Stock symbol.
+        start (datetime): First date to download.
+        end (datetime): Date to download up to, exclusive.
+
+    Returns:
+        pd.DataFrame: Prices indexed by date, with PRICE_COLUMNS as columns.
+    """
+    url = f'https://query1.finance.yahoo.com/v7/finance/download/{symbol}?period1={start.strftime("%s")}&period2={end.strftime("%s")}&interval=1d&events=history&includeAdjustedClose=true'
+    user_agent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+    text = requests.get(url, headers={'User-Agent': user_agent}).text
+    return pd.read_csv(io.StringIO(text), encoding='utf8', parse_dates=True, index_col=0)
+
+
+class PriceStore:
+    """Keeps daily prices of stock symbols on disk, fetching only the dates that are not stored yet."""
+
+    def __init__(self, root=None, fetch=fetch_finance_data, offline=False):
+        """Initialize PriceStore object.
+
+        Args:
+            root (str, optional): Directory to store prices in. Defaults to default_root().
+            fetch (callable, optional): Function taking a symbol, a start and an end datetime and returning prices as a DataFrame indexed by date. Defaults to fetch_finance_data.
+            offline (bool, optional): Whether to only use stored prices, without fetching missing dates. Defaults to False.
+        """
+        self.root = root if root is not None else default_root()
+        self.fetch = fetch
+        self.offline = offline
+
+    def _path(self, symbol, extension):
+        return os.path.join(self.root, symbol + extension)
+
+    def load(self, symbol):
+        """Load the stored prices of a symbol.
+
+        Args:
+            symbol (str): Stock symbol.
+
+        Returns:
+            tuple: Record array of prices with a 'Date' field and one field per column, and the (start, end) dates fetched, or (None, None) if nothing is stored.
+        """
+        try:
+            with open(self._path(symbol, '.json')) as f:
+                fetched = json.load(f)
+        except FileNotFoundError:
+            return None, None
+        prices = np.load(self._path(symbol, '.npy'))
+        return prices, (np.datetime64(fetched['start']), np.datetime64(fetched['end']))
+
+    def get(self, symbol, start, end):
+        """Get the daily prices of a symbol, fetching and storing the dates that are not stored yet.
+
+        Args:
+            symbol (str): Stock symbol.
+            start (datetime): First date.
+            end (datetime): Date to get prices up to, exclusive.
+
+        Returns:
+            pd.DataFrame: Prices indexed by date, with PRICE_COLUMNS as columns.
+        """
+        start, end = np.datetime64(start, 'D'), np.datetime64(end, 'D')
+        prices, fetched = self.load(symbol)
+        if fetched is None or start < fetched[0] or end > fetched[1]:
+            if self.offline:
+                raise FileNotFoundError("Prices of {} from {} to {} are not stored in {}".format(symbol, start, end, self.root))
+            prices, fetched = self._update(symbol, prices, fetched, start, end)
+        prices = prices[(prices['Date'] >= start) & (prices['Date'] < end)]
+        return pd.DataFrame({column: prices[column] for column in PRICE_COLUMNS},
+                            index=pd.DatetimeIndex(prices['Date'], name='Date'))
+
+    def _update(self, symbol, prices, fetched, start, end):
+        # fetch the dates before and after the stored range, keeping the stored range contiguous
+        if fetched is None:
+            ranges = [(start, end)]
+            fetched = (start, end)
+        else:
+            ranges = [(a, b) for a, b in [(start, fetched[0]), (fetched[1], end)] if a < b]
+            fetched = (min(start, fetched[0]), max(end, fetched[1]))
+        parts = [] if prices is None else [prices]
+        for a, b in ranges:
+            parts.append(_to_records(self.fetch(symbol, _to_datetime(a), _to_datetime(b))))
+        prices = np.concatenate(parts)
+        _, unique = np.unique(prices['Date'], return_index=True)
+        prices = prices[unique]
+
+        os.makedirs(self.root, exist_ok=True)
+        tmp = '.{}.tmp'.format(os.getpid())
+        np.save(self._path(symbol, tmp + '.npy'), prices)
+        os.replace(self._path(symbol, tmp + '.npy'), self._path(symbol, '.npy'))
+        with open(self._path(symbol, tmp + '.json'), 'w') as f:
+            json.dump({'start': str(fetched[0]), 'end': str(fetched[1])}, f)
+        os.replace(self._path(symbol, tmp + '.json'), self._path(symbol, '.json'))
+        return prices, fetched
+
+
+def _to_records(frame):
+    records = np.empty(len(frame), dtype=[('Date', 'datetime64[D]')] + [(column, 'f8') for column in PRICE_COLUMNS])
+    records['Date'] = pd.to_datetime(frame.index).values.astype('datetime64[D]')
+    for column in PRICE_COLUMNS:
+        records[column] = pd.to_numeric(frame[column], errors='coerce')
+    return records
+
+
+def _to_datetime(date):
+    return datetime.datetime.combine(date.astype(datetime.date), datetime.time())
@@ -1,4 +1,4 @@
-from memory_profiler import memory_usage
+from eval_scripts.profiling import Profiler, active_profiler, phase
 import time
 
 
@@ -10,19 +10,33 @@ def getallparams(li):
     return params
 
 
-def all_in_one_train(trainprocess, trainmodules):
+def all_in_one_train(trainprocess, trainmodules, profiler=None):
+    if profiler is None:
+        profiler = active_profiler() or Profiler()
     starttime = time.time()
-    mem = max(memory_usage(proc=trainprocess))
+    with profiler:
+        trainprocess()
     endtime = time.time()
 
     print("Training Time: "+str(endtime-starttime))
-    print("Training Peak Mem: "+str(mem))
+    peak = profiler.peak_memory()
+    if 'rss_mb' in peak:
+        print("Training Peak Mem: "+str(peak['rss_mb']))
+    else:
+        print("Training Peak Mem (process lifetime max RSS): "+str(peak.get('max_rss_mb')))
     print("Training Params: "+str(getallparams(trainmodules)))
+    for name, seconds in profiler.totals.items():
+        print("Training "+name+" time: "+str(seconds))
+    return profiler
 
 
-def all_in_one_test(testprocess, testmodules):
+def all_in_one_test(testprocess, testmodules, profiler=None):
+    if profiler is None:
+        profiler = active_profiler() or Profiler()
     teststart = time.time()
-    testprocess()
+    with profiler, phase('inference'):
+        testprocess()
     testend = time.time()
     print("Inference Time: "+str(testend-teststart))
     print("Inference Params: "+str(getallparams(testmodules)))
+    return profiler
@@ -0,0 +1,148 @@
+"""Implements metrics that are accumulated and computed on device with vectorized torch ops.
+
+These mirror the sklearn-based metrics in eval_scripts/performance.py, but take tensors and never copy them to the host per sample or per batch.
+"""
+import torch
+
+
+def _align(true, pred):
+    if true.numel() == pred.numel():
+        true = true.reshape(pred.shape)
+    return true.to(pred.device)
+
+
+def accuracy(true, pred):
+    """Get the fraction of samples whose prediction matches the truth.
+
+    Rows of 2D predictions count as correct only if every entry matches, as in sklearn.metrics.accuracy_score.
+
+    Args:
+        true (torch.Tensor): True labels.
+        pred (torch.Tensor): Predicted labels.
+
+    Returns:
+        float: Accuracy.
+    """
+    true = _align(true, pred)
+    correct = (pred == true).reshape(len(pred), -1).all(1)
+    return correct.sum().item() / len(correct)
+
+
+def f1_score(true, pred, average):
+    """Get the F1 score of predictions, as in sklearn.metrics.f1_score.
+
+    Args:
+        true (torch.Tensor): True labels, either 1D class labels or a 2D binary label indicator.
+        pred (torch.Tensor): Predicted labels, in the same format as true.
+        average (str): Either "micro" or "macro".
+
+    Returns:
+        float: F1 score.
+    """
+    true = _align(true, pred)
+    if pred.dim() == 1:
+        classes = torch.unique(torch.cat([true, pred]))
+        true = true[:, None] == classes
+        pred = pred[:, None] == classes
+    true = true.bool()
+    pred = pred.bool()
+    tp = (true & pred).sum(0).double()
+    fp = (~true & pred).sum(0).double()
+    fn = (true & ~pred).sum(0).double()
+    if average == "micro":
+        tp, fp, fn = tp.sum(), fp.sum(), fn.sum()
+    elif average != "macro":
+        raise ValueError("Unsupported average: " + str(average))
+    denominator = 2 * tp + fp + fn
+    f1 = torch.where(denominator > 0, 2 * tp / denominator.clamp(min=1), torch.zeros_like(tp))
+    return f1.mean().item()
+
+
+def average_precision(true, scores):
+    """Get the area under the precision-recall curve, as in sklearn.metrics.average_precision_score.
+
+    Args:
+        true (torch.Tensor): True binary labels, 1 for the positive class.
+        scores (torch.Tensor): Predicted probability of the positive class.
+
+    Returns:
+        float: Average precision.
+    """
+    scores = scores.reshape(-1)
+    true = _align(true, scores)
+    order = torch.argsort(scores, descending=True)
+    scores = scores[order]
+    positives = (true[order] == 1).double()
+    # one threshold per distinct score, at the last sample with that score
+    last = torch.ones_like(scores, dtype=torch.bool)
+    last[:-1] = scores[1:] != scores[:-1]
+    tps = torch.cumsum(positives, 0)[last]
+    seen = torch.nonzero(last).reshape(-1).double() + 1
+    precision = tps / seen
+    recall = tps / tps[-1].clamp(min=1)
+    recall_steps = torch.diff(recall, prepend=recall.new_zeros(1))
+    return (recall_steps * precision).sum().item()
+
+
+class MetricsAccumulator:
+    """Accumulates losses, predictions and scores over an epoch without synchronizing with the device.
+
+    Losses are summed as detached tensors and predictions are kept in per-batch buffers on their device, so the metrics are computed once at the end with vectorized ops.
+    """
+
+    def __init__(self):
+        """Initialize MetricsAccumulator object."""
+        self.total = 0
+        self.loss_sum = 0.0
+        self.true = []
+        self.pred = []
+        self.score_true = []
+        self.scores = []
+
+    def update(self, true, pred=None, scores=None, loss=None):
+        """Add one batch.
+
+        Args:
+            true (torch.Tensor): True labels of the batch.
+            pred (torch.Tensor, optional): Predicted labels of the batch. Defaults to None.
+            scores (torch.Tensor, optional): Predicted probability of the positive class, for AUPRC. Defaults to None.
+            loss (torch.Tensor, optional): Mean loss over the batch. Defaults to None.
+        """
+        count = len(true)
+        self.total += count
+        if loss is not None:
+            self.loss_sum = self.loss_sum + loss.detach() * count
+        if pred is not None:
+            self.true.append(true)
+            self.pred.append(pred.detach())
+        if scores is not None:
+            self.score_true.append(true)
+            self.scores.append(scores.detach())
+
+    def loss(self):
+        """Get the mean loss per sample."""
+        return self.loss_sum / self.total
+
+    def predictions(self):
+        """Get all predictions and true labels, concatenated, on the device of the predictions.
+
+        Returns:
+            tuple: Tuple of (true labels, predicted labels).
+        """
+        pred = torch.cat(self.pred, 0)
+        true = torch.cat([t.to(pred.device) for t in self.true], 0)
+        return true, pred
+
+    def accuracy(self):
+        """Get accuracy over the predictions added so far."""
+        return accuracy(*self.predictions())
+
+    def f1_score(self, average):
+        """Get F1 score over the predictions added so far, averaged as given ("micro" or "macro")."""
+        return f1_score(*self.predictions(), average=average)
+
+    def auprc(self):
+        """Get AUPRC over the scores added so far."""
+        scores = torch.cat(self.scores, 0)
+        true = torch.cat([t.reshape(-1).to(scores.device) for t in self.score_true], 0)
+        return average_precision(true, scores)
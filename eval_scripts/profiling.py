@@ -0,0 +1,212 @@
+"""Implements low-overhead profiling hooks for the training structures.
+
+The training structures mark their phases (data loading, forward, backward, optimizer step, validation) with `phase`, `iterate` and `end_epoch`. These do nothing unless a `Profiler` is active, so they cost a function call per phase when profiling is off.
+"""
+import contextlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import torch
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+_active = None
+# current resident set size is only cheap to read on Linux
+_STATM = '/proc/self/statm' if os.path.exists('/proc/self/statm') else None
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if _STATM is not None else None
+
+
+def _max_rss_mb():
+    if resource is None:  # pragma: no cover
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+
+def _rss_mb():
+    if _STATM is None:
+        return None
+    with open(_STATM, 'rb') as f:
+        return int(f.read().split()[1]) * _PAGE_SIZE / 2**20
+
+
+class Profiler:
+    """Records wall-clock time per phase and peak memory per epoch.
+
+    Peak memory per epoch covers the resident set size sampled at the end of every phase (on Linux, where it is cheap to read), Python allocations (if traced) and CUDA memory. The maximum resident set size of the process over its whole lifetime is reported by peak_memory as well.
+
+    Use as a context manager around training; the hooks in this module record into the innermost active Profiler. Entering a Profiler that is already active is a no-op, so an outer Profiler also collects the runs of `all_in_one_train`.
+    """
+
+    def __init__(self, trace_path=None, trace_python_memory=False, synchronize=None):
+        """Initialize Profiler object.
+
+        Args:
+            trace_path (str, optional): If given, run torch.profiler as well and export a Chrome trace of all operators and phases to this path. Defaults to None.
+            trace_python_memory (bool, optional): Whether to trace Python allocations (including numpy arrays) with tracemalloc to report their peak per epoch. Slows down allocation-heavy code. Defaults to False.
+            synchronize (bool, optional): Whether to synchronize CUDA at phase boundaries, so asynchronous kernels are attributed to the phase that launched them, at the cost of stalling the host at every phase. Defaults to None, which synchronizes only when trace_path is given.
+        """
+        self.trace_path = trace_path
+        self.trace_python_memory = trace_python_memory
+        if synchronize is None:
+            synchronize = trace_path is not None
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self._rss = 0.0
+        self.epochs = []
+        self.totals = dict()
+        self.total_time = 0.0
+        self._current = dict()
+        self._depth = 0
+        self._previous = None
+        self._start = None
+        self._torch_profiler = None
+
+    def __enter__(self):
+        """Start profiling and make this the active Profiler."""
+        global _active
+        self._depth += 1
+        if self._depth > 1:
+            return self
+        self._previous = _active
+        _active = self
+        if self.trace_python_memory:
+            tracemalloc.start()
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        if self.trace_path is not None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self._torch_profiler = torch.profiler.profile(activities=activities)
+            self._torch_profiler.__enter__()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        """Stop profiling, flush the last epoch and export the Chrome trace if requested."""
+        global _active
+        self._depth -= 1
+        if self._depth > 0:
+            return False
+        self.total_time += time.perf_counter() - self._start
+        if self._current or not self.epochs:
+            self.end_epoch()
+        if self._torch_profiler is not None:
+            self._torch_profiler.__exit__(*exc)
+            self._torch_profiler.export_chrome_trace(self.trace_path)
+            self._torch_profiler = None
+        if self.trace_python_memory:
+            tracemalloc.stop()
+        _active = self._previous
+        return False
+
+    def _sync(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time the enclosed block as phase name of the current epoch."""
+        self._sync()
+        start = time.perf_counter()
+        if self._torch_profiler is None:
+            yield
+        else:
+            with torch.autograd.profiler.record_function(name):
+                yield
+        self._sync()
+        self._current[name] = self._current.get(name, 0.0) + time.perf_counter() - start
+        rss = _rss_mb()
+        if rss is not None and rss > self._rss:
+            self._rss = rss
+
+    def iterate(self, iterable, name='data'):
+        """Iterate over iterable, timing the wait for every item as phase name."""
+        with self.phase(name):
+            iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def end_epoch(self):
+        """Close the current epoch, recording its phase times and peak memory."""
+        record = {'epoch': len(self.epochs), 'time': self._current,
+                  'peak_memory': self._peak_memory()}
+        for name, seconds in self._current.items():
+            self.totals[name] = self.totals.get(name, 0.0) + seconds
+        self.epochs.append(record)
+        self._current = dict()
+
+    def _peak_memory(self):
+        peak = dict()
+        rss = _rss_mb()
+        if rss is not None:
+            peak['rss_mb'] = max(self._rss, rss)
+            self._rss = 0.0
+        if tracemalloc.is_tracing():
+            peak['python_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            else:
+                # Python < 3.9 cannot reset the peak alone
+                tracemalloc.stop()
+                tracemalloc.start()
+        if torch.cuda.is_available():
+            peak['cuda_mb'] = torch.cuda.max_memory_allocated() / 2**20
+            torch.cuda.reset_peak_memory_stats()
+        return peak
+
+    def peak_memory(self):
+        """Get the peak memory (in MiB) over all epochs so far, per kind of memory, and the maximum resident set size of the process over its lifetime as max_rss_mb."""
+        rss = _max_rss_mb()
+        peak = dict() if rss is None else {'max_rss_mb': rss}
+        for record in self.epochs:
+            for kind, value in record['peak_memory'].items():
+                if value is not None:
+                    peak[kind] = max(peak.get(kind, 0.0), value)
+        return peak
+
+    def summary(self):
+        """Get all recorded times (in seconds) and peak memory (in MiB) as a dict."""
+        return {'total_time': self.total_time, 'phases': self.totals,
+                'peak_memory': self.peak_memory(), 'epochs': self.epochs}
+
+    def export_json(self, path):
+        """Write the summary to path as JSON."""
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+def active_profiler():
+    """Get the active Profiler, or None."""
+    return _active
+
+
+def phase(name):
+    """Time the enclosed block as phase name if a Profiler is active."""
+    if _active is None:
+        return contextlib.nullcontext()
+    return _active.phase(name)
+
+
+def iterate(iterable, name='data'):
+    """Iterate over iterable, timing the wait for every item as phase name if a Profiler is active."""
+    if _active is None:
+        return iterable
+    return _active.iterate(iterable, name)
+
+
+def end_epoch():
+    """Close the current epoch of the active Profiler, if any."""
+    if _active is not None:
+        _active.end_epoch()
@@ -1,3 +1,13 @@
+"""Implements the relative and effective robustness metrics, a store for robustness results and robustness plots.
+
+The reference curves of the benchmarked methods (`robustness` below) are indexed once into a [method, task, noise level] array, so metrics for many curves are computed in one vectorized call instead of re-scanning the reference dictionaries per call.
+"""
+import csv
+import json
+import os
+import sqlite3
+import time
+
 import matplotlib.pyplot as plt
 from matplotlib.ticker import FormatStrFormatter
 import numpy as np
@@ -23,25 +33,38 @@ def get_robustness_metric(robustness_result, task, metric):
     """
     if metric == 'effective' and task not in robustness['LF']:
         return "Invalid example name!"
+    return robustness_metrics([robustness_result], [task], metric)[0]
+
+
+def robustness_metrics(robustness_results, tasks, metric):
+    """
+    Compute a robustness metric for many performance curves at once, each normalized against the benchmarked methods on its task.
+
+    :param robustness_results: Performance curves, one per method and task, as a list of lists or an array of shape [N, number of noise levels].
+    :param tasks: Name of the task of every curve.
+    :param metric: Type of robustness metric to be computed. ( "effective" / "relative" )
+    :return: Array of N normalized metrics. The effective metric is nan for tasks without a late fusion reference.
+    """
+    table = reference_table()
+    curves = _pad(robustness_results)
+    task_ind = np.array([table.task_index.get(task, -1) for task in tasks], dtype=np.int64)
+    known = task_ind >= 0
+    if metric == 'relative':
+        raw = _relative(curves)
+    elif metric == 'effective':
+        raw = np.full(len(curves), np.nan)
+        baseline = _resize(table.baseline, curves.shape[1])[task_ind[known]]
+        raw[known] = _effective(curves[known], baseline)
     else:
-        result = dict()
-        if metric == 'relative':
-            helper = relative_robustness_helper
-        elif metric == 'effective':
-            helper = effective_robustness_helper
-        my_method = helper(robustness_result, task)
-        for method in list(robustness.keys()):
-            if not method.endswith('Transformer'):
-                for t in list(robustness[method].keys()):
-                    if t == task:
-                        if (method == 'EF' or method == 'LF') and task in robustness[method+'-Transformer']:
-                            result[method] = helper((np.array(
-                                robustness[method][task])+np.array(robustness[method+'-Transformer'][task]))/2, task)
-                        else:
-                            result[method] = helper(
-                                robustness[method][task], task)
-        result['my method'] = my_method
-        return maxmin_normalize(result, task)
+        raise ValueError("metric must be 'relative' or 'effective', got " + str(metric))
+    low, high = np.full(len(curves), np.inf), np.full(len(curves), -np.inf)
+    ref_low, ref_high = table.reference_range(metric)
+    low[known], high[known] = ref_low[task_ind[known]], ref_high[task_ind[known]]
+    sign = np.array([-1.0 if task.startswith('finance') else 1.0 for task in tasks])
+    raw = sign * raw
+    low, high = np.minimum(low, raw), np.maximum(high, raw)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (raw - low) / (high - low)
 
 
 def relative_robustness_helper(robustness_result, task):
@@ -50,10 +73,7 @@ def relative_robustness_helper(robustness_result, task):
 
     :param robustness_result: Performance of the method on datasets applied with different level of noises.
     """
-    area = 0
-    for i in range(len(robustness_result)-1):
-        area += (robustness_result[i] + robustness_result[i+1]) * 0.1 / 2
-    return area
+    return _relative(_pad([robustness_result]))[0]
 
 
 def effective_robustness_helper(robustness_result, task):
@@ -63,10 +83,7 @@ def effective_robustness_helper(robustness_result, task):
     :param robustness_result: Performance of the method on datasets applied with different level of noises.
     :param task: Name of the task on which the method is evaluated.
     """
-    f = np.array(robustness_result)
-    lf = np.array(robustness['LF'][task])
-    beta_f = lf + (f[0] - lf[0])
-    return np.sum(f - beta_f)
+    return _effective(_pad([robustness_result]), _pad([robustness['LF'][task]]))[0]
 
 
 def maxmin_normalize(result, task):
@@ -88,10 +105,244 @@ def maxmin_normalize(result, task):
     return tmp[method2idx['my method']]
 
 
+class ReferenceTable:
+    """Reference performance curves of the benchmarked methods, indexed as a [method, task, noise level] array.
+
+    EF and LF curves are averaged with their Transformer variants where those exist, and the Transformer variants are not methods of their own.
+    """
+
+    def __init__(self, reference):
+        """Index reference curves.
+
+        :param reference: Maps method -> task -> performance curve, like `robustness` below.
+        """
+        methods = dict()
+        for method, results in reference.items():
+            if method.endswith('Transformer'):
+                continue
+            methods[method] = dict()
+            for task, curve in results.items():
+                transformer = reference.get(method + '-Transformer', dict())
+                if method in ['EF', 'LF'] and task in transformer:
+                    curve = (np.array(curve) + np.array(transformer[task])) / 2
+                methods[method][task] = curve
+        self.methods = list(methods)
+        self.tasks = sorted({task for results in methods.values() for task in results})
+        self.task_index = {task: i for i, task in enumerate(self.tasks)}
+        curves = _pad([methods[m].get(t) for m in self.methods for t in self.tasks])
+        self.curves = curves.reshape(len(self.methods), len(self.tasks), -1)
+        self.baseline = _pad([reference['LF'].get(t) for t in self.tasks])
+        self._ranges = dict()
+
+    def reference_range(self, metric):
+        """Get the lowest and highest (sign-adjusted) metric among the methods on every task, each of shape [number of tasks]."""
+        if metric not in self._ranges:
+            curves = self.curves.reshape(-1, self.curves.shape[-1])
+            if metric == 'relative':
+                raw = _relative(curves)
+            else:
+                raw = _effective(curves, np.tile(self.baseline, (len(self.methods), 1)))
+            raw = raw.reshape(len(self.methods), len(self.tasks))
+            raw = raw * np.array([-1.0 if t.startswith('finance') else 1.0 for t in self.tasks])
+            self._ranges[metric] = (np.where(np.isnan(raw), np.inf, raw).min(0),
+                                    np.where(np.isnan(raw), -np.inf, raw).max(0))
+        return self._ranges[metric]
+
+
+_reference_table = None
+
+
+def reference_table():
+    """Get the ReferenceTable of the `robustness` results below, building it on first use."""
+    global _reference_table
+    if _reference_table is None:
+        _reference_table = ReferenceTable(robustness)
+    return _reference_table
+
+
+def _pad(curves):
+    """Stack curves of different lengths (or None) into one array, padded with nan."""
+    curves = [[] if c is None else [float(v) for v in c] for c in curves]
+    out = np.full((len(curves), max([len(c) for c in curves] + [1])), np.nan)
+    for i, c in enumerate(curves):
+        out[i, :len(c)] = c
+    return out
+
+
+def _resize(curves, length):
+    """Pad curves with nan, or cut them, to the given length."""
+    if curves.shape[1] >= length:
+        return curves[:, :length]
+    return np.pad(curves, ((0, 0), (0, length - curves.shape[1])), constant_values=np.nan)
+
+
+def _relative(curves):
+    """Trapezoidal area under every row of nan-padded curves, with noise levels 0.1 apart."""
+    pairs = curves[:, :-1] + curves[:, 1:]
+    area = np.where(np.isnan(pairs), 0, pairs).sum(1) * 0.1 / 2
+    return np.where(np.isnan(curves[:, 0]), np.nan, area)
+
+
+def _effective(curves, baseline):
+    """Sum of the differences between every row of curves and the matching baseline row shifted to start at the same performance."""
+    baseline = _resize(baseline, curves.shape[1])
+    diff = (curves - baseline) - (curves[:, :1] - baseline[:, :1])
+    return np.where(np.isnan(curves[:, 0]), np.nan, np.where(np.isnan(diff), 0, diff).sum(1))
+
+
+class RobustnessStore:
+    """Append-only store of robustness results, kept in a CSV file or an SQLite database.
+
+    Every record is one performance curve of a method on a task, with its metrics and a timestamp. Records are only ever appended, so stores of many runs or jobs can be compared later.
+    """
+
+    FIELDS = ['time', 'method', 'task', 'noisy_modality', 'measure', 'curve', 'relative', 'effective']
+
+    def __init__(self, path):
+        """Open a store.
+
+        :param path: Path to the store. Files ending in .db, .sqlite or .sqlite3 are SQLite databases, anything else is CSV.
+        """
+        self.path = path
+        self.sqlite = os.path.splitext(path)[1] in ['.db', '.sqlite', '.sqlite3']
+        if self.sqlite:
+            with sqlite3.connect(path) as db:
+                db.execute('CREATE TABLE IF NOT EXISTS robustness ({})'.format(', '.join(self.FIELDS)))
+
+    def append(self, records):
+        """Append records.
+
+        :param records: List of dicts with the keys in FIELDS. Curves are lists of floats, and time defaults to now.
+        """
+        rows = []
+        for record in records:
+            record = dict(record, time=record.get('time', time.time()))
+            record['curve'] = json.dumps([float(v) for v in record['curve']])
+            rows.append([_plain(record.get(field)) for field in self.FIELDS])
+        if self.sqlite:
+            with sqlite3.connect(self.path) as db:
+                db.executemany('INSERT INTO robustness VALUES ({})'.format(', '.join('?' * len(self.FIELDS))), rows)
+        else:
+            new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            with open(self.path, 'a', newline='') as f:
+                writer = csv.writer(f)
+                if new:
+                    writer.writerow(self.FIELDS)
+                writer.writerows(rows)
+
+    def read(self):
+        """Read all records, as a list of dicts with curves decoded to lists."""
+        if self.sqlite:
+            with sqlite3.connect(self.path) as db:
+                rows = db.execute('SELECT {} FROM robustness'.format(', '.join(self.FIELDS))).fetchall()
+            records = [dict(zip(self.FIELDS, row)) for row in rows]
+        else:
+            if not os.path.exists(self.path):
+                return []
+            with open(self.path, newline='') as f:
+                records = list(csv.DictReader(f))
+            for record in records:
+                for field in ['time', 'relative', 'effective']:
+                    record[field] = float(record[field]) if record[field] not in ['', 'None'] else None
+        for record in records:
+            record['curve'] = json.loads(record['curve'])
+        return records
+
+
+def _plain(value):
+    if isinstance(value, (np.floating, np.integer)):
+        return value.item()
+    return value
+
+
+_store = None
+_deferred_plots = None
+
+
+class results_store:
+    """Context manager that makes `report_robustness` append its results to a RobustnessStore."""
+
+    def __init__(self, path):
+        """Use the store at path (see RobustnessStore) within the context."""
+        self.store = RobustnessStore(path)
+
+    def __enter__(self):
+        global _store
+        self._previous, _store = _store, self.store
+        return self.store
+
+    def __exit__(self, *exc):
+        global _store
+        _store = self._previous
+
+
+class deferred_plots:
+    """Context manager that queues the figures of `single_plot` instead of rendering them one at a time.
+
+    The queued figures are rendered together when the context exits, or never if render is False, so the evaluation itself is not held up by matplotlib.
+    """
+
+    def __init__(self, render=True):
+        """Queue plots within the context, and render them on exit if render is True."""
+        self.render = render
+        self.plots = []
+
+    def __enter__(self):
+        global _deferred_plots
+        self._previous, _deferred_plots = _deferred_plots, self
+        return self
+
+    def __exit__(self, *exc):
+        global _deferred_plots
+        _deferred_plots = self._previous
+        if self.render and exc[0] is None:
+            render_plots(self.plots)
+
+
+def report_robustness(curves, dataset, method_name):
+    """
+    Print the relative and effective robustness of every robustness curve, record them in the active results store and plot the curves.
+
+    All metrics are computed in two vectorized calls. Plots are queued if `deferred_plots` is active.
+
+    :param curves: Maps each noisy modality to its robustness curve, a dict of measure -> performance per noise level, as returned by `eval_scripts.sweep.robustness_curves`.
+    :param dataset: Name of the dataset, used to look up the reference results of the task.
+    :param method_name: Name of the method.
+    """
+    entries = []
+    for noisy_modality, robustness_curve in curves.items():
+        for measure, robustness_result in robustness_curve.items():
+            relative_key = '{} {}'.format(dataset, noisy_modality)
+            effective_key = relative_key if len(robustness_curve) == 1 else '{} {}'.format(relative_key, measure)
+            entries.append((noisy_modality, measure, robustness_result, relative_key, effective_key))
+    if not entries:
+        return
+    results = [e[2] for e in entries]
+    relative = robustness_metrics(results, [e[3] for e in entries], 'relative')
+    effective = robustness_metrics(results, [e[4] for e in entries], 'effective')
+    records = []
+    for (noisy_modality, measure, robustness_result, _, robustness_key), rel, eff in zip(entries, relative, effective):
+        print("relative robustness ({}, {}): {}".format(noisy_modality, measure, str(rel)))
+        valid = robustness_key in robustness['LF']
+        print("effective robustness ({}, {}): {}".format(noisy_modality, measure,
+                                                        str(eff) if valid else "Invalid example name!"))
+        fig_name = '{}-{}-{}-{}'.format(method_name, robustness_key, noisy_modality, measure)
+        single_plot(robustness_result, robustness_key, xlabel='Noise level',
+                    ylabel=measure, fig_name=fig_name, method=method_name)
+        print("Plot saved as "+fig_name)
+        records.append({'method': method_name, 'task': robustness_key, 'noisy_modality': noisy_modality,
+                        'measure': measure, 'curve': robustness_result, 'relative': rel,
+                        'effective': eff if valid else None})
+    if _store is not None:
+        _store.append(records)
+
+
 def single_plot(robustness_result, task, xlabel, ylabel, fig_name, method):
     """
     Produce performance vs. robustness plot of a single method.
 
+    The plot is queued instead if `deferred_plots` is active.
+
     :param robustness_result: Performance of the method on dataset applied with different level of noises.
     :param task: Name of the task on which the method is evaluated.
     :param xlabel: Label of x-axis to be appeared in the plot.
@@ -99,20 +350,42 @@ def single_plot(robustness_result, task, xlabel, ylabel, fig_name, method):
     :param fig_name: Name of plot to be saved.
     :param method: Name of the method.
     """
+    plot = dict(robustness_result=[float(v) for v in robustness_result], task=task, xlabel=xlabel,
+                ylabel=ylabel, fig_name=fig_name, method=method)
+    if _deferred_plots is not None:
+        _deferred_plots.plots.append(plot)
+    else:
+        render_plots([plot])
+
+
+def render_plots(plots):
+    """
+    Render queued plots, reusing one figure for all of them.
+
+    :param plots: List of dicts with the arguments of `single_plot`.
+    """
     fig, axs = plt.subplots()
-    if task.startswith('gentle push') or task.startswith('robotics image') or task.startswith('robotics force'):
-        robustness_result = list(np.log(np.array(robustness_result)))
-        plt.ylabel('log '+ylabel, fontsize=20)
-    axs.plot(np.arange(len(robustness_result)) / 10,
-             robustness_result, label=method, linewidth=2.5)
-    plt.xlabel(xlabel, fontsize=20)
-    plt.xticks(fontsize=15)
-    plt.yticks(fontsize=15)
-    # Uncomment the line below to show legends
-    # fig.legend(fontsize=15, loc='upper left', bbox_to_anchor=(0.92, 0.94))
-    axs.yaxis.set_major_formatter(FormatStrFormatter('%.2f'))
-    fig.savefig(fig_name, bbox_inches='tight')
-    plt.close(fig)
+    try:
+        for plot in plots:
+            axs.clear()
+            robustness_result = plot['robustness_result']
+            ylabel = plot['ylabel']
+            task = plot['task']
+            if task.startswith('gentle push') or task.startswith('robotics image') or task.startswith('robotics force'):
+                robustness_result = list(np.log(np.array(robustness_result)))
+                ylabel = 'log '+ylabel
+            axs.plot(np.arange(len(robustness_result)) / 10,
+                     robustness_result, label=plot['method'], linewidth=2.5)
+            axs.set_xlabel(plot['xlabel'], fontsize=20)
+            if ylabel != plot['ylabel']:
+                axs.set_ylabel(ylabel, fontsize=20)
+            axs.tick_params(labelsize=15)
+            # Uncomment the line below to show legends
+            # fig.legend(fontsize=15, loc='upper left', bbox_to_anchor=(0.92, 0.94))
+            axs.yaxis.set_major_formatter(FormatStrFormatter('%.2f'))
+            fig.savefig(plot['fig_name'], bbox_inches='tight')
+    finally:
+        plt.close(fig)
 
 
 ###############################################################
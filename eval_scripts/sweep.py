@@ -0,0 +1,63 @@
+"""Implements a robustness sweep executor that scores noisy test sets in parallel.
+
+The `test` functions in `training_structures` score one dataloader per (noisy modality, noise level). `robustness_curves` runs these evaluations in a pool of forked worker processes, each holding its own replica of the model and an equal share of the torch threads, and merges the results into one robustness curve per noisy modality. Workers are forked so that neither the model nor the lazily built test sets have to be picklable.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import torch
+from tqdm import tqdm
+
+# (evaluate, test_dataloaders_all) of the running sweep, inherited by forked workers
+_sweep = None
+
+
+def robustness_curves(evaluate, test_dataloaders_all, num_workers=1):
+    """Score every noisy test set and collect the results into robustness curves.
+
+    Args:
+        evaluate (callable): Function taking a test dataloader and returning a dict of measure -> result.
+        test_dataloaders_all (Mapping): Maps each noisy modality to a sequence of test dataloaders, one per noise level, such as a RobustTestSuite.
+        num_workers (int, optional): Number of worker processes to run evaluations in. The sweep runs in this process if 1, or if forking is not possible (no fork start method, or CUDA already initialized). Defaults to 1.
+
+    Returns:
+        dict: Maps each noisy modality to its robustness curve, a dict of measure -> list of results in noise level order.
+    """
+    global _sweep
+    tasks = [(noisy_modality, noise_ind) for noisy_modality, test_dataloaders in test_dataloaders_all.items()
+             for noise_ind in range(len(test_dataloaders))]
+    if num_workers > 1 and can_fork():
+        print("Testing on noisy data ({}) with {} workers...".format(', '.join(test_dataloaders_all), num_workers))
+        threads = max(1, torch.get_num_threads() // num_workers)
+        _sweep = (evaluate, test_dataloaders_all)
+        try:
+            with ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('fork'),
+                                     initializer=torch.set_num_threads, initargs=(threads,)) as pool:
+                results = list(tqdm(pool.map(_evaluate, tasks), total=len(tasks)))
+        finally:
+            _sweep = None
+    else:
+        results = []
+        for noisy_modality, test_dataloaders in test_dataloaders_all.items():
+            print("Testing on noisy data ({})...".format(noisy_modality))
+            for noise_ind in tqdm(range(len(test_dataloaders))):
+                results.append(evaluate(test_dataloaders[noise_ind]))
+    curves = {noisy_modality: dict() for noisy_modality in test_dataloaders_all}
+    for (noisy_modality, _), result in zip(tasks, results):
+        for k, v in result.items():
+            curves[noisy_modality].setdefault(k, []).append(v)
+    return curves
+
+
+def _evaluate(task):
+    evaluate, test_dataloaders_all = _sweep
+    noisy_modality, noise_ind = task
+    return evaluate(test_dataloaders_all[noisy_modality][noise_ind])
+
+
+def can_fork():
+    """Check whether worker processes can be forked from this process, which needs the fork start method and CUDA not to be initialized."""
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return False
+    # a forked child cannot use CUDA once the parent has initialized it
+    return not torch.cuda.is_initialized()
@@ -3,14 +3,139 @@ Implements fusion network structure for MFAS.
 
 See https://github.com/slyviacassell/_MFAS/tree/master/models for hyperparameter details.
 """
+import os
+import multiprocessing
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 import torch
 import copy
+import numpy as np
 import torch.optim as op
 from torch import nn
+from torch.utils.data import DataLoader, RandomSampler
 import utils.aux_models as aux
 import utils.scheduler as sc
+from eval_scripts import profiling
+from eval_scripts.sweep import can_fork
 
 
+def load_unimodal_encoders(unimodal_files):
+    """Load pretrained unimodal encoders, set to output every layer.
+
+    Args:
+        unimodal_files (List[path]): List of unimodal encoder paths.
+
+    Returns:
+        List[nn.Module]: The encoders, in the order of unimodal_files.
+    """
+    encoders = []
+    for i in unimodal_files:
+        encoders.append(torch.load(i,map_location=torch.device("cuda:0" if torch.cuda.is_available() else "cpu")))
+    for encoder in encoders:
+        encoder.output_each_layer = True
+    return encoders
+
+
+class LayerOutputCache:
+    """Caches the layer outputs of frozen unimodal encoders over every split of a dataset.
+
+    The encoders are run once per split, in evaluation mode, and the outputs of the layers MFAS can fuse are kept in memory-mapped arrays. `loader` then iterates over batches of these outputs, which `Searchable` fuses without running its encoders, so training a sampled configuration only costs the compute of its fusion layers.
+    """
+
+    def __init__(self, encoders, sub_sizes, dataloaders, root=None):
+        """Run the encoders over every split and cache their layer outputs.
+
+        Args:
+            encoders (List[nn.Module]): Pretrained unimodal encoders, set to output every layer.
+            sub_sizes (list of tuples): The output size of each layer within the unimodal encoders. Only the first len(sub_sizes[i]) layers of encoder i are cached.
+            dataloaders (dict): Maps each split, such as 'train' and 'dev', to its dataloader.
+            root (str, optional): Directory to keep the arrays in. Defaults to None, which uses a temporary directory removed with the cache.
+        """
+        self.encoders = encoders
+        self.num_layers = [len(sizes) for sizes in sub_sizes]
+        if root is None:
+            self._tmpdir = tempfile.TemporaryDirectory(prefix='mfas_layers_')
+            root = self._tmpdir.name
+        self.root = root
+        self.arrays = dict()
+        self.loaders = dict()
+        for split, dataloader in dataloaders.items():
+            self.arrays[split] = self._cache_split(split, dataloader)
+            self.loaders[split] = CachedLayerLoader(
+                *self.arrays[split], batch_size=dataloader.batch_size,
+                shuffle=isinstance(dataloader.sampler, RandomSampler), drop_last=dataloader.drop_last)
+
+    def _cache_split(self, split, dataloader):
+        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        # iterate in dataset order, whatever the order of the original dataloader
+        ordered = DataLoader(dataloader.dataset, batch_size=dataloader.batch_size, shuffle=False,
+                             num_workers=dataloader.num_workers, collate_fn=dataloader.collate_fn)
+        total = len(dataloader.dataset)
+        layers, labels = None, None
+        start = 0
+        for encoder in self.encoders:
+            encoder.to(device)
+            encoder.train(False)
+        with torch.no_grad():
+            for data in ordered:
+                inputs = [d.float().to(device) for d in data[:-1]]
+                outputs = [self.encoders[i](inputs[i])[1:self.num_layers[i] + 1] for i in range(len(inputs))]
+                if layers is None:
+                    layers = [[self._open(split, 'm{}_l{}'.format(i, j), (total,) + tuple(out.shape[1:]), np.float32)
+                               for j, out in enumerate(outs)] for i, outs in enumerate(outputs)]
+                    labels = self._open(split, 'labels', (total,) + tuple(data[-1].shape[1:]), data[-1].numpy().dtype)
+                end = start + len(data[-1])
+                for i, outs in enumerate(outputs):
+                    for j, out in enumerate(outs):
+                        layers[i][j][start:end] = out.float().cpu().numpy()
+                labels[start:end] = data[-1].numpy()
+                start = end
+        for array in [a for arrays in layers for a in arrays] + [labels]:
+            array.flush()
+        return layers, labels
+
+    def _open(self, split, name, shape, dtype):
+        return np.lib.format.open_memmap(os.path.join(self.root, '{}_{}.npy'.format(split, name)),
+                                         mode='w+', dtype=dtype, shape=shape)
+
+
+class CachedLayerLoader:
+    """Iterates over batches of layer outputs cached by LayerOutputCache.
+
+    Batches are lists with, for every encoder, the list of its cached layer outputs, followed by the labels, so they can be passed to `train_track_acc` in place of the batches of the original dataloader.
+    """
+
+    def __init__(self, layers, labels, batch_size, shuffle=False, drop_last=False):
+        """Initialize CachedLayerLoader object.
+
+        Args:
+            layers (List[List[np.ndarray]]): For every encoder, the array of outputs of each of its layers.
+            labels (np.ndarray): Labels.
+            batch_size (int): Batch size.
+            shuffle (bool, optional): Whether to shuffle the samples every epoch. Defaults to False.
+            drop_last (bool, optional): Whether to drop the last incomplete batch. Defaults to False.
+        """
+        self.layers = [[torch.from_numpy(array) for array in arrays] for arrays in layers]
+        self.labels = torch.from_numpy(labels)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        """Iterate over the batches of one epoch."""
+        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        total = len(self.labels)
+        order = torch.randperm(total) if self.shuffle else torch.arange(total)
+        end = total - total % self.batch_size if self.drop_last else total
+        for start in range(0, end, self.batch_size):
+            rows = order[start:start + self.batch_size]
+            yield [[layer[rows].to(device) for layer in layers] for layers in self.layers] + [self.labels[rows]]
+
+    def __len__(self):
+        """Get number of batches per epoch."""
+        if self.drop_last:
+            return len(self.labels) // self.batch_size
+        return (len(self.labels) + self.batch_size - 1) // self.batch_size
 
 
 def train_sampled_models(sampled_configurations, searchable_type, dataloaders,
@@ -18,7 +143,7 @@ def train_sampled_models(sampled_configurations, searchable_type, dataloaders,
                          eta_max, eta_min, Ti, Tm,
                          return_model=False, premodels=False, preaccuracies=False,
                          train_only_central_params=True,
-                         state_dict=dict()):
+                         state_dict=dict(), layer_cache=None, num_workers=1, halving_rate=None, min_epochs=1):
     """Train sampled configurations from MFAS.
 
     Args:
@@ -42,6 +167,10 @@ def train_sampled_models(sampled_configurations, searchable_type, dataloaders,
         preaccuracies (bool, optional): (Unused). Defaults to False.
         train_only_central_params (bool, optional): Whether to train only central parameters or not. Defaults to True.
         state_dict (_type_, optional): (unused). Defaults to dict().
+        layer_cache (LayerOutputCache, optional): Cached layer outputs of the encoders of unimodal_files over the dataloaders. If given, configurations are trained on the cached outputs and share the encoders of the cache, which are neither reloaded nor copied. Defaults to None.
+        num_workers (int, optional): Number of worker processes to train configurations in concurrently. Training runs in this process if 1, or if forking is not possible. Workers draw shuffled batch orders from their own copy of the random state, so with a shuffled train loader the accuracies differ from those trained in this process. Defaults to 1.
+        halving_rate (int, optional): If given, configurations are trained with successive halving: all of them are trained for a fraction of the epochs, then only the best 1 / halving_rate of them are trained further, and so on until the survivors reach all epochs. Discarded configurations report the best accuracy they reached. Defaults to None, which trains every configuration for all epochs.
+        min_epochs (int, optional): Number of epochs of the first round of successive halving, at least. Defaults to 1.
 
     Returns:
         List: List of model accuracies.
@@ -50,22 +179,23 @@ def train_sampled_models(sampled_configurations, searchable_type, dataloaders,
     num_batches_per_epoch = dataset_sizes['train'] / batch_size
     criterion = torch.nn.CrossEntropyLoss()
 
-    real_accuracies = []
-
-    if return_model:
-        models = []
+    if layer_cache is not None:
+        train_dataloaders = layer_cache.loaders
+    else:
+        train_dataloaders = dataloaders
 
+    candidates = []
     for idx, configuration in enumerate(sampled_configurations):
 
         if not return_model or idx in return_model:
 
             # model to train
             if not premodels:
-                sds = []
-                for i in unimodal_files:
-                    sds.append(torch.load(i,map_location=torch.device("cuda:0" if torch.cuda.is_available() else "cpu")))
-                for sd in sds:
-                    sd.output_each_layer = True
+                if layer_cache is not None:
+                    # encoders are not run on cached layer outputs, so every candidate shares the same ones
+                    sds = layer_cache.encoders
+                else:
+                    sds = load_unimodal_encoders(unimodal_files)
                 rmode = searchable_type(
                     sds, rep_size, classes, configuration, sub_sizes)
 
@@ -79,108 +209,236 @@ def train_sampled_models(sampled_configurations, searchable_type, dataloaders,
 
             rmode.to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
 
-            best_model_acc = train_track_acc(rmode, [criterion], optimizer, scheduler, dataloaders,
-                                             dataset_sizes,
-                                             device=torch.device("cuda:0" if torch.cuda.is_available() else "cpu"), num_epochs=epochs, verbose=False,
-                                             multitask=False)
+            candidates.append(CandidateTraining(rmode, [criterion], optimizer, scheduler, multitask=False,
+                                                frozen=['encoders'] if layer_cache is not None else None))
 
-            real_accuracies.append(best_model_acc)
+    alive = list(range(len(candidates)))
+    for budget in halving_budgets(epochs, len(candidates), halving_rate, min_epochs):
+        tasks = [(i, budget - candidates[i].epochs) for i in alive]
+        _train_candidates(candidates, tasks, train_dataloaders, dataset_sizes, num_workers)
+        if budget < epochs:
+            # keep the best 1 / halving_rate of the candidates for the next round
+            alive = sorted(alive, key=lambda i: -float(candidates[i].best_acc))
+            alive = sorted(alive[:-(-len(alive) // halving_rate)])
 
-            if return_model:
-                models.append(rmode)
+    real_accuracies = [candidate.finish() for candidate in candidates]
 
     if return_model:
-        return real_accuracies, models
+        return real_accuracies, [candidate.model for candidate in candidates]
     else:
         return real_accuracies
 
 
-def train_track_acc(model, criteria, optimizer, scheduler, dataloaders, dataset_sizes,
-                    device=None, num_epochs=200, verbose=False, multitask=False):
-    """Get best accuracy for model when training on a set of dataloaders.
+def halving_budgets(epochs, num_candidates, halving_rate=None, min_epochs=1):
+    """Get the number of epochs candidates are trained for at each round of successive halving.
 
     Args:
-        model (nn.Module): Model to train on.
-        criteria (nn.Module): Loss function.
-        optimizer (nn.optim.Optimizer): Optimizer instance
-        scheduler (nn.optim.Scheduler): LRScheduler to use.
-        dataloaders (List): List of dataloaders to train on.
-        dataset_sizes (List): List of the sizes of the datasets
-        device (torch.device, optional): Device to train on. Defaults to None.
-        num_epochs (int, optional): Number of epochs to train on. Defaults to 200.
-        verbose (bool, optional): (Unused) Defaults to False.
-        multitask (bool, optional): Whether to train as a multitask setting. Defaults to False.
+        epochs (int): Number of epochs of the last round.
+        num_candidates (int): Number of candidates of the first round.
+        halving_rate (int, optional): Factor by which candidates are cut and epochs grow from one round to the next. Defaults to None, which trains in one round.
+        min_epochs (int, optional): Number of epochs of the first round, at least. Defaults to 1.
 
     Returns:
-        float: Best accuracy when training.
+        List[int]: Total number of epochs of each round, increasing and ending with epochs.
     """
-    best_model_sd = copy.deepcopy(model.state_dict())
-    best_acc = 0
+    if not halving_rate or halving_rate < 2:
+        return [epochs]
+    budgets = [epochs]
+    while num_candidates >= halving_rate and budgets[0] // halving_rate >= min_epochs:
+        budgets.insert(0, budgets[0] // halving_rate)
+        num_candidates = -(-num_candidates // halving_rate)
+    return budgets
+
+
+# (candidates, dataloaders, dataset_sizes) of the running round, inherited by forked workers
+_round = None
+
+
+def _train_candidates(candidates, tasks, dataloaders, dataset_sizes, num_workers=1):
+    global _round
+    if num_workers > 1 and len(tasks) > 1 and can_fork():
+        threads = max(1, torch.get_num_threads() // num_workers)
+        _round = (candidates, dataloaders, dataset_sizes)
+        try:
+            with ProcessPoolExecutor(min(num_workers, len(tasks)), mp_context=multiprocessing.get_context('fork'),
+                                     initializer=torch.set_num_threads, initargs=(threads,)) as pool:
+                for (i, _), state in zip(tasks, pool.map(_train_candidate, tasks)):
+                    candidates[i].load_state(state)
+        finally:
+            _round = None
+    else:
+        for i, num_epochs in tasks:
+            candidates[i].train(dataloaders, dataset_sizes, num_epochs)
 
-    for epoch in range(num_epochs):
-        # Each epoch has a training and validation phase
-        for phase in ['train', 'dev']:
 
-            if phase == 'train':
-                if not isinstance(scheduler, sc.LRCosineAnnealingScheduler):
-                    scheduler.step()
-                model.train(True)  # Set model to training mode
-            else:
-                model.train(False)  # Set model to evaluate mode
+def _train_candidate(task):
+    # only the trained state is sent back, not the whole model
+    candidates, dataloaders, dataset_sizes = _round
+    i, num_epochs = task
+    return candidates[i].train(dataloaders, dataset_sizes, num_epochs).state()
 
-            running_loss = 0.0
-            running_corrects = 0
 
-            # Iterate over data.
-            for data in dataloaders[phase]:
+class CandidateTraining:
+    """Training state of a sampled configuration, which can be trained a few epochs at a time while tracking its best accuracy."""
 
-                # get the inputs
-                inputs = [d.float().to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")) for d in data[:-1]]
-                label = data[-1].to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
+    def __init__(self, model, criteria, optimizer, scheduler, multitask=False, frozen=None):
+        """Initialize CandidateTraining object.
 
-                # zero the parameter gradients
-                optimizer.zero_grad()
+        Args:
+            model (nn.Module): Model to train on.
+            criteria (nn.Module): Loss function.
+            optimizer (nn.optim.Optimizer): Optimizer instance
+            scheduler (nn.optim.Scheduler): LRScheduler to use.
+            multitask (bool, optional): Whether to train as a multitask setting. Defaults to False.
+            frozen (List[str], optional): Names of the submodules of model which neither training nor evaluation change, such as encoders whose layer outputs are cached. Their weights are left out of the best model state and of the training state. Defaults to None.
+        """
+        self.model = model
+        self.criteria = criteria
+        self.optimizer = optimizer
+        self.scheduler = scheduler
+        self.multitask = multitask
+        self.frozen = tuple(name + '.' for name in frozen or [])
+        self.best_model_sd = self._model_state()
+        self.best_acc = 0
+        self.epochs = 0
+
+    def _model_state(self):
+        return {name: copy.deepcopy(value) for name, value in self.model.state_dict().items()
+                if not name.startswith(self.frozen)}
+
+    def state(self):
+        """Get the training state, without the frozen weights of the model.
+
+        Returns:
+            dict: Trained weights, optimizer and scheduler states, best accuracy, best trained weights and number of epochs.
+        """
+        return {'model': self._model_state(), 'optimizer': self.optimizer.state_dict(),
+                'scheduler': self.scheduler.state_dict(), 'best_acc': self.best_acc,
+                'best_model_sd': self.best_model_sd, 'epochs': self.epochs}
+
+    def load_state(self, state):
+        """Restore a training state, such as one returned by state in a worker process.
+
+        Args:
+            state (dict): Training state.
+        """
+        self.model.load_state_dict(state['model'], strict=not self.frozen)
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.scheduler.load_state_dict(state['scheduler'])
+        self.best_acc = state['best_acc']
+        self.best_model_sd = state['best_model_sd']
+        self.epochs = state['epochs']
 
-                # forward
-                # track history if only in train
-                with torch.set_grad_enabled(phase == 'train'):
-                    output = model(inputs)
+    def train(self, dataloaders, dataset_sizes, num_epochs):
+        """Train for some more epochs.
 
-                    if not multitask:
-                        _, preds = torch.max(output.detach(), 1)
-                        loss = criteria[0](output, label)
-                    else:
-                        _, preds = torch.max(sum(output), 1)
-                        loss = criteria[0](output[0], label) + criteria[1](output[1], label) + criteria[2](output[2],
-                                                                                                           label)
+        Args:
+            dataloaders (List): List of dataloaders to train on, or of CachedLayerLoaders.
+            dataset_sizes (List): List of the sizes of the datasets
+            num_epochs (int): Number of epochs to train on.
+
+        Returns:
+            CandidateTraining: This object, after training.
+        """
+        model, criteria, optimizer, scheduler, multitask = self.model, self.criteria, self.optimizer, self.scheduler, self.multitask
+        for epoch in range(num_epochs):
+            # Each epoch has a training and validation phase
+            for phase in ['train', 'dev']:
+
+                if phase == 'train':
+                    if not isinstance(scheduler, sc.LRCosineAnnealingScheduler):
+                        scheduler.step()
+                    model.train(True)  # Set model to training mode
+                else:
+                    model.train(False)  # Set model to evaluate mode
+
+                running_loss = 0.0
+                running_corrects = 0
+
+                # Iterate over data.
+                batches = profiling.iterate(dataloaders[phase]) if phase == 'train' else dataloaders[phase]
+                for data in batches:
+
+                    # get the inputs
+                    inputs = [[layer.float() for layer in d] if isinstance(d, list) else d.float().to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")) for d in data[:-1]]
+                    label = data[-1].to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
+
+                    # zero the parameter gradients
+                    optimizer.zero_grad()
+
+                    # forward
+                    # track history if only in train
+                    with torch.set_grad_enabled(phase == 'train'), profiling.phase('forward' if phase == 'train' else 'validation'):
+                        output = model(inputs)
+
+                        if not multitask:
+                            _, preds = torch.max(output.detach(), 1)
+                            loss = criteria[0](output, label)
+                        else:
+                            _, preds = torch.max(sum(output), 1)
+                            loss = criteria[0](output[0], label) + criteria[1](output[1], label) + criteria[2](output[2],
+                                                                                                               label)
 
                     # backward + optimize only if in training phase
                     if phase == 'train':
                         if isinstance(scheduler, sc.LRCosineAnnealingScheduler):
                             scheduler.step()
                             scheduler.update_optimizer(optimizer)
-                        loss.backward()
-                        optimizer.step()
+                        with profiling.phase('backward'):
+                            loss.backward()
+                        with profiling.phase('step'):
+                            optimizer.step()
+
+                    # statistics
+                    running_loss += loss.item() * label.size(0)
+                    running_corrects += torch.sum(preds == label.detach())
 
-                # statistics
-                running_loss += loss.item() * data[0].size(0)
-                running_corrects += torch.sum(preds == label.detach())
+                epoch_acc = torch.true_divide(
+                    running_corrects, dataset_sizes[phase])
 
-            epoch_acc = torch.true_divide(
-                running_corrects, dataset_sizes[phase])
+                print('{} Acc: {:.4f}'.format(phase, epoch_acc))
+
+                # deep copy the model
+                if phase == 'dev' and epoch_acc > self.best_acc:
+                    self.best_acc = epoch_acc
+                    self.best_model_sd = self._model_state()
+            self.epochs += 1
+            profiling.end_epoch()
+        return self
+
+    def finish(self):
+        """Restore the best model, and save it.
+
+        Returns:
+            float: Best accuracy when training.
+        """
+        self.model.load_state_dict(self.best_model_sd, strict=not self.frozen)
+        self.model.train(False)
+        torch.save(self.model, 'tests/best'+str(self.best_acc)+'.pt')
+        return self.best_acc
 
-            print('{} Acc: {:.4f}'.format(phase, epoch_acc))
 
-            # deep copy the model
-            if phase == 'dev' and epoch_acc > best_acc:
-                best_acc = epoch_acc
-                best_model_sd = copy.deepcopy(model.state_dict())
+def train_track_acc(model, criteria, optimizer, scheduler, dataloaders, dataset_sizes,
+                    device=None, num_epochs=200, verbose=False, multitask=False):
+    """Get best accuracy for model when training on a set of dataloaders.
 
-    model.load_state_dict(best_model_sd)
-    model.train(False)
-    torch.save(model, 'tests/best'+str(best_acc)+'.pt')
+    Args:
+        model (nn.Module): Model to train on.
+        criteria (nn.Module): Loss function.
+        optimizer (nn.optim.Optimizer): Optimizer instance
+        scheduler (nn.optim.Scheduler): LRScheduler to use.
+        dataloaders (List): List of dataloaders to train on, or of CachedLayerLoaders.
+        dataset_sizes (List): List of the sizes of the datasets
+        device (torch.device, optional): Device to train on. Defaults to None.
+        num_epochs (int, optional): Number of epochs to train on. Defaults to 200.
+        verbose (bool, optional): (Unused) Defaults to False.
+        multitask (bool, optional): Whether to train as a multitask setting. Defaults to False.
 
-    return best_acc
+    Returns:
+        float: Best accuracy when training.
+    """
+    candidate = CandidateTraining(model, criteria, optimizer, scheduler, multitask)
+    return candidate.train(dataloaders, dataset_sizes, num_epochs).finish()
 
 
 class Searchable(nn.Module):
@@ -216,14 +474,17 @@ class Searchable(nn.Module):
         """Apply Searchable Module to Layer Inputs.
 
         Args:
-            inputs (torch.Tensor): List of input tensors
+            inputs (torch.Tensor): List of input tensors. An input can also be the list of the layer outputs of its encoder, as cached by LayerOutputCache, in which case the encoder is not run.
 
         Returns:
             torch.Tensor: Layer Output
         """
         features = []
         for i in range(len(inputs)):
-            feat = self.encoders[i](inputs[i])[1:]
+            if isinstance(inputs[i], list):
+                feat = inputs[i]
+            else:
+                feat = self.encoders[i](inputs[i])[1:]
             features.append([feat[idx] for idx in self.conf[:, i]])
 
         for layer, conf in enumerate(self.conf):
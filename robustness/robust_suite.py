@@ -0,0 +1,63 @@
+"""Implements lazily built robustness test suites."""
+from collections.abc import Mapping, Sequence
+
+
+class NoisyLoaders(Sequence):
+    """Sequence of test dataloaders, one per noise level, each built only when it is accessed."""
+
+    def __init__(self, build_loader, noise_levels):
+        """Instantiate NoisyLoaders.
+
+        Args:
+            build_loader (callable): Function taking a noise level and returning the dataloader for it.
+            noise_levels (list): Noise levels, in the order the dataloaders are visited.
+        """
+        self.build_loader = build_loader
+        self.noise_levels = list(noise_levels)
+
+    def __getitem__(self, ind):
+        """Build the dataloader for the ind-th noise level."""
+        if isinstance(ind, slice):
+            return NoisyLoaders(self.build_loader, self.noise_levels[ind])
+        return self.build_loader(self.noise_levels[ind])
+
+    def __len__(self):
+        """Get number of noise levels."""
+        return len(self.noise_levels)
+
+
+class RobustTestSuite(Mapping):
+    """Maps each noisy modality to a NoisyLoaders sequence.
+
+    Drop-in replacement for the dict of dataloader lists that the `test` functions in `training_structures` iterate over. Only one noisy test set exists at a time, so memory stays flat no matter how many noise levels are swept.
+    """
+
+    def __init__(self):
+        """Instantiate an empty RobustTestSuite."""
+        self._loaders = dict()
+
+    def add(self, noisy_modality, build_loader, noise_levels):
+        """Register the dataloaders for one noisy modality.
+
+        Args:
+            noisy_modality (str): Name of the noise setting, e.g. 'timeseries' or 'robust_text'.
+            build_loader (callable): Function taking a noise level and returning the dataloader for it.
+            noise_levels (list): Noise levels to sweep.
+
+        Returns:
+            RobustTestSuite: self, so calls can be chained.
+        """
+        self._loaders[noisy_modality] = NoisyLoaders(build_loader, noise_levels)
+        return self
+
+    def __getitem__(self, noisy_modality):
+        """Get the NoisyLoaders of a noisy modality."""
+        return self._loaders[noisy_modality]
+
+    def __iter__(self):
+        """Iterate over noisy modalities."""
+        return iter(self._loaders)
+
+    def __len__(self):
+        """Get number of noisy modalities."""
+        return len(self._loaders)
@@ -1,11 +1,15 @@
-"""Implements text transformations."""
+"""Implements text transformations.
+
+`TextCorpus` tokenizes a corpus once and corrupts it at any noise level by drawing the decisions for all of its tokens as arrays, so only the corrupted tokens are touched in Python. `WordEmbeddingCache` embeds the vocabulary of a corpus once and keeps the embeddings of corrupted words in an LRU cache, so re-embedding a noisy corpus only looks up the corrupted words.
+"""
 import numpy as np
 import re
-from tqdm import tqdm
+from collections import OrderedDict, namedtuple
+from itertools import compress
 
 ##############################################################################
 # Text
-def add_text_noise(tests, noise_level=0.3, swap=True, rand_mid=True, typo=True, sticky=True, omit=True):
+def add_text_noise(tests, noise_level=0.3, swap=True, rand_mid=True, typo=True, sticky=True, omit=True, seed=None):
     """
     Add various types of noise to text data.
     
@@ -15,30 +19,167 @@ def add_text_noise(tests, noise_level=0.3, swap=True, rand_mid=True, typo=True,
     :param typo: Simulate keyboard typos for the word. ( default: True )
     :param sticky: Randomly repeat letters inside a word. ( default: True )
     :param omit: Randomly omit some letters from a word ( default: True )
+    :param seed: Integer seed or `np.random.RandomState` to draw noise from. Uses the global numpy random state if None. ( default: None )
     """
-    noises = []
-    if swap:
-        noises.append(swap_letter)
-    if rand_mid:
-        noises.append(random_mid)
-    if typo:
-        noises.append(qwerty_typo)
-    if sticky:
-        noises.append(sticky_keys)
-    if omit:
-        noises.append(omission)
-    robustness_tests = []
-    for i in tqdm(range(len(tests))):
-        newtext = []
-        text = _normalizeText(tests[i])
-        for word in text:
-            if _last_char(word) > 3 and np.random.sample() <= noise_level:
-                mode = np.random.randint(len(noises))
-                newtext.append(noises[mode](word))
-            else:
-                newtext.append(word)
-        robustness_tests.append(' '.join(newtext))
-    return robustness_tests
+    corpus = TextCorpus(tests)
+    return corpus.texts(corpus.corrupt(noise_level, swap, rand_mid, typo, sticky, omit, seed=seed))
+
+
+Corruption = namedtuple('Corruption', ['positions', 'words'])
+Corruption.__doc__ = """Corrupted tokens of a TextCorpus: the flat token positions that changed, and the words they changed to."""
+
+
+class TextCorpus:
+    """Tokenized corpus that can be corrupted at any noise level without tokenizing it again."""
+
+    def __init__(self, texts):
+        """Initialize TextCorpus object.
+
+        :param texts: List of documents. Each document is normalized and split into words once.
+        """
+        documents = [_normalizeText(t) for t in texts]
+        lengths = np.array([len(d) for d in documents], dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)])
+        word2id = dict()
+        self.ids = np.array([word2id.setdefault(w, len(word2id)) for d in documents for w in d], dtype=np.int64)
+        self.vocab = list(word2id)
+        self._eligible = np.array([_last_char(w) > 3 for w in self.vocab], dtype=bool)
+        self._clean = None
+
+    def __len__(self):
+        """Get the number of documents."""
+        return len(self.offsets) - 1
+
+    def corrupt(self, noise_level=0.3, swap=True, rand_mid=True, typo=True, sticky=True, omit=True, seed=None):
+        """Draw the noise of every token at once and apply it to the selected tokens.
+
+        :param noise_level: Probability of randomly applying noise to a word.
+        :param seed: Integer seed or `np.random.RandomState` to draw noise from. Uses the global numpy random state if None.
+        :return: A `Corruption` to pass to `texts` or `embed`.
+
+        The other parameters toggle the noises as in `add_text_noise`.
+        """
+        noises = [noise for noise, on in [(swap_letter, swap), (random_mid, rand_mid), (qwerty_typo, typo),
+                                          (sticky_keys, sticky), (omission, omit)] if on]
+        rng = _get_rng(seed)
+        selected = rng.random_sample(len(self.ids)) <= noise_level
+        positions = np.flatnonzero(selected & self._eligible[self.ids])
+        if not noises:
+            return Corruption(positions[:0], [])
+        modes = rng.randint(len(noises), size=len(positions))
+        words = [noises[mode](self.vocab[self.ids[pos]], rng=rng) for pos, mode in zip(positions, modes)]
+        return Corruption(positions, words)
+
+    def texts(self, corruption=None):
+        """Get the documents as strings of space separated words.
+
+        :param corruption: `Corruption` to apply, as returned by `corrupt`. Gets the clean documents if None.
+        """
+        words = np.array(self.vocab, dtype=object)[self.ids]
+        if corruption is not None:
+            words[corruption.positions] = corruption.words
+        return [' '.join(words[start:end]) for start, end in zip(self.offsets[:-1], self.offsets[1:])]
+
+    def embed(self, embedder, corruption=None):
+        """Embed the words of every document.
+
+        The vocabulary is embedded once per embedder, and only the corrupted tokens are looked up again.
+
+        :param embedder: `WordEmbeddingCache` to embed words with.
+        :param corruption: `Corruption` to apply, as returned by `corrupt`. Embeds the clean documents if None.
+        :return: Generator of (vectors, found) per document, of shapes [num_words, dim] and [num_words], where found tells which words the embedding knows.
+        """
+        if self._clean is None or self._clean[0] is not embedder:
+            self._clean = (embedder,) + embedder(self.vocab, cache=False)
+        _, vocab_vectors, vocab_found = self._clean
+        if corruption is None:
+            corruption = Corruption(np.zeros(0, dtype=np.int64), [])
+        changed_vectors, changed_found, changed_index = embedder._embed_unique(corruption.words)
+        # The corrupted tokens of every document, as a range of the sorted positions
+        bounds = np.searchsorted(corruption.positions, self.offsets)
+        for i in range(len(self)):
+            start, end = self.offsets[i], self.offsets[i + 1]
+            ids = self.ids[start:end]
+            vectors, found = vocab_vectors[ids], vocab_found[ids]
+            changed = slice(bounds[i], bounds[i + 1])
+            vectors[corruption.positions[changed] - start] = changed_vectors[changed_index[changed]]
+            found[corruption.positions[changed] - start] = changed_found[changed_index[changed]]
+            yield vectors, found
+
+
+class WordEmbeddingCache:
+    """Embeds words through a lookup function, caching the embeddings of corrupted words."""
+
+    def __init__(self, lookup, dim, max_size=2 ** 17):
+        """Initialize WordEmbeddingCache object.
+
+        :param lookup: Function taking a list of words and returning their embeddings as a [num_words, dim] array and a boolean array telling which words the embedding knows.
+        :param dim: Dimension of the embeddings.
+        :param max_size: Maximum number of corrupted words to keep the embeddings of.
+        """
+        self.lookup = lookup
+        self.dim = dim
+        self.max_size = max_size
+        # LRU order of the cached words, each mapped to its row in _vectors and _found
+        self._slots = OrderedDict()
+        self._vectors = np.zeros((0, dim), dtype=np.float32)
+        self._found = np.zeros(0, dtype=bool)
+
+    def __call__(self, words, cache=True):
+        """Embed a list of words.
+
+        :param words: Words to embed.
+        :param cache: Whether to look words up in, and add them to, the LRU cache. A corpus embeds its own vocabulary once without it.
+        :return: Tuple of the embeddings, of shape [num_words, dim], and a boolean array telling which words the embedding knows.
+        """
+        if not cache:
+            return self._lookup(list(words))
+        vectors, found, inverse = self._embed_unique(words)
+        if len(vectors) == len(words):
+            return vectors, found
+        return vectors[inverse], found[inverse]
+
+    def _embed_unique(self, words):
+        """Embed the distinct words of a list, returning their embeddings and the index of every word among them."""
+        index = dict()
+        inverse = np.fromiter((index.setdefault(w, len(index)) for w in words), dtype=np.int64, count=len(words))
+        unique = list(index)
+        slots = np.array([self._slots.get(w, -1) for w in unique], dtype=np.int64)
+        hit = slots >= 0
+        missing = [w for w, h in zip(unique, hit) if not h]
+        missing_vectors, missing_found = self._lookup(missing)
+        if not hit.any():
+            vectors, found = missing_vectors, missing_found
+        else:
+            vectors = np.empty((len(unique), self.dim), dtype=np.float32)
+            found = np.empty(len(unique), dtype=bool)
+            vectors[hit], found[hit] = self._vectors[slots[hit]], self._found[slots[hit]]
+            vectors[~hit], found[~hit] = missing_vectors, missing_found
+            for w in compress(unique, hit):
+                self._slots.move_to_end(w)
+        self._insert(missing, missing_vectors, missing_found)
+        return vectors, found, inverse
+
+    def _insert(self, words, vectors, found):
+        keep = slice(max(len(words) - self.max_size, 0), None)
+        words, vectors, found = words[keep], vectors[keep], found[keep]
+        if len(self._vectors) == 0:
+            # only the rows that get written take up memory
+            self._vectors = np.empty((self.max_size, self.dim), dtype=np.float32)
+            self._found = np.empty(self.max_size, dtype=bool)
+        used = len(self._slots)
+        free = min(len(words), self.max_size - used)
+        slots = list(range(used, used + free))
+        slots += [self._slots.popitem(last=False)[1] for _ in range(len(words) - free)]
+        slots = np.array(slots, dtype=np.int64)
+        self._vectors[slots], self._found[slots] = vectors, found
+        self._slots.update(zip(words, slots.tolist()))
+
+    def _lookup(self, words):
+        if not words:
+            return np.zeros((0, self.dim), dtype=np.float32), np.zeros(0, dtype=bool)
+        vectors, found = self.lookup(words)
+        return np.asarray(vectors, dtype=np.float32).reshape(len(words), self.dim), np.asarray(found, dtype=bool)
 
 
 def _normalizeText(text):
@@ -63,69 +204,82 @@ def _last_char(word):
     return -1
 
 
-def swap_letter(word):
+def swap_letter(word, rng=np.random):
     """Swap two random adjacent letters.
     
     :param word: word to apply transformations to.
+    :param rng: `np.random.RandomState` to draw from. ( default: the global numpy random state )
     """
     last = _last_char(word)
-    pos = np.random.randint(last-2) + 1
+    pos = rng.randint(last-2) + 1
     return word[:pos] + word[pos+1] + word[pos] + word[pos+2:]
 
 
-def random_mid(word):
+def random_mid(word, rng=np.random):
     """Randomly permute the middle chunk of a word (all letters except the first and last letter).
     
     :param word: word to apply transformations to.
+    :param rng: `np.random.RandomState` to draw from. ( default: the global numpy random state )
     """
     last = _last_char(word)
     mid = [char for char in word[1:last]]
-    np.random.shuffle(mid)
+    rng.shuffle(mid)
     return word[0]+''.join(mid)+word[last:]
 
 
-def qwerty_typo(word):
+def qwerty_typo(word, rng=np.random):
     """Randomly replace num_typo number of letters of a word to a one adjacent to it on qwerty keyboard.
     
     :param word: word to apply transformations to.:
+    :param rng: `np.random.RandomState` to draw from. ( default: the global numpy random state )
     """
     qwerty = {'q': ['w'], 'w': ['q', 'e', 's'], 'e': ['w', 'r', 'd'], 'r': ['e', 't', 'f'], 't': ['r', 'g', 'y'], 'y': ['t', 'u', 'h'], 'u': ['y', 'i', 'j'], 'i': ['u', 'o', 'k'], 'o': ['i', 'p', 'l'], 'p': ['o'], 'a': ['q', 's', 'z'], 's': ['a', 'w', 'd', 'x', 'z'], 'd': ['s', 'e', 'f', 'x', 'c'], 'f': ['d', 'r', 'g', 'c', 'v'], 'g': [
         'f', 't', 'h', 'v', 'b'], 'h': ['g', 'y', 'j', 'b', 'n'], 'j': ['h', 'u', 'k', 'n', 'm'], 'k': ['j', 'i', 'l', 'm'], 'l': ['k', 'o'], 'z': ['a', 's', 'x'], 'x': ['z', 's', 'd', 'c'], 'c': ['x', 'd', 'f', 'v'], 'v': ['c', 'f', 'g', 'b'], 'b': ['v', 'g', 'h', 'n'], 'n': ['b', 'h', 'm', 'j'], 'm': ['n', 'j', 'k']}
     last = _last_char(word)
     typos = np.arange(last+1)
-    np.random.shuffle(typos)
+    rng.shuffle(typos)
     for i in range(len(typos)):
         if word[typos[i]] in qwerty:
             typo = qwerty[word[typos[i]]]
-            key = typo[np.random.randint(len(typo))]
+            key = typo[rng.randint(len(typo))]
             word = word[:typos[i]] + key + word[typos[i]+1:]
             break
     return word
 
 
-def sticky_keys(word, num_sticky=1):
+def sticky_keys(word, num_sticky=1, rng=np.random):
     """Randomly repeat letters of a word once.
     
     :param word: word to apply transformations to.
     :param num_sticky: Number of letters to randomly repeat once.
+    :param rng: `np.random.RandomState` to draw from. ( default: the global numpy random state )
     """
     last = _last_char(word)
     sticky = np.arange(last+1)
-    np.random.shuffle(sticky)
+    rng.shuffle(sticky)
     for i in range(num_sticky):
         word = word[:sticky[i]] + word[sticky[i]] + word[sticky[i]:]
     return word
 
 
-def omission(word, num_omit=1):
+def omission(word, num_omit=1, rng=np.random):
     """Randomly omit num_omit number of letters of a word.
     
     :param word: word to apply transformations to.
     :param num_sticky: Number of letters to randomly omit.
+    :param rng: `np.random.RandomState` to draw from. ( default: the global numpy random state )
     """
     last = _last_char(word)
     for i in range(num_omit):
-        omit = np.random.randint(last-1) + 1
+        omit = rng.randint(last-1) + 1
         word = word[:omit] + word[omit+1:]
         last -= 1
     return word
+
+
+def _get_rng(seed):
+    if seed is None:
+        return np.random
+    if isinstance(seed, np.random.RandomState):
+        return seed
+    return np.random.RandomState(seed)
@@ -1,81 +1,214 @@
 """Implements timeseries transformations."""
 import numpy as np
+import torch
+
+try:
+    from torch.utils.data import default_collate
+except ImportError:  # torch < 1.11 does not export it
+    from torch.utils.data._utils.collate import default_collate
 
 
 ##############################################################################
 # Time-Series
-def add_timeseries_noise(tests, noise_level=0.3, gaussian_noise=True, rand_drop=True, struct_drop=True):
+def add_timeseries_noise(tests, noise_level=0.3, gaussian_noise=True, rand_drop=True, struct_drop=True, seed=None):
     """
     Add various types of noise to timeseries data.
-    
+
+    Every noise is applied to the whole array in one vectorized pass. `tests` is either an array/tensor of shape [N, T, ...] or a list of such arrays (e.g. one per modality), in which case the list itself is treated as the leading axis.
+
     :param noise_level: Standard deviation of gaussian noise, and drop probability in random drop and structural drop
     :param gauss_noise:  Add Gaussian noise to the time series ( default: True )
     :param rand_drop: Add randomized dropout to the time series ( default: True )
     :param struct_drop: Add randomized structural dropout to the time series ( default: True )
+    :param seed: Integer seed or `np.random.Generator` to draw noise from. Uses the global numpy random state if None. ( default: None )
     """
-    # robust_tests = np.array(tests)
+    rng = _get_rng(seed)
     robust_tests = tests
     if gaussian_noise:
-        robust_tests = white_noise(robust_tests, noise_level)
+        robust_tests = white_noise(robust_tests, noise_level, rng)
     if rand_drop:
-        robust_tests = random_drop(robust_tests, noise_level)
+        robust_tests = random_drop(robust_tests, noise_level, rng)
     if struct_drop:
-        robust_tests = structured_drop(robust_tests, noise_level)
+        robust_tests = structured_drop(robust_tests, noise_level, rng)
     return robust_tests
 
 
-def white_noise(data, p):
+def white_noise(data, p, rng=None):
     """Add noise sampled from zero-mean Gaussian with standard deviation p at every time step.
-    
+
     :param data: Data to process.
     :param p: Standard deviation of added Gaussian noise.
+    :param rng: Optional `np.random.Generator` to draw noise from.
     """
-    for i in range(len(data)):
-        for time in range(len(data[i])):
-            data[i][time] += np.random.normal(0, p)
-    return data
-
+    def _apply(x, step_shape):
+        noise = _normal(p, step_shape, rng)
+        x += _like(_expand(noise, x.ndim), x)
+    return _map_steps(data, _apply)
 
 
-
-def random_drop(data, p):
+def random_drop(data, p, rng=None):
     """Drop each time series entry independently with probability p.
-    
+
     :param data: Data to process.
     :param p: Probability to drop feature.
+    :param rng: Optional `np.random.Generator` to draw noise from.
     """
-    for i in range(len(data)):
-        data[i] = _random_drop_helper(data[i], p, len(np.array(data).shape))
-    return data
+    def _apply(x, step_shape):
+        _fill_zero(x, _uniform(tuple(x.shape), rng) < p)
+    return _map_steps(data, _apply)
 
 
-def _random_drop_helper(data, p, level):
-    """
-    Helper function that implements random drop for 2-/higher-dimentional timeseris data.
+def structured_drop(data, p, rng=None):
+    """Drop each time series entry independently with probability p, but drop all modalities if you drop an element.
 
     :param data: Data to process.
-    :param p: Probability to drop feature.
-    :param level: Dimensionality.
+    :param p: Probability to drop entire element of time series.
+    :param rng: Optional `np.random.Generator` to draw noise from.
     """
-    if level == 2:
-        for i in range(len(data)):
-            if np.random.random_sample() < p:
-                data[i] = 0
-        return data
+    def _apply(x, step_shape):
+        _fill_zero(x, _expand(_uniform(step_shape, rng) < p, x.ndim))
+    return _map_steps(data, _apply)
+
+
+class TimeseriesNoiseCollate:
+    """Collate function that corrupts timeseries modalities of every batch on the fly.
+
+    Wraps an existing collate function so that noisy test sets do not have to be materialized up front: each collated batch of shape [B, T, ...] is corrupted in place with `add_timeseries_noise`.
+    """
+
+    def __init__(self, collate_fn=None, modalities=(0,), noise_level=0.3, gaussian_noise=True, rand_drop=True, struct_drop=True, seed=None):
+        """Instantiate TimeseriesNoiseCollate.
+
+        :param collate_fn: Collate function to wrap. Uses torch's default collate if None.
+        :param modalities: Positions of the timeseries modalities in the collated batch. A tuple such as (0, 1) indexes into nested batches.
+        :param noise_level: Standard deviation of gaussian noise, and drop probability in random drop and structural drop
+        :param gaussian_noise: Add Gaussian noise to the time series ( default: True )
+        :param rand_drop: Add randomized dropout to the time series ( default: True )
+        :param struct_drop: Add randomized structural dropout to the time series ( default: True )
+        :param seed: Base seed. Noise for each batch is drawn from a generator keyed on (seed, worker id, batch count), so a fixed number of workers gives reproducible outputs. ( default: None )
+        """
+        self.collate_fn = collate_fn if collate_fn is not None else default_collate
+        self.modalities = modalities
+        self.noise_level = noise_level
+        self.gaussian_noise = gaussian_noise
+        self.rand_drop = rand_drop
+        self.struct_drop = struct_drop
+        self.seed = seed
+        self._batches = 0
+
+    def __call__(self, inputs):
+        """Collate inputs and corrupt the selected modalities."""
+        batch = self.collate_fn(inputs)
+        rng = self._next_rng()
+
+        def _corrupt(x):
+            if torch.is_tensor(x) and not x.is_floating_point():
+                x = x.float()
+            return add_timeseries_noise(x, self.noise_level, self.gaussian_noise, self.rand_drop, self.struct_drop, seed=rng)
+
+        for modality in self.modalities:
+            path = modality if isinstance(modality, tuple) else (modality,)
+            batch = _replace(batch, path, _corrupt)
+        return batch
+
+    def _next_rng(self):
+        if self.seed is None:
+            return None
+        info = torch.utils.data.get_worker_info()
+        worker = 0 if info is None else info.id
+        self._batches += 1
+        return np.random.default_rng([self.seed, worker, self._batches])
+
+
+class TimeseriesSampleNoise:
+    """Corrupts one sample at a time, e.g. inside `Dataset.__getitem__`.
+
+    Per-sample decisions are drawn once for the whole split, so each sample is corrupted the same way as when the full [N, T, ...] array is wrapped in a list and passed to `add_timeseries_noise`: one gaussian offset per sample, elementwise random drop, and structured drop of the whole sample.
+    """
+
+    def __init__(self, num_samples, noise_level=0.3, gaussian_noise=True, rand_drop=True, struct_drop=True, seed=None):
+        """Instantiate TimeseriesSampleNoise.
+
+        :param num_samples: Number of samples in the split.
+        :param noise_level: Standard deviation of gaussian noise, and drop probability in random drop and structural drop
+        :param gaussian_noise: Add Gaussian noise to the time series ( default: True )
+        :param rand_drop: Add randomized dropout to the time series ( default: True )
+        :param struct_drop: Add randomized structural dropout to the time series ( default: True )
+        :param seed: Integer seed. Drawn from the global numpy random state if None. ( default: None )
+        """
+        if seed is None:
+            seed = np.random.randint(2 ** 31)
+        rng = np.random.default_rng(seed)
+        self.noise_level = noise_level
+        self.rand_drop = rand_drop
+        self.seed = seed
+        self.offsets = rng.normal(0, noise_level, num_samples) if gaussian_noise else np.zeros(num_samples)
+        self.dropped = rng.random(num_samples) < noise_level if struct_drop else np.zeros(num_samples, dtype=bool)
+
+    def __call__(self, sample, ind):
+        """Return a corrupted copy of `sample`, the ind-th sample of the split."""
+        x = np.array(sample, dtype=np.result_type(sample, np.float32))
+        if self.dropped[ind]:
+            return np.zeros_like(x)
+        x += self.offsets[ind]
+        if self.rand_drop:
+            rng = np.random.default_rng([self.seed, int(ind)])
+            x[rng.random(x.shape) < self.noise_level] = 0
+        return x
+
+
+def _replace(batch, path, fn):
+    """Replace the entry of a (nested) batch at `path` with `fn(entry)`, turning tuples into lists."""
+    batch = list(batch) if isinstance(batch, tuple) else batch
+    if len(path) == 1:
+        batch[path[0]] = fn(batch[path[0]])
     else:
-        for i in range(len(data)):
-            data[i] = _random_drop_helper(data[i], p, level - 1)
-        return data
+        batch[path[0]] = _replace(batch[path[0]], path[1:], fn)
+    return batch
 
 
-def structured_drop(data, p):
-    """Drop each time series entry independently with probability p, but drop all modalities if you drop an element.
-    
-    :param data: Data to process.
-    :param p: Probability to drop entire element of time series.
+def _get_rng(seed):
+    if seed is None or isinstance(seed, np.random.Generator):
+        return seed
+    return np.random.default_rng(seed)
+
+
+def _uniform(shape, rng):
+    return np.random.random_sample(shape) if rng is None else rng.random(shape)
+
+
+def _normal(scale, shape, rng):
+    return np.random.normal(0, scale, shape) if rng is None else rng.normal(0, scale, shape)
+
+
+def _expand(arr, ndim):
+    """Append singleton axes so a per-timestep array broadcasts over the feature axes."""
+    return arr.reshape(arr.shape + (1,) * (ndim - arr.ndim))
+
+
+def _like(arr, x):
+    if torch.is_tensor(x):
+        return torch.from_numpy(arr).to(device=x.device, dtype=x.dtype)
+    return arr
+
+
+def _fill_zero(x, mask):
+    if torch.is_tensor(x):
+        x.masked_fill_(torch.from_numpy(mask).to(x.device), 0)
+    else:
+        x[np.broadcast_to(mask, x.shape)] = 0
+
+
+def _map_steps(data, fn):
+    """Apply `fn(x, step_shape)` over the (sample, time) axes of `data` in place.
+
+    Arrays and tensors are processed in one call with the first two axes as the time steps. Lists are treated as the leading axis, so each element is processed with its own first axis as the time steps.
     """
+    if isinstance(data, np.ndarray) or torch.is_tensor(data):
+        fn(data, tuple(data.shape[:2]))
+        return data
     for i in range(len(data)):
-        for time in range(len(data[i])):
-            if np.random.random_sample() < p:
-                data[i][time] = np.zeros(data[i][time].shape)
+        if not (isinstance(data[i], np.ndarray) or torch.is_tensor(data[i])):
+            data[i] = np.array(data[i], dtype=float)
+        fn(data[i], tuple(data[i].shape[:1]))
     return data
@@ -1,15 +1,21 @@
-"""Implements visual transformations."""
+"""Implements visual transformations.
+
+`add_visual_noise_batch` corrupts a batch of images at once: the color and noise corruptions are vectorized numpy kernels over [N, H, W, 3] uint8 chunks, rotation and cropping run PIL's single-pass C kernels on the selected images only, and the random decisions of all images are drawn in bulk from one seedable generator. The result matches the PIL-based per-image transformations below (`grayscale`, `low_contrast`, ..., `random_crop`) pixel for pixel.
+"""
 import numpy as np
+import torch
 from PIL import Image, ImageOps, ImageEnhance
 import colorsys
 
 
 ##############################################################################
 # Visual
-def add_visual_noise(tests, noise_level=0.3, gray=True, contrast=True, inv=True, temp=True, color=True, s_and_p=True, gaus=True, rot=True, flip=True, crop=True):
+def add_visual_noise(tests, noise_level=0.3, gray=True, contrast=True, inv=True, temp=True, color=True, s_and_p=True, gaus=True, rot=True, flip=True, crop=True, seed=None):
     """
     Add various types of noise to visual data.
 
+    Images of the same shape and dtype are corrupted together with `add_visual_noise_batch`.
+
     :param noise_level: Probability of randomly applying noise to each audio signal, and standard deviation for gaussian noise, and structured dropout probability.
     :param gray: Boolean flag denoting if grayscale should be applied as a noise type.
     :param contrast: Boolean flag denoting if lowering the contrast should be applied as a noise type. 
@@ -21,38 +27,113 @@ def add_visual_noise(tests, noise_level=0.3, gray=True, contrast=True, inv=True,
     :param rot: Boolean flag denoting if randomly rotating the image should be applied as a noise type. 
     :param flip: Boolean flag denoting if randomly flipping the image should be applied as a noise type. 
     :param crop: Boolean flag denoting if randomly cropping the image should be applied as a noise type. 
+    :param seed: Integer seed or `np.random.Generator` to draw noise from. Drawn from the global numpy random state if None. ( default: None )
+    """
+    rng = _get_rng(seed)
+    groups = dict()
+    for i in range(len(tests)):
+        img = np.asarray(tests[i])
+        groups.setdefault((img.shape, img.dtype.str), []).append(i)
+    robustness_tests = [None] * len(tests)
+    for inds in groups.values():
+        noisy = add_visual_noise_batch(np.stack([np.asarray(tests[i]) for i in inds]), noise_level, gray, contrast, inv,
+                                       temp, color, s_and_p, gaus, rot, flip, crop, seed=rng)
+        for i, img in zip(inds, noisy):
+            robustness_tests[i] = img
+    return robustness_tests
+
+
+def add_visual_noise_batch(images, noise_level=0.3, gray=True, contrast=True, inv=True, temp=True, color=True, s_and_p=True, gaus=True, rot=True, flip=True, crop=True, seed=None):
+    """
+    Add various types of noise to a batch of images, one noise type at a time over the whole batch.
+
+    Each image is corrupted as by applying `grayscale`, `low_contrast`, `inversion`, `WB`, `colorize`, `salt_and_pepper`, `gaussian`, `rotate`, `horizontal_flip` and `random_crop` to it in turn, with all random decisions drawn per image in bulk.
+
+    :param images: Array or tensor of shape [N, H, W] (grayscale) or [N, H, W, 3] (RGB). uint8 images are processed directly; other images are converted to RGB and back through PIL, as in `add_visual_noise`.
+    :param noise_level: Probability of applying each noise to each image, and standard deviation for gaussian noise.
+    :param gray, contrast, inv, temp, color, s_and_p, gaus, rot, flip, crop: Boolean flags denoting which noise types to apply, as in `add_visual_noise`.
+    :param seed: Integer seed or `np.random.Generator` to draw noise from. Drawn from the global numpy random state if None. ( default: None )
+    :returns: Corrupted images, in the type and layout of `images`. Cropping resizes an H x W image to W x H (as `random_crop` does), so for non-square images a list of arrays is returned if only some of them are cropped.
     """
-    noises = []
+    rng = _get_rng(seed)
+    is_tensor = torch.is_tensor(images)
+    arr = images.cpu().numpy() if is_tensor else np.asarray(images)
+    if len(arr) == 0:
+        return images
+    # corrupt a few images at a time so every kernel works on data that fits in cache
+    step = max(1, _CHUNK_PIXELS // (arr.shape[1] * arr.shape[2]))
+    flags = (gray, contrast, inv, temp, color, s_and_p, gaus, rot, flip, crop)
+    chunks = [_corrupt(arr[start:start+step], noise_level, flags, rng) for start in range(0, len(arr), step)]
+    if all(isinstance(chunk, np.ndarray) for chunk in chunks) and len({chunk.shape[1:] for chunk in chunks}) == 1:
+        out = np.concatenate(chunks)
+        return torch.from_numpy(out) if is_tensor else out
+    out = [img for chunk in chunks for img in chunk]
+    return [torch.from_numpy(img) for img in out] if is_tensor else out
+
+
+_CHUNK_PIXELS = 2 ** 18
+
+
+def _corrupt(arr, p, flags, rng):
+    """Apply the noises of add_visual_noise_batch to a chunk of images, drawing all random decisions of the chunk at once."""
+    gray, contrast, inv, temp, color, s_and_p, gaus, rot, flip, crop = flags
+    x, mode = _to_rgb(arr)
+    n = len(x)
+    # whether each image is in mode 'L' (all channels equal) rather than 'RGB'
+    is_gray = np.zeros(n, dtype=bool)
+
+    def _draw():
+        return rng.random(n) <= p
+
     if gray:
-        noises.append(grayscale)
+        apply = _draw()
+        x[apply] = _luma(x[apply])[..., None]
+        is_gray |= apply
     if contrast:
-        noises.append(low_contrast)
+        apply = _draw()
+        x[apply] = _low_contrast(x[apply])
     if inv:
-        noises.append(inversion)
+        apply = _draw()
+        x[apply] = 255 - x[apply]
     if temp:
-        noises.append(WB)
+        apply = _draw() & ~is_gray
+        kelvin = rng.integers(len(_KELVIN_TABLE), size=n)
+        x[apply] = _white_balance(x[apply], kelvin[apply])
     if color:
-        noises.append(colorize)
+        apply = _draw() & ~is_gray
+        tint = rng.integers(len(_TINTS), size=n)
+        x[apply] = _blend(x[apply], _TINTS[tint[apply]][:, None, None, :], 0.3)
     if s_and_p:
-        noises.append(salt_and_pepper)
+        apply = _draw()
+        x[apply] = _luma(x[apply])[..., None]
+        is_gray |= apply
+        _salt_and_pepper(x, np.flatnonzero(apply), p, rng)
     if gaus:
-        noises.append(gaussian)
+        apply = _draw()
+        noise = rng.normal(0, p, (int(apply.sum()),) + x.shape[1:3])
+        x[apply] = ((_luma(x[apply]) + noise).astype('uint8'))[..., None]
+        is_gray |= apply
     if rot:
-        noises.append(rotate)
+        apply = _draw()
+        angles = rng.random(n) * 40 - 20
+        _rotate(x, np.flatnonzero(apply), angles)
     if flip:
-        noises.append(horizontal_flip)
+        apply = _draw()
+        x[apply] = x[apply, :, ::-1]
     if crop:
-        noises.append(random_crop)
-    robustness_tests = []
-    for i in range(len(tests)):
-        img = Image.fromarray(tests[i])
-        mode = img.mode
-        img = img.convert('RGB')
-        for noise in noises:
-            img = noise(img, noise_level)
-        img = img.convert(mode)
-        robustness_tests.append(np.array(img))
-    return robustness_tests
+        apply = _draw()
+        offsets = rng.random((n, 2))
+        x = _random_crop(x, apply, offsets)
+    if isinstance(x, list):
+        return [_from_rgb(img[None], is_gray[i:i+1], mode)[0] for i, img in enumerate(x)]
+    return _from_rgb(x, is_gray, mode)
+
+
+_KELVIN_TABLE = {1000: (255, 56, 0), 1500: (255, 109, 0), 2000: (255, 137, 18), 2500: (255, 161, 72), 3000: (255, 180, 107), 3500: (255, 196, 137), 4000: (255, 209, 163), 4500: (255, 219, 186), 5000: (255, 228, 206), 5500: (
+    255, 236, 224), 6000: (255, 243, 239), 6500: (255, 249, 253), 7000: (245, 243, 255), 7500: (235, 238, 255), 8000: (227, 233, 255), 8500: (220, 229, 255), 9000: (214, 225, 255), 9500: (208, 222, 255), 10000: (204, 219, 255)}
+
+# 'red', 'blue' and 'green' as PIL's ImageColor defines them
+_TINTS = np.array([(255, 0, 0), (0, 0, 255), (0, 128, 0)], dtype=np.uint8)
 
 
 def grayscale(img, p):
@@ -100,8 +181,7 @@ def WB(img, p):
     :param p: Probability of applying transformation.
     """
     if np.random.sample() <= p and img.mode == 'RGB':
-        kelvin_table = {1000: (255, 56, 0), 1500: (255, 109, 0), 2000: (255, 137, 18), 2500: (255, 161, 72), 3000: (255, 180, 107), 3500: (255, 196, 137), 4000: (255, 209, 163), 4500: (255, 219, 186), 5000: (255, 228, 206), 5500: (
-            255, 236, 224), 6000: (255, 243, 239), 6500: (255, 249, 253), 7000: (245, 243, 255), 7500: (235, 238, 255), 8000: (227, 233, 255), 8500: (220, 229, 255), 9000: (214, 225, 255), 9500: (208, 222, 255), 10000: (204, 219, 255)}
+        kelvin_table = _KELVIN_TABLE
         temps = list(kelvin_table.keys())
         temp = temps[np.random.choice(len(temps))]
         r, g, b = kelvin_table[temp]
@@ -139,13 +219,11 @@ def salt_and_pepper(img, p):
         nb_salt = np.ceil(p*output.size*0.5)
         coords = [np.random.randint(0, i-1, int(nb_salt))
                   for i in output.shape]
-        for i in range(int(nb_salt)):
-            output[coords[0][i]][coords[1][i]] = 1
+        output[coords[0], coords[1]] = 1
         nb_pepper = np.ceil(p*output.size*0.5)
         coords = [np.random.randint(0, i-1, int(nb_pepper))
                   for i in output.shape]
-        for i in range(int(nb_pepper)):
-            output[coords[0][i]][coords[1][i]] = 0
+        output[coords[0], coords[1]] = 0
         return Image.fromarray(output)
     else:
         return img
@@ -211,3 +289,107 @@ def periodic(img, periodic_noise_filename="periodic_noise"): # pragma: no cover
             (width*2, height*2)), np.random.random_sample()*360, 'white'), height, width)
         output.append(Image.blend(img.convert("RGBA"), noise, 0.3))
     return output
+
+
+def _get_rng(seed):
+    if isinstance(seed, np.random.Generator):
+        return seed
+    if seed is None:
+        seed = np.random.randint(2 ** 31)
+    return np.random.default_rng(seed)
+
+
+def _to_rgb(arr):
+    """Get images as a new [N, H, W, 3] uint8 array, and the PIL mode to convert them back to."""
+    if arr.dtype == np.uint8 and arr.ndim == 3:
+        return np.repeat(arr[..., None], 3, axis=-1), 'L'
+    if arr.dtype == np.uint8 and arr.ndim == 4 and arr.shape[-1] == 3:
+        return arr.copy(), 'RGB'
+    imgs = [Image.fromarray(img) for img in arr]
+    return np.stack([np.array(img.convert('RGB')) for img in imgs]), imgs[0].mode
+
+
+def _from_rgb(x, is_gray, mode):
+    """Convert [N, H, W, 3] uint8 images back to mode, taking images in is_gray to be in mode 'L'."""
+    if mode == 'L':
+        return _luma(x)
+    if mode == 'RGB':
+        return x
+    return np.stack([np.array(Image.fromarray(img[..., 0] if g else img).convert(mode)) for img, g in zip(x, is_gray)])
+
+
+def _luma(x):
+    """Convert [..., 3] RGB to L with PIL's fixed-point ITU-R 601-2 luma transform."""
+    acc = x[..., 0] * np.uint32(19595)
+    acc += x[..., 1] * np.uint32(38470)
+    acc += x[..., 2] * np.uint32(7471)
+    acc += 0x8000
+    acc >>= 16
+    return acc.astype(np.uint8)
+
+
+def _blend(x, other, alpha):
+    """Blend x towards other as PIL's Image.blend(x, other, alpha) does, in single precision."""
+    x32 = x.astype(np.float32)
+    return (x32 + np.float32(alpha) * (other.astype(np.float32) - x32)).astype(np.uint8)
+
+
+def _low_contrast(x):
+    """Halve the contrast of each image around its mean luma, as ImageEnhance.Contrast(img).enhance(0.5) does."""
+    luma = _luma(x).reshape(len(x), x.shape[1] * x.shape[2])
+    mean = np.floor(luma.sum(1, dtype=np.int64) / luma.shape[1] + 0.5).astype(np.uint16)
+    return ((mean[:, None, None, None] + x) >> 1).astype(np.uint8)
+
+
+def _white_balance(x, kelvin):
+    """Scale the channels of each image by the color of a temperature in _KELVIN_TABLE, as WB does."""
+    scales = (np.array(list(_KELVIN_TABLE.values())) / 255.0).astype(np.float32)
+    v = scales[kelvin][:, None, None, :] * x.astype(np.float32) + np.float32(0.5)
+    return np.clip(v, 0, 255).astype(np.uint8)
+
+
+def _salt_and_pepper(x, inds, p, rng):
+    """Set random pixels of images inds to 1 (salt), then random pixels to 0 (pepper), as salt_and_pepper does."""
+    if len(inds) == 0:
+        return
+    height, width = x.shape[1:3]
+    count = int(np.ceil(p*height*width*0.5))
+    for value in (1, 0):
+        rows = rng.integers(0, height-1, (len(inds), count))
+        cols = rng.integers(0, width-1, (len(inds), count))
+        x[inds[:, None], rows, cols] = value
+
+
+def _rotate(x, inds, angles):
+    """Rotate images inds by their angles (in degrees) with bilinear filtering, in place.
+
+    PIL's rotation is a single pass in C, which is faster than any formulation as whole-array numpy operations.
+    """
+    for i in inds:
+        x[i] = np.asarray(Image.fromarray(x[i]).rotate(angles[i], Image.BILINEAR))
+
+
+def _random_crop(x, apply, offsets):
+    """Crop a random 4/5 x 4/5 window of images where apply is set and resize it to W x H, as random_crop does.
+
+    Returns an array, or a list of arrays if this makes the images differ in shape.
+    """
+    height, width = x.shape[1:3]
+    inds = np.flatnonzero(apply)
+    if len(inds) == 0:
+        return x
+    cropped_height = height / 5
+    cropped_width = width / 5
+    resized = dict()
+    for i in inds:
+        init_height = offsets[i, 0] * cropped_height
+        init_width = offsets[i, 1] * cropped_width
+        box = (init_width, init_height, width - cropped_width + init_width, height - cropped_height + init_height)
+        resized[i] = np.asarray(Image.fromarray(x[i]).crop(box).resize((height, width)))
+    if height == width:
+        for i, img in resized.items():
+            x[i] = img
+        return x
+    if len(inds) == len(x):
+        return np.stack([resized[i] for i in range(len(x))])
+    return [resized.get(i, x[i]) for i in range(len(x))]
@@ -1,5 +1,6 @@
 from unimodals.common_models import MLP
 from fusions.common_fusions import Concat
+import argparse
 import copy
 import torch
 import torch.nn as nn
@@ -12,10 +13,24 @@ from torch.utils.data import DataLoader
 from tqdm import tqdm
 
 
-device = 1
+parser = argparse.ArgumentParser()
+parser.add_argument('--data-dir', default='/home/pliang/yiwei/kinetics_small',
+                    help='directory with the train, valid and test .pdt shards')
+parser.add_argument('--store-dir', default=None,
+                    help='directory to keep the clip stores converted from them in, <data-dir>/clip_store by default')
+parser.add_argument('--device', default='cuda:1')
+args = parser.parse_args()
+
+device = torch.device(args.device)
 batch_size = 16
 num_workers = 1
 sys.path.append(os.getcwd())
+from datasets.kinetics.clip_store import ClipStream, kinetics_stores, normalize_video  # noqa
+
+stores = kinetics_stores(args.data_dir, args.store_dir)
+# the next shard is read in the background while the current one is used
+train_stream = ClipStream(stores['train'], batch_size, shuffle=True,
+                          transforms={'video': normalize_video}, device=device)
 
 
 def multimodalcompute(models, train_x):
@@ -30,25 +45,20 @@ def multimodalcondense(models, fuse, train_x):
     return fuse(outs)
 
 
-def gettrainloss(model, head, monum, batch_size, num_workers):
+def gettrainloss(model, head, monum, loader):
     losses = 0.0
     total = 0
     with torch.no_grad():
-        for fid in range(22):
-            datas = torch.load(
-                '/home/pliang/yiwei/kinetics_small/train/batch_37'+str(fid)+'.pdt')
-            train_dataloader = DataLoader(
-                datas, shuffle=True, batch_size=batch_size, num_workers=num_workers)
-            for j in train_dataloader:
-                total += len(j[0])
-                train_x = j[monum].float().cuda(device)
-                if monum == 1:
-                    train_x = train_x.unsqueeze(1)
-                train_y = j[-1].cuda(device)
-                out = model(train_x)
-                out = head(out)
-                loss = criterion(out, train_y)
-                losses += loss*len(j[0])
+        for j in loader:
+            total += len(j[0])
+            train_x = j[monum].float().to(device)
+            if monum == 1:
+                train_x = train_x.unsqueeze(1)
+            train_y = j[-1].to(device)
+            out = model(train_x)
+            out = head(out)
+            loss = criterion(out, train_y)
+            losses += loss*len(j[0])
     return losses/total
 
 
@@ -59,10 +69,10 @@ def getvalloss(model, head, loaders, monum):
         for loader in loaders:
             for j in loader:
                 total += len(j[0])
-                train_x = j[monum].float().cuda(device)
+                train_x = j[monum].float().to(device)
                 if monum == 1:
                     train_x = train_x.unsqueeze(1)
-                train_y = j[-1].cuda(device)
+                train_y = j[-1].to(device)
                 out = model(train_x)
                 out = head(out)
                 loss = criterion(out, train_y)
@@ -70,23 +80,17 @@ def getvalloss(model, head, loaders, monum):
     return losses/total
 
 
-def gettrainmloss(models, head, fuse, batch_size, num_workers):
+def gettrainmloss(models, head, fuse, loader):
     losses = 0.0
     total = 0
     with torch.no_grad():
-        for fid in range(22):
-            datas = torch.load(
-                '/home/pliang/yiwei/kinetics_small/train/batch_37'+str(fid)+'.pdt')
-            train_dataloader = DataLoader(
-                datas, shuffle=True, batch_size=batch_size, num_workers=num_workers)
-            for j in train_dataloader:
-                total += len(j[0])
-                train_x = [j[0].float().cuda(
-                    device), j[1].unsqueeze(1).float().cuda(device)]
-                train_y = j[-1].cuda(device)
-                out = head(multimodalcondense(models, fuse, train_x))
-                loss = criterion(out, train_y)
-                losses += loss*len(j[0])
+        for j in loader:
+            total += len(j[0])
+            train_x = [j[0].float().to(device), j[1].unsqueeze(1).float().to(device)]
+            train_y = j[-1].to(device)
+            out = head(multimodalcondense(models, fuse, train_x))
+            loss = criterion(out, train_y)
+            losses += loss*len(j[0])
     return losses/total
 
 
@@ -97,9 +101,8 @@ def getvalmloss(models, head, fuse, loaders):
         for loader in loaders:
             for j in loader:
                 total += len(j[0])
-                train_x = [j[0].float().cuda(
-                    device), j[1].unsqueeze(1).float().cuda(device)]
-                train_y = j[-1].cuda(device)
+                train_x = [j[0].float().to(device), j[1].unsqueeze(1).float().to(device)]
+                train_y = j[-1].to(device)
                 out = head(multimodalcondense(models, fuse, train_x))
                 loss = criterion(out, train_y)
                 losses += loss*len(j[0])
@@ -168,12 +171,11 @@ r50 = torchvision.models.resnet50(pretrained=True)
 r50.conv1 = torch.nn.Conv2d(
     1, 64, kernel_size=7, stride=2, padding=3, bias=False)
 audio_model = torch.nn.Sequential(r50, MLP(1000, 200, 64))
-unimodal_models = [ResNetLSTMEnc(64).cuda(
-    device), audio_model.cuda(device)]  # encoders
-fuse = Concat().cuda(device)  # fusion
-multimodal_classification_head = MLP(128, 200, 5).cuda(device)
+unimodal_models = [ResNetLSTMEnc(64).to(device), audio_model.to(device)]  # encoders
+fuse = Concat().to(device)  # fusion
+multimodal_classification_head = MLP(128, 200, 5).to(device)
 unimodal_classification_heads = [
-    MLP(64, 200, 5).cuda(device), MLP(64, 200, 5).cuda(device)]
+    MLP(64, 200, 5).to(device), MLP(64, 200, 5).to(device)]
 
 lr = 0.0001
 params = []
@@ -185,8 +187,8 @@ params.extend(multimodal_classification_head.parameters())
 params.extend(fuse.parameters())
 optim = torch.optim.Adam(params, lr=lr)
 
-finetunehead = copy.deepcopy(multimodal_classification_head).cuda(device)
-fusehead = copy.deepcopy(fuse).cuda(device)
+finetunehead = copy.deepcopy(multimodal_classification_head).to(device)
+fusehead = copy.deepcopy(fuse).to(device)
 params = list(finetunehead.parameters())
 if fuse.parameters() is not None:
     params.extend(list(fuse.parameters()))
@@ -196,13 +198,8 @@ bestvalloss = 10000.0
 num_epoch = 60  # 30 # 16
 gb_epoch = 6  # 3 # 2
 finetune_epoch = 3  # 2
-datas = torch.load('/home/pliang/yiwei/kinetics_small/valid/batch_370.pdt')
-valid_dataloader0 = DataLoader(
-    datas, shuffle=False, batch_size=batch_size, num_workers=num_workers)
-datas = torch.load('/home/pliang/yiwei/kinetics_small/valid/batch_371.pdt')
-valid_dataloader1 = DataLoader(
-    datas, shuffle=False, batch_size=batch_size, num_workers=num_workers)
-valid_dataloaders = [valid_dataloader0, valid_dataloader1]
+valid_dataloaders = [ClipStream(stores['valid'], batch_size,
+                                transforms={'video': normalize_video}, device=device)]
 delta = False
 bestvaloss = 1000.0
 
@@ -211,35 +208,30 @@ for ep in tqdm(range(num_epoch//gb_epoch)):
     weights = []
     for monum in range(len(unimodal_models)):
         print("At gb_estimate unimodal "+str(monum))
-        model = copy.deepcopy(unimodal_models[monum]).cuda(device)
-        head = copy.deepcopy(unimodal_classification_heads[monum]).cuda(device)
+        model = copy.deepcopy(unimodal_models[monum]).to(device)
+        head = copy.deepcopy(unimodal_classification_heads[monum]).to(device)
         optim = torch.optim.Adam(
             list(model.parameters()) + list(head.parameters()), lr=lr)
-        ltN = gettrainloss(model, head, monum, batch_size, num_workers)
+        ltN = gettrainloss(model, head, monum, train_stream)
         lvN = getvalloss(model, head, valid_dataloaders, monum)
         for i in range(gb_epoch):
             totalloss = 0.0
             total = 0
-            for fid in range(22):
-                datas = torch.load(
-                    '/home/pliang/yiwei/kinetics_small/train/batch_37'+str(fid)+'.pdt')
-                train_dataloader = DataLoader(
-                    datas, shuffle=True, batch_size=batch_size, num_workers=num_workers)
-                for j in train_dataloader:
-                    total += len(j[0])
-                    train_x = j[monum].float().cuda(device)
-                    if monum == 1:
-                        train_x = train_x.unsqueeze(1)
-                    train_y = j[-1].cuda(device)
-                    optim.zero_grad()
-                    out = model(train_x)
-                    out = head(out)
-                    loss = criterion(out, train_y)
-                    totalloss += loss * len(j[0])
-                    loss.backward()
-                    optim.step()
+            for j in train_stream:
+                total += len(j[0])
+                train_x = j[monum].float().to(device)
+                if monum == 1:
+                    train_x = train_x.unsqueeze(1)
+                train_y = j[-1].to(device)
+                optim.zero_grad()
+                out = model(train_x)
+                out = head(out)
+                loss = criterion(out, train_y)
+                totalloss += loss * len(j[0])
+                loss.backward()
+                optim.step()
             print("Epoch "+str(i)+" loss: "+str(totalloss / total))
-        ltNn = gettrainloss(model, head, monum, batch_size, num_workers)
+        ltNn = gettrainloss(model, head, monum, train_stream)
         lvNn = getvalloss(model, head, valid_dataloaders, monum)
         print("Final train loss: "+str(ltNn)+" valid loss: "+str(lvNn))
         oNn = lvNn-ltNn
@@ -256,9 +248,9 @@ for ep in tqdm(range(num_epoch//gb_epoch)):
         w = abs(g/(oi*oi))
         weights.append(w)
     print("At gb_estimate multimodal ")
-    allcopies = [copy.deepcopy(x).cuda(device) for x in unimodal_models]
-    mmcopy = copy.deepcopy(multimodal_classification_head).cuda(device)
-    fusecopy = copy.deepcopy(fuse).cuda(device)
+    allcopies = [copy.deepcopy(x).to(device) for x in unimodal_models]
+    mmcopy = copy.deepcopy(multimodal_classification_head).to(device)
+    fusecopy = copy.deepcopy(fuse).to(device)
     params = []
     for model in allcopies:
         params.extend(list(model.parameters()))
@@ -266,30 +258,24 @@ for ep in tqdm(range(num_epoch//gb_epoch)):
     if fusecopy.parameters() is not None:
         params.extend(list(fusecopy.parameters()))
     optim = torch.optim.Adam(params, lr=lr)
-    ltN = gettrainmloss(allcopies, mmcopy, fusecopy, batch_size, num_workers)
+    ltN = gettrainmloss(allcopies, mmcopy, fusecopy, train_stream)
     lvN = getvalmloss(allcopies, mmcopy, fusecopy, valid_dataloaders)
     for i in range(gb_epoch):
         totalloss = 0.0
         total = 0
-        for fid in range(22):
-            datas = torch.load(
-                '/home/pliang/yiwei/kinetics_small/train/batch_37'+str(fid)+'.pdt')
-            train_dataloader = DataLoader(
-                datas, shuffle=True, batch_size=batch_size, num_workers=num_workers)
-            for j in train_dataloader:
-                total += len(j[0])
-                # train_x = [x.float().cuda(device) for x in j[:-1]]
-                train_x = [j[0].float().cuda(
-                    device), j[1].unsqueeze(1).float().cuda(device)]
-                train_y = j[-1].cuda(device)
-                optim.zero_grad()
-                out = mmcopy(multimodalcondense(allcopies, fusecopy, train_x))
-                loss = criterion(out, train_y)
-                totalloss += loss*len(j[0])
-                loss.backward()
-                optim.step()
+        for j in train_stream:
+            total += len(j[0])
+            # train_x = [x.float().to(device) for x in j[:-1]]
+            train_x = [j[0].float().to(device), j[1].unsqueeze(1).float().to(device)]
+            train_y = j[-1].to(device)
+            optim.zero_grad()
+            out = mmcopy(multimodalcondense(allcopies, fusecopy, train_x))
+            loss = criterion(out, train_y)
+            totalloss += loss*len(j[0])
+            loss.backward()
+            optim.step()
         print("Epoch "+str(i)+" loss: "+str(totalloss/total))
-    ltNn = gettrainmloss(allcopies, mmcopy, fusecopy, batch_size, num_workers)
+    ltNn = gettrainmloss(allcopies, mmcopy, fusecopy, train_stream)
     lvNn = getvalmloss(allcopies, mmcopy, fusecopy, valid_dataloaders)
     print("Final train loss: "+str(ltNn)+" valid loss: "+str(lvNn))
     oNn = lvNn-ltNn
@@ -314,49 +300,37 @@ for ep in tqdm(range(num_epoch//gb_epoch)):
     for jj in range(gb_epoch):
         totalloss = 0.0
         total = 0
-        for fid in range(22):
-            datas = torch.load(
-                '/home/pliang/yiwei/kinetics_small/train/batch_37'+str(fid)+'.pdt')
-            train_dataloader = DataLoader(
-                datas, shuffle=True, batch_size=batch_size, num_workers=num_workers)
-            for j in train_dataloader:
-                train_x = [j[0].float().cuda(
-                    device), j[1].unsqueeze(1).float().cuda(device)]
-                train_y = j[2].cuda(device)
-                optim.zero_grad()
-                outs = multimodalcompute(unimodal_models, train_x)
-                catout = fuse(outs, training=True)
-                blendloss = criterion(multimodal_classification_head(
-                    catout, training=True), train_y)*weights[-1]
-                for ii in range(len(unimodal_models)):
-                    loss = criterion(unimodal_classification_heads[ii](
-                        outs[ii]), train_y)
-                    blendloss += loss * weights[ii]
-                totalloss += blendloss*len(j[0])
-                blendloss.backward()
-                optim.step()
-                total += len(j[0])
+        for j in train_stream:
+            train_x = [j[0].float().to(device), j[1].unsqueeze(1).float().to(device)]
+            train_y = j[2].to(device)
+            optim.zero_grad()
+            outs = multimodalcompute(unimodal_models, train_x)
+            catout = fuse(outs, training=True)
+            blendloss = criterion(multimodal_classification_head(
+                catout, training=True), train_y)*weights[-1]
+            for ii in range(len(unimodal_models)):
+                loss = criterion(unimodal_classification_heads[ii](
+                    outs[ii]), train_y)
+                blendloss += loss * weights[ii]
+            totalloss += blendloss*len(j[0])
+            blendloss.backward()
+            optim.step()
+            total += len(j[0])
         print("epoch "+str(jj+ep*gb_epoch)+" blend train loss: " +
               str(totalloss/total))
 
     # finetunes classification head
     finetunetrains = []
     with torch.no_grad():
-        for fid in range(22):
-            datas = torch.load(
-                '/home/pliang/yiwei/kinetics_small/train/batch_37'+str(fid)+'.pdt')
-            train_dataloader = DataLoader(
-                datas, shuffle=True, batch_size=batch_size, num_workers=num_workers)
-            for j in train_dataloader:
-                # train_x = [x.float().cuda(device) for x in j[:-1]]
-                train_x = [j[0].float().cuda(
-                    device), j[1].unsqueeze(1).float().cuda(device)]
-                train_y = j[2].cuda(device)
-                outs = multimodalcompute(unimodal_models, train_x)
-                for iii in range(len(train_y)):
-                    aa = [x[iii].cpu() for x in outs]
-                    aa.append(train_y[iii].cpu())
-                    finetunetrains.append(aa)
+        for j in train_stream:
+            # train_x = [x.float().to(device) for x in j[:-1]]
+            train_x = [j[0].float().to(device), j[1].unsqueeze(1).float().to(device)]
+            train_y = j[2].to(device)
+            outs = multimodalcompute(unimodal_models, train_x)
+            for iii in range(len(train_y)):
+                aa = [x[iii].cpu() for x in outs]
+                aa.append(train_y[iii].cpu())
+                finetunetrains.append(aa)
     print("Length of ftt_dataloader: "+str(len(finetunetrains)))
     ftt_dataloader = DataLoader(
         finetunetrains, shuffle=True, num_workers=num_workers, batch_size=batch_size)
@@ -364,9 +338,8 @@ for ep in tqdm(range(num_epoch//gb_epoch)):
         totalloss = 0.0
         for j in ftt_dataloader:
             optimi.zero_grad()
-            train_x = [j[0].float().cuda(
-                device), j[1].unsqueeze(1).float().cuda(device)]
-            train_y = j[-1].cuda(device)
+            train_x = [j[0].float().to(device), j[1].unsqueeze(1).float().to(device)]
+            train_y = j[-1].to(device)
             blendloss = criterion(finetunehead(
                 fusehead(train_x, training=True), training=True), train_y)
             totalloss += blendloss * len(j[0])
@@ -379,9 +352,8 @@ for ep in tqdm(range(num_epoch//gb_epoch)):
             corrects = 0
             for valid_dataloader in valid_dataloaders:
                 for j in valid_dataloader:
-                    valid_x = [j[0].float().cuda(
-                        device), j[1].unsqueeze(1).float().cuda(device)]
-                    valid_y = j[-1].cuda(device)
+                    valid_x = [j[0].float().to(device), j[1].unsqueeze(1).float().to(device)]
+                    valid_y = j[-1].to(device)
                     outs = multimodalcompute(unimodal_models, valid_x)
                     catout = fusehead(outs, training=False)
                     predicts = finetunehead(catout, training=False)
@@ -402,27 +374,23 @@ for ep in tqdm(range(num_epoch//gb_epoch)):
                            fusehead, finetunehead), 'best_kgrb.pt')
 
 print('testing')
-model = torch.load('best_kgrb.pt').cuda(device)
+model = torch.load('best_kgrb.pt').to(device)
 valid_dataloader = None
 total = 0
 corrects = 0
 totalloss = 0.0
-for fid in range(3):
-    datas = torch.load(
-        '/home/pliang/yiwei/kinetics_small/test/batch_37%d.pdt' % fid)
-    test_dataloader = DataLoader(
-        datas, shuffle=False, batch_size=batch_size, num_workers=num_workers)
-    with torch.no_grad():
-        for j in test_dataloader:
-            valid_x = [j[0].float().cuda(
-                device), j[1].unsqueeze(1).float().cuda(device)]
-            valid_y = j[-1].cuda(device)
-            predicts = model(valid_x)
-            blendloss = criterion(predicts, valid_y.squeeze())
-            totalloss += blendloss*len(j[0])
-            predictlist = predicts.tolist()
-            for ii in range(len(j[0])):
-                total += 1
-                if predictlist[ii].index(max(predictlist[ii])) == valid_y[ii]:
-                    corrects += 1
+test_dataloader = ClipStream(stores['test'], batch_size,
+                             transforms={'video': normalize_video}, device=device)
+with torch.no_grad():
+    for j in test_dataloader:
+        valid_x = [j[0].float().to(device), j[1].unsqueeze(1).float().to(device)]
+        valid_y = j[-1].to(device)
+        predicts = model(valid_x)
+        blendloss = criterion(predicts, valid_y.squeeze())
+        totalloss += blendloss*len(j[0])
+        predictlist = predicts.tolist()
+        for ii in range(len(j[0])):
+            total += 1
+            if predictlist[ii].index(max(predictlist[ii])) == valid_y[ii]:
+                corrects += 1
 print("Test loss: "+str(totalloss/total)+" acc: "+str(float(corrects)/total))
@@ -1,5 +1,6 @@
 from unimodals.common_models import MLP
 from fusions.common_fusions import Concat
+import argparse
 import torch
 import torch.nn as nn
 import torchvision
@@ -8,7 +9,6 @@ from memory_profiler import memory_usage
 import os
 import time
 from torch.nn import functional as F
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 
 
@@ -20,10 +20,22 @@ def getallparams(li):
     return params
 
 
-device = 0  # 1
+parser = argparse.ArgumentParser()
+parser.add_argument('--data-dir', default='/home/pliang/yiwei/kinetics_small',
+                    help='directory with the train, valid and test .pdt shards')
+parser.add_argument('--store-dir', default=None,
+                    help='directory to keep the clip stores converted from them in, <data-dir>/clip_store by default')
+parser.add_argument('--device', default='cuda:0')
+args = parser.parse_args()
+
+device = torch.device(args.device)
 batch_size = 16  # 8 # 5
-num_workers = 1  # 1
 sys.path.append(os.getcwd())
+from datasets.kinetics.clip_store import ClipStream, kinetics_stores, normalize_video  # noqa
+
+stores = kinetics_stores(args.data_dir, args.store_dir)
+train_stream = ClipStream(stores['train'], batch_size, shuffle=True,
+                          transforms={'video': normalize_video}, device=device)
 
 
 class ResNetLSTMEnc(torch.nn.Module):
@@ -74,11 +86,11 @@ r50 = torchvision.models.resnet50(pretrained=True)
 r50.conv1 = torch.nn.Conv2d(
     1, 64, kernel_size=7, stride=2, padding=3, bias=False)
 audio_model = torch.nn.Sequential(r50, MLP(1000, 200, 64))
-encoders = [ResNetLSTMEnc(64).cuda(device), audio_model.cuda(device)]
-fusion = Concat().cuda(device)
-head = MLP(64+64, 200, 5).cuda(device)
-model = MMDL(encoders, fusion, head, False).cuda(device)
-# odel=torch.load('best_kslf.pt').cuda(device)
+encoders = [ResNetLSTMEnc(64).to(device), audio_model.to(device)]
+fusion = Concat().to(device)
+head = MLP(64+64, 200, 5).to(device)
+model = MMDL(encoders, fusion, head, False).to(device)
+# odel=torch.load('best_kslf.pt').to(device)
 optim = torch.optim.Adam(model.parameters(), lr=0.0001)
 criterion = torch.nn.CrossEntropyLoss()
 
@@ -89,50 +101,26 @@ def train(ep=0):
     totalloss = 0.0
     total = 0
     model.train()
-    for fid in range(22):
-        print("epoch "+str(ep)+" subiter "+str(fid))
-        datas = torch.load(
-            '/home/pliang/yiwei/kinetics_small/train/batch_37'+str(fid)+'.pdt')
-        print(len(datas))
-        
-        train_dataloader = DataLoader(
-            datas, shuffle=True, batch_size=batch_size, num_workers=num_workers)
-        for j in train_dataloader:
-            optim.zero_grad()
-            out = model([i.float().cuda(device)
-                        for i in j[:-1]], training=True)
-            loss = criterion(out, j[2].cuda(device))
-            loss.backward()
-            optim.step()
-            totalloss += loss*len(j[0])
-            total += len(j[0])
+    for j in train_stream:
+        optim.zero_grad()
+        out = model([i.float().to(device)
+                    for i in j[:-1]], training=True)
+        loss = criterion(out, j[2].to(device))
+        loss.backward()
+        optim.step()
+        totalloss += loss*len(j[0])
+        total += len(j[0])
     print("Epoch "+str(ep)+" train loss: "+str(totalloss/total))
 
 # mem = max(memory_usage(proc=train))
 
 
 
-num_data = 0
-for fid in range(22):
-    datas = torch.load(
-        '/home/pliang/yiwei/kinetics_small/train/batch_37'+str(fid)+'.pdt')
-    num_data += len(datas)
-for fid in range(2):
-    datas = torch.load(
-        '/home/pliang/yiwei/kinetics_small/valid/batch_37%d.pdt' % fid)
-    num_data += len(datas)
-for fid in range(3):
-    datas = torch.load(
-        '/home/pliang/yiwei/kinetics_small/test/batch_37%d.pdt' % fid)
-    num_data += len(datas)
+num_data = sum(store.num_clips() for store in stores.values())
 
 '''
 epochs = 15
-datas = torch.load('/home/pliang/yiwei/kinetics_small/valid/batch_370.pdt')
-valid_dataloader0 = DataLoader(datas,shuffle=False,batch_size=batch_size,num_workers=num_workers)
-datas = torch.load('/home/pliang/yiwei/kinetics_small/valid/batch_371.pdt')
-valid_dataloader1 = DataLoader(datas,shuffle=False,batch_size=batch_size,num_workers=num_workers)
-valid_dataloaders = [valid_dataloader0, valid_dataloader1]
+valid_dataloaders = [ClipStream(stores['valid'], batch_size, transforms={'video': normalize_video}, device=device)]
 bestvaloss=1000
 #a=input()
 for ep in tqdm(range(epochs)):
@@ -144,8 +132,8 @@ for ep in tqdm(range(epochs)):
     with torch.no_grad():
         for valid_dataloader in valid_dataloaders:
             for j in valid_dataloader:
-                out = model([i.float().cuda(device) for i in j[:-1]],training=False)
-                loss = criterion(out,j[2].cuda(device))
+                out = model([i.float().to(device) for i in j[:-1]],training=False)
+                loss = criterion(out,j[2].to(device))
                 totalloss += loss*len(j[0])
                 for ii in range(len(out)):
                     total += 1
@@ -166,21 +154,18 @@ valid_dataloader = None
 total = 0
 correct = 0
 totalloss = 0.0
-for fid in range(3):
-    datas = torch.load(
-        '/home/pliang/yiwei/kinetics_small/test/batch_37%d.pdt' % fid)
-    test_dataloader = DataLoader(
-        datas, shuffle=False, batch_size=batch_size, num_workers=num_workers)
-    with torch.no_grad():
-        for j in test_dataloader:
-            out = model([i.float().cuda(device)
-                        for i in j[:-1]], training=False)
-            loss = criterion(out, j[2].cuda(device))
-            totalloss += loss
-            for ii in range(len(out)):
-                total += 1
-                if out[ii].tolist().index(max(out[ii])) == j[2][ii]:
-                    correct += 1
+test_dataloader = ClipStream(stores['test'], batch_size,
+                             transforms={'video': normalize_video}, device=device)
+with torch.no_grad():
+    for j in test_dataloader:
+        out = model([i.float().to(device)
+                    for i in j[:-1]], training=False)
+        loss = criterion(out, j[2].to(device))
+        totalloss += loss
+        for ii in range(len(out)):
+            total += 1
+            if out[ii].tolist().index(max(out[ii])) == j[2][ii]:
+                correct += 1
 print("Test loss: "+str(totalloss/total)+" acc: "+str(float(correct)/total))
 
 t1 = time.time()
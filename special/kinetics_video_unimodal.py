@@ -1,3 +1,4 @@
+import argparse
 import torch
 import torch.nn as nn
 import torchvision
@@ -6,7 +7,6 @@ from memory_profiler import memory_usage
 import os
 import time
 from torch.nn import functional as F
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 
 
@@ -18,10 +18,22 @@ def getallparams(li):
     return params
 
 
-device = 0
+parser = argparse.ArgumentParser()
+parser.add_argument('--data-dir', default='/home/pliang/yiwei/kinetics_small',
+                    help='directory with the train, valid and test .pdt shards')
+parser.add_argument('--store-dir', default=None,
+                    help='directory to keep the clip stores converted from them in, <data-dir>/clip_store by default')
+parser.add_argument('--device', default='cuda:0')
+args = parser.parse_args()
+
+device = torch.device(args.device)
 batch_size = 16  # 8 # 5
-num_workers = 1  # 1
 sys.path.append(os.getcwd())
+from datasets.kinetics.clip_store import ClipStream, kinetics_stores, normalize_video  # noqa
+
+stores = kinetics_stores(args.data_dir, args.store_dir)
+train_stream = ClipStream(stores['train'], batch_size, shuffle=True,
+                          transforms={'video': normalize_video}, device=device)
 
 
 class ResNetLSTM(torch.nn.Module):
@@ -48,8 +60,8 @@ class ResNetLSTM(torch.nn.Module):
         return out
 
 
-model = ResNetLSTM(64, 5).cuda(device)
-# model=torch.load('best_kvu.pt').cuda(device)
+model = ResNetLSTM(64, 5).to(device)
+# model=torch.load('best_kvu.pt').to(device)
 optim = torch.optim.Adam(model.parameters(), lr=0.0001)
 criterion = torch.nn.CrossEntropyLoss()
 
@@ -60,22 +72,15 @@ def train(ep=0):
     totalloss = 0.0
     total = 0
     model.train()
-    for fid in range(22):
-        print("epoch "+str(ep)+" subiter "+str(fid))
-        datas = torch.load(
-            '/home/pliang/yiwei/kinetics_small/train/batch_37'+str(fid)+'.pdt')
-        
-        train_dataloader = DataLoader(
-            datas, shuffle=True, batch_size=batch_size, num_workers=num_workers)
-        for j in train_dataloader:
-            optim.zero_grad()
-            model.train()
-            out = model(j[0].cuda(device))
-            loss = criterion(out, j[2].cuda(device))
-            loss.backward()
-            optim.step()
-            totalloss += loss*len(j[0])
-            total += len(j[0])
+    for j in train_stream:
+        optim.zero_grad()
+        model.train()
+        out = model(j[0].to(device))
+        loss = criterion(out, j[2].to(device))
+        loss.backward()
+        optim.step()
+        totalloss += loss*len(j[0])
+        total += len(j[0])
     print("Epoch "+str(ep)+" train loss: "+str(totalloss/total))
 
 # mem = max(memory_usage(proc=train))
@@ -83,13 +88,8 @@ def train(ep=0):
 
 
 epochs = 15
-datas = torch.load('/home/pliang/yiwei/kinetics_small/valid/batch_370.pdt')
-valid_dataloader0 = DataLoader(
-    datas, shuffle=False, batch_size=batch_size, num_workers=num_workers)
-datas = torch.load('/home/pliang/yiwei/kinetics_small/valid/batch_371.pdt')
-valid_dataloader1 = DataLoader(
-    datas, shuffle=False, batch_size=batch_size, num_workers=num_workers)
-valid_dataloaders = [valid_dataloader0, valid_dataloader1]
+valid_dataloaders = [ClipStream(stores['valid'], batch_size,
+                                transforms={'video': normalize_video}, device=device)]
 bestvaloss = 1000
 # a=input()
 for ep in tqdm(range(epochs)):
@@ -102,8 +102,8 @@ for ep in tqdm(range(epochs)):
         for valid_dataloader in valid_dataloaders:
             for j in valid_dataloader:
                 model.train()
-                out = model(j[0].cuda(device))
-                loss = criterion(out, j[2].cuda(device))
+                out = model(j[0].to(device))
+                loss = criterion(out, j[2].to(device))
                 totalloss += loss*len(j[0])
                 for ii in range(len(out)):
                     total += 1
@@ -119,26 +119,23 @@ for ep in tqdm(range(epochs)):
 t0 = time.time()
 
 print('testing')
-model = torch.load('best_kvu.pt')
+model = torch.load('best_kvu.pt').to(device)
 valid_dataloader = None
 total = 0
 correct = 0
 totalloss = 0.0
-for fid in range(3):
-    datas = torch.load(
-        '/home/pliang/yiwei/kinetics_small/test/batch_37%d.pdt' % fid)
-    test_dataloader = DataLoader(
-        datas, shuffle=False, batch_size=batch_size, num_workers=num_workers)
-    with torch.no_grad():
-        for j in test_dataloader:
-            model.eval()
-            out = model(j[0].cuda(device))
-            loss = criterion(out, j[2].cuda(device))
-            totalloss += loss
-            for ii in range(len(out)):
-                total += 1
-                if out[ii].tolist().index(max(out[ii])) == j[2][ii]:
-                    correct += 1
+test_dataloader = ClipStream(stores['test'], batch_size,
+                             transforms={'video': normalize_video}, device=device)
+with torch.no_grad():
+    for j in test_dataloader:
+        model.eval()
+        out = model(j[0].to(device))
+        loss = criterion(out, j[2].to(device))
+        totalloss += loss
+        for ii in range(len(out)):
+            total += 1
+            if out[ii].tolist().index(max(out[ii])) == j[2][ii]:
+                correct += 1
 print("Test loss: "+str(totalloss/total)+" acc: "+str(float(correct)/total))
 
 t1 = time.time()
@@ -1,3 +1,5 @@
+import copy
+import numpy as np
 from fusions.common_fusions import Concat, ConcatWithLinear
 import torch
 from torch import nn
@@ -125,3 +127,101 @@ def test_Supervised_Learning_multimodal_regression():
             output.append(encoders[j](i[j][None]))
         output = fusion(output)
         assert torch.allclose(output, o[None], atol=0.1)
+
+def test_Supervised_Learning_amp_classification():
+    model = nn.Sequential(
+        nn.Linear(2, 32),
+        nn.ReLU(),
+        nn.Linear(32, 32),
+        nn.ReLU(),
+        nn.Linear(32, 2),
+    )
+
+    x = torch.tensor([[0, 0], [0, 1], [1, 0], [1, 1]], dtype=torch.float)
+    y = torch.tensor([[0], [1], [1], [0]], dtype=torch.long)
+
+    torch.manual_seed(42)
+    train_ds = UnimodalDataset(x, y)
+    train_loader = DataLoader(train_ds)
+
+    train([model], Concat(), nn.Identity(), train_loader, train_loader, 80, amp=True)
+
+    for i, o in zip(x, y):
+        assert torch.allclose(torch.argmax(model(i[None]), dim=-1), o[None])
+
+def test_Supervised_Learning_resume(tmp_path):
+    x = torch.tensor([[0, 0], [0, 1], [1, 0], [1, 1]], dtype=torch.float)
+    y = torch.tensor([[0], [1], [1], [0]], dtype=torch.long)
+    train_loader = DataLoader(UnimodalDataset(x, y), batch_size=2, shuffle=True)
+
+    def _model():
+        torch.manual_seed(0)
+        return nn.Sequential(nn.Linear(2, 8), nn.ReLU(), nn.Linear(8, 2))
+
+    full = _model()
+    train([full], Concat(), nn.Identity(), train_loader, train_loader, 6, save=str(tmp_path / 'best.pt'),
+          checkpoint_dir=str(tmp_path / 'full'), keep_last=6, track_complexity=False)
+    interrupted = _model()
+    train([interrupted], Concat(), nn.Identity(), train_loader, train_loader, 3, save=str(tmp_path / 'best.pt'),
+          checkpoint_dir=str(tmp_path / 'part'), track_complexity=False)
+    resumed = _model()
+    train([resumed], Concat(), nn.Identity(), train_loader, train_loader, 6, save=str(tmp_path / 'best.pt'),
+          resume=str(tmp_path / 'part'), track_complexity=False)
+
+    assert len(list((tmp_path / 'full').glob('checkpoint_*.pt'))) == 6
+    assert torch.load(str(tmp_path / 'best.pt'), weights_only=False) is not None
+    for p, q in zip(full.parameters(), resumed.parameters()):
+        assert torch.equal(p, q)
+
+def test_gb_estimate():
+    """Test the one-pass gradient-blending weights against training every model on its own.
+
+    The trained models are the same, but the train loss of gb_estimate is the running loss of the last epoch
+    instead of a separate pass over the trained model, so the weights deviate from the old ones, here by a few hundredths.
+    """
+    from training_structures import gradient_blend as gb
+    torch.manual_seed(0)
+    y = torch.randint(0, 2, (96,))
+    xs = [y[:, None].float() + torch.randn(96, 4), torch.randn(96, 3)]
+    train_loader = DataLoader(MultimodalDataset([x[:64] for x in xs], y[:64]), batch_size=16)
+    valid_loader = DataLoader(MultimodalDataset([x[64:] for x in xs], y[64:]), batch_size=16)
+    encoders = [nn.Sequential(nn.Linear(4, 8), nn.ReLU()), nn.Sequential(nn.Linear(3, 8), nn.ReLU())]
+    heads = [nn.Linear(8, 2), nn.Linear(8, 2)]
+    mmhead = nn.Linear(16, 2)
+
+    old = []
+    for i in range(2):
+        model, head = copy.deepcopy(encoders[i]), copy.deepcopy(heads[i])
+        optim = torch.optim.SGD(list(model.parameters()) + list(head.parameters()), lr=0.1)
+        old.append(gb.train_unimodal(model, head, optim, train_loader, valid_loader, i, 3, 16))
+    models, head = copy.deepcopy(encoders), copy.deepcopy(mmhead)
+    optim = torch.optim.SGD([p for m in models + [head] for p in m.parameters()], lr=0.1)
+    old.append(gb.train_multimodal(models, head, Concat(), optim, train_loader, valid_loader, 3, 16))
+    old = [(w / sum(old)).item() for w in old]
+
+    new = gb.gb_estimate(encoders, mmhead, Concat(), heads, train_loader, 3, 16, valid_loader, 0.1)
+    assert np.allclose(new, old, atol=0.05)
+    assert np.argmax(new) == np.argmax(old)
+    assert gb.gb_estimate(encoders, mmhead, Concat(), heads, train_loader, 3, 16, valid_loader, 0.1,
+                          num_workers=2) == new
+
+def test_Supervised_Learning_channels_last(tmp_path):
+    from unimodals.common_models import LeNet
+    torch.manual_seed(0)
+    x = torch.randn(8, 1, 8, 8)
+    y = torch.randint(0, 2, (8,))
+    train_loader = DataLoader(UnimodalDataset(x, y), batch_size=4)
+
+    models = []
+    for channels_last in [False, True]:
+        torch.manual_seed(1)
+        encoder, head = LeNet(1, 4, 1), nn.Linear(32, 2)
+        train([encoder], Concat(), head, train_loader, train_loader, 3, save=str(tmp_path / 'best.pt'),
+              channels_last=channels_last, track_complexity=False)
+        models.append((encoder, head))
+    assert models[1][0].convs[0].weight.is_contiguous(memory_format=torch.channels_last)
+    for encoder, head in models:
+        encoder.eval()
+    with torch.no_grad():
+        expected = models[0][1](models[0][0](x).flatten(1))
+        assert torch.allclose(models[1][1](models[1][0](x).flatten(1)), expected, atol=1e-4)
@@ -0,0 +1,470 @@
+import os
+import pickle
+import sys
+sys.path.append(os.getcwd())
+from tests.common import *
+import torch
+import numpy as np
+from PIL import Image
+
+
+def _old_resize_and_crop_image(img, output_box=[224, 224], fit=True):
+    # VGGClassifier.resize_and_crop_image before preprocessing was split in two
+    box = output_box
+    factor = 1
+    while img.size[0] / factor > 2 * box[0] and img.size[1] * 2 / factor > 2 * box[1]:
+        factor *= 2
+    if factor > 1:
+        img.thumbnail((img.size[0] / factor, img.size[1] / factor), Image.NEAREST)
+    if fit:
+        x1 = y1 = 0
+        x2, y2 = img.size
+        wRatio = 1.0 * x2 / box[0]
+        hRatio = 1.0 * y2 / box[1]
+        if hRatio > wRatio:
+            y1 = int(y2 / 2 - box[1] * wRatio / 2)
+            y2 = int(y2 / 2 + box[1] * wRatio / 2)
+        else:
+            x1 = int(x2 / 2 - box[0] * hRatio / 2)
+            x2 = int(x2 / 2 + box[0] * hRatio / 2)
+        img = img.crop((x1, y1, x2, y2))
+    img = img.resize(box, Image.LANCZOS).convert('RGB')
+    img = np.asarray(img, dtype='float32')[..., [2, 1, 0]]
+    img[:, :, 0] -= 103.939
+    img[:, :, 1] -= 116.779
+    img[:, :, 2] -= 123.68
+    img = img.transpose((2, 0, 1))
+    return np.expand_dims(img, axis=0)
+
+
+def test_vgg_preprocessing(set_seeds):
+    from datasets.imdb.vgg_preprocessing import crop_image, normalize_images
+    for size in [(600, 300), (250, 700), (224, 224)]:
+        pixels = np.random.randint(0, 256, size[::-1] + (3,), dtype=np.uint8)
+        old = _old_resize_and_crop_image(Image.fromarray(pixels))
+        crops = [crop_image(Image.fromarray(pixels)) for _ in range(2)]
+        new = normalize_images(np.stack(crops))
+        assert new.shape == (2, 3, 224, 224)
+        assert np.array_equal(new[:1], old) and np.array_equal(new[1:], old)
+
+
+def _affect_pickle(path, n=6, seq_len=5):
+    # front-padded sequences as in the affect pickles, with one entry without text
+    lengths = np.random.randint(0, seq_len + 1, (3, n))
+    lengths[0] = np.maximum(lengths[0], 1)
+    lengths[0, 2] = 0
+    dataset = dict()
+    for modality, features, lens in zip(['text', 'vision', 'audio'], [4, 3, 2], lengths):
+        data = np.zeros((n, seq_len, features), dtype=np.float32)
+        for i, length in enumerate(lens):
+            data[i, seq_len - length:] = np.random.rand(length, features) + 0.1
+        dataset[modality] = data
+    dataset['audio'][0, -1, 0] = -np.inf
+    dataset['labels'] = np.random.rand(n, 1, 1).astype(np.float32)
+    dataset['id'] = np.array([['clip', str(i)] for i in range(n)], dtype=object)
+    with open(path, 'wb') as f:
+        pickle.dump({'train': dataset, 'test': dataset}, f)
+    return dataset
+
+
+def test_affect_store_round_trip(set_seeds, tmp_path):
+    from datasets.affect.mmap_data import PaddedSequences, convert_pickle, load_converted
+    raw = _affect_pickle(str(tmp_path / 'raw.pkl'))
+    convert_pickle(str(tmp_path / 'raw.pkl'), str(tmp_path / 'store'))
+    store = load_converted(str(tmp_path / 'store'))
+    keep = [0, 1, 3, 4, 5]
+    assert sorted(store) == ['test', 'train']
+    for modality, data in raw.items():
+        expected = data[keep]
+        if modality == 'audio':
+            expected[expected == -np.inf] = 0.0
+        loaded = store['train'][modality]
+        assert isinstance(loaded, PaddedSequences) == (modality in ['text', 'vision', 'audio'])
+        assert loaded.shape == expected.shape
+        assert np.array_equal(np.asarray(loaded), expected)
+        assert np.array_equal(loaded[1], expected[1])
+
+
+def test_padded_sequences_pickle(set_seeds, tmp_path):
+    from datasets.affect.mmap_data import convert_pickle, load_converted
+    raw = _affect_pickle(str(tmp_path / 'raw.pkl'))
+    convert_pickle(str(tmp_path / 'raw.pkl'), str(tmp_path / 'store'))
+    vision = load_converted(str(tmp_path / 'store'))['train']['vision']
+    view = vision[np.array([3, 0])]
+    view[0]  # opens the memory map
+    assert isinstance(view._data, np.memmap)
+    copied = pickle.loads(pickle.dumps(view))
+    assert copied._data is None
+    assert np.array_equal(copied[0], raw['vision'][4]) and np.array_equal(copied[1], raw['vision'][0])
+    assert isinstance(copied._data, np.memmap)
+
+
+def _old_affect_sequences(dataset, ind, aligned, z_norm):
+    # Affectdataset.__getitem__ before starts and stats were precomputed
+    vision, audio, text = [torch.tensor(dataset[m][ind]) for m in ['vision', 'audio', 'text']]
+    if aligned:
+        start = text.nonzero(as_tuple=False)[0][0]
+        vision, audio, text = vision[start:].float(), audio[start:].float(), text[start:].float()
+    else:
+        vision = vision[vision.nonzero()[0][0]:].float()
+        audio = audio[audio.nonzero()[0][0]:].float()
+        text = text[text.nonzero()[0][0]:].float()
+    if z_norm:
+        vision = torch.nan_to_num((vision - vision.mean(0, keepdims=True)) / (torch.std(vision, axis=0, keepdims=True)))
+        audio = torch.nan_to_num((audio - audio.mean(0, keepdims=True)) / (torch.std(audio, axis=0, keepdims=True)))
+        text = torch.nan_to_num((text - text.mean(0, keepdims=True)) / (torch.std(text, axis=0, keepdims=True)))
+    return vision, audio, text
+
+
+def test_affect_precomputed_starts(set_seeds, tmp_path):
+    pytest.importorskip('torchtext')
+    from datasets.affect.get_data import Affectdataset
+    raw = _affect_pickle(str(tmp_path / 'raw.pkl'))
+    # every sequence has at least one step, as the old per-access path needs
+    for modality in ['vision', 'audio', 'text']:
+        raw[modality][:, -1] += 0.5
+    for aligned in [True, False]:
+        for z_norm in [False, True]:
+            dataset = Affectdataset(raw, False, aligned=aligned, z_norm=z_norm)
+            noisy = Affectdataset(raw, False, aligned=aligned, z_norm=z_norm, noise={'text': lambda s, i: s})
+            for ind in range(len(raw['labels'])):
+                old = _old_affect_sequences(raw, ind, aligned, z_norm)
+                for new in [dataset[ind][:3], noisy[ind][:3]]:
+                    for a, b in zip(new, old):
+                        assert a.shape == b.shape and torch.allclose(a, b, atol=1e-5)
+
+
+def test_length_bucket_sampler(set_seeds):
+    pytest.importorskip('torchtext')
+    from datasets.affect.get_data import LengthBucketSampler
+    lengths = np.random.randint(1, 50, 103)
+    for shuffle in [False, True]:
+        sampler = LengthBucketSampler(lengths, 8, shuffle=shuffle, bucket_size=4)
+        batches = list(sampler)
+        assert len(batches) == len(sampler) == 13
+        assert sorted(i for batch in batches for i in batch) == list(range(103))
+        for batch in batches:
+            assert len(batch) <= 8
+            # batches are cut from a bucket sorted by length
+            assert list(lengths[batch]) == sorted(lengths[batch])
+
+
+def _assert_same_batches(batches, expected):
+    batches, expected = list(batches), list(expected)
+    assert len(batches) == len(expected)
+    for batch, other in zip(batches, expected):
+        assert len(batch) == len(other)
+        for a, b in zip(batch, other):
+            assert a.dtype == b.dtype and torch.equal(a, b)
+
+
+def test_batch_dataloader(set_seeds, tmp_path):
+    from datasets.array_dataset import ArrayDataset, batch_dataloader
+    np.save(str(tmp_path / 'x.npy'), np.random.rand(30, 2, 3).astype(np.float32))
+    arrays = [np.load(str(tmp_path / 'x.npy'), mmap_mode='r'), np.random.rand(30, 4), np.random.randint(0, 3, 30)]
+    dataset = ArrayDataset(arrays, indices=np.arange(3, 28), transforms=[lambda x: x * 2, None, None])
+    for shuffle in [False, True]:
+        for drop_last in [False, True]:
+            torch.manual_seed(1)
+            batches = list(batch_dataloader(dataset, 4, shuffle=shuffle, drop_last=drop_last))
+            torch.manual_seed(1)
+            expected = torch.utils.data.DataLoader(dataset, batch_size=4, shuffle=shuffle, drop_last=drop_last)
+            _assert_same_batches(batches, expected)
+
+
+def test_in_memory_batch_loader(set_seeds):
+    from datasets.array_dataset import ArrayDataset, InMemoryBatchLoader
+    arrays = [np.random.rand(30, 2, 3).astype(np.float32), np.random.randint(0, 3, 30), np.arange(30)]
+    dataset = ArrayDataset(arrays)
+    for drop_last in [False, True]:
+        loader = InMemoryBatchLoader(arrays, 4, drop_last=drop_last)
+        expected = torch.utils.data.DataLoader(dataset, batch_size=4, drop_last=drop_last)
+        assert len(loader) == len(expected)
+        _assert_same_batches(loader, expected)
+        _assert_same_batches(InMemoryBatchLoader.from_dataset(dataset, 4, drop_last=drop_last), expected)
+
+    loader = InMemoryBatchLoader(arrays, 4, shuffle=True)
+    epochs = [torch.cat([batch[-1] for batch in loader]) for _ in range(2)]
+    for rows in epochs:
+        assert sorted(rows.tolist()) == list(range(30))
+    assert not torch.equal(epochs[0], epochs[1])
+    rows = torch.cat([batch[-1] for batch in InMemoryBatchLoader(arrays, 4, shuffle=True, drop_last=True)])
+    assert len(rows) == 28 and len(set(rows.tolist())) == 28
+    # the other arrays are gathered with the same rows
+    for batch in loader:
+        assert torch.equal(batch[0], torch.from_numpy(arrays[0])[batch[-1]])
+        assert torch.equal(batch[1], torch.from_numpy(arrays[1])[batch[-1]])
+
+
+def _episode_files(directory, lengths=(11, 7)):
+    import h5py
+    filenames = []
+    for i, length in enumerate(lengths):
+        filename = str(directory / 'episode_{}.h5'.format(i))
+        with h5py.File(filename, 'w', libver='latest') as f:
+            f.create_dataset('proprio', data=np.random.rand(length, 8), chunks=(4, 8))
+            f.create_dataset('action', data=np.random.rand(length, 4).astype(np.float32))
+        filenames.append(filename)
+    return filenames
+
+
+def test_episode_reader(set_seeds, tmp_path):
+    import h5py
+    from datasets.robotics.episode_store import EpisodeReader
+    filenames = _episode_files(tmp_path)
+    expected = dict()
+    for filename in filenames:
+        with h5py.File(filename, 'r') as f:
+            expected[filename] = {key: f[key][()] for key in f}
+    # room for one file and two proprio windows, so windows and files are evicted while reading
+    reader = EpisodeReader(max_open_files=1, cache_bytes=2 * 4 * 8 * 8)
+    for _ in range(2):
+        for filename in filenames + filenames[::-1]:
+            for key, data in expected[filename].items():
+                for index in list(range(len(data))) + [5, 0, len(data) - 1]:
+                    row = reader.read(filename, key, index)
+                    assert np.array_equal(row, data[index])
+                    row += 1
+                    assert np.array_equal(reader.read(filename, key, index), data[index])
+                assert np.array_equal(reader.episode(filename, key), data)
+            assert len(reader._files) == 1
+            assert reader._cached_bytes <= reader.cache_bytes
+    copied = pickle.loads(pickle.dumps(reader))
+    assert not copied._files and not copied._windows
+    reader.close()
+
+
+def test_pack_episodes(set_seeds, tmp_path):
+    import h5py
+    from datasets.robotics.episode_store import PackedEpisodes, pack_episodes
+    filenames = _episode_files(tmp_path)
+    packed = pack_episodes(filenames + filenames[:1], str(tmp_path / 'packed'), keys=('proprio', 'action'))
+    for reader in [packed, PackedEpisodes(str(tmp_path / 'packed'))]:
+        for filename in filenames:
+            with h5py.File(filename, 'r') as f:
+                for key in ['proprio', 'action']:
+                    assert np.array_equal(reader.episode(filename, key), f[key][()])
+                    for index in range(len(f[key])):
+                        assert np.array_equal(reader.read(filename, key, index), f[key][index])
+                    with pytest.raises(IndexError):
+                        reader.read(filename, key, len(f[key]))
+    packed.arrays()
+    copied = pickle.loads(pickle.dumps(packed))
+    assert copied._arrays is None
+    assert np.array_equal(copied.read(filenames[1], 'action', 2), packed.read(filenames[1], 'action', 2))
+
+
+def test_episode_window_sampler(set_seeds):
+    from datasets.array_dataset import EpisodeWindowSampler
+    episodes = np.repeat(np.arange(10), np.random.randint(1, 6, 10))
+    np.random.shuffle(episodes)
+    counts = np.bincount(episodes)
+    sampler = EpisodeWindowSampler(episodes, episodes_per_shard=3)
+    epochs = [list(sampler) for _ in range(2)]
+    for indices in epochs:
+        assert len(indices) == len(sampler)
+        assert sorted(indices) == list(range(len(episodes)))
+        # all windows of a shard of three episodes are drawn before those of the next one
+        shard, drawn = set(), 0
+        for index in indices:
+            shard.add(episodes[index])
+            drawn += 1
+            assert len(shard) <= 3
+            if len(shard) == 3 and drawn == counts[list(shard)].sum():
+                shard, drawn = set(), 0
+        assert drawn == counts[list(shard)].sum()
+    assert epochs[0] != epochs[1]
+    seeded = [list(EpisodeWindowSampler(episodes, seed=5)) for _ in range(2)]
+    assert seeded[0] == seeded[1]
+    ordered = list(EpisodeWindowSampler(episodes, shuffle=False))
+    assert list(episodes[ordered]) == sorted(episodes)
+
+
+def _old_split_trajectories(trajectories, subsequence_length, modalities=None):
+    # split_trajectories before subsequences became views, for dict observations
+    subsequences = []
+    for traj in trajectories:
+        for offset in (0, subsequence_length // 2):
+            def split_fn(x):
+                x = x[offset:]
+                sections = len(x) // subsequence_length
+                return np.split(x[:sections * subsequence_length], sections) if sections else []
+            o = {key: split_fn(value) for key, value in traj.observations.items()}
+            for k, (s, c) in enumerate(zip(split_fn(traj.states), split_fn(traj.controls))):
+                named = {'gripper_pos': o['gripper_pos'][k], 'gripper_sensors': o['gripper_sensors'][k],
+                         'image': o['image'][k], 'control': c}
+                names = modalities if modalities is not None else ['gripper_pos', 'gripper_sensors', 'image', 'control']
+                subsequences.append(tuple(named[m] for m in names) + (s,))
+    return subsequences
+
+
+def test_subsequence_dataset(set_seeds):
+    pytest.importorskip('fannypack')
+    from datasets.gentle_push.data_loader import SubsequenceDataset, TrajectoryNumpy
+    trajectories = []
+    for length in [17, 6, 3]:
+        observations = {'gripper_pos': np.random.rand(length, 3), 'gripper_sensors': np.random.rand(length, 7),
+                        'image': np.random.rand(length, 4, 4)}
+        trajectories.append(TrajectoryNumpy(np.random.rand(length, 2), observations, np.random.rand(length, 7)))
+    for modalities in [None, ['image', 'control']]:
+        dataset = SubsequenceDataset(trajectories, 4, modalities)
+        expected = _old_split_trajectories(trajectories, 4, modalities)
+        assert len(dataset) == len(expected) == 9
+        for i, subsequence in enumerate(expected):
+            assert len(dataset[i]) == len(subsequence)
+            for a, b in zip(dataset[i], subsequence):
+                assert np.array_equal(a, b)
+        assert list(dataset.episodes) == [0] * 7 + [1] * 2
+
+
+def test_price_store(tmp_path):
+    pd = pytest.importorskip('pandas')
+    pytest.importorskip('requests')
+    import datetime
+    from datasets.stocks.price_store import PRICE_COLUMNS, PriceStore
+    calls = []
+
+    def _fetch(symbol, start, end):
+        calls.append((symbol, start, end))
+        dates = pd.bdate_range(start, end - datetime.timedelta(days=1))
+        values = np.arange(len(dates))[:, None] + dates.dayofyear.values[:, None] * np.arange(1, 7)
+        return pd.DataFrame(values.astype(float), index=dates, columns=list(PRICE_COLUMNS))
+
+    day = datetime.datetime(2020, 3, 2)
+    store = PriceStore(str(tmp_path), fetch=_fetch)
+    first = store.get('ABC', day, day + datetime.timedelta(days=20))
+    assert calls == [('ABC', day, day + datetime.timedelta(days=20))]
+    assert len(first) == 15 and list(first.columns) == list(PRICE_COLUMNS)
+    inner = store.get('ABC', day + datetime.timedelta(days=7), day + datetime.timedelta(days=14))
+    assert len(calls) == 1
+    assert inner.equals(first.loc[day + datetime.timedelta(days=7):day + datetime.timedelta(days=13)])
+
+    # only the dates before and after the stored range are fetched
+    outer = store.get('ABC', day - datetime.timedelta(days=7), day + datetime.timedelta(days=27))
+    assert calls[1:] == [('ABC', day - datetime.timedelta(days=7), day),
+                         ('ABC', day + datetime.timedelta(days=20), day + datetime.timedelta(days=27))]
+    assert len(outer) == 25 and outer.index.is_monotonic_increasing
+    assert outer.loc[first.index].equals(first)
+
+    offline = PriceStore(str(tmp_path), fetch=_fetch, offline=True)
+    assert offline.get('ABC', day - datetime.timedelta(days=7), day + datetime.timedelta(days=27)).equals(outer)
+    with pytest.raises(FileNotFoundError):
+        offline.get('ABC', day, day + datetime.timedelta(days=28))
+    with pytest.raises(FileNotFoundError):
+        offline.get('XYZ', day, day + datetime.timedelta(days=1))
+    assert len(calls) == 3
+
+
+def test_sliding_windows(set_seeds):
+    pytest.importorskip('pandas')
+    pytest.importorskip('requests')
+    from datasets.stocks.get_data import sliding_windows
+    RX = torch.randn(40, 5)
+    input_stocks = [0, 3, 4]
+    old = torch.cat([RX[i:i + 8, input_stocks].reshape(1, 8, -1) for i in range(len(RX) - 8)])
+    windows = sliding_windows(RX[:, input_stocks], 8)
+    assert windows.shape == old.shape and torch.equal(windows, old)
+    assert torch.equal(sliding_windows(RX[:, 0], 8), old[:, :, 0])
+
+
+def _old_normalize_clip(v):
+    # per-clip video preprocessing of tobatch_37.py before it moved to normalize_video
+    v = ((v.float() / 255.0) - torch.FloatTensor([0.43216, 0.394666, 0.37645])) / torch.FloatTensor([0.22803, 0.22145, 0.216989])
+    v = v.transpose(0, 3).transpose(3, 1)
+    return torch.nn.AvgPool2d((2, 2))(v)
+
+
+def test_normalize_video(set_seeds):
+    from datasets.kinetics.clip_store import normalize_video
+    video = torch.randint(0, 256, (3, 5, 8, 6, 3), dtype=torch.uint8)
+    normalized = normalize_video(video)
+    assert normalized.shape == (3, 3, 5, 3, 4)
+    for clip, expected in zip(normalized, video):
+        assert torch.allclose(clip, _old_normalize_clip(expected), atol=1e-5)
+    assert normalize_video(normalized) is normalized
+
+
+def test_clip_stream(set_seeds, tmp_path):
+    from datasets.kinetics.clip_store import ClipStore, ClipStream, normalize_video, write_clip_store
+    clips = [(torch.randint(0, 256, (2, 4, 4, 3), dtype=torch.uint8), torch.randn(6), i) for i in range(23)]
+    write_clip_store(clips, str(tmp_path), shard_size=10)
+    store = ClipStore(str(tmp_path))
+    assert store.shard_sizes == [10, 10, 3] and store.num_clips() == 23
+    for shuffle in [False, True]:
+        for drop_last, num_batches, num_clips in [(False, 7, 23), (True, 4, 16)]:
+            stream = ClipStream(store, 4, shuffle=shuffle, drop_last=drop_last, transforms={'video': normalize_video})
+            epochs = [list(stream) for _ in range(2)]
+            for batches in epochs:
+                assert len(batches) == len(stream) == num_batches
+                labels = torch.cat([batch[2] for batch in batches]).tolist()
+                assert len(labels) == len(set(labels)) == num_clips
+                if not drop_last:
+                    assert sorted(labels) == list(range(23))
+                if not shuffle:
+                    assert labels == sorted(labels)
+                for video, audio, label in batches:
+                    # batches do not span shards
+                    assert len(set((label // 10).tolist())) == 1
+                    for v, a, l in zip(video, audio, label):
+                        assert torch.allclose(v, _old_normalize_clip(clips[l][0]), atol=1e-5)
+                        assert torch.equal(a, clips[l][1])
+            if shuffle:
+                assert [b[2].tolist() for b in epochs[0]] != [b[2].tolist() for b in epochs[1]]
+
+
+class _StubVocab:
+    def __init__(self):
+        self.words = dict()
+
+    def word2index(self, words):
+        return [self.words.setdefault(word, len(self.words)) for word in words]
+
+
+class _StubTask:
+    # the parts of an RTFM task that the Text and Symbol featurizers read
+    def __init__(self, world, perspective, max_placement):
+        self.world = world
+        self.perspective = perspective
+        self.max_placement = max_placement
+        self.vocab = _StubVocab()
+        self.max_name, self.max_inv, self.max_wiki, self.max_task = 8, 10, 20, 12
+
+    @property
+    def world_shape(self):
+        return (self.world.height, self.world.width)
+
+    def get_wiki(self):
+        return 'goblins are weak to fire. wolves are strong against poison.'
+
+    def get_task(self):
+        return 'defeat the goblin'
+
+    def get_inv(self):
+        return 'empty'
+
+
+def test_rtfm_featurize_into():
+    for module in ['gym', 'revtok', 'vocab']:
+        pytest.importorskip(module)
+    sys.path.append(os.path.join(os.getcwd(), 'datasets', 'RTFM'))
+    from datasets.RTFM.get_env import featurize_into
+    from rtfm import featurizer as X
+    from rtfm.dynamics import monster as M, world as W
+
+    for max_placement in [1, 2]:
+        world = W.World()
+        W.Room(6, 7).place((0, 0), world)
+        # the far corner is out of sight of the agent
+        agent, monster = M.QueuedAgent(intelligence=3), M.HostileMonster()
+        agent.place((2, 3), world)
+        monster.place((2, 3), world)
+        M.HostileMonster().place((4, 1), world)
+        for perspective in [None, agent]:
+            task = _StubTask(world, perspective, max_placement)
+            featurizer = X.Concat([X.Text(), X.Symbol()])
+            expected = featurizer.featurize(task)
+            arrays = {k: np.full((2,) + tuple(v.shape), -1, dtype=np.int64) for k, v in expected.items()}
+            featurize_into(featurizer, task, arrays, 1)
+            for k, v in expected.items():
+                assert np.array_equal(arrays[k][1], v.numpy()), k
+                assert (arrays[k][0] == -1).all()
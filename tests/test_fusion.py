@@ -197,3 +197,75 @@ def test_LateFusionTransformer(set_seeds):
     out = fusion(torch.randn((3,10,10)))
     assert out.shape == (3,9)
     assert np.isclose(torch.norm(out).item(),5.1961259841918945)
+
+def test_layer_output_cache(set_seeds):
+    """Test that Searchable fuses cached layer outputs like it fuses its encoders' outputs."""
+    from fusions.searchable import LayerOutputCache, Searchable
+    encoders = [MLP(8, 6, 4, output_each_layer=True), MLP(5, 7, 3, output_each_layer=True)]
+    data = torch.utils.data.TensorDataset(torch.randn(10, 8), torch.randn(10, 5), torch.randint(0, 3, (10,)))
+    dl = torch.utils.data.DataLoader(data, batch_size=4)
+    cache = LayerOutputCache(encoders, [(8, 6, 4), (5, 7, 3)], {'train': dl})
+    assert len(cache.loaders['train']) == 3
+    model = Searchable(encoders, 10, 3, np.array([[1, 0, 2], [2, 2, 0]]), [(8, 6, 4), (5, 7, 3)]).to(device)
+    model.train(False)
+    for batch, cached in zip(dl, cache.loaders['train']):
+        assert torch.equal(batch[-1], cached[-1])
+        out = model([d.to(device) for d in batch[:-1]])
+        assert torch.allclose(out, model(cached[:-1]))
+
+def test_halving_budgets():
+    """Test the epochs of the rounds of successive halving."""
+    from fusions.searchable import halving_budgets
+    assert halving_budgets(8, 16) == [8]
+    assert halving_budgets(8, 16, 2) == [1, 2, 4, 8]
+    assert halving_budgets(8, 3, 3) == [2, 8]
+    assert halving_budgets(3, 15, 2, min_epochs=2) == [3]
+
+def test_train_sampled_models_workers(set_seeds):
+    """Test that successive halving trains the configurations the same in worker processes as in this process."""
+    from fusions.searchable import LayerOutputCache, Searchable, train_sampled_models
+    encoders = [MLP(8, 6, 4, output_each_layer=True), MLP(5, 7, 3, output_each_layer=True)]
+    sub_sizes = [(8, 6, 4), (5, 7, 3)]
+    y = torch.randint(0, 3, (48,))
+    data = torch.utils.data.TensorDataset(torch.randn(48, 8) + y[:, None], torch.randn(48, 5), y)
+    dls = {'train': torch.utils.data.DataLoader(torch.utils.data.Subset(data, range(32)), batch_size=8),
+           'dev': torch.utils.data.DataLoader(torch.utils.data.Subset(data, range(32, 48)), batch_size=8)}
+    cache = LayerOutputCache(encoders, sub_sizes, dls)
+    confs = [np.array(c) for c in [[[1, 0, 2]], [[2, 2, 0]], [[0, 1, 1], [1, 2, 0]], [[2, 0, 1], [2, 2, 2]]]]
+    saved = set(os.listdir('tests'))
+    try:
+        accuracies = []
+        for num_workers in [1, 2]:
+            torch.manual_seed(0)
+            accuracies.append(train_sampled_models(confs, Searchable, dls, False, device, None, 10, 3, sub_sizes, 8, 4,
+                                                   0.01, 0.001, 1, 2, layer_cache=cache, num_workers=num_workers,
+                                                   halving_rate=2))
+    finally:
+        for name in set(os.listdir('tests')) - saved:
+            os.remove(os.path.join('tests', name))
+    assert len(accuracies[0]) == 4
+    assert [float(a) for a in accuracies[0]] == [float(a) for a in accuracies[1]]
+
+
+def test_train_sampled_models_shared_encoders(set_seeds):
+    """Test that configurations trained on cached layer outputs share the encoders, which are left out of their training state."""
+    from fusions.searchable import CandidateTraining, LayerOutputCache, Searchable, train_sampled_models
+    encoders = [MLP(8, 6, 4, output_each_layer=True), MLP(5, 7, 3, output_each_layer=True)]
+    sub_sizes = [(8, 6, 4), (5, 7, 3)]
+    data = torch.utils.data.TensorDataset(torch.randn(16, 8), torch.randn(16, 5), torch.randint(0, 3, (16,)))
+    dls = {'train': torch.utils.data.DataLoader(data, batch_size=8), 'dev': torch.utils.data.DataLoader(data, batch_size=8)}
+    cache = LayerOutputCache(encoders, sub_sizes, dls)
+    confs = [np.array([[1, 0, 2]]), np.array([[2, 2, 0]])]
+    saved = set(os.listdir('tests'))
+    try:
+        _, models = train_sampled_models(confs, Searchable, dls, False, device, None, 10, 3, sub_sizes, 8, 1,
+                                         0.01, 0.001, 1, 2, return_model=[0, 1], layer_cache=cache)
+    finally:
+        for name in set(os.listdir('tests')) - saved:
+            os.remove(os.path.join('tests', name))
+    assert all(a is b for a, b in zip(models[0].encoders, encoders))
+    assert all(a is b for a, b in zip(models[1].encoders, encoders))
+    candidate = CandidateTraining(models[0], [torch.nn.CrossEntropyLoss()], torch.optim.Adam(models[0].central_params()),
+                                  None, frozen=['encoders'])
+    assert candidate.best_model_sd
+    assert not any(name.startswith('encoders.') for name in candidate.best_model_sd)
@@ -41,7 +41,7 @@ def test_visual(set_seeds):
     np.random.seed(0)
     test = np.random.random((3,128,128))
     idf = add_visual_noise(test, noise_level=1)
-    assert np.isclose(np.linalg.norm(idf),25996.547)
+    assert np.isclose(np.linalg.norm(idf),25884.766)
     assert idf[0].shape == (128,128)
     test = np.random.random((3,128,128))
     idf = add_visual_noise(test, noise_level=0)
@@ -57,6 +57,19 @@ def test_visual(set_seeds):
     im2 = WB(im,1.0)
     assert im2.size == (100,100)    
 
+def test_visual_batch():
+    """Test batched visual noise against the per-image transformations."""
+    images = np.random.default_rng(0).integers(0, 256, (4, 32, 32, 3), dtype=np.uint8)
+    off = dict(gray=False, contrast=False, inv=False, temp=False, color=False, s_and_p=False, gaus=False, rot=False, flip=False, crop=False)
+    for flag, noise in [('gray', grayscale), ('contrast', low_contrast), ('inv', inversion), ('flip', horizontal_flip)]:
+        idf = add_visual_noise_batch(images, noise_level=1, **dict(off, **{flag: True}))
+        for i in range(len(images)):
+            assert (idf[i] == np.array(noise(Image.fromarray(images[i]), 1).convert('RGB'))).all()
+    idf = add_visual_noise_batch(torch.from_numpy(images), noise_level=0.5, seed=1)
+    assert torch.is_tensor(idf) and idf.shape == images.shape
+    assert (idf.numpy() == add_visual_noise_batch(images, noise_level=0.5, seed=1)).all()
+    assert all((a == b).all() for a, b in zip(add_visual_noise(list(images), noise_level=0.5, seed=1), idf.numpy()))
+
 def test_text(set_seeds):
     """Test text module."""
     text = ['Assistance', 'imprudence', 'yet', 'sentiments', 'unpleasant', 'expression', 'met', 'surrounded', 'not', 'Saw', 'vicinity', 'judgment', 'remember', 'finished', 'men', 'throwing.']
@@ -66,10 +79,31 @@ def test_text(set_seeds):
     idf_sticky = add_text_noise(text[10:12], noise_level=1, swap=False, rand_mid=False, typo=False, omit=False)
     idf_omit = add_text_noise(text[12:], noise_level=1, swap=False, rand_mid=False, typo=False, sticky=False)
     idf = np.concatenate([idf_swap, idf_rand_mid, idf_typo, idf_sticky, idf_omit])
-    target = ["assistnace", "imprduence", "yet", "stnmeteins", "usneaanplt", "esorpixesn", "met", "surrounsed", "not", "saw", "vicinitty", "judggment", "rememer", "finised", "men", "thrwing ."]
+    target = ["assitsance", "imrpudence", "yet", "snientmtes", "usleapnant", "ersioespxn", "met", "sufrounded", "not", "saw", "viicinity", "juddgment", "remeber", "finshed", "men", "throing ."]
     for i in range(len(idf)):
         assert idf[i] == target[i]
-    
+
+def test_text_corpus():
+    text = ['Assistance imprudence yet', 'Sentiments, unpleasant expression met!', '', 'Surrounded not saw vicinity judgment']
+    corpus = TextCorpus(text)
+    assert corpus.texts() == ['assistance imprudence yet', 'sentiments , unpleasant expression met !', '', 'surrounded not saw vicinity judgment']
+    corruption = corpus.corrupt(0.5, seed=0)
+    noisy = corpus.texts(corruption)
+    assert noisy == corpus.texts(corpus.corrupt(0.5, seed=0))
+    assert noisy == add_text_noise(text, 0.5, seed=0)
+    def embed(words):
+        return np.array([[len(w), w.count('e')] for w in words]).reshape(-1, 2), np.array([w != 'yet' for w in words])
+    looked_up = []
+    def lookup(words):
+        looked_up.extend(words)
+        return embed(words)
+    embedder = WordEmbeddingCache(lookup, 2)
+    for _ in range(2):
+        for doc, (vectors, found) in zip(noisy, corpus.embed(embedder, corruption)):
+            assert (vectors == embed(doc.split())[0]).all() and (found == embed(doc.split())[1]).all()
+    # every word is looked up once: the vocabulary when first embedded, corrupted words through the cache
+    assert sorted(looked_up) == sorted(corpus.vocab + list(set(corruption.words)))
+
 def test_ts(set_seeds):
     np.random.seed(0)
     test = [[ np.array([1.0,2.0,3.0]),np.array([4.0,5.0,6.0])]]
@@ -78,3 +112,41 @@ def test_ts(set_seeds):
     test = [[ np.array([1.0,2.0,3.0]),np.array([4.0,5.0,6.0])]]
     idf = add_timeseries_noise(test, noise_level=0)
     assert np.isclose(idf, test).all()
+
+def test_ts_vectorized(set_seeds):
+    test = np.ones((4, 5, 3))
+    idf = add_timeseries_noise(test.copy(), noise_level=0.5, seed=0)
+    assert np.isclose(idf, add_timeseries_noise(test.copy(), noise_level=0.5, seed=0)).all()
+    idf = structured_drop(np.ones((4, 5, 3)), 0.5, np.random.default_rng(0))
+    assert ((idf == 0).all(-1) | (idf == 1).all(-1)).all()
+    idf = white_noise(torch.zeros((4, 5, 3)), 1, np.random.default_rng(0))
+    assert (idf[..., 0:1] == idf).all()
+    collate = TimeseriesNoiseCollate(modalities=(0,), noise_level=1, seed=0)
+    batch = collate([(torch.ones(5, 3), 1) for _ in range(4)])
+    assert np.isclose(np.linalg.norm(batch[0]), 0)
+    assert (batch[1] == 1).all()
+
+def test_ts_sample_noise(set_seeds):
+    data = np.ones((6, 5, 3))
+    noise = TimeseriesSampleNoise(len(data), noise_level=0.5, rand_drop=False, seed=0)
+    for ind in range(len(data)):
+        idf = noise(data[ind], ind)
+        if noise.dropped[ind]:
+            assert (idf == 0).all()
+        else:
+            assert np.isclose(idf, 1 + noise.offsets[ind]).all()
+    assert (data == 1).all()
+    noise = TimeseriesSampleNoise(len(data), noise_level=1, struct_drop=False, seed=0)
+    assert np.isclose(np.linalg.norm(noise(data[0], 0)), 0)
+
+def test_robust_suite():
+    from robustness.robust_suite import RobustTestSuite
+    built = []
+    def _build(noise_level):
+        built.append(noise_level)
+        return [noise_level]
+    suite = RobustTestSuite().add('timeseries', _build, [0, 0.5, 1])
+    assert list(suite.keys()) == ['timeseries'] and built == []
+    assert len(suite['timeseries']) == 3
+    assert [loader for loader in suite['timeseries']] == [[0], [0.5], [1]]
+    assert suite['timeseries'][0] == [0] and built == [0, 0.5, 1, 0]
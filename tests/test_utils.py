@@ -1,3 +1,4 @@
+import sys
 import numpy as np
 from objective_functions.recon import *
 
@@ -13,4 +14,125 @@ def test_weighted_acc():
 def test_recon():
     assert sigmloss1d(torch.ones((10,10)),torch.ones((10,10))).shape == (10,)
     assert sigmloss1dcentercrop(10,10)(torch.ones((1,1,10,10)),torch.ones((1,1,10,10))).shape == (1,)
-    assert nosigmloss1d(torch.ones((10,10)),torch.ones((10,10))).shape == (10,)
\ No newline at end of file
+    assert nosigmloss1d(torch.ones((10,10)),torch.ones((10,10))).shape == (10,)
+def test_metrics_accumulator():
+    import sklearn.metrics
+    from eval_scripts.metrics import MetricsAccumulator
+    torch.manual_seed(0)
+    true = torch.randint(0, 2, (100, 1))
+    scores = torch.rand(100)
+    pred = torch.randint(0, 2, (100,))
+    metrics = MetricsAccumulator()
+    for i in range(0, 100, 32):
+        metrics.update(true[i:i+32], pred[i:i+32], scores[i:i+32], torch.tensor(1.0))
+    assert metrics.total == 100
+    assert torch.isclose(metrics.loss(), torch.tensor(1.0))
+    assert metrics.accuracy() == sklearn.metrics.accuracy_score(true.numpy(), pred.numpy())
+    assert np.isclose(metrics.f1_score("macro"), sklearn.metrics.f1_score(true.numpy(), pred.numpy(), average="macro"))
+    assert np.isclose(metrics.auprc(), sklearn.metrics.average_precision_score(true.numpy(), scores.numpy()))
+
+def test_profiler():
+    from eval_scripts import profiling
+    with profiling.phase('forward'):
+        pass
+    with profiling.Profiler() as profiler:
+        for _ in range(2):
+            for _ in profiling.iterate(range(3)):
+                with profiling.phase('forward'):
+                    pass
+            profiling.end_epoch()
+    assert profiling.active_profiler() is None
+    assert len(profiler.epochs) == 2
+    assert set(profiler.summary()['phases']) == {'data', 'forward'}
+    assert 'max_rss_mb' in profiler.peak_memory()
+    if sys.platform.startswith('linux'):
+        assert all(record['peak_memory']['rss_mb'] > 0 for record in profiler.epochs)
+    assert not profiler.synchronize and profiling.Profiler(trace_path='trace.json').synchronize == torch.cuda.is_available()
+
+def test_checkpoint_manager(tmp_path):
+    from utils.checkpoint import CheckpointManager, load_checkpoint
+    model = torch.nn.Linear(2, 2)
+    op = torch.optim.SGD(model.parameters(), lr=0.1)
+    manager = CheckpointManager(str(tmp_path), keep_last=2, keep_best=1, mode='min')
+    for epoch, loss in enumerate([0.5, 0.1, 0.4, 0.3, 0.2]):
+        manager.save(epoch, {'model': model}, {'optimizer': op}, metric=loss, extra={'loss': loss})
+    manager.close()
+    assert sorted(p.name for p in tmp_path.glob('checkpoint_*.pt')) == ['checkpoint_0001.pt', 'checkpoint_0003.pt', 'checkpoint_0004.pt']
+    assert manager.best().endswith('checkpoint_0001.pt')
+    state = load_checkpoint(str(tmp_path), {'model': torch.nn.Linear(2, 2)}, restore_rng=False)
+    assert state['epoch'] == 4 and state['extra']['loss'] == 0.2
+
+def test_feature_cache(tmp_path):
+    import threading
+    from utils.feature_cache import FeatureCache
+    cache = FeatureCache(str(tmp_path))
+    calls = []
+    def compute():
+        calls.append(1)
+        return np.arange(6.0).reshape(2, 3)
+    key = dict(dataset='toy', split='test', modality='text', noise='add_text_noise', noise_level=0.1, seed=0)
+    threads = [threading.Thread(target=cache.get_or_compute, args=(compute,), kwargs=key) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    features = FeatureCache(str(tmp_path)).get_or_compute(compute, **key)
+    assert isinstance(features, np.memmap) and (features == np.arange(6.0).reshape(2, 3)).all()
+    assert len(calls) == 1
+    features = cache.get_or_compute(lambda: {'a': np.zeros(2), 'b': np.ones(3)}, **dict(key, noise_level=0.2, extractor=torch.nn.Linear(2, 2)))
+    assert set(features) == {'a', 'b'} and (features['b'] == 1).all()
+    def fill(out):
+        for i in range(0, len(out), 2):
+            out[i:i + 2] = i
+    features = cache.get_or_fill(fill, (5, 3), np.float32, **dict(key, modality='image'))
+    assert features.dtype == np.float32 and (features[:, 0] == [0, 0, 2, 2, 4]).all()
+
+def test_robustness_curves():
+    from eval_scripts.sweep import robustness_curves
+    from robustness.robust_suite import RobustTestSuite
+    model = torch.nn.Linear(3, 2)
+    data = torch.rand(4, 3)
+    suite = RobustTestSuite().add('a', lambda level: data * level, [0, 1, 2]).add('b', lambda level: data + level, [0, 1])
+    def evaluate(loader):
+        with torch.no_grad():
+            return {'sum': model(loader).sum().item(), 'max': model(loader).max().item()}
+    curves = robustness_curves(evaluate, suite)
+    assert len(curves['a']['sum']) == 3 and len(curves['b']['max']) == 2
+    assert robustness_curves(evaluate, suite, num_workers=2) == curves
+
+def test_robustness_report(tmp_path):
+    from eval_scripts import robustness
+    curve = [0.9, 0.8, 0.6, 0.5, 0.5, 0.4, 0.3, 0.3, 0.2, 0.1]
+    area = sum((curve[i] + curve[i + 1]) * 0.1 / 2 for i in range(len(curve) - 1))
+    assert np.isclose(robustness.relative_robustness_helper(curve, 'mosi text'), area)
+    tasks = ['mosi text', 'imdb text micro', 'finance tech timeseries']
+    batched = robustness.robustness_metrics([curve] * 3, tasks, 'relative')
+    assert np.allclose(batched, [robustness.relative_robustness(curve, task) for task in tasks])
+    assert robustness.effective_robustness(curve, 'no such task') == "Invalid example name!"
+    curves = {'text': {'Accuracy': curve}, 'timeseries': {'Accuracy': curve[::-1]}}
+    for name in ['results.csv', 'results.db']:
+        with robustness.results_store(str(tmp_path / name)) as store, robustness.deferred_plots() as plots:
+            robustness.report_robustness(curves, 'mosi', str(tmp_path / name.split('.')[1]))
+            assert len(plots.plots) == 2 and not list(tmp_path.glob(name.split('.')[1] + '*.png'))
+        records = store.read()
+        assert [r['noisy_modality'] for r in records] == ['text', 'timeseries'] and records[0]['curve'] == curve
+        assert np.isclose(records[0]['relative'], robustness.relative_robustness(curve, 'mosi text'))
+    assert len(list(tmp_path.glob('*.png'))) == 4
+
+def test_surrogate_batch():
+    from utils.surrogate import SimpleRecurrentSurrogate, SurrogateDataloader
+    confs = [np.array([[0, 1, 2]]), np.array([[1, 1, 0], [2, 0, 1]]), np.array([[0, 1, 2]])]
+    data = SurrogateDataloader()
+    for conf, acc in zip(confs, [0.2, 0.5, 0.4]):
+        data.add_datum(conf, acc)
+    assert len(data) == 2
+    dataset_conf, dataset_acc = data.get_data()
+    assert [c.shape for c in dataset_conf] == [(1, 1, 3), (2, 1, 3)]
+    assert np.allclose(dataset_acc[0], 0.4)
+    padded, accs, lengths = data.get_batch()
+    assert padded.shape == (2, 2, 3) and list(lengths) == [1, 2] and (padded[1, 0] == 0).all()
+    torch.manual_seed(0)
+    surrogate = SimpleRecurrentSurrogate()
+    batched = surrogate.eval_models(confs[:2], 'cpu')
+    assert np.allclose(batched, [surrogate.eval_model(conf, 'cpu') for conf in confs[:2]], atol=1e-6)
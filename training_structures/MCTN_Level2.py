@@ -1,10 +1,12 @@
 """Implements training pipeline for 2 Level MCTN."""
 from eval_scripts.complexity import all_in_one_test
-from eval_scripts.robustness import relative_robustness, effective_robustness, single_plot
+from eval_scripts import profiling
+from eval_scripts.sweep import robustness_curves
+from eval_scripts.robustness import report_robustness
 from fusions.MCTN import Seq2Seq, L2_MCTN
 from utils.evaluation_metric import eval_mosei_senti_return
+from utils.checkpoint import CheckpointManager, checkpoint_directory, load_checkpoint
 from unimodals.common_models import MLP
-from tqdm import tqdm
 from torch.nn import functional as F
 from torch import nn
 import torch
@@ -39,7 +41,7 @@ def train(
         dropout_p=0.1, early_stop=False, patience_num=15,
         lr=1e-4, weight_decay=0.01, op_type=torch.optim.AdamW,
         epoch=100, model_save='best_mctn.pt',
-        testdata=None):
+        testdata=None, checkpoint_dir=None, resume=None, keep_last=1, keep_best=1):
     """Train a 2-level MCTN Instance
 
     Args:
@@ -68,6 +70,10 @@ def train(
         epoch (int, optional): Number of epochs. Defaults to 100.
         model_save (str, optional): Path to save best model. Defaults to 'best_mctn.pt'.
         testdata (torch.utils.data.DataLoader, optional): Data Loader for test data. Defaults to None.
+        checkpoint_dir (str, optional): Directory to write a resumable checkpoint to after every epoch (written in the background). Defaults to None, which does not checkpoint.
+        resume (str, optional): Checkpoint file or directory to resume training from. checkpoint_dir defaults to its directory. Defaults to None.
+        keep_last (int, optional): Number of most recent checkpoints to keep. Defaults to 1.
+        keep_best (int, optional): Number of checkpoints with the lowest validation MAE to keep. Defaults to 1.
     """
     seq2seq0 = Seq2Seq(encoder0, decoder0).to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
     seq2seq1 = Seq2Seq(encoder1, decoder1).to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
@@ -77,15 +83,24 @@ def train(
     patience = 0
     best_acc = 0
     best_mae = 10000
-
-    for ep in range(epoch):
+    start_epoch = 0
+    if resume is not None:
+        state = load_checkpoint(resume, {'model': model}, {'optimizer': op}, map_location=torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
+        start_epoch = state['epoch'] + 1
+        best_acc, best_mae, patience = [state['extra'][k] for k in ('best_acc', 'best_mae', 'patience')]
+    directory = checkpoint_directory(checkpoint_dir, resume)
+    checkpoints = None
+    if directory is not None:
+        checkpoints = CheckpointManager(directory, keep_last, keep_best, mode='min')
+
+    for ep in range(start_epoch, epoch):
         model.train()
         print('start training ---------->>')
 
         sum_total_loss = 0
         sum_reg_loss = 0
         total_batch = 0
-        for i, inputs in enumerate(traindata):
+        for i, inputs in enumerate(profiling.iterate(traindata)):
             src, trg0, trg1, labels, f_dim = _process_input_L2(
                 inputs, max_seq_len)
             translation_loss_0 = 0
@@ -96,31 +111,34 @@ def train(
 
             op.zero_grad()
 
-            out, reout, rereout, head_out = model(src, trg0, trg1)
+            with profiling.phase('forward'):
+                out, reout, rereout, head_out = model(src, trg0, trg1)
 
-            for j, o in enumerate(out):
-                translation_loss_0 += criterion_t0(o, trg0[j])
-            translation_loss_0 = translation_loss_0 / out.size(0)
+                for j, o in enumerate(out):
+                    translation_loss_0 += criterion_t0(o, trg0[j])
+                translation_loss_0 = translation_loss_0 / out.size(0)
 
-            for j, o in enumerate(reout):
-                cyclic_loss += criterion_c(o, src[j])
-            cyclic_loss = cyclic_loss / reout.size(0)
+                for j, o in enumerate(reout):
+                    cyclic_loss += criterion_c(o, src[j])
+                cyclic_loss = cyclic_loss / reout.size(0)
 
-            for j, o in enumerate(rereout):
-                translation_loss_1 += criterion_t1(o, trg1[j])
-            translation_loss_1 = translation_loss_1 / rereout.size(0)
+                for j, o in enumerate(rereout):
+                    translation_loss_1 += criterion_t1(o, trg1[j])
+                translation_loss_1 = translation_loss_1 / rereout.size(0)
 
-            reg_loss = criterion_r(head_out, labels)
+                reg_loss = criterion_r(head_out, labels)
 
-            total_loss = mu_t0 * translation_loss_0 + mu_c * \
-                cyclic_loss + mu_t1 * translation_loss_1 + reg_loss
+                total_loss = mu_t0 * translation_loss_0 + mu_c * \
+                    cyclic_loss + mu_t1 * translation_loss_1 + reg_loss
 
-            sum_total_loss += total_loss
-            sum_reg_loss += reg_loss
+            sum_total_loss += total_loss.detach()
+            sum_reg_loss += reg_loss.detach()
             total_batch += 1
 
-            total_loss.backward()
-            op.step()
+            with profiling.phase('backward'):
+                total_loss.backward()
+            with profiling.phase('step'):
+                op.step()
 
         sum_total_loss /= total_batch
         sum_reg_loss /= total_batch
@@ -133,7 +151,7 @@ def train(
         print('Start Evaluating ---------->>')
         pred = []
         true = []
-        with torch.no_grad():
+        with torch.no_grad(), profiling.phase('validation'):
             for i, inputs in enumerate(validdata):
                 # process input
                 src, trg0, trg1, labels, feature_dim = _process_input_L2(
@@ -160,11 +178,20 @@ def train(
                 best_mae = mae
                 print('<------------ Saving Best Model')
                 print()
-                torch.save(model, model_save)
+                if checkpoints is None:
+                    torch.save(model, model_save)
+                else:
+                    checkpoints.save_model(model, model_save)
             else:
                 patience += 1
+            if checkpoints is not None:
+                checkpoints.save(ep, {'model': model}, {'optimizer': op}, metric=mae,
+                                 extra={'best_acc': best_acc, 'best_mae': best_mae, 'patience': patience})
             if early_stop and patience > patience_num:
                 break
+        profiling.end_epoch()
+    if checkpoints is not None:
+        checkpoints.close()
 
 
 def single_test(model, testdata, max_seq_len=20):
@@ -203,7 +230,7 @@ def single_test(model, testdata, max_seq_len=20):
         return {'Acc:': Acc2}
 
 
-def test(model, test_dataloaders_all, dataset, method_name='My method', is_packed=False, criterion=nn.CrossEntropyLoss(), task="classification", auprc=False, input_to_float=True, no_robust=True):
+def test(model, test_dataloaders_all, dataset, method_name='My method', is_packed=False, criterion=nn.CrossEntropyLoss(), task="classification", auprc=False, input_to_float=True, no_robust=True, sweep_workers=1):
     """Test MCTN_Level2 Module on a set of test dataloaders.
 
     Args:
@@ -217,6 +244,7 @@ def test(model, test_dataloaders_all, dataset, method_name='My method', is_packe
         auprc (bool, optional): (unused). Defaults to False.
         input_to_float (bool, optional): (unused). Defaults to True.
         no_robust (bool, optional): Whether to not apply robustness transformations or not. Defaults to True.
+        sweep_workers (int, optional): Number of processes to score the noisy test sets in parallel, each with a replica of the model. Defaults to 1.
     """
     if no_robust:
         def _testprocess():
@@ -227,28 +255,10 @@ def test(model, test_dataloaders_all, dataset, method_name='My method', is_packe
             single_test(model, test_dataloaders_all[list(
                 test_dataloaders_all.keys())[0]][0])
         all_in_one_test(_testprocess, [model])
-        for noisy_modality, test_dataloaders in test_dataloaders_all.items():
-            print("Testing on noisy data ({})...".format(noisy_modality))
-            robustness_curve = dict()
-            for test_dataloader in tqdm(test_dataloaders):
-                single_test_result = single_test(model, test_dataloader)
-                for k, v in single_test_result.items():
-                    curve = robustness_curve.get(k, [])
-                    curve.append(v)
-                    robustness_curve[k] = curve
-            for measure, robustness_result in robustness_curve.items():
-                robustness_key = '{} {}'.format(dataset, noisy_modality)
-                print("relative robustness ({}, {}): {}".format(noisy_modality, measure, str(
-                    relative_robustness(robustness_result, robustness_key))))
-                if len(robustness_curve) != 1:
-                    robustness_key = '{} {}'.format(robustness_key, measure)
-                print("effective robustness ({}, {}): {}".format(noisy_modality, measure, str(
-                    effective_robustness(robustness_result, robustness_key))))
-                fig_name = '{}-{}-{}-{}'.format(method_name,
-                                                robustness_key, noisy_modality, measure)
-                single_plot(robustness_result, robustness_key, xlabel='Noise level',
-                            ylabel=measure, fig_name=fig_name, method=method_name)
-                print("Plot saved as "+fig_name)
+        def _evaluate(test_dataloader):
+            return single_test(model, test_dataloader)
+        curves = robustness_curves(_evaluate, test_dataloaders_all, sweep_workers)
+        report_robustness(curves, dataset, method_name)
 
 
 def _process_input_L2(inputs, max_seq=20):
@@ -3,10 +3,14 @@
 import torch
 from torch import nn
 import time
-from eval_scripts.performance import AUPRC, f1_score, accuracy, eval_affect
+from eval_scripts.performance import eval_affect
+from eval_scripts.metrics import MetricsAccumulator
 from eval_scripts.complexity import all_in_one_train, all_in_one_test
-from eval_scripts.robustness import relative_robustness, effective_robustness, single_plot
-from tqdm import tqdm
+from eval_scripts import profiling
+from eval_scripts.sweep import robustness_curves
+from eval_scripts.robustness import report_robustness
+from unimodals.common_models import set_channels_last
+from utils.checkpoint import CheckpointManager, checkpoint_directory, load_checkpoint
 #import pdb
 
 softmax = nn.Softmax()
@@ -81,13 +85,23 @@ def deal_with_objective(objective, pred, truth, args):
         return objective(pred, truth, args)
 
 
+def _autocast(device, enabled):
+    """Get the mixed precision context for device: float16 on CUDA, bfloat16 on CPU."""
+    dtype = torch.float16 if device.type == 'cuda' else torch.bfloat16
+    return torch.autocast(device_type=device.type, dtype=dtype, enabled=enabled)
+
+
+def _grad_scaler():
+    if hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda')
+    return torch.cuda.amp.GradScaler()
 
 
 def train(
         encoders, fusion, head, train_dataloader, valid_dataloader, total_epochs, additional_optimizing_modules=[], is_packed=False,
         early_stop=False, task="classification", optimtype=torch.optim.RMSprop, lr=0.001, weight_decay=0.0,
         objective=nn.CrossEntropyLoss(), auprc=False, save='best.pt', validtime=False, objective_args_dict=None, input_to_float=True, clip_val=8,
-        track_complexity=True):
+        track_complexity=True, amp=False, channels_last=False, checkpoint_dir=None, resume=None, keep_last=1, keep_best=1):
     """
     Handle running a simple supervised training loop.
     
@@ -110,9 +124,17 @@ def train(
     :param input_to_float: whether to convert input to float type or not
     :param clip_val: grad clipping limit
     :param track_complexity: whether to track training complexity or not
+    :param amp: whether to run the forward pass and objective in mixed precision (float16 with gradient scaling on CUDA, bfloat16 on CPU) or not
+    :param channels_last: whether to run the convolutional encoders in channels-last memory format or not
+    :param checkpoint_dir: directory to write a resumable checkpoint to after every epoch (written in the background), or None to not checkpoint
+    :param resume: checkpoint file or directory to resume training from; training continues at the epoch after the checkpoint, and checkpoint_dir defaults to the directory of the checkpoint
+    :param keep_last: number of most recent checkpoints to keep in checkpoint_dir
+    :param keep_best: number of checkpoints with the best validation performance to keep in checkpoint_dir
     """
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
     model = MMDL(encoders, fusion, head, has_padding=is_packed).to(device)
+    if channels_last:
+        set_channels_last(model)
 
     def _trainprocess():
         additional_params = []
@@ -125,6 +147,19 @@ def train(
         bestacc = 0
         bestf1 = 0
         patience = 0
+        scaler = _grad_scaler() if amp and device.type == 'cuda' else None
+        optimizers = {'optimizer': op}
+        if scaler is not None:
+            optimizers['scaler'] = scaler
+        start_epoch = 0
+        if resume is not None:
+            state = load_checkpoint(resume, {'model': model}, optimizers, map_location=device)
+            start_epoch = state['epoch'] + 1
+            bestvalloss, bestacc, bestf1, patience = [state['extra'][k] for k in ('bestvalloss', 'bestacc', 'bestf1', 'patience')]
+        directory = checkpoint_directory(checkpoint_dir, resume)
+        checkpoints = None
+        if directory is not None:
+            checkpoints = CheckpointManager(directory, keep_last, keep_best, mode='min' if task == "regression" else 'max')
 
         def _processinput(inp):
             if input_to_float:
@@ -132,99 +167,104 @@ def train(
             else:
                 return inp
 
-        for epoch in range(total_epochs):
-            totalloss = 0.0
-            totals = 0
+        def _savebest():
+            print("Saving Best")
+            if checkpoints is None:
+                torch.save(model, save)
+            else:
+                checkpoints.save_model(model, save)
+
+        for epoch in range(start_epoch, total_epochs):
+            metrics = MetricsAccumulator()
             model.train()
-            for j in train_dataloader:
+            for j in profiling.iterate(train_dataloader):
                 op.zero_grad()
-                if is_packed:
-                    with torch.backends.cudnn.flags(enabled=False):
-                        model.train()
-                        out = model([[_processinput(i).to(device)
-                                    for i in j[0]], j[1]])
-
-                else:
-                    model.train()
-                    out = model([_processinput(i).to(device)
-                                for i in j[:-1]])
-                if not (objective_args_dict is None):
-                    objective_args_dict['reps'] = model.reps
-                    objective_args_dict['fused'] = model.fuseout
-                    objective_args_dict['inputs'] = j[:-1]
-                    objective_args_dict['training'] = True
-                    objective_args_dict['model'] = model
-                loss = deal_with_objective(
-                    objective, out, j[-1], objective_args_dict)
-
-                totalloss += loss * len(j[-1])
-                totals += len(j[-1])
-                loss.backward()
-                torch.nn.utils.clip_grad_norm_(model.parameters(), clip_val)
-                op.step()
-            print("Epoch "+str(epoch)+" train loss: "+str(totalloss/totals))
-            validstarttime = time.time()
-            if validtime:
-                print("train total: "+str(totals))
-            model.eval()
-            with torch.no_grad():
-                totalloss = 0.0
-                pred = []
-                true = []
-                pts = []
-                for j in valid_dataloader:
+                with profiling.phase('forward'), _autocast(device, amp):
                     if is_packed:
-                        out = model([[_processinput(i).to(device)
-                                    for i in j[0]], j[1]])
+                        with torch.backends.cudnn.flags(enabled=False):
+                            model.train()
+                            out = model([[_processinput(i).to(device)
+                                        for i in j[0]], j[1]])
+
                     else:
+                        model.train()
                         out = model([_processinput(i).to(device)
                                     for i in j[:-1]])
-
                     if not (objective_args_dict is None):
                         objective_args_dict['reps'] = model.reps
                         objective_args_dict['fused'] = model.fuseout
                         objective_args_dict['inputs'] = j[:-1]
-                        objective_args_dict['training'] = False
+                        objective_args_dict['training'] = True
+                        objective_args_dict['model'] = model
                     loss = deal_with_objective(
                         objective, out, j[-1], objective_args_dict)
-                    totalloss += loss*len(j[-1])
-                    
+
+                metrics.update(j[-1], loss=loss)
+                with profiling.phase('backward'):
+                    (loss if scaler is None else scaler.scale(loss)).backward()
+                with profiling.phase('step'):
+                    if scaler is None:
+                        torch.nn.utils.clip_grad_norm_(model.parameters(), clip_val)
+                        op.step()
+                    else:
+                        scaler.unscale_(op)
+                        torch.nn.utils.clip_grad_norm_(model.parameters(), clip_val)
+                        scaler.step(op)
+                        scaler.update()
+            print("Epoch "+str(epoch)+" train loss: "+str(metrics.loss()))
+            validstarttime = time.time()
+            if validtime:
+                print("train total: "+str(metrics.total))
+            model.eval()
+            with torch.no_grad(), profiling.phase('validation'):
+                metrics = MetricsAccumulator()
+                for j in valid_dataloader:
+                    with _autocast(device, amp):
+                        if is_packed:
+                            out = model([[_processinput(i).to(device)
+                                        for i in j[0]], j[1]])
+                        else:
+                            out = model([_processinput(i).to(device)
+                                        for i in j[:-1]])
+
+                        if not (objective_args_dict is None):
+                            objective_args_dict['reps'] = model.reps
+                            objective_args_dict['fused'] = model.fuseout
+                            objective_args_dict['inputs'] = j[:-1]
+                            objective_args_dict['training'] = False
+                        loss = deal_with_objective(
+                            objective, out, j[-1], objective_args_dict)
+                    if amp:
+                        out = out.float()
+
+                    pred = None
                     if task == "classification":
-                        pred.append(torch.argmax(out, 1))
+                        pred = torch.argmax(out, 1)
                     elif task == "multilabel":
-                        pred.append(torch.sigmoid(out).round())
-                    true.append(j[-1])
-                    if auprc:
-                        # pdb.set_trace()
-                        sm = softmax(out)
-                        pts += [(sm[i][1].item(), j[-1][i].item())
-                                for i in range(j[-1].size(0))]
-            if pred:
-                pred = torch.cat(pred, 0)
-            true = torch.cat(true, 0)
-            totals = true.shape[0]
-            valloss = totalloss/totals
+                        pred = torch.sigmoid(out).round()
+                    scores = softmax(out)[:, 1] if auprc else None
+                    metrics.update(j[-1], pred, scores, loss)
+            totals = metrics.total
+            valloss = metrics.loss()
             if task == "classification":
-                acc = accuracy(true, pred)
+                acc = metrics.accuracy()
                 print("Epoch "+str(epoch)+" valid loss: "+str(valloss) +
                       " acc: "+str(acc))
                 if acc > bestacc:
                     patience = 0
                     bestacc = acc
-                    print("Saving Best")
-                    torch.save(model, save)
+                    _savebest()
                 else:
                     patience += 1
             elif task == "multilabel":
-                f1_micro = f1_score(true, pred, average="micro")
-                f1_macro = f1_score(true, pred, average="macro")
+                f1_micro = metrics.f1_score("micro")
+                f1_macro = metrics.f1_score("macro")
                 print("Epoch "+str(epoch)+" valid loss: "+str(valloss) +
                       " f1_micro: "+str(f1_micro)+" f1_macro: "+str(f1_macro))
                 if f1_macro > bestf1:
                     patience = 0
                     bestf1 = f1_macro
-                    print("Saving Best")
-                    torch.save(model, save)
+                    _savebest()
                 else:
                     patience += 1
             elif task == "regression":
@@ -232,18 +272,24 @@ def train(
                 if valloss < bestvalloss:
                     patience = 0
                     bestvalloss = valloss
-                    print("Saving Best")
-                    torch.save(model, save)
+                    _savebest()
                 else:
                     patience += 1
+            if checkpoints is not None:
+                metric = acc if task == "classification" else f1_macro if task == "multilabel" else valloss
+                checkpoints.save(epoch, {'model': model}, optimizers, metric=metric,
+                                 extra={'bestvalloss': bestvalloss, 'bestacc': bestacc, 'bestf1': bestf1, 'patience': patience})
+            profiling.end_epoch()
             if early_stop and patience > 7:
                 break
             if auprc:
-                print("AUPRC: "+str(AUPRC(pts)))
+                print("AUPRC: "+str(metrics.auprc()))
             validendtime = time.time()
             if validtime:
                 print("valid time:  "+str(validendtime-validstarttime))
                 print("Valid total: "+str(totals))
+        if checkpoints is not None:
+            checkpoints.close()
     if track_complexity:
         all_in_one_train(_trainprocess, [model]+additional_optimizing_modules)
     else:
@@ -252,7 +298,7 @@ def train(
 
 def single_test(
         model, test_dataloader, is_packed=False,
-        criterion=nn.CrossEntropyLoss(), task="classification", auprc=False, input_to_float=True):
+        criterion=nn.CrossEntropyLoss(), task="classification", auprc=False, input_to_float=True, amp=False, channels_last=False):
     """Run single test for model.
 
     Args:
@@ -263,25 +309,30 @@ def single_test(
         task (str, optional): Task to evaluate. Choose between "classification", "multiclass", "regression", "posneg-classification". Defaults to "classification".
         auprc (bool, optional): Whether to get AUPRC scores or not. Defaults to False.
         input_to_float (bool, optional): Whether to convert inputs to float before processing. Defaults to True.
+        amp (bool, optional): Whether to run the model in mixed precision (float16 on CUDA, bfloat16 on CPU) or not. Defaults to False.
+        channels_last (bool, optional): Whether to run the convolutional encoders in channels-last memory format or not. Defaults to False.
     """
     def _processinput(inp):
         if input_to_float:
             return inp.float()
         else:
             return inp
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    if channels_last:
+        set_channels_last(model)
     with torch.no_grad():
-        totalloss = 0.0
-        pred = []
-        true = []
-        pts = []
+        metrics = MetricsAccumulator()
         for j in test_dataloader:
             model.eval()
-            if is_packed:
-                out = model([[_processinput(i).to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
-                            for i in j[0]], j[1]])
-            else:
-                out = model([_processinput(i).float().to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
-                            for i in j[:-1]])
+            with _autocast(device, amp):
+                if is_packed:
+                    out = model([[_processinput(i).to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
+                                for i in j[0]], j[1]])
+                else:
+                    out = model([_processinput(i).float().to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
+                                for i in j[:-1]])
+            if amp:
+                out = out.float()
             if type(criterion) == torch.nn.modules.loss.BCEWithLogitsLoss or type(criterion) == torch.nn.MSELoss:
                 loss = criterion(out, j[-1].float().to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")))
 
@@ -296,47 +347,33 @@ def single_test(
                 loss = criterion(out, truth1.long().to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")))
             else:
                 loss = criterion(out, j[-1].to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")))
-            totalloss += loss*len(j[-1])
+            pred = None
             if task == "classification":
-                pred.append(torch.argmax(out, 1))
+                pred = torch.argmax(out, 1)
             elif task == "multilabel":
-                pred.append(torch.sigmoid(out).round())
+                pred = torch.sigmoid(out).round()
             elif task == "posneg-classification":
-                prede = []
-                oute = out.cpu().numpy().tolist()
-                for i in oute:
-                    if i[0] > 0:
-                        prede.append(1)
-                    elif i[0] < 0:
-                        prede.append(-1)
-                    else:
-                        prede.append(0)
-                pred.append(torch.LongTensor(prede))
-            true.append(j[-1])
-            if auprc:
-                # pdb.set_trace()
-                sm = softmax(out)
-                pts += [(sm[i][1].item(), j[-1][i].item())
-                        for i in range(j[-1].size(0))]
-        if pred:
-            pred = torch.cat(pred, 0)
-        true = torch.cat(true, 0)
-        totals = true.shape[0]
-        testloss = totalloss/totals
+                pred = torch.sign(out[:, 0]).long()
+            scores = softmax(out)[:, 1] if auprc else None
+            metrics.update(j[-1], pred, scores, loss)
+        testloss = metrics.loss()
         if auprc:
-            print("AUPRC: "+str(AUPRC(pts)))
+            print("AUPRC: "+str(metrics.auprc()))
         if task == "classification":
-            print("acc: "+str(accuracy(true, pred)))
-            return {'Accuracy': accuracy(true, pred)}
+            acc = metrics.accuracy()
+            print("acc: "+str(acc))
+            return {'Accuracy': acc}
         elif task == "multilabel":
-            print(" f1_micro: "+str(f1_score(true, pred, average="micro")) +
-                  " f1_macro: "+str(f1_score(true, pred, average="macro")))
-            return {'micro': f1_score(true, pred, average="micro"), 'macro': f1_score(true, pred, average="macro")}
+            f1_micro = metrics.f1_score("micro")
+            f1_macro = metrics.f1_score("macro")
+            print(" f1_micro: "+str(f1_micro) +
+                  " f1_macro: "+str(f1_macro))
+            return {'micro': f1_micro, 'macro': f1_macro}
         elif task == "regression":
             print("mse: "+str(testloss.item()))
             return {'MSE': testloss.item()}
         elif task == "posneg-classification":
-            trueposneg = true
+            trueposneg, pred = metrics.predictions()
             accs = eval_affect(trueposneg, pred)
             acc2 = eval_affect(trueposneg, pred, exclude_zero=False)
             print("acc: "+str(accs) + ', ' + str(acc2))
@@ -345,7 +382,7 @@ def single_test(
 
 
 def test(
-        model, test_dataloaders_all, dataset='default', method_name='My method', is_packed=False, criterion=nn.CrossEntropyLoss(), task="classification", auprc=False, input_to_float=True, no_robust=False):
+        model, test_dataloaders_all, dataset='default', method_name='My method', is_packed=False, criterion=nn.CrossEntropyLoss(), task="classification", auprc=False, input_to_float=True, no_robust=False, amp=False, channels_last=False, sweep_workers=1):
     """
     Handle getting test results for a simple supervised training loop.
     
@@ -353,38 +390,22 @@ def test(
     :param test_dataloaders_all: test data
     :param dataset: the name of dataset, need to be set for testing effective robustness
     :param criterion: only needed for regression, put MSELoss there   
+    :param amp: whether to run the model in mixed precision or not
+    :param channels_last: whether to run the convolutional encoders in channels-last memory format or not
+    :param sweep_workers: number of processes to score the noisy test sets in parallel, each with a replica of the model
     """
     if no_robust:
         def _testprocess():
             single_test(model, test_dataloaders_all, is_packed,
-                        criterion, task, auprc, input_to_float)
+                        criterion, task, auprc, input_to_float, amp, channels_last)
         all_in_one_test(_testprocess, [model])
         return
 
     def _testprocess():
         single_test(model, test_dataloaders_all[list(test_dataloaders_all.keys())[
-                    0]][0], is_packed, criterion, task, auprc, input_to_float)
+                    0]][0], is_packed, criterion, task, auprc, input_to_float, amp, channels_last)
     all_in_one_test(_testprocess, [model])
-    for noisy_modality, test_dataloaders in test_dataloaders_all.items():
-        print("Testing on noisy data ({})...".format(noisy_modality))
-        robustness_curve = dict()
-        for test_dataloader in tqdm(test_dataloaders):
-            single_test_result = single_test(
-                model, test_dataloader, is_packed, criterion, task, auprc, input_to_float)
-            for k, v in single_test_result.items():
-                curve = robustness_curve.get(k, [])
-                curve.append(v)
-                robustness_curve[k] = curve
-        for measure, robustness_result in robustness_curve.items():
-            robustness_key = '{} {}'.format(dataset, noisy_modality)
-            print("relative robustness ({}, {}): {}".format(noisy_modality, measure, str(
-                relative_robustness(robustness_result, robustness_key))))
-            if len(robustness_curve) != 1:
-                robustness_key = '{} {}'.format(robustness_key, measure)
-            print("effective robustness ({}, {}): {}".format(noisy_modality, measure, str(
-                effective_robustness(robustness_result, robustness_key))))
-            fig_name = '{}-{}-{}-{}'.format(method_name,
-                                            robustness_key, noisy_modality, measure)
-            single_plot(robustness_result, robustness_key, xlabel='Noise level',
-                        ylabel=measure, fig_name=fig_name, method=method_name)
-            print("Plot saved as "+fig_name)
+    def _evaluate(test_dataloader):
+        return single_test(model, test_dataloader, is_packed, criterion, task, auprc, input_to_float, amp, channels_last)
+    curves = robustness_curves(_evaluate, test_dataloaders_all, sweep_workers)
+    report_robustness(curves, dataset, method_name)
@@ -1,5 +1,5 @@
 """Implements training procedure for MFAS."""
-from utils.AUPRC import AUPRC
+import functools
 import torch
 import torch.optim as op
 import numpy as np
@@ -8,10 +8,11 @@ import utils.surrogate as surr
 import utils.search_tools as tools
 
 import fusions.searchable as avm
-# from eval_scripts.performance import AUPRC
+from eval_scripts import profiling
+from eval_scripts.metrics import MetricsAccumulator
 from eval_scripts.complexity import all_in_one_train, all_in_one_test
-from eval_scripts.robustness import relative_robustness, effective_robustness, single_plot
-from tqdm import tqdm
+from eval_scripts.sweep import robustness_curves
+from eval_scripts.robustness import report_robustness
 
 
 def train(unimodal_files, rep_size, classes, sub_sizes, train_data, valid_data, surrogate, max_labels,
@@ -19,7 +20,7 @@ def train(unimodal_files, rep_size, classes, sub_sizes, train_data, valid_data,
           search_iter=3, num_samples=15, epoch_surrogate=50,
           eta_max=0.001, eta_min=0.000001, Ti=1, Tm=2,
           temperature_init=10.0, temperature_final=0.2, temperature_decay=4.0, max_progression_levels=4,
-          lr_surrogate=0.001, use_weightsharing=False):
+          lr_surrogate=0.001, use_weightsharing=False, cache_layers=False, num_workers=1, halving_rate=None):
     """Train MFAS Model.
     
     See https://github.com/slyviacassell/_MFAS/blob/master/models/searchable.py for more details.
@@ -48,6 +49,9 @@ def train(unimodal_files, rep_size, classes, sub_sizes, train_data, valid_data,
         max_progression_levels (int, optional): See MFAS github for more details. Defaults to 4.
         lr_surrogate (float, optional): Surrogate learning rate. Defaults to 0.001.
         use_weightsharing (bool, optional): Use weight-sharing when training architectures for evaluation. Defaults to False.
+        cache_layers (bool, optional): Run the frozen unimodal encoders once per split and train sampled architectures on their cached layer outputs, instead of running the encoders every epoch of every architecture. This changes the sampled accuracies: the cached encoders run in evaluation mode, so BatchNorm uses its running statistics and dropout is off, where uncached encoders run in training mode during the train phase. Defaults to False.
+        num_workers (int, optional): Number of worker processes to train sampled architectures in concurrently. Defaults to 1.
+        halving_rate (int, optional): If given, sampled architectures are trained with successive halving, only the best 1 / halving_rate of them being trained further at each round. Defaults to None, which trains all of them for all epochs.
 
     Returns:
         _type_: _description_
@@ -58,7 +62,8 @@ def train(unimodal_files, rep_size, classes, sub_sizes, train_data, valid_data,
     searcher.device = device
     s_data = searcher.search(surrogate,
                              use_weightsharing, unimodal_files, rep_size, classes, sub_sizes, batch_size, epochs, max_labels,
-                             eta_max, eta_min, Ti, Tm)
+                             eta_max, eta_min, Ti, Tm, cache_layers=cache_layers,
+                             num_workers=num_workers, halving_rate=halving_rate)
     return s_data
 
 
@@ -98,7 +103,8 @@ class ModelSearcher():
 
     def search(self, surrogate,
                use_weightsharing, unimodal_files, rep_size, classes, sub_sizes, batch_size, epochs, max_labels,
-               eta_max, eta_min, Ti, Tm, criterion=torch.nn.MSELoss()):
+               eta_max, eta_min, Ti, Tm, criterion=torch.nn.MSELoss(), cache_layers=False,
+               num_workers=1, halving_rate=None):
         """Search for the best model using MFAS.
 
         Args:
@@ -116,20 +122,27 @@ class ModelSearcher():
             Ti (float): Ti for LRCosineAnnealingScheduler
             Tm (float): Tm for LRCosineAnnealingScheduler
             criterion (nn.Module, optional): Loss function. Defaults to torch.nn.MSELoss().
+            cache_layers (bool, optional): Whether to train sampled architectures on layer outputs of the encoders cached once per split, with the encoders in evaluation mode. Defaults to False.
+            num_workers (int, optional): Number of worker processes to train sampled architectures in concurrently. Defaults to 1.
+            halving_rate (int, optional): Rate of successive halving of the sampled architectures. Defaults to None, which trains all of them for all epochs.
 
         Returns:
             torch.Tensor: Surrogate function training data ( i.e. model configs and their performances )
         """
-        searchmethods = {'train_sampled_fun': avm.train_sampled_models,
+        searchmethods = {'train_sampled_fun': functools.partial(avm.train_sampled_models, num_workers=num_workers,
+                                                                halving_rate=halving_rate),
                          'get_layer_confs': avm.get_possible_layer_configurations}
         surro_dict = {'model': surrogate, 'criterion': criterion}
+        layer_cache = None
+        if cache_layers:
+            layer_cache = avm.LayerOutputCache(avm.load_unimodal_encoders(unimodal_files), sub_sizes, self.dataloaders)
         return self._epnas(avm.Searchable, surro_dict, self.dataloaders, searchmethods,
                            use_weightsharing, self.device, unimodal_files, rep_size, classes, sub_sizes, batch_size, epochs,
-                           eta_max, eta_min, Ti, Tm, max_labels)
+                           eta_max, eta_min, Ti, Tm, max_labels, layer_cache)
 
     def _epnas(self, model_type, surrogate_dict, dataloaders, dataset_searchmethods,
                use_weightsharing, device, unimodal_files, rep_size, classes, sub_sizes, batch_size, epochs,
-               eta_max, eta_min, Ti, Tm, max_labels):
+               eta_max, eta_min, Ti, Tm, max_labels, layer_cache=None):
 
         # surrogate
         surrogate = surrogate_dict['model']
@@ -173,11 +186,12 @@ class ModelSearcher():
                     all_accuracies = train_sampled_models(all_configurations, model_type, dataloaders,
                                                           use_weightsharing, device, unimodal_files, rep_size, classes, sub_sizes, batch_size, epochs,
                                                           eta_max, eta_min, Ti, Tm,
-                                                          state_dict=shared_weights)
+                                                          state_dict=shared_weights, layer_cache=layer_cache)
                     tools.update_surrogate_dataloader(
                         s_data, all_configurations, all_accuracies)
-                    tools.train_surrogate(
-                        surrogate, s_data, s_optim, s_crite, self.surrep, device)
+                    with profiling.phase('surrogate'):
+                        tools.train_surrogate(
+                            surrogate, s_data, s_optim, s_crite, self.surrep, device)
                     print("Predicted accuracies: ")
                     print(list(zip(all_configurations, all_accuracies)))
 
@@ -211,12 +225,13 @@ class ModelSearcher():
                     sampled_k_accs = train_sampled_models(sampled_k_confs, model_type, dataloaders,
                                                           use_weightsharing, device, unimodal_files, rep_size, classes, sub_sizes, batch_size, epochs,
                                                           eta_max, eta_min, Ti, Tm,
-                                                          state_dict=shared_weights)
+                                                          state_dict=shared_weights, layer_cache=layer_cache)
 
                     tools.update_surrogate_dataloader(
                         s_data, sampled_k_confs, sampled_k_accs)
-                    err = tools.train_surrogate(
-                        surrogate, s_data, s_optim, s_crite, self.surrep, device)
+                    with profiling.phase('surrogate'):
+                        err = tools.train_surrogate(
+                            surrogate, s_data, s_optim, s_crite, self.surrep, device)
 
                     print("Trained architectures: ")
                     print(list(zip(sampled_k_confs, sampled_k_accs)))
@@ -241,26 +256,21 @@ def single_test(model, test_dataloader, auprc=False):
     Returns:
         dict: Dictionary of (metric, value) pairs.
     """
-    total = 0
-    corrects = 0
-    pts = []
+    metrics = MetricsAccumulator()
     with torch.no_grad():
         for j in test_dataloader:
             x = [y.float().to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")) for y in j[:-1]]
             out = model(x)
             outs = torch.nn.Softmax()(out)
-            for ii in range(len(outs)):
-                total += 1
-                if outs[ii].tolist().index(max(outs[ii])) == j[-1][ii].item():
-                    corrects += 1
-                pts.append([outs[ii][1], j[-1][ii].item()])
-    print('test acc: '+str(float(corrects)/total))
+            metrics.update(j[-1], torch.argmax(outs, 1), outs[:, 1] if auprc else None)
+    acc = metrics.accuracy()
+    print('test acc: '+str(acc))
     if auprc:
-        print("AUPRC: "+str(AUPRC(pts)))
-    return {'Accuracy': float(corrects)/total}
+        print("AUPRC: "+str(metrics.auprc()))
+    return {'Accuracy': acc}
 
 
-def test(model, test_dataloaders_all, dataset, method_name='My method', auprc=False, no_robust=False): # pragma: no cover 
+def test(model, test_dataloaders_all, dataset, method_name='My method', auprc=False, no_robust=False, sweep_workers=1): # pragma: no cover 
     """Test MFAS Model.
 
     Args:
@@ -270,6 +280,7 @@ def test(model, test_dataloaders_all, dataset, method_name='My method', auprc=Fa
         method_name (str, optional): Method name. Defaults to 'My method'.
         auprc (bool, optional): Whether to output AUPRC scores or not. Defaults to False.
         no_robust (bool, optional): Whether to not apply robustness transformations or not. Defaults to False.
+        sweep_workers (int, optional): Number of processes to score the noisy test sets in parallel, each with a replica of the model. Defaults to 1.
     """
     if no_robust:
         def _testprocess():
@@ -281,25 +292,7 @@ def test(model, test_dataloaders_all, dataset, method_name='My method', auprc=Fa
         single_test(model, test_dataloaders_all[list(
             test_dataloaders_all.keys())[0]][0], auprc)
     all_in_one_test(_testprocess, [model])
-    for noisy_modality, test_dataloaders in test_dataloaders_all.items():
-        print("Testing on noisy data ({})...".format(noisy_modality))
-        robustness_curve = dict()
-        for test_dataloader in tqdm(test_dataloaders):
-            single_test_result = single_test(model, test_dataloader, auprc)
-            for k, v in single_test_result.items():
-                curve = robustness_curve.get(k, [])
-                curve.append(v)
-                robustness_curve[k] = curve
-        for measure, robustness_result in robustness_curve.items():
-            robustness_key = '{} {}'.format(dataset, noisy_modality)
-            print("relative robustness ({}, {}): {}".format(noisy_modality, measure, str(
-                relative_robustness(robustness_result, robustness_key))))
-            if len(robustness_curve) != 1:
-                robustness_key = '{} {}'.format(robustness_key, measure)
-            print("effective robustness ({}, {}): {}".format(noisy_modality, measure, str(
-                effective_robustness(robustness_result, robustness_key))))
-            fig_name = '{}-{}-{}-{}'.format(method_name,
-                                            robustness_key, noisy_modality, measure)
-            single_plot(robustness_result, robustness_key, xlabel='Noise level',
-                        ylabel=measure, fig_name=fig_name, method=method_name)
-            print("Plot saved as "+fig_name)
+    def _evaluate(test_dataloader):
+        return single_test(model, test_dataloader, auprc)
+    curves = robustness_curves(_evaluate, test_dataloaders_all, sweep_workers)
+    report_robustness(curves, dataset, method_name)
@@ -3,11 +3,15 @@ import sklearn.metrics
 import torch
 from torch import nn
 import copy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from torch.utils.data import DataLoader, Subset
-from eval_scripts.performance import AUPRC, f1_score, accuracy
+from eval_scripts.metrics import MetricsAccumulator
 from eval_scripts.complexity import all_in_one_train, all_in_one_test
-from eval_scripts.robustness import relative_robustness, effective_robustness, single_plot
-from tqdm import tqdm
+from eval_scripts import profiling
+from eval_scripts.sweep import can_fork, robustness_curves
+from eval_scripts.robustness import report_robustness
+from utils.checkpoint import CheckpointManager, checkpoint_directory, load_checkpoint
 
 criterion = nn.CrossEntropyLoss()
 delta = False
@@ -43,6 +47,32 @@ def getloss(model, head, data, monum, batch_size):
     return losses/total
 
 
+def blend_weight(ltN, lvN, ltNn, lvNn):
+    """Compute the gradient-blending weight of a model from its losses before and after training.
+
+    Args:
+        ltN (float): Train loss before training. Only used if delta is set.
+        lvN (float): Validation loss before training. Only used if delta is set.
+        ltNn (float): Train loss after training.
+        lvNn (float): Validation loss after training.
+
+    Returns:
+        float: Unnormalized weight, the generalization over the squared overfitting.
+    """
+    oNn = lvNn-ltNn
+    if delta:
+        oN = lvN-ltN
+        oi = oNn-oN
+        g = lvNn-lvN
+    else:
+        oi = oNn
+        if oi < 0:
+            oi = 0.0001
+        g = lvNn
+    print("raw: "+str(g/(oi*oi)))
+    return abs(g/(oi*oi))
+
+
 def train_unimodal(model, head, optim, trains, valids, monum, epoch, batch_size):
     """Train unimodal gradient blending module.
 
@@ -72,7 +102,7 @@ def train_unimodal(model, head, optim, trains, valids, monum, epoch, batch_size)
             out = model(train_x)
             out = head(out)
             loss = criterion(out, train_y.squeeze())
-            totalloss += loss * len(j[0])
+            totalloss += loss.detach() * len(j[0])
             loss.backward()
             optim.step()
         print("Epoch "+str(i)+" loss: "+str(totalloss / total))
@@ -80,18 +110,7 @@ def train_unimodal(model, head, optim, trains, valids, monum, epoch, batch_size)
     ltNn = getloss(model, head, trains, monum, batch_size)
     lvNn = getloss(model, head, valids, monum, batch_size)
     print("Final train loss: "+str(ltNn)+" valid loss: "+str(lvNn))
-    oNn = lvNn-ltNn
-    oN = lvN-ltN
-    if delta:
-        oi = oNn-oN
-        g = lvNn-lvN
-    else:
-        oi = oNn
-        if oi < 0:
-            oi = 0.0001
-        g = lvNn
-    print("raw: "+str(g/(oi*oi)))
-    return abs(g/(oi*oi))
+    return blend_weight(ltN, lvN, ltNn, lvNn)
 
 
 def multimodalcondense(models, fuse, train_x):
@@ -179,31 +198,22 @@ def train_multimodal(models, head, fuse, optim, trains, valids, epoch, batch_siz
             optim.zero_grad()
             out = head(multimodalcondense(models, fuse, train_x))
             loss = criterion(out, train_y.squeeze())
-            totalloss += loss*len(j[0])
+            totalloss += loss.detach()*len(j[0])
             loss.backward()
             optim.step()
         print("Epoch "+str(i)+" loss: "+str(totalloss/total))
     ltNn = getmloss(models, head, fuse, trains, batch_size)
     lvNn = getmloss(models, head, fuse, valids, batch_size)
     print("Final train loss: "+str(ltNn)+" valid loss: "+str(lvNn))
-    oNn = lvNn-ltNn
-    oN = lvN-ltN
-    if delta:
-        oi = oNn-oN
-        g = lvNn-lvN
-    else:
-        oi = oNn
-        if oi < 0:
-            oi = 0.0001
-        g = lvNn
-    print("raw: "+str(g/(oi*oi)))
-    return abs(g/(oi*oi))
+    return blend_weight(ltN, lvN, ltNn, lvNn)
 
 
 def gb_estimate(unimodal_models, multimodal_classification_head, fuse, unimodal_classification_heads, train_dataloader, gb_epoch,
-                batch_size, v_dataloader, lr, weight_decay=0.0, optimtype=torch.optim.SGD):
+                batch_size, v_dataloader, lr, weight_decay=0.0, optimtype=torch.optim.SGD, num_workers=1):
     """Compute estimate of gradient-blending score.
 
+    A copy of every unimodal model with its head, and a copy of the multimodal model, are trained side by side: each batch is loaded once and used to step all of them. The train loss after training is the average loss of the last epoch, accumulated while training, so only the validation data is scanned again. The models are trained as train_unimodal and train_multimodal train them, but that running loss is a little higher than the loss of the trained model they measure in a separate pass, so the weights deviate slightly from theirs (by a few hundredths on small problems).
+
     Args:
         unimodal_models (list): List of encoder modules
         multimodal_classification_head (nn.Module): Classifier given fusion instance
@@ -216,24 +226,23 @@ def gb_estimate(unimodal_models, multimodal_classification_head, fuse, unimodal_
         lr (float): Learning Rate
         weight_decay (float, optional): Weight decay parameter. Defaults to 0.0.
         optimtype (torch.optim.Optimizer, optional): Optimizer instance. Defaults to torch.optim.SGD.
+        num_workers (int, optional): Number of worker processes to train the copies in, each worker training some of them on its own pass over the data. Training runs in this process if 1, or if forking is not possible. Defaults to 1.
 
     Returns:
         float: Normalized weights between unimodal and multimodal models
     """
-    weights = []
+    global _estimation
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    runs = []
     for i in range(len(unimodal_models)):
-        print("At gb_estimate unimodal "+str(i))
-        model = copy.deepcopy(unimodal_models[i]).to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
-        head = copy.deepcopy(unimodal_classification_heads[i]).to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
+        model = copy.deepcopy(unimodal_models[i]).to(device)
+        head = copy.deepcopy(unimodal_classification_heads[i]).to(device)
         optim = optimtype(list(model.parameters()) +
                           list(head.parameters()), lr=lr, weight_decay=weight_decay)
-        w = train_unimodal(model, head, optim, train_dataloader,
-                           v_dataloader, i, gb_epoch, batch_size)
-        weights.append(w)
-    print("At gb_estimate multimodal ")
-    allcopies = [copy.deepcopy(x).to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")) for x in unimodal_models]
-    mmcopy = copy.deepcopy(multimodal_classification_head).to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
-    fusecopy = copy.deepcopy(fuse).to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
+        runs.append(("unimodal "+str(i), _unimodal_forward(model, head, i), optim))
+    allcopies = [copy.deepcopy(x).to(device) for x in unimodal_models]
+    mmcopy = copy.deepcopy(multimodal_classification_head).to(device)
+    fusecopy = copy.deepcopy(fuse).to(device)
     params = []
     for model in allcopies:
         params.extend(list(model.parameters()))
@@ -241,12 +250,99 @@ def gb_estimate(unimodal_models, multimodal_classification_head, fuse, unimodal_
     if fusecopy.parameters() is not None:
         params.extend(list(fusecopy.parameters()))
     optim = optimtype(params, lr=lr, weight_decay=weight_decay)
-    weights.append(train_multimodal(allcopies, mmcopy, fusecopy,
-                                    optim, train_dataloader, v_dataloader, gb_epoch, batch_size))
+    runs.append(("multimodal", _multimodal_forward(allcopies, mmcopy, fusecopy), optim))
+
+    if num_workers > 1 and can_fork():
+        threads = max(1, torch.get_num_threads() // num_workers)
+        _estimation = (runs, train_dataloader, v_dataloader, gb_epoch)
+        try:
+            with ProcessPoolExecutor(min(num_workers, len(runs)), mp_context=multiprocessing.get_context('fork'),
+                                     initializer=torch.set_num_threads, initargs=(threads,)) as pool:
+                weights = list(pool.map(_estimate_run, range(len(runs))))
+        finally:
+            _estimation = None
+    else:
+        weights = train_blend_runs(runs, train_dataloader, v_dataloader, gb_epoch)
     z = sum(weights)
     return [(w/z).item() for w in weights]
 
 
+def _unimodal_forward(model, head, monum):
+    def forward(x):
+        return head(model(x[monum]))
+    return forward
+
+
+def _multimodal_forward(models, head, fuse):
+    def forward(x):
+        return head(multimodalcondense(models, fuse, x))
+    return forward
+
+
+# (runs, train_dataloader, v_dataloader, gb_epoch) of the running estimate, inherited by forked workers
+_estimation = None
+
+
+def _estimate_run(index):
+    runs, trains, valids, epoch = _estimation
+    return train_blend_runs([runs[index]], trains, valids, epoch)[0]
+
+
+def _blend_losses(runs, data):
+    # average loss of every run over data, in one pass
+    losses = [0.0 for _ in runs]
+    total = 0
+    with torch.no_grad():
+        for j in data:
+            total += len(j[0])
+            x = [v.float().to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")) for v in j[:-1]]
+            y = j[-1].to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")).squeeze()
+            for r, (_, forward, _) in enumerate(runs):
+                losses[r] += criterion(forward(x), y)*len(j[0])
+    return [loss/float(total) for loss in losses]
+
+
+def train_blend_runs(runs, trains, valids, epoch):
+    """Train models side by side on the same batches, and compute their gradient-blending weights.
+
+    Args:
+        runs (list): List of (name, forward, optimizer), where forward maps the list of input tensors of a batch to the output of the model, and optimizer steps its parameters.
+        trains (torch.utils.data.Dataloader): Training data loader
+        valids (torch.utils.data.Dataloader): Validation data loader
+        epoch (int): Number of epochs to train on
+
+    Returns:
+        list: Unnormalized weight of every run.
+    """
+    ltN = lvN = [None for _ in runs]
+    if delta:
+        ltN = _blend_losses(runs, trains)
+        lvN = _blend_losses(runs, valids)
+    ltNn = _blend_losses(runs, trains) if epoch == 0 else None
+    for i in range(epoch):
+        totalloss = [0.0 for _ in runs]
+        total = 0
+        for j in trains:
+            total += len(j[0])
+            x = [v.float().to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")) for v in j[:-1]]
+            y = j[-1].to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")).squeeze()
+            for r, (_, forward, optim) in enumerate(runs):
+                optim.zero_grad()
+                loss = criterion(forward(x), y)
+                totalloss[r] += loss.detach()*len(j[0])
+                loss.backward()
+                optim.step()
+        ltNn = [loss/total for loss in totalloss]
+        for (name, _, _), loss in zip(runs, ltNn):
+            print("Epoch "+str(i)+" "+name+" loss: "+str(loss))
+    lvNn = _blend_losses(runs, valids)
+    weights = []
+    for r, (name, _, _) in enumerate(runs):
+        print("At gb_estimate "+name+" final train loss: "+str(ltNn[r])+" valid loss: "+str(lvNn[r]))
+        weights.append(blend_weight(ltN[r], lvN[r], ltNn[r], lvNn[r]))
+    return weights
+
+
 softmax = nn.Softmax()
 
 
@@ -297,7 +393,8 @@ def calcAUPRC(pts):
 def train(unimodal_models,  multimodal_classification_head,
           unimodal_classification_heads, fuse, train_dataloader, valid_dataloader,
           num_epoch, lr, gb_epoch=20, v_rate=0.08, weight_decay=0.0, optimtype=torch.optim.SGD,
-          finetune_epoch=25, classification=True, AUPRC=False, savedir='best.pt', track_complexity=True):
+          finetune_epoch=25, classification=True, AUPRC=False, savedir='best.pt', track_complexity=True,
+          checkpoint_dir=None, resume=None, keep_last=1, keep_best=1, gb_workers=1):
     """Train model using gradient_blending.
 
     Args:
@@ -318,6 +415,11 @@ def train(unimodal_models,  multimodal_classification_head,
         AUPRC (bool, optional): Whether to compute auprc score or not. Defaults to False.
         savedir (str, optional): The name of the saved file for the model with current best validation performance. Defaults to 'best.pt'.
         track_complexity (bool, optional): Whether to track complexity or not. Defaults to True.
+        checkpoint_dir (str, optional): Directory to write a resumable checkpoint to after every gb_epoch epochs and head finetuning (written in the background). Defaults to None, which does not checkpoint.
+        resume (str, optional): Checkpoint file or directory to resume training from. checkpoint_dir defaults to its directory. Defaults to None.
+        keep_last (int, optional): Number of most recent checkpoints to keep. Defaults to 1.
+        keep_best (int, optional): Number of checkpoints with the lowest validation loss to keep. Defaults to 1.
+        gb_workers (int, optional): Number of worker processes to estimate the gradient-blending weights in. Defaults to 1.
     """
     def _trainprocess():
         nonlocal train_dataloader
@@ -349,37 +451,60 @@ def train(unimodal_models,  multimodal_classification_head,
             params.extend(list(fuse.parameters()))
         optimi = optimtype(params, lr=lr, weight_decay=weight_decay)
         bestvalloss = 10000.0
-        for i in range(num_epoch//gb_epoch):
+        modules = {'finetunehead': finetunehead, 'fusehead': fusehead, 'fuse': fuse,
+                   'multimodal_classification_head': multimodal_classification_head}
+        for ii in range(len(unimodal_models)):
+            modules['unimodal_model_'+str(ii)] = unimodal_models[ii]
+            modules['unimodal_classification_head_'+str(ii)] = unimodal_classification_heads[ii]
+        optimizers = {'optim': optim, 'optimi': optimi}
+        start = 0
+        if resume is not None:
+            state = load_checkpoint(resume, modules, optimizers, map_location=torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
+            start = state['epoch'] + 1
+            bestvalloss = state['extra']['bestvalloss']
+        directory = checkpoint_directory(checkpoint_dir, resume)
+        checkpoints = None
+        if directory is not None:
+            checkpoints = CheckpointManager(directory, keep_last, keep_best, mode='min')
+        for i in range(start, num_epoch//gb_epoch):
+            # validation loss of this round, unset if the head is not finetuned
+            valoss = None
             # """
-            weights = gb_estimate(unimodal_models,  multimodal_classification_head, fuse,
-                                  unimodal_classification_heads, train_dataloader, gb_epoch, train_dataloader.batch_size, tv_dataloader, lr, weight_decay, optimtype)
+            with profiling.phase('gb_estimate'):
+                weights = gb_estimate(unimodal_models,  multimodal_classification_head, fuse,
+                                      unimodal_classification_heads, train_dataloader, gb_epoch, train_dataloader.batch_size, tv_dataloader, lr, weight_decay, optimtype,
+                                      num_workers=gb_workers)
             # """
             # weights=(1.0,1.0,1.0)
             print("epoch "+str(i*gb_epoch)+" weights: "+str(weights))
             for jj in range(gb_epoch):
                 totalloss = 0.0
-                for j in train_dataloader:
+                for j in profiling.iterate(train_dataloader):
                     train_x = [x.float().to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")) for x in j[:-1]]
                     train_y = j[-1].to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
                     optim.zero_grad()
-                    outs = multimodalcompute(unimodal_models, train_x)
-                    fuse.train()
-                    multimodal_classification_head.train()
-                    catout = fuse(outs)
-                    blendloss = criterion(multimodal_classification_head(
-                        catout), train_y.squeeze())*weights[-1]
-                    for ii in range(len(unimodal_models)):
-                        loss = criterion(unimodal_classification_heads[ii](
-                            outs[ii]), train_y.squeeze())
-                        blendloss += loss * weights[ii]
-                    totalloss += blendloss*len(j[0])
-                    blendloss.backward()
-                    optim.step()
+                    with profiling.phase('forward'):
+                        outs = multimodalcompute(unimodal_models, train_x)
+                        fuse.train()
+                        multimodal_classification_head.train()
+                        catout = fuse(outs)
+                        blendloss = criterion(multimodal_classification_head(
+                            catout), train_y.squeeze())*weights[-1]
+                        for ii in range(len(unimodal_models)):
+                            loss = criterion(unimodal_classification_heads[ii](
+                                outs[ii]), train_y.squeeze())
+                            blendloss += loss * weights[ii]
+                    totalloss += blendloss.detach()*len(j[0])
+                    with profiling.phase('backward'):
+                        blendloss.backward()
+                    with profiling.phase('step'):
+                        optim.step()
                 print("epoch "+str(jj+i*gb_epoch)+" blend train loss: " +
                       str(totalloss/len(train_data)))
+                profiling.end_epoch()
             # finetunes classification head
             finetunetrains = []
-            with torch.no_grad():
+            with torch.no_grad(), profiling.phase('finetune'):
                 for j in train_dataloader:
                     train_x = [x.float().to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")) for x in j[:-1]]
                     train_y = j[-1].to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
@@ -395,23 +520,21 @@ def train(unimodal_models,  multimodal_classification_head,
                 finetunetrains, shuffle=True, num_workers=8, batch_size=train_dataloader.batch_size)
             for jj in range(finetune_epoch):
                 totalloss = 0.0
-                for j in ftt_dataloader:
+                for j in profiling.iterate(ftt_dataloader, 'finetune'):
                     optimi.zero_grad()
                     train_x = [x.float().to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")) for x in j[:-1]]
                     train_y = j[-1].to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
                     finetunehead.train()
                     fusehead.train()
-                    blendloss = criterion(finetunehead(
-                        fusehead(train_x)), train_y.squeeze())
-                    totalloss += blendloss * len(j[0])
-                    blendloss.backward()
-                    optimi.step()
+                    with profiling.phase('finetune'):
+                        blendloss = criterion(finetunehead(
+                            fusehead(train_x)), train_y.squeeze())
+                        totalloss += blendloss.detach() * len(j[0])
+                        blendloss.backward()
+                        optimi.step()
                 print("finetune train loss: "+str(totalloss/len(train_data)))
-                with torch.no_grad():
-                    totalloss = 0.0
-                    total = 0
-                    corrects = 0
-                    auprclist = []
+                with torch.no_grad(), profiling.phase('validation'):
+                    metrics = MetricsAccumulator()
                     for j in valid_dataloader:
                         valid_x = [x.float().to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")) for x in j[:-1]]
                         valid_y = j[-1].to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
@@ -421,27 +544,27 @@ def train(unimodal_models,  multimodal_classification_head,
                         finetunehead.eval()
                         predicts = finetunehead(catout)
                         blendloss = criterion(predicts, valid_y.squeeze())
-                        totalloss += blendloss*len(j[0])
-                        predictlist = predicts.tolist()
-                        for ii in range(len(j[0])):
-                            total += 1
-                            if AUPRC:
-                                predictval = softmax(predicts[ii])
-                                auprclist.append(
-                                    (predictval[1].item(), valid_y[ii].item()))
-                            if classification:
-                                if predictlist[ii].index(max(predictlist[ii])) == valid_y[ii]:
-                                    corrects += 1
-                    valoss = totalloss/total
-                    print("epoch "+str((i+1)*gb_epoch-1)+" valid loss: "+str(totalloss/total) +
-                          ((" acc: "+str(float(corrects)/total)) if classification else ''))
+                        metrics.update(valid_y, torch.argmax(predicts, 1) if classification else None,
+                                       softmax(predicts)[:, 1] if AUPRC else None, blendloss)
+                    valoss = metrics.loss()
+                    print("epoch "+str((i+1)*gb_epoch-1)+" valid loss: "+str(valoss) +
+                          ((" acc: "+str(metrics.accuracy())) if classification else ''))
                     if AUPRC:
-                        print("With AUPRC: "+str(calcAUPRC(auprclist)))
+                        print("With AUPRC: "+str(metrics.auprc()))
                     if valoss < bestvalloss:
                         bestvalloss = valoss
                         print("Saving best")
-                        torch.save(completeModule(unimodal_models,
-                                                  fusehead, finetunehead), savedir)
+                        if checkpoints is None:
+                            torch.save(completeModule(unimodal_models,
+                                                      fusehead, finetunehead), savedir)
+                        else:
+                            checkpoints.save_model(completeModule(unimodal_models,
+                                                                  fusehead, finetunehead), savedir)
+                profiling.end_epoch()
+            if checkpoints is not None:
+                checkpoints.save(i, modules, optimizers, metric=valoss, extra={'bestvalloss': bestvalloss})
+        if checkpoints is not None:
+            checkpoints.close()
     if track_complexity:
         all_in_one_train(_trainprocess, unimodal_models +
                          [multimodal_classification_head, fuse]+unimodal_classification_heads)
@@ -462,37 +585,26 @@ def single_test(model, test_dataloader, auprc=False, classification=True):
         dict: Dictionary of (metric, value) pairs
     """
     with torch.no_grad():
-        totalloss = 0.0
-        total = 0
-        corrects = 0
-        auprclist = []
+        metrics = MetricsAccumulator()
         for j in test_dataloader:
             valid_x = [x.float().to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")) for x in j[:-1]]
             valid_y = j[-1].to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
             predicts = model(valid_x)
             blendloss = criterion(predicts, valid_y.squeeze())
-            totalloss += blendloss*len(j[0])
-            predictlist = predicts.tolist()
-            for ii in range(len(j[0])):
-                total += 1
-                if auprc:
-                    predictval = softmax(predicts[ii])
-                    auprclist.append(
-                        (predictval[1].item(), valid_y[ii].item()))
-                if classification:
-                    if predictlist[ii].index(max(predictlist[ii])) == valid_y[ii]:
-                        corrects += 1
-        print("test loss: "+str(totalloss/total) +
-              ((" acc: "+str(float(corrects)/total)) if classification else ''))
+            metrics.update(valid_y, torch.argmax(predicts, 1) if classification else None,
+                           softmax(predicts)[:, 1] if auprc else None, blendloss)
+        acc = metrics.accuracy() if classification else None
+        print("test loss: "+str(metrics.loss()) +
+              ((" acc: "+str(acc)) if classification else ''))
         if auprc:
-            print("With AUPRC: "+str(calcAUPRC(auprclist)))
+            print("With AUPRC: "+str(metrics.auprc()))
     if classification:
-        return {'Accuracy': float(corrects)/total}
+        return {'Accuracy': acc}
     else:
-        return {'MSE': (totalloss/total).item()}
+        return {'MSE': metrics.loss().item()}
 
 
-def test(model, test_dataloaders_all, dataset, method_name='My method', auprc=False, classification=True, no_robust=False):
+def test(model, test_dataloaders_all, dataset, method_name='My method', auprc=False, classification=True, no_robust=False, sweep_workers=1):
     """Test module, reporting results to stdout.
 
     Args:
@@ -503,6 +615,7 @@ def test(model, test_dataloaders_all, dataset, method_name='My method', auprc=Fa
         auprc (bool, optional): Whether to use AUPRC scores or not. Defaults to False.
         classification (bool, optional): Whether the task is classificaion or not. Defaults to True.
         no_robust (bool, optional): Whether to not apply robustness variations to input. Defaults to False.
+        sweep_workers (int, optional): Number of processes to score the noisy test sets in parallel, each with a replica of the model. Defaults to 1.
     """
     if no_robust:
         def _testprocess():
@@ -514,26 +627,7 @@ def test(model, test_dataloaders_all, dataset, method_name='My method', auprc=Fa
         single_test(model, test_dataloaders_all[list(
             test_dataloaders_all.keys())[0]][0], auprc, classification)
     all_in_one_test(_testprocess, [model])
-    for noisy_modality, test_dataloaders in test_dataloaders_all.items():
-        print("Testing on noisy data ({})...".format(noisy_modality))
-        robustness_curve = dict()
-        for test_dataloader in tqdm(test_dataloaders):
-            single_test_result = single_test(
-                model, test_dataloader, auprc, classification)
-            for k, v in single_test_result.items():
-                curve = robustness_curve.get(k, [])
-                curve.append(v)
-                robustness_curve[k] = curve
-        for measure, robustness_result in robustness_curve.items():
-            robustness_key = '{} {}'.format(dataset, noisy_modality)
-            print("relative robustness ({}, {}): {}".format(noisy_modality, measure, str(
-                relative_robustness(robustness_result, robustness_key))))
-            if len(robustness_curve) != 1:
-                robustness_key = '{} {}'.format(robustness_key, measure)
-            print("effective robustness ({}, {}): {}".format(noisy_modality, measure, str(
-                effective_robustness(robustness_result, robustness_key))))
-            fig_name = '{}-{}-{}-{}'.format(method_name,
-                                            robustness_key, noisy_modality, measure)
-            single_plot(robustness_result, robustness_key, xlabel='Noise level',
-                        ylabel=measure, fig_name=fig_name, method=method_name)
-            print("Plot saved as "+fig_name)
+    def _evaluate(test_dataloader):
+        return single_test(model, test_dataloader, auprc, classification)
+    curves = robustness_curves(_evaluate, test_dataloaders_all, sweep_workers)
+    report_robustness(curves, dataset, method_name)
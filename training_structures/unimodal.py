@@ -1,16 +1,17 @@
 """Implements training pipeline for unimodal comparison."""
-from sklearn.metrics import accuracy_score, f1_score
 import torch
 from torch import nn
-from utils.AUPRC import AUPRC
 from eval_scripts.performance import eval_affect
+from eval_scripts.metrics import MetricsAccumulator
 from eval_scripts.complexity import all_in_one_train, all_in_one_test
-from eval_scripts.robustness import relative_robustness, effective_robustness, single_plot
-from tqdm import tqdm
+from eval_scripts import profiling
+from eval_scripts.sweep import robustness_curves
+from eval_scripts.robustness import report_robustness
+from utils.checkpoint import CheckpointManager, checkpoint_directory, load_checkpoint
 softmax = nn.Softmax()
 
 
-def train(encoder, head, train_dataloader, valid_dataloader, total_epochs, early_stop=False, optimtype=torch.optim.RMSprop, lr=0.001, weight_decay=0.0, criterion=nn.CrossEntropyLoss(), auprc=False, save_encoder='encoder.pt', save_head='head.pt', modalnum=0, task='classification', track_complexity=True):
+def train(encoder, head, train_dataloader, valid_dataloader, total_epochs, early_stop=False, optimtype=torch.optim.RMSprop, lr=0.001, weight_decay=0.0, criterion=nn.CrossEntropyLoss(), auprc=False, save_encoder='encoder.pt', save_head='head.pt', modalnum=0, task='classification', track_complexity=True, checkpoint_dir=None, resume=None, keep_last=1, keep_best=1):
     """Train unimodal module.
 
     Args:
@@ -30,6 +31,10 @@ def train(encoder, head, train_dataloader, valid_dataloader, total_epochs, early
         modalnum (int, optional): Which modality to apply encoder to. Defaults to 0.
         task (str, optional): Type of task to try. Supports "classification", "regression", or "multilabel". Defaults to 'classification'.
         track_complexity (bool, optional): Whether to track the model's complexity or not. Defaults to True.
+        checkpoint_dir (str, optional): Directory to write a resumable checkpoint to after every epoch (written in the background). Defaults to None, which does not checkpoint.
+        resume (str, optional): Checkpoint file or directory to resume training from. checkpoint_dir defaults to its directory. Defaults to None.
+        keep_last (int, optional): Number of most recent checkpoints to keep. Defaults to 1.
+        keep_best (int, optional): Number of checkpoints with the best validation performance to keep. Defaults to 1.
     """
     def _trainprocess():
         model = nn.Sequential(encoder, head)
@@ -38,73 +43,79 @@ def train(encoder, head, train_dataloader, valid_dataloader, total_epochs, early
         bestacc = 0
         bestf1 = 0
         patience = 0
-        for epoch in range(total_epochs):
-            totalloss = 0.0
-            totals = 0
-            for j in train_dataloader:
+        modules = {'encoder': encoder, 'head': head}
+        start_epoch = 0
+        if resume is not None:
+            state = load_checkpoint(resume, modules, {'optimizer': op}, map_location=torch.device("cuda:0" if torch.cuda.is_available() else "cpu"))
+            start_epoch = state['epoch'] + 1
+            bestvalloss, bestacc, bestf1, patience = [state['extra'][k] for k in ('bestvalloss', 'bestacc', 'bestf1', 'patience')]
+        directory = checkpoint_directory(checkpoint_dir, resume)
+        checkpoints = None
+        if directory is not None:
+            checkpoints = CheckpointManager(directory, keep_last, keep_best, mode='min' if task == "regression" else 'max')
+
+        def _savebest():
+            print("Saving Best")
+            if checkpoints is None:
+                torch.save(encoder, save_encoder)
+                torch.save(head, save_head)
+            else:
+                checkpoints.save_model(encoder, save_encoder)
+                checkpoints.save_model(head, save_head)
+
+        for epoch in range(start_epoch, total_epochs):
+            metrics = MetricsAccumulator()
+            for j in profiling.iterate(train_dataloader):
                 op.zero_grad()
-                out = model(j[modalnum].float().to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")))
-                
-                if type(criterion) == torch.nn.modules.loss.BCEWithLogitsLoss:
-                    loss = criterion(out, j[-1].float().to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")))
-                else:
-                    loss = criterion(out, j[-1].to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")))
-                totalloss += loss * len(j[-1])
-                totals += len(j[-1])
-                loss.backward()
-                torch.nn.utils.clip_grad_norm_(model.parameters(), 8)
-                op.step()
-            print("Epoch "+str(epoch)+" train loss: "+str(totalloss/totals))
-            with torch.no_grad():
-                totalloss = 0.0
-                pred = []
-                true = []
-                pts = []
+                with profiling.phase('forward'):
+                    out = model(j[modalnum].float().to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")))
+
+                    if type(criterion) == torch.nn.modules.loss.BCEWithLogitsLoss:
+                        loss = criterion(out, j[-1].float().to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")))
+                    else:
+                        loss = criterion(out, j[-1].to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")))
+                metrics.update(j[-1], loss=loss)
+                with profiling.phase('backward'):
+                    loss.backward()
+                with profiling.phase('step'):
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), 8)
+                    op.step()
+            print("Epoch "+str(epoch)+" train loss: "+str(metrics.loss()))
+            with torch.no_grad(), profiling.phase('validation'):
+                metrics = MetricsAccumulator()
                 for j in valid_dataloader:
                     out = model(j[modalnum].float().to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")))
                     if type(criterion) == torch.nn.modules.loss.BCEWithLogitsLoss:
                         loss = criterion(out, j[-1].float().to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")))
                     else:
                         loss = criterion(out, j[-1].to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")))
-                    totalloss += loss*len(j[-1])
+                    pred = None
                     if task == "classification":
-                        pred.append(torch.argmax(out, 1))
+                        pred = torch.argmax(out, 1)
                     elif task == "multilabel":
-                        pred.append(torch.sigmoid(out).round())
-                    true.append(j[-1])
-                    if auprc:
-                        # pdb.set_trace()
-                        sm = softmax(out)
-                        pts += [(sm[i][1].item(), j[-1][i].item())
-                                for i in range(j[-1].size(0))]
-            if pred:
-                pred = torch.cat(pred, 0).cpu().numpy()
-            true = torch.cat(true, 0).cpu().numpy()
-            totals = true.shape[0]
-            valloss = totalloss/totals
+                        pred = torch.sigmoid(out).round()
+                    scores = softmax(out)[:, 1] if auprc else None
+                    metrics.update(j[-1], pred, scores, loss)
+            valloss = metrics.loss()
             if task == "classification":
-                acc = accuracy_score(true, pred)
+                acc = metrics.accuracy()
                 print("Epoch "+str(epoch)+" valid loss: "+str(valloss) +
                       " acc: "+str(acc))
                 if acc > bestacc:
                     patience = 0
                     bestacc = acc
-                    print("Saving Best")
-                    torch.save(encoder, save_encoder)
-                    torch.save(head, save_head)
+                    _savebest()
                 else:
                     patience += 1
             elif task == "multilabel":
-                f1_micro = f1_score(true, pred, average="micro")
-                f1_macro = f1_score(true, pred, average="macro")
+                f1_micro = metrics.f1_score("micro")
+                f1_macro = metrics.f1_score("macro")
                 print("Epoch "+str(epoch)+" valid loss: "+str(valloss) +
                       " f1_micro: "+str(f1_micro)+" f1_macro: "+str(f1_macro))
                 if f1_macro > bestf1:
                     patience = 0
                     bestf1 = f1_macro
-                    print("Saving Best")
-                    torch.save(encoder, save_encoder)
-                    torch.save(head, save_head)
+                    _savebest()
                 else:
                     patience += 1
             elif task == "regression":
@@ -112,15 +123,20 @@ def train(encoder, head, train_dataloader, valid_dataloader, total_epochs, early
                 if valloss < bestvalloss:
                     patience = 0
                     bestvalloss = valloss
-                    print("Saving Best")
-                    torch.save(encoder, save_encoder)
-                    torch.save(head, save_head)
+                    _savebest()
                 else:
                     patience += 1
+            if checkpoints is not None:
+                metric = acc if task == "classification" else f1_macro if task == "multilabel" else valloss
+                checkpoints.save(epoch, modules, {'optimizer': op}, metric=metric,
+                                 extra={'bestvalloss': bestvalloss, 'bestacc': bestacc, 'bestf1': bestf1, 'patience': patience})
+            profiling.end_epoch()
             if early_stop and patience > 7:
                 break
             if auprc:
-                print("AUPRC: "+str(AUPRC(pts)))
+                print("AUPRC: "+str(metrics.auprc()))
+        if checkpoints is not None:
+            checkpoints.close()
     if track_complexity:
         all_in_one_train(_trainprocess, [encoder, head])
     else:
@@ -144,62 +160,46 @@ def single_test(encoder, head, test_dataloader, auprc=False, modalnum=0, task='c
     """
     model = nn.Sequential(encoder, head)
     with torch.no_grad():
-        pred = []
-        true = []
-        totalloss = 0
-        pts = []
+        metrics = MetricsAccumulator()
         for j in test_dataloader:
             out = model(j[modalnum].float().to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")))
+            loss = None
             if criterion is not None:
                 loss = criterion(out, j[-1].to(torch.device("cuda:0" if torch.cuda.is_available() else "cpu")))
-                totalloss += loss*len(j[-1])
+            pred = None
             if task == "classification":
-                pred.append(torch.argmax(out, 1))
+                pred = torch.argmax(out, 1)
             elif task == "multilabel":
-                pred.append(torch.sigmoid(out).round())
+                pred = torch.sigmoid(out).round()
             elif task == "posneg-classification":
-                prede = []
-                oute = out.cpu().numpy().tolist()
-                for i in oute:
-                    if i[0] > 0:
-                        prede.append(1)
-                    elif i[0] < 0:
-                        prede.append(-1)
-                    else:
-                        prede.append(0)
-                pred.append(torch.LongTensor(prede))
-            true.append(j[-1])
-            if auprc:
-                # pdb.set_trace()
-                sm = softmax(out)
-                pts += [(sm[i][1].item(), j[-1][i].item())
-                        for i in range(j[-1].size(0))]
-        if pred:
-            pred = torch.cat(pred, 0).cpu().numpy()
-        true = torch.cat(true, 0).cpu().numpy()
-        totals = true.shape[0]
+                pred = torch.sign(out[:, 0]).long()
+            scores = softmax(out)[:, 1] if auprc else None
+            metrics.update(j[-1], pred, scores, loss)
         if auprc:
-            print("AUPRC: "+str(AUPRC(pts)))
+            print("AUPRC: "+str(metrics.auprc()))
         if criterion is not None:
-            print("loss: " + str(totalloss / totals))
+            print("loss: " + str(metrics.loss()))
         if task == "classification":
-            print("acc: "+str(accuracy_score(true, pred)))
-            return {'Accuracy': accuracy_score(true, pred)}
+            acc = metrics.accuracy()
+            print("acc: "+str(acc))
+            return {'Accuracy': acc}
         elif task == "multilabel":
-            print(" f1_micro: "+str(f1_score(true, pred, average="micro")) +
-                  " f1_macro: "+str(f1_score(true, pred, average="macro")))
-            return {'F1 score (micro)': f1_score(true, pred, average="micro"), 'F1 score (macro)': f1_score(true, pred, average="macro")}
+            f1_micro = metrics.f1_score("micro")
+            f1_macro = metrics.f1_score("macro")
+            print(" f1_micro: "+str(f1_micro) +
+                  " f1_macro: "+str(f1_macro))
+            return {'F1 score (micro)': f1_micro, 'F1 score (macro)': f1_macro}
         elif task == "posneg-classification":
-            trueposneg = true
+            trueposneg, pred = metrics.predictions()
             accs = eval_affect(trueposneg, pred)
             acc2 = eval_affect(trueposneg, pred, exclude_zero=False)
             print("acc: "+str(accs) + ', ' + str(acc2))
             return {'Accuracy': accs}
         else:
-            return {'MSE': (totalloss / totals).item()}
+            return {'MSE': metrics.loss().item()}
 
 
-def test(encoder, head, test_dataloaders_all, dataset='default', method_name='My method', auprc=False, modalnum=0, task='classification', criterion=None, no_robust=False):
+def test(encoder, head, test_dataloaders_all, dataset='default', method_name='My method', auprc=False, modalnum=0, task='classification', criterion=None, no_robust=False, sweep_workers=1):
     """Test unimodal model on all provided dataloaders.
 
     Args:
@@ -213,6 +213,7 @@ def test(encoder, head, test_dataloaders_all, dataset='default', method_name='My
         task (str, optional): Type of task to try. Supports "classification", "regression", or "multilabel". Defaults to 'classification'.
         criterion (nn.Module, optional): Loss module. Defaults to None.
         no_robust (bool, optional): Whether to not apply robustness methods or not. Defaults to False.
+        sweep_workers (int, optional): Number of processes to score the noisy test sets in parallel, each with a replica of the model. Defaults to 1.
     """
     if no_robust:
         def _testprocess():
@@ -225,26 +226,7 @@ def test(encoder, head, test_dataloaders_all, dataset='default', method_name='My
         single_test(encoder, head, test_dataloaders_all[list(
             test_dataloaders_all.keys())[0]][0], auprc, modalnum, task, criterion)
     all_in_one_test(_testprocess, [encoder, head])
-    for noisy_modality, test_dataloaders in test_dataloaders_all.items():
-        print("Testing on noisy data ({})...".format(noisy_modality))
-        robustness_curve = dict()
-        for test_dataloader in tqdm(test_dataloaders):
-            single_test_result = single_test(
-                encoder, head, test_dataloader, auprc, modalnum, task, criterion)
-            for k, v in single_test_result.items():
-                curve = robustness_curve.get(k, [])
-                curve.append(v)
-                robustness_curve[k] = curve
-        for measure, robustness_result in robustness_curve.items():
-            robustness_key = '{} {}'.format(dataset, noisy_modality)
-            print("relative robustness ({}, {}): {}".format(noisy_modality, measure, str(
-                relative_robustness(robustness_result, robustness_key))))
-            if len(robustness_curve) != 1:
-                robustness_key = '{} {}'.format(robustness_key, measure)
-            print("effective robustness ({}, {}): {}".format(noisy_modality, measure, str(
-                effective_robustness(robustness_result, robustness_key))))
-            fig_name = '{}-{}-{}-{}'.format(method_name,
-                                            robustness_key, noisy_modality, measure)
-            single_plot(robustness_result, robustness_key, xlabel='Noise level',
-                        ylabel=measure, fig_name=fig_name, method=method_name)
-            print("Plot saved as "+fig_name)
+    def _evaluate(test_dataloader):
+        return single_test(encoder, head, test_dataloader, auprc, modalnum, task, criterion)
+    curves = robustness_curves(_evaluate, test_dataloaders_all, sweep_workers)
+    report_robustness(curves, dataset, method_name)
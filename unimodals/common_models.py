@@ -443,7 +443,7 @@ class LeNet(nn.Module):
             torch.Tensor: Layer Output
         """
         tempouts = []
-        out = x
+        out = _channels_last_input(self, x)
         for i in range(len(self.convs)):
             out = F.relu(self.bns[i](self.convs[i](out)))
             out = F.max_pool2d(out, 2)
@@ -486,7 +486,7 @@ class VGG16(nn.Module):
         Returns:
             torch.Tensor: Layer Output
         """
-        return self.model(x)
+        return self.model(_channels_last_input(self, x))
 
 
 class VGG16Slim(nn.Module):  
@@ -527,7 +527,7 @@ class VGG16Slim(nn.Module):
         Returns:
             torch.Tensor: Layer Output
         """
-        return self.model(x)
+        return self.model(_channels_last_input(self, x))
 
 
 class VGG11Slim(nn.Module): 
@@ -571,7 +571,7 @@ class VGG11Slim(nn.Module):
         Returns:
             torch.Tensor: Layer Output
         """
-        return self.model(x)
+        return self.model(_channels_last_input(self, x))
 
 
 class VGG11Pruned(nn.Module):
@@ -624,7 +624,7 @@ class VGG11Pruned(nn.Module):
         Returns:
             torch.Tensor: Layer Output
         """
-        return self.model(x)
+        return self.model(_channels_last_input(self, x))
 
 
 
@@ -678,7 +678,7 @@ class VGG16Pruned(nn.Module):
         Returns:
             torch.Tensor: Layer Output
         """
-        return self.model(x)
+        return self.model(_channels_last_input(self, x))
 
 
 class VGG(nn.Module):
@@ -713,6 +713,7 @@ class VGG(nn.Module):
         Returns:
             torch.Tensor: Output Tensor
         """
+        x = _channels_last_input(self, x)
         for i_l, layer in enumerate(self.vgg):
 
             x = layer(x)
@@ -987,6 +988,7 @@ class ResNetLSTMEnc(torch.nn.Module):
         cbatch_size = x.shape[0]
         x = x.permute([0, 2, 1, 3, 4])  # (cbatch_size, 150, 3, 112, 112)
         x = x.reshape(-1, 3, 112, 112)  # (cbatch_size*150, 3, 112, 112)
+        x = _channels_last_input(self, x)
         x = self.enc(x)  # (cbatch_size*150, 1000)
         x = x.reshape(cbatch_size, -1, 1000)
         hidden = self.lstm(x)[1][0]
@@ -1029,3 +1031,27 @@ class Transformer(nn.Module):
         x = x.permute([2, 0, 1])
         x = self.transformer(x)[-1]
         return x
+
+
+def _channels_last_input(module, x):
+    if getattr(module, 'channels_last', False) and x.dim() == 4:
+        return x.contiguous(memory_format=torch.channels_last)
+    return x
+
+
+def set_channels_last(module):
+    """Switch the convolutional encoders inside a module to channels-last memory format.
+
+    The weights of LeNet, the VGG encoders and ResNetLSTMEnc are converted in place, and their 4D inputs are converted on every forward pass.
+
+    Args:
+        module (nn.Module): Module to convert, e.g. an encoder or a whole MMDL model.
+
+    Returns:
+        nn.Module: The converted module.
+    """
+    for m in module.modules():
+        if isinstance(m, (LeNet, VGG16, VGG16Slim, VGG11Slim, VGG11Pruned, VGG16Pruned, VGG, ResNetLSTMEnc)):
+            m.to(memory_format=torch.channels_last)
+            m.channels_last = True
+    return module
@@ -0,0 +1,222 @@
+"""Implements resumable training checkpoints that are written in the background.
+
+A checkpoint holds the state_dict of every module and optimizer, the epoch, the best metric so far, the RNG states and any extra training state. The state is copied to host memory on the calling thread, so training can go on while a single background thread writes it to disk. Every file is written to a temporary path and atomically renamed, so an interrupted run never leaves a truncated checkpoint behind.
+"""
+import inspect
+import io
+import json
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+INDEX_NAME = 'checkpoints.json'
+# checkpoints hold more than tensors (RNG states, extra training state); older torch has no weights_only
+_LOAD_KWARGS = {'weights_only': False} if 'weights_only' in inspect.signature(torch.load).parameters else dict()
+
+
+def _to_cpu(obj):
+    """Copy every tensor in a nested structure of dicts, lists and tuples to host memory."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, _to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def _atomic_write(path, write):
+    """Call write on a temporary file next to path, then rename it to path."""
+    tmp = '{}.tmp.{}'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def get_rng_state():
+    """Get the states of the python, numpy and torch (CPU and CUDA) random number generators."""
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """Restore random number generator states returned by get_rng_state."""
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class CheckpointManager:
+    """Saves checkpoints to a directory in the background, keeping the last and the best ones."""
+
+    def __init__(self, directory, keep_last=1, keep_best=1, mode='max'):
+        """Initialize CheckpointManager object.
+
+        Args:
+            directory (str): Directory to write checkpoints to. Checkpoints already listed there are kept track of, so a resumed run prunes them as well.
+            keep_last (int, optional): Number of most recent checkpoints to keep. Defaults to 1.
+            keep_best (int, optional): Number of checkpoints with the best metric to keep. Defaults to 1.
+            mode (str, optional): "max" if a higher metric is better, "min" if a lower one is. Defaults to 'max'.
+        """
+        if mode not in ('max', 'min'):
+            raise ValueError("mode must be 'max' or 'min', got " + str(mode))
+        self.directory = directory
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.mode = mode
+        os.makedirs(directory, exist_ok=True)
+        self.checkpoints = _read_index(directory)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = []
+
+    def save(self, epoch, modules, optimizers=None, metric=None, extra=None):
+        """Snapshot the training state and write it as a checkpoint in the background.
+
+        Args:
+            epoch (int): Index of the epoch that just finished.
+            modules (dict): Modules to save, by name.
+            optimizers (dict, optional): Optimizers (or anything else with a state_dict, such as a GradScaler) to save, by name. Defaults to None.
+            metric (float, optional): Validation metric of this epoch, used to keep the best checkpoints. Defaults to None.
+            extra (dict, optional): Any other state needed to resume, such as the patience counter. Defaults to None.
+
+        Returns:
+            str: Path the checkpoint will be written to.
+        """
+        if metric is not None:
+            metric = float(metric)
+        state = _to_cpu({
+            'epoch': epoch,
+            'metric': metric,
+            'modules': {name: m.state_dict() for name, m in modules.items()},
+            'optimizers': {name: o.state_dict() for name, o in (optimizers or dict()).items()},
+            'rng': get_rng_state(),
+            'extra': extra or dict(),
+        })
+        name = 'checkpoint_{:04d}.pt'.format(epoch)
+        index = [c for c in self.checkpoints if c['file'] != name]
+        index.append({'file': name, 'epoch': epoch, 'metric': metric})
+        keep = self._kept(index)
+        self.checkpoints = [c for c in index if c['file'] in keep]
+        stale = [c['file'] for c in index if c['file'] not in keep]
+        self._submit(self._write, state, name, list(self.checkpoints), stale)
+        return os.path.join(self.directory, name)
+
+    def save_model(self, model, path):
+        """Pickle the whole model (as torch.save(model, path) does) and write it in the background.
+
+        Args:
+            model (nn.Module): Model to save.
+            path (str): File to write to.
+        """
+        buffer = io.BytesIO()
+        torch.save(model, buffer)
+        self._submit(_atomic_write, path, lambda f: f.write(buffer.getbuffer()))
+
+    def _submit(self, fn, *args):
+        self._pending = [p for p in self._pending if not p.done() or p.exception() is not None]
+        self._pending.append(self._executor.submit(fn, *args))
+
+    def _write(self, state, name, index, stale):
+        if name in {c['file'] for c in index}:
+            _atomic_write(os.path.join(self.directory, name), lambda f: torch.save(state, f))
+        # the index only lists files that are fully written, so it is updated after them
+        _atomic_write(os.path.join(self.directory, INDEX_NAME),
+                      lambda f: f.write(json.dumps(index, indent=2).encode()))
+        for file in stale:
+            try:
+                os.remove(os.path.join(self.directory, file))
+            except FileNotFoundError:
+                pass
+
+    def _kept(self, index):
+        by_epoch = sorted(index, key=lambda c: c['epoch'])
+        keep = {c['file'] for c in by_epoch[max(len(by_epoch) - self.keep_last, 0):]} if self.keep_last > 0 else set()
+        scored = [c for c in index if c['metric'] is not None]
+        scored.sort(key=lambda c: c['metric'], reverse=self.mode == 'max')
+        keep.update(c['file'] for c in scored[:self.keep_best])
+        return keep
+
+    def latest(self):
+        """Get the path of the most recent checkpoint, or None if there is none."""
+        return _latest(self.directory, self.checkpoints)
+
+    def best(self):
+        """Get the path of the checkpoint with the best metric, or None if there is none."""
+        scored = [c for c in self.checkpoints if c['metric'] is not None]
+        if not scored:
+            return None
+        pick = max if self.mode == 'max' else min
+        return os.path.join(self.directory, pick(scored, key=lambda c: c['metric'])['file'])
+
+    def wait(self):
+        """Block until all pending writes are done, raising the first error of any of them."""
+        pending, self._pending = self._pending, []
+        for p in pending:
+            p.result()
+
+    def close(self):
+        """Wait for pending writes and stop the background thread."""
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown()
+
+
+def _read_index(directory):
+    try:
+        with open(os.path.join(directory, INDEX_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def _latest(directory, checkpoints):
+    if not checkpoints:
+        return None
+    return os.path.join(directory, max(checkpoints, key=lambda c: c['epoch'])['file'])
+
+
+def checkpoint_directory(checkpoint_dir, resume):
+    """Get the directory a training run writes checkpoints to: checkpoint_dir if given, else the directory of the checkpoint it resumes from, else None."""
+    if checkpoint_dir is not None or resume is None:
+        return checkpoint_dir
+    return resume if os.path.isdir(resume) else os.path.dirname(resume)
+
+
+def load_checkpoint(path, modules, optimizers=None, map_location=None, restore_rng=True):
+    """Load a checkpoint written by CheckpointManager into modules and optimizers.
+
+    Args:
+        path (str): Checkpoint file, or a checkpoint directory to load the most recent checkpoint from.
+        modules (dict): Modules to load state into, by the names they were saved with.
+        optimizers (dict, optional): Optimizers (or GradScalers) to load state into, by name. Defaults to None.
+        map_location (optional): Passed on to torch.load. Defaults to None.
+        restore_rng (bool, optional): Whether to restore the random number generator states, so shuffling and dropout continue as if training had not stopped. Defaults to True.
+
+    Returns:
+        dict: The checkpoint, with the "epoch", "metric" and "extra" entries to resume from.
+    """
+    if os.path.isdir(path):
+        directory = path
+        path = _latest(directory, _read_index(directory))
+        if path is None:
+            raise FileNotFoundError("No checkpoint in " + directory)
+    state = torch.load(path, map_location=map_location, **_LOAD_KWARGS)
+    for name, m in modules.items():
+        m.load_state_dict(state['modules'][name])
+    for name, o in (optimizers or dict()).items():
+        if name in state['optimizers']:
+            o.load_state_dict(state['optimizers'][name])
+    if restore_rng:
+        set_rng_state(state['rng'])
+    return state
@@ -0,0 +1,223 @@
+"""Implements a persistent, content-addressed cache for features of (noisy) test sets.
+
+Every entry is keyed by a hash of what produced it: dataset, split, modality, noise function, noise level, seed and feature extractor. An entry is a directory of .npy shards, one per array, that are opened memory-mapped, and a manifest.json describing them. The shards are written to a temporary directory that is renamed into place once complete, and a file lock per key makes concurrent jobs wait for each other instead of computing the same entry twice.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows, where only the atomic rename protects entries
+    fcntl = None
+
+MANIFEST_NAME = 'manifest.json'
+
+
+def default_root():
+    """Get the cache directory used when none is given: $MULTIBENCH_CACHE, or ~/.cache/multibench/features."""
+    return os.environ.get('MULTIBENCH_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'multibench', 'features'))
+
+
+def fingerprint(obj):
+    """Hash an object that determines cached features, such as a feature extractor.
+
+    Args:
+        obj: A module, tensor or array (hashed by content), or any nesting of dicts, lists, strings and numbers.
+
+    Returns:
+        str: Hex digest identifying obj.
+    """
+    digest = hashlib.sha256()
+    _update(digest, obj)
+    return digest.hexdigest()
+
+
+def _update(digest, obj):
+    if isinstance(obj, torch.nn.Module):
+        digest.update(type(obj).__qualname__.encode())
+        obj = obj.state_dict()
+    if isinstance(obj, torch.Tensor):
+        obj = obj.detach().cpu().numpy()
+    if isinstance(obj, np.generic):
+        obj = obj.item()
+    if isinstance(obj, np.ndarray):
+        digest.update('{}{}'.format(obj.dtype.str, obj.shape).encode())
+        digest.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, dict):
+        for k in sorted(obj, key=str):
+            _update(digest, str(k))
+            _update(digest, obj[k])
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            _update(digest, v)
+    else:
+        digest.update(json.dumps(obj).encode())
+
+
+def file_fingerprint(path):
+    """Hash a file that determines cached features, such as pretrained weights, by its path, size and modification time.
+
+    Args:
+        path (str): Path to the file. A file that does not exist is hashed by its path only.
+
+    Returns:
+        str: Hex digest identifying the file.
+    """
+    path = os.path.abspath(path)
+    if not os.path.isfile(path):
+        return fingerprint([path])
+    stat = os.stat(path)
+    return fingerprint([path, stat.st_size, stat.st_mtime_ns])
+
+
+class FeatureCache:
+    """Stores arrays under a key describing how they were computed, and computes each key at most once."""
+
+    def __init__(self, root=None):
+        """Initialize FeatureCache object.
+
+        Args:
+            root (str, optional): Directory to keep entries in. Defaults to default_root().
+        """
+        self.root = root if root is not None else default_root()
+
+    @staticmethod
+    def key(dataset, split, modality, noise=None, noise_level=None, seed=None, extractor=None, **kwargs):
+        """Get the key of an entry.
+
+        Args:
+            dataset (str): Dataset name.
+            split (str): Split, such as 'test'.
+            modality (str): Modality the features are of.
+            noise (str, optional): Name of the noise function applied. Defaults to None.
+            noise_level (float, optional): Noise level applied. Defaults to None.
+            seed (int, optional): Seed the noise was drawn with. Defaults to None.
+            extractor (optional): Feature extractor, passed through fingerprint. Defaults to None.
+            **kwargs: Anything else the features depend on.
+
+        Returns:
+            str: Hex digest of all the arguments.
+        """
+        return fingerprint(dict(kwargs, dataset=dataset, split=split, modality=modality, noise=noise,
+                                noise_level=noise_level, seed=seed,
+                                extractor=None if extractor is None else fingerprint(extractor)))
+
+    def path(self, key):
+        """Get the directory of the entry with the given key."""
+        return os.path.join(self.root, key[:2], key)
+
+    def load(self, key):
+        """Open the entry with the given key, or return None if there is none.
+
+        Returns:
+            np.ndarray or dict: The memory-mapped array, or dict of arrays, that was stored.
+        """
+        entry = self.path(key)
+        try:
+            with open(os.path.join(entry, MANIFEST_NAME)) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return None
+        arrays = {name: np.load(os.path.join(entry, info['file']), mmap_mode='r')
+                  for name, info in manifest['arrays'].items()}
+        return arrays[''] if manifest['single'] else arrays
+
+    def get_or_compute(self, compute, dataset, split, modality, **kwargs):
+        """Load an entry, computing and storing it first if it does not exist yet.
+
+        If another process is computing the same entry, this waits for it and loads its result.
+
+        Args:
+            compute (callable): Function without arguments returning an array or a dict of arrays to store.
+            dataset, split, modality, **kwargs: Key of the entry, as in FeatureCache.key.
+
+        Returns:
+            np.ndarray or dict: The stored array, or dict of arrays, memory-mapped.
+        """
+        def _write(tmp):
+            value = compute()
+            single = not isinstance(value, dict)
+            arrays = dict()
+            for i, (name, array) in enumerate(({'': value} if single else value).items()):
+                array = np.asarray(array)
+                if array.dtype == object:
+                    raise ValueError("Can only cache numeric arrays, got an object array for " + repr(name))
+                arrays[name] = _shard_info(i, array)
+                np.save(os.path.join(tmp, arrays[name]['file']), array)
+            return single, arrays
+        return self._get_or_store(_write, dataset, split, modality, kwargs)
+
+    def get_or_fill(self, fill, shape, dtype, dataset, split, modality, **kwargs):
+        """Load an entry that is a single array, letting fill write it in place first if it does not exist yet.
+
+        Unlike get_or_compute, the array is never held in memory as a whole: fill gets the memory-mapped shard and can stream results into it.
+
+        Args:
+            fill (callable): Function taking the [shape] array to write to.
+            shape (tuple): Shape of the array.
+            dtype: Data type of the array.
+            dataset, split, modality, **kwargs: Key of the entry, as in FeatureCache.key.
+
+        Returns:
+            np.ndarray: The stored array, memory-mapped.
+        """
+        def _write(tmp):
+            info = _shard_info(0, np.empty(0, dtype=dtype))
+            info['shape'] = list(shape)
+            out = np.lib.format.open_memmap(os.path.join(tmp, info['file']), mode='w+', dtype=dtype, shape=tuple(shape))
+            fill(out)
+            out.flush()
+            return True, {'': info}
+        return self._get_or_store(_write, dataset, split, modality, kwargs)
+
+    def _get_or_store(self, write, dataset, split, modality, kwargs):
+        key = self.key(dataset, split, modality, **kwargs)
+        value = self.load(key)
+        if value is not None:
+            return value
+        os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+        with _locked(self.path(key) + '.lock'):
+            value = self.load(key)
+            if value is None:
+                self._store(key, write, dict(kwargs, dataset=dataset, split=split, modality=modality))
+                value = self.load(key)
+        return value
+
+    def _store(self, key, write, description):
+        entry = self.path(key)
+        tmp = '{}.tmp.{}'.format(entry, os.getpid())
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        single, arrays = write(tmp)
+        manifest = {'key': {k: v if isinstance(v, (str, int, float, type(None))) else fingerprint(v)
+                            for k, v in description.items()},
+                    'single': single, 'arrays': arrays}
+        with open(os.path.join(tmp, MANIFEST_NAME), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        if os.path.exists(entry):
+            # an entry without a manifest is incomplete
+            shutil.rmtree(entry)
+        os.rename(tmp, entry)
+
+
+def _shard_info(i, array):
+    return {'file': 'shard_{:03d}.npy'.format(i), 'shape': list(array.shape), 'dtype': array.dtype.str}
+
+
+@contextlib.contextmanager
+def _locked(path):
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
@@ -59,6 +59,22 @@ class LRCosineAnnealingScheduler():
             param_group['lr'] = self.eta
         optimizer.load_state_dict(state_dict)
 
+    def state_dict(self):
+        """Get the state of the scheduler.
+
+        Returns:
+            dict: Scheduler attributes.
+        """
+        return dict(vars(self))
+
+    def load_state_dict(self, state_dict):
+        """Restore a state of the scheduler.
+
+        Args:
+            state_dict (dict): Scheduler attributes, as returned by state_dict.
+        """
+        vars(self).update(state_dict)
+
 
 # %%
 class FixedScheduler():
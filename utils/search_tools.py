@@ -29,14 +29,8 @@ def predict_accuracies_with_surrogate(configurations, surrogate, device):
     Returns:
         list[float]: Accuracy per configuration.
     """
-    # uses surrogate to evaluate input configurations
-
-    accs = []
-
-    for c in configurations:
-        accs.append(surrogate.eval_model(c, device))
-
-    return accs
+    # uses surrogate to evaluate all input configurations in one batch
+    return list(surrogate.eval_models(configurations, device))
 
 
 def update_surrogate_dataloader(surrogate_dataloader, configurations, accuracies):
@@ -65,7 +59,7 @@ def train_surrogate(surrogate, surrogate_dataloader, surrogate_optimizer, surrog
     Returns:
         float: Loss of surrogate with current training data.
     """
-    s_data = surrogate_dataloader.get_data(to_torch=True)
+    s_data = surrogate_dataloader.get_batch(to_torch=True)
     err = surr.train_simple_surrogate(surrogate, surrogate_criterion,
                                       surrogate_optimizer, s_data,
                                       ep, device)
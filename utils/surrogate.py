@@ -43,25 +43,30 @@ class SimpleRecurrentSurrogate(nn.Module):
                 m.weight.data.uniform_(-0.1, 0.1)
                 m.bias.data.fill_(1.8)
 
-    def forward(self, sequence_of_operations):
+    def forward(self, sequence_of_operations, lengths=None):
         """Apply SimpleRecurrentSurrogate to list of configurations, to get accuracy predictions.
 
         Args:
-            sequence_of_operations (list): List of configurations to predict accuracies.
+            sequence_of_operations (list): List of configurations to predict accuracies, as a tensor of size [seq_len, batch, input_size].
+            lengths (torch.Tensor, optional): Length of each configuration, if they are padded to seq_len. Defaults to None, which takes all of them to be seq_len long.
 
         Returns:
             nn.Tensor: Predicted accuracies.
         """
         # (seq_len, batch, input_size):
 
-        embeds = []
-        for s in sequence_of_operations:
-            embeds.append(self.embedding(s))
-        embeds = torch.stack(embeds, dim=0)
+        embeds = self.embedding(sequence_of_operations)
 
-        lstm_out, hidden = self.lstm(embeds)
+        if lengths is None:
+            lstm_out, hidden = self.lstm(embeds)
+            last = lstm_out[-1]
+        else:
+            # the final hidden state of a packed sequence is taken at its own length
+            packed = nn.utils.rnn.pack_padded_sequence(embeds, torch.as_tensor(lengths).cpu(), enforce_sorted=False)
+            _, (hidden, _) = self.lstm(packed)
+            last = hidden[-1]
 
-        val_space = self.hid2val(lstm_out[-1])
+        val_space = self.hid2val(last)
         val_space = self.nonlinearity(val_space)
 
         return val_space
@@ -83,14 +88,69 @@ class SimpleRecurrentSurrogate(nn.Module):
 
         return res[0, 0]
 
+    def eval_models(self, configurations, device):
+        """Apply SimpleRecurrentSurrogate to many configurations at once, in a single padded batch.
+
+        Args:
+            configurations (list[np.array[int]]): Configurations, each of size len_seq x input_size.
+            device (torch.utils.data.device): Device to compute on.
+
+        Returns:
+            np.array: Predicted accuracy of each configuration.
+        """
+        padded, lengths = pad_configurations(configurations)
+        ragged = lengths.min() != lengths.max()
+        with torch.no_grad():
+            res = self.forward(torch.from_numpy(padded).to(device), torch.from_numpy(lengths) if ragged else None)
+        return res.cpu().numpy()[:, 0]
+
+
+def pad_configurations(configurations):
+    """Pad configurations of different lengths into one array.
+
+    Args:
+        configurations (list[np.array[int]]): Configurations, each of size len_seq x input_size.
+
+    Returns:
+        tuple(np.array, np.array): Configurations as a float32 array of size [max_len_seq, num_configurations, input_size], zero-padded after each configuration, and the length of each configuration.
+    """
+    lengths = np.array([len(conf) for conf in configurations], dtype=np.int64)
+    padded = np.zeros((lengths.max(), len(configurations), np.shape(configurations[0])[-1]), np.float32)
+    for i, conf in enumerate(configurations):
+        padded[:lengths[i], i] = conf
+    return padded, lengths
+
 
 # %%
 class SurrogateDataloader():
-    """Implements a data loader for the surrogate instance, predicting accuracies from configurations."""
+    """Implements a data loader for the surrogate instance, predicting accuracies from configurations.
+
+    Configurations are kept zero-padded in arrays that grow geometrically, with their lengths and accuracies, so that all of them can be fed to the surrogate as one batch.
+    """
     
     def __init__(self):
         """Initialize SurrogateDataloader Instance."""
-        self._dict_data = {}
+        self._index = {}
+        self._count = 0
+        self._confs = np.zeros((0, 0, 0), np.float32)
+        self._lengths = np.zeros(0, np.int64)
+        self._accs = np.zeros(0, np.float32)
+
+    def __len__(self):
+        """Get number of distinct configurations stored."""
+        return self._count
+
+    def _reserve(self, seq_len, num_feats):
+        capacity, max_len = self._confs.shape[:2]
+        if self._count < capacity and seq_len <= max_len:
+            return
+        confs = np.zeros((max(2 * capacity, 16) if self._count >= capacity else capacity,
+                          max(seq_len, max_len), num_feats), np.float32)
+        if self._count:
+            confs[:self._count, :max_len] = self._confs[:self._count]
+        self._confs = confs
+        self._lengths = np.resize(self._lengths, len(confs))
+        self._accs = np.resize(self._accs, len(confs))
 
     def add_datum(self, datum_conf, datum_acc):
         """Add data to surrogate data loader
@@ -102,18 +162,28 @@ class SurrogateDataloader():
         # data_conf is of size [seq_len, len_data]
 
         seq_len = len(datum_conf)
-        datum_hash = datum_conf.data.tobytes()
-
-        if seq_len in self._dict_data:
-
-            if datum_hash in self._dict_data[seq_len]:
-                # if the configuration is already stored, keep the max accuracy
-                self._dict_data[seq_len][datum_hash] = (
-                    datum_conf, max(datum_acc, self._dict_data[seq_len][datum_hash][1]))
-            else:
-                self._dict_data[seq_len][datum_hash] = (datum_conf, datum_acc)
-        else:
-            self._dict_data[seq_len] = {datum_hash: (datum_conf, datum_acc)}
+        datum_hash = (seq_len, datum_conf.data.tobytes())
+
+        row = self._index.get(datum_hash)
+        if row is not None:
+            # if the configuration is already stored, keep the max accuracy
+            self._accs[row] = max(datum_acc, self._accs[row])
+            return
+
+        self._reserve(seq_len, np.shape(datum_conf)[-1])
+        row = self._index[datum_hash] = self._count
+        self._confs[row] = 0
+        self._confs[row, :seq_len] = datum_conf
+        self._lengths[row] = seq_len
+        self._accs[row] = datum_acc
+        self._count += 1
+
+    def _bucket_order(self):
+        # rows grouped by length, lengths in order of first appearance, rows in order of insertion
+        lengths = self._lengths[:self._count]
+        unique, first = np.unique(lengths, return_index=True)
+        unique = unique[np.argsort(first)]
+        return unique, [np.flatnonzero(lengths == seq_len) for seq_len in unique]
 
     def get_data(self, to_torch=False):
         """Get data for training
@@ -129,21 +199,9 @@ class SurrogateDataloader():
         dataset_conf = list()
         dataset_acc = list()
 
-        for len_key, data_dict in self._dict_data.items():
-
-            conf_list = list()
-            acc_list = list()
-
-            for datum_hash, datum in data_dict.items():
-                conf_list.append(datum[0])
-                acc_list.append(datum[1])
-
-            conf_list = np.transpose(np.asarray(
-                conf_list, np.float32), (1, 0, 2))
-
-            dataset_conf.append(np.array(conf_list, np.float32))
-            dataset_acc.append(np.expand_dims(
-                np.array(acc_list, np.float32), 1))
+        for seq_len, rows in zip(*self._bucket_order()):
+            dataset_conf.append(np.ascontiguousarray(self._confs[rows, :seq_len].transpose(1, 0, 2)))
+            dataset_acc.append(self._accs[rows, None].copy())
 
         if to_torch:
             for index in range(len(dataset_conf)):
@@ -152,6 +210,22 @@ class SurrogateDataloader():
 
         return dataset_conf, dataset_acc
 
+    def get_batch(self, to_torch=False):
+        """Get all data for training as one padded batch.
+
+        Args:
+            to_torch (bool, optional): Whether to turn output to torch tensors. Defaults to False.
+
+        Returns:
+            tuple(np.array|torch.tensor): Configurations of size [max_seq_len, num_configurations, len_data], zero-padded, their accuracies of size [num_configurations, 1], and their lengths.
+        """
+        max_len = self._lengths[:self._count].max() if self._count else 0
+        data = (np.ascontiguousarray(self._confs[:self._count, :max_len].transpose(1, 0, 2)),
+                self._accs[:self._count, None].copy(), self._lengths[:self._count].copy())
+        if to_torch:
+            data = tuple(torch.from_numpy(array) for array in data)
+        return data
+
     def get_k_best(self, k):
         """Get K best configurations, given all that has been sampled so far.
 
@@ -161,18 +235,13 @@ class SurrogateDataloader():
         Returns:
             tuple(configs, accuracies, index): Tuple of the list of configurations, their accuracies, and their position in the dataloader.
         """
-        dataset_conf = list()
-        dataset_acc = list()
-
-        for len_key, data_dict in self._dict_data.items():
-            for datum_hash, datum in data_dict.items():
-                dataset_conf.append(datum[0])
-                dataset_acc.append(datum[1])
+        lengths, buckets = self._bucket_order()
+        rows = np.concatenate(buckets)
 
-        dataset_acc = np.array(dataset_acc)
+        dataset_acc = self._accs[rows].astype(np.float64)
         top_k_idx = np.argpartition(dataset_acc, -k)[-k:]
 
-        confs = [dataset_conf[i] for i in top_k_idx]
+        confs = [self._confs[rows[i], :self._lengths[rows[i]]] for i in top_k_idx]
         accs = [dataset_acc[i] for i in top_k_idx]
 
         return (confs, accs, top_k_idx)
@@ -186,30 +255,32 @@ def train_simple_surrogate(model, criterion, optimizer, data_tensors, num_epochs
         model (nn.Module): Model to train on.
         criterion (nn.Module): Loss function to train on.
         optimizer (nn.optim.Optimizer): Optimizer to apply.
-        data_tensors (torch.Tensor): Dataset to train on.
+        data_tensors (torch.Tensor): Dataset to train on, either as lists of configurations and accuracies with one batch per configuration length (SurrogateDataloader.get_data), or as one padded batch of configurations, accuracies and lengths (SurrogateDataloader.get_batch).
         num_epochs (int): Number of epochs to train this surrogate on.
         device (torch.device): Device to train on.
 
     Returns:
         float: Loss of this surrogate.
     """
+    if len(data_tensors) == 3:
+        inputs, outputs, lengths = data_tensors
+        # padding only matters if lengths differ
+        batches = [(inputs.to(device), outputs.to(device), lengths if lengths.min() != lengths.max() else None)]
+    else:
+        batches = [(inputs.to(device), outputs.to(device), None) for inputs, outputs in zip(*data_tensors)]
+
     for epoch in range(num_epochs):
 
         model.train(True)  # Set model to training mode
 
         # get the inputs
-        for batch in range(len(data_tensors[0])):
-            inputs, outputs = data_tensors[0][batch], data_tensors[1][batch]
-
-            # move to device
-            inputs = inputs.to(device)
-            outputs = outputs.to(device)
+        for inputs, outputs, lengths in batches:
 
             optimizer.zero_grad()
 
             # forward
             with torch.set_grad_enabled(True):
-                f_outputs = model(inputs)
+                f_outputs = model(inputs) if lengths is None else model(inputs, lengths)
 
                 loss = criterion(f_outputs, outputs)
                 loss.backward()